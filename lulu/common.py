@@ -4,16 +4,22 @@ import io
 import os
 import re
 import sys
+import json
 import time
 import socket
 import locale
 import logging
 import argparse
+import threading
+import itertools
 from urllib import parse
+from contextlib import closing
 from html import unescape
 from http import cookiejar
 from importlib import import_module
+from collections import OrderedDict
 from multiprocessing.dummy import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 import urllib3
 import requests
@@ -23,9 +29,12 @@ from lulu.config import (
     FAKE_HEADERS,
 )
 from lulu.util import log, term
+from lulu import ratelimit
 from lulu.version import __version__
 from lulu import json_output as json_output_
 from lulu.util.strings import get_filename
+from lulu.scheduler import Job, Scheduler, current_job
+from lulu.journal import Journal, exists as journal_exists
 try:
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf8')
 except Exception:
@@ -39,6 +48,28 @@ player = None
 extractor_proxy = None
 cookies = None
 output_filename = None
+# live recordings start a new file past this many bytes or media seconds
+rotate_size = None
+rotate_time = None
+# merge FLV and MPEG-TS parts while they are downloaded
+stream_merge = False
+
+# bytes read from a response body at a time
+CHUNK_SIZE = 64 * 1024
+# ranges smaller than this are not worth a connection of their own
+SEGMENT_MIN_SIZE = 4 * 1024 * 1024
+# how many bytes a range may receive between two saves of its resume state
+SEGMENT_STATE_INTERVAL = 1024 * 1024
+# how many URLs are probed for their size and type at the same time
+PROBE_WORKERS = 8
+# how many probes are kept, and for how many seconds: signed CDN URLs
+# expire, and a long-running lulu (--serve) probes without end
+PROBE_CACHE_SIZE = 1024
+PROBE_CACHE_TTL = 600
+# keep-alive connections kept by the shared session for a host, at the least
+POOL_SIZE = 10
+# how many times a request tries again to connect to its host
+CONNECT_RETRIES = 2
 
 
 if sys.stdout.isatty():
@@ -52,6 +83,37 @@ urllib3.disable_warnings()
 session = requests.Session()
 
 
+def mount_adapters(concurrency=1):
+    """Sizes the connection pools of the shared session for concurrency
+    downloads to one host at once, besides the probes, and sets the retry
+    policy of its requests, for every http:// and https:// URL.
+
+    Every request of lulu goes through the session, so that its connections
+    are reused from extraction to download, with the same proxy and retries.
+    """
+    pool_size = max(POOL_SIZE, concurrency + PROBE_WORKERS)
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=urllib3.util.Retry(
+                total=CONNECT_RETRIES, read=False, backoff_factor=0.5
+            )
+        ))
+
+
+mount_adapters()
+
+# the page and the extractor module of the download running on a thread, for
+# its journal; set by any_download
+_extraction = threading.local()
+
+# (url, request headers) -> (Future of its probed response headers, when
+# it was asked for), oldest first; see probe_url()
+_probes = OrderedDict()
+_probes_lock = threading.Lock()
+_probe_executor = None
+
+
 def rc4(key, data):
     # all encryption algo should work on bytes
     assert type(key) == type(data) and type(key) == type(b'')
@@ -78,17 +140,10 @@ def rc4(key, data):
 
 
 def general_m3u8_extractor(url, headers=FAKE_HEADERS):
-    m3u8_list = get_content(url, headers=headers).split('\n')
-    urls = []
-    for line in m3u8_list:
-        line = line.strip()
-        if line and not line.startswith('#'):
-            if line.startswith('http'):
-                urls.append(line)
-            else:
-                seg_url = parse.urljoin(url, line)
-                urls.append(seg_url)
-    return urls
+    from .hls import load_playlist
+    return [
+        segment.uri for segment in load_playlist(url, headers).segments
+    ]
 
 
 def maybe_print(*s):
@@ -214,9 +269,18 @@ def get_location(url):
     return response.url
 
 
+def throttle(n):
+    """Waits for n bytes just read to fit the bandwidth limit, if any (see
+    lulu.ratelimit).
+    """
+    ratelimit.bandwidth.consume(n)
+
+
 def urlopen_with_retry(*args, method='get', **kwargs):
     retry_time = 3
     for i in range(retry_time):
+        # every attempt is a request for the limit of its host
+        ratelimit.request_rate.wait(args[0] if args else kwargs['url'])
         try:
             return getattr(session, method)(
                 *args, stream=True, verify=False, **kwargs
@@ -282,29 +346,116 @@ def post_content(url, headers=FAKE_HEADERS, post_data={}):
     return data
 
 
+def _probe(url, headers):
+    logging.debug('probe: {}'.format(url))
+    try:
+        with closing(urlopen_with_retry(
+            url, method='head', headers=headers, allow_redirects=True
+        )) as response:
+            if response.status_code < 400 and (
+                'content-length' in response.headers or
+                response.headers.get('transfer-encoding') == 'chunked'
+            ):
+                return response.headers
+    except requests.RequestException:
+        pass
+    # some servers and signed CDN URLs only answer GET properly
+    with closing(urlopen_with_retry(url, headers=headers)) as response:
+        return response.headers
+
+
+def _forget_failed_probe(key, future):
+    if future.exception() is not None:
+        with _probes_lock:
+            if _probes.get(key, (None,))[0] is future:
+                del _probes[key]
+
+
+def probe_url(url, headers=FAKE_HEADERS):
+    """Starts probing the response headers of a URL in the background.
+
+    Probes send HEAD (falling back to GET) and run on a bounded pool of
+    PROBE_WORKERS threads. The last PROBE_CACHE_SIZE of them are cached for
+    PROBE_CACHE_TTL seconds, by URL and request headers, so asking twice for
+    the same URL costs one request.
+
+    Returns:
+        A concurrent.futures.Future of the response headers.
+    """
+    global _probe_executor
+    key = url, tuple(sorted(headers.items()))
+    now = time.monotonic()
+    with _probes_lock:
+        future, asked = _probes.get(key, (None, None))
+        if future is not None and now - asked <= PROBE_CACHE_TTL:
+            return future
+        if _probe_executor is None:
+            _probe_executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+        future = _probe_executor.submit(_probe, url, dict(headers))
+        _probes.pop(key, None)
+        _probes[key] = future, now
+        while len(_probes) > PROBE_CACHE_SIZE:
+            _probes.popitem(last=False)
+    # out of the lock: a probe which already failed calls back at once
+    future.add_done_callback(
+        lambda future: _forget_failed_probe(key, future)
+    )
+    return future
+
+
+def clear_probe_cache():
+    with _probes_lock:
+        _probes.clear()
+
+
+def _size_from_headers(headers):
+    size = headers.get('content-length')
+    if size is None or headers.get('transfer-encoding') == 'chunked':
+        return float('inf')
+    return int(size)
+
+
 def url_size(url, headers=FAKE_HEADERS):
-    response = urlopen_with_retry(url, headers=headers)
-    size = response.headers['content-length']
-    return int(size) if size is not None else float('inf')
+    return _size_from_headers(probe_url(url, headers=headers).result())
 
 
 def urls_size(urls, headers=FAKE_HEADERS):
-    return sum([url_size(url, headers=headers) for url in urls])
+    futures = [probe_url(url, headers=headers) for url in urls]
+    return sum(_size_from_headers(future.result()) for future in futures)
 
 
-def get_head(url, headers=FAKE_HEADERS):
+def get_head(url, headers=FAKE_HEADERS, get_method='HEAD'):
     logging.debug('get_head: {}'.format(url))
-    res = urlopen_with_retry(url, headers=headers)
-    return res.headers
+    if get_method == 'GET':
+        with closing(urlopen_with_retry(url, headers=headers)) as res:
+            return res.headers
+    return probe_url(url, headers=headers).result()
 
 
 def url_info(url, headers=FAKE_HEADERS, refer=None):
     logging.debug('url_info: {}'.format(url))
     if refer:
-        headers.update({'Referer': refer})
-    headers = get_head(url, headers)
+        headers = dict(headers, Referer=refer)
+    return _url_info_from_headers(url, get_head(url, headers))
+
+
+def urls_info(urls, headers=FAKE_HEADERS, refer=None):
+    """Like url_info, for many URLs probed concurrently.
+
+    Returns:
+        A list of (type, ext, size) tuples in the order of urls.
+    """
+    if refer:
+        headers = dict(headers, Referer=refer)
+    futures = [probe_url(url, headers=headers) for url in urls]
+    return [
+        _url_info_from_headers(url, future.result())
+        for url, future in zip(urls, futures)
+    ]
+
 
-    _type = headers['content-type']
+def _url_info_from_headers(url, headers):
+    _type = headers.get('content-type')
     if _type == 'image/jpg; charset=UTF-8' or _type == 'image/jpg':
         _type = 'audio/mpeg'  # fix for netease
     mapping = {
@@ -332,7 +483,7 @@ def url_info(url, headers=FAKE_HEADERS, refer=None):
         _type = ext = url.split('.')[-1]
     else:
         _type = None
-        if headers['content-disposition']:
+        if headers.get('content-disposition'):
             try:
                 filename = parse.unquote(
                     match1(
@@ -349,7 +500,8 @@ def url_info(url, headers=FAKE_HEADERS, refer=None):
             ext = None
 
     if headers.get('transfer-encoding') != 'chunked':
-        size = headers['content-length'] and int(headers['content-length'])
+        size = headers.get('content-length') and \
+            int(headers['content-length'])
     else:
         size = None
 
@@ -361,112 +513,429 @@ def url_locations(urls, headers=FAKE_HEADERS):
     for url in urls:
         logging.debug('url_locations: %s' % url)
 
-        response = urlopen_with_retry(url, headers=headers)
-
-        locations.append(response.url)
+        with closing(urlopen_with_retry(url, headers=headers)) as response:
+            locations.append(response.url)
     return locations
 
 
+def load_segment_state(state_filepath, file_size):
+    """Loads the per-range resume state of a segmented download.
+
+    Returns:
+        A list of [start, end, received] ranges, or None if there is no
+        usable state for a file of file_size bytes.
+    """
+    try:
+        with open(state_filepath, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('size') != file_size:
+        return None
+    return state['ranges']
+
+
+def save_segment_state(state_filepath, file_size, ranges):
+    tmp_filepath = state_filepath + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump({'size': file_size, 'ranges': ranges}, f)
+    os.replace(tmp_filepath, state_filepath)
+
+
+def split_ranges(file_size, segments):
+    segment_size = -(-file_size // segments)
+    return [
+        [start, min(start + segment_size, file_size) - 1, 0]
+        for start in range(0, file_size, segment_size)
+    ]
+
+
+def url_save_segmented(
+    url, temp_filepath, bar, file_size, headers, thread, timeout=None,
+    response=None
+):
+    """Downloads url into temp_filepath over several concurrent HTTP range
+    requests, each one writing at its own offset of a preallocated file.
+
+    The progress of every range is kept in temp_filepath + '.ranges', so an
+    interrupted download resumes each range where it stopped. A response
+    already streaming the file from its first byte can be passed in to be
+    used for the first range.
+    """
+    state_filepath = temp_filepath + '.ranges'
+    ranges = None
+    if not force and os.path.exists(temp_filepath):
+        ranges = load_segment_state(state_filepath, file_size)
+    if ranges is None:
+        segments = min(thread, -(-file_size // SEGMENT_MIN_SIZE))
+        ranges = split_ranges(file_size, segments)
+        save_segment_state(state_filepath, file_size, ranges)
+        with open(temp_filepath, 'wb') as output:
+            output.truncate(file_size)
+    elif bar:
+        bar.update_received(sum(r[2] for r in ranges))
+
+    lock = threading.Lock()
+    ranges_supported = True
+
+    first_response = response
+    if ranges[0][2]:
+        first_response = None
+        if response is not None:
+            response.close()
+
+    def _download_range(index):
+        start, end, received = ranges[index]
+        if start + received > end:
+            return
+        if index == 0 and first_response is not None:
+            response = first_response
+        else:
+            range_headers = headers.copy()
+            range_headers['Range'] = 'bytes={}-{}'.format(
+                start + received, end
+            )
+            kwargs = {'headers': range_headers}
+            if timeout:
+                kwargs['timeout'] = timeout
+            response = urlopen_with_retry(url, **kwargs)
+        try:
+            if response is not first_response \
+                    and response.status_code != 206:
+                nonlocal ranges_supported
+                ranges_supported = False
+                return
+            unsaved = 0
+            with open(temp_filepath, 'r+b') as output:
+                output.seek(start + received)
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    chunk = chunk[:end + 1 - start - received]
+                    output.write(chunk)
+                    received += len(chunk)
+                    throttle(len(chunk))
+                    unsaved += len(chunk)
+                    if bar:
+                        bar.update_received(len(chunk))
+                    if unsaved >= SEGMENT_STATE_INTERVAL:
+                        output.flush()
+                        with lock:
+                            ranges[index][2] = received
+                            save_segment_state(
+                                state_filepath, file_size, ranges
+                            )
+                        unsaved = 0
+                    if start + received > end:
+                        break
+        finally:
+            response.close()
+            with lock:
+                ranges[index][2] = received
+                save_segment_state(state_filepath, file_size, ranges)
+        if start + received <= end:
+            raise IOError('range {}-{} is incomplete'.format(start, end))
+
+    with Pool(processes=len(ranges)) as pool:
+        pool.map(_download_range, range(len(ranges)))
+    os.remove(state_filepath)
+    if not ranges_supported:
+        logging.debug('url_save_segmented: ranges not supported by {}'.format(
+            url
+        ))
+        if bar:
+            bar.received -= sum(r[2] for r in ranges)
+        os.remove(temp_filepath)
+    return ranges_supported
+
+
+def parse_content_range(response, offset=0):
+    """Works out where the body of a response starts and how big the whole
+    file is, from the response headers alone.
+
+    Args:
+        response: A streaming response to a GET request.
+        offset: The first byte asked for with a Range header, if any.
+
+    Returns:
+        A (range_start, file_size) tuple; file_size is float('inf') if the
+        server does not tell.
+    """
+    content_range = response.headers.get('content-range')
+    if response.status_code == 416:
+        # the part we already have is the whole file
+        total = content_range and content_range.split('/')[-1]
+        if total and total.isdigit() and int(total) == offset:
+            return offset, offset
+        return 0, float('inf')
+    if response.status_code == 206 and content_range:
+        byte_range, total = content_range[6:].split('/')
+        range_start = int(byte_range.split('-')[0])
+        if total.isdigit():
+            return range_start, int(total)
+        return range_start, float('inf')
+    content_length = response.headers.get('content-length')
+    if content_length and \
+            response.headers.get('transfer-encoding') != 'chunked':
+        return 0, int(content_length)
+    return 0, float('inf')
+
+
+def connection_stats():
+    """Counts the requests sent and the connections opened through the pools
+    of the shared session so far.
+
+    Returns:
+        A (requests, connections) tuple; every request beyond the connections
+        count went over a reused keep-alive connection.
+    """
+    num_requests = num_connections = 0
+    for adapter in session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+    return num_requests, num_connections
+
+
+def log_connection_stats(name, since):
+    """Logs how many connections were reused since the connection_stats()
+    snapshot since was taken.
+    """
+    num_requests, num_connections = (
+        now - before for now, before in zip(connection_stats(), since)
+    )
+    logging.debug('{}: {} requests over {} connections ({} reused)'.format(
+        name, num_requests, num_connections, num_requests - num_connections
+    ))
+
+
 def url_save(
     url, filepath, bar, refer=None, is_part=False, headers=None, timeout=None,
-    **kwargs
+    thread=0, part=None, **kwargs
 ):
+    """Downloads url into filepath, through filepath + '.download', which a
+    later call resumes.
+
+    Args:
+        part: The journal entry of filepath (see lulu.journal), which
+            decides what of filepath + '.download' can be resumed, and is
+            kept up to date.
+    """
     tmp_headers = headers.copy() if headers else FAKE_HEADERS.copy()
     # When a referer specified with param refer,
     # the key must be 'Referer' for the hack here
     if refer:
         tmp_headers['Referer'] = refer
-    file_size = url_size(url, headers=tmp_headers)
 
+    temp_filepath = filepath + '.download'
+    state_filepath = temp_filepath + '.ranges'
+    received = 0
     if os.path.exists(filepath):
-        if not force and file_size == os.path.getsize(filepath):
-            if not is_part:
-                if bar:
-                    bar.done()
-                print(
-                    'Skipping {}: file already exists'.format(
-                        tr(os.path.basename(filepath))
-                    )
-                )
-            else:
-                if bar:
-                    bar.update_received(file_size)
-            return
-        else:
-            if not is_part:
-                if bar:
-                    bar.done()
-                print('Overwriting %s' % tr(os.path.basename(filepath)), '...')
+        pass
     elif not os.path.exists(os.path.dirname(filepath)):
         os.mkdir(os.path.dirname(filepath))
+    elif not force and os.path.exists(temp_filepath) \
+            and not os.path.exists(state_filepath):
+        received = part.resume(temp_filepath) if part \
+            else os.path.getsize(temp_filepath)
+
+    # the size of the file, the offset to resume from and the body all come
+    # from this one response
+    request_headers = tmp_headers.copy()
+    if received:
+        request_headers['Range'] = 'bytes={}-'.format(received)
+    request_kwargs = {'headers': request_headers}
+    if timeout:
+        request_kwargs['timeout'] = timeout
+    response = urlopen_with_retry(url, **request_kwargs)
+    range_start, file_size = parse_content_range(response, received)
+    if received and (
+        # what we have is past the end of the file: it shrank or changed
+        response.status_code == 416 and file_size != received or
+        # another file than the one resumed, from a fresh URL
+        part and not part.matches(response, file_size)
+    ):
+        logging.debug('url_save: {} changed, starting over'.format(filepath))
+        response.close()
+        os.remove(temp_filepath)
+        received = 0
+        request_kwargs['headers'] = tmp_headers
+        response = urlopen_with_retry(url, **request_kwargs)
+        range_start, file_size = parse_content_range(response, received)
+    if response.status_code == 416 and file_size != received:
+        response.close()
+        response.raise_for_status()
+    with closing(response):
+
+        if os.path.exists(filepath):
+            if not force and file_size == os.path.getsize(filepath):
+                if not is_part:
+                    if bar:
+                        bar.done()
+                    print(
+                        'Skipping {}: file already exists'.format(
+                            tr(os.path.basename(filepath))
+                        )
+                    )
+                else:
+                    if bar:
+                        bar.update_received(file_size)
+                if part:
+                    part.finish(file_size)
+                return
+            else:
+                if not is_part:
+                    if bar:
+                        bar.done()
+                    print(
+                        'Overwriting %s' % tr(os.path.basename(filepath)),
+                        '...'
+                    )
 
-    temp_filepath = filepath + '.download' if file_size != float('inf') \
-        else filepath
-    received = 0
-    if not force:
-        open_mode = 'ab'
-
-        if os.path.exists(temp_filepath):
-            received += os.path.getsize(temp_filepath)
-            if bar:
-                bar.update_received(os.path.getsize(temp_filepath))
-    else:
-        open_mode = 'wb'
-
-    if received < file_size:
-        if received:
-            tmp_headers['Range'] = 'bytes=' + str(received) + '-'
-        if refer:
-            tmp_headers['Referer'] = refer
-        kwargs = {
-            'headers': tmp_headers,
-        }
-        if timeout:
-            kwargs['timeout'] = timeout
-        response = urlopen_with_retry(url, **kwargs)
-        try:
-            range_start = int(
-                response.headers[
-                    'content-range'
-                ][6:].split('/')[0].split('-')[0]
-            )
-            end_length = int(
-                response.headers['content-range'][6:].split('/')[1]
-            )
-            range_length = end_length - range_start
-        except Exception:
-            content_length = response.headers['content-length']
-            range_length = int(content_length) if content_length \
-                else float('inf')
-
-        if file_size != received + range_length:
+        if file_size == float('inf') and response.status_code == 200:
+            # of unknown length, so never taken for a partial download
+            temp_filepath = filepath
             received = 0
-            if bar:
-                bar.received = 0
-            open_mode = 'wb'
-
-        with open(temp_filepath, open_mode) as output:
-            for chunk in response.iter_content(chunk_size=2048):
-                if chunk:
-                    output.write(chunk)
-                    received += len(chunk)
-                    if bar:
-                        bar.update_received(len(chunk))
+        elif range_start != received:
+            # the server ignored the Range header, start over
+            received = 0
+        if received and bar:
+            bar.update_received(received)
+        if part:
+            if not received:
+                part.reset()
+            part.start(response, file_size)
+            part.journal.save()
+
+        if received < file_size and thread > 1 \
+                and file_size != float('inf') \
+                and file_size >= 2 * SEGMENT_MIN_SIZE and not received and (
+                    response.status_code == 206 or
+                    response.headers.get('accept-ranges') == 'bytes'
+                ) and url_save_segmented(
+                    url, temp_filepath, bar, file_size, tmp_headers, thread,
+                    timeout=timeout, response=response
+                ):
+            received = file_size
+            if part:
+                part.written_out_of_order()
+
+        if received < file_size:
+            if response.raw.closed:
+                # consumed by a segmented attempt the server turned down
+                response = urlopen_with_retry(
+                    url, headers=tmp_headers, timeout=timeout
+                )
+            if not received and os.path.exists(state_filepath):
+                os.remove(state_filepath)
+            open_mode = 'ab' if received else 'wb'
+            with closing(response), open(temp_filepath, open_mode) as output:
+                try:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:
+                            output.write(chunk)
+                            received += len(chunk)
+                            throttle(len(chunk))
+                            if part:
+                                part.update(chunk, output)
+                            if bar:
+                                bar.update_received(len(chunk))
+                finally:
+                    if part:
+                        # what made it, for the next run
+                        part.checkpoint(output)
 
     assert received == os.path.getsize(temp_filepath), '{} == {} == {}'.format(
         received, os.path.getsize(temp_filepath), temp_filepath
     )
 
-    if os.access(filepath, os.W_OK):
+    if temp_filepath != filepath:
+        replace_file(temp_filepath, filepath)
+    if part:
+        part.finish(received)
+
+
+class PartReader(io.RawIOBase):
+    """Reads the body of url like a file, reporting what is read to bar.
+
+    A broken connection is picked up where it broke with a range request,
+    since what was read may already be merged and cannot be read again.
+    """
+    def __init__(self, url, headers, bar=None, timeout=None, retries=3):
+        self.url = url
+        self.headers = headers
+        self.bar = bar
+        self.timeout = timeout
+        self.retries = retries
+        self.received = 0
+        self.response = None
+        self.connect()
+
+    def connect(self):
+        headers = self.headers
+        if self.received:
+            headers = dict(headers, Range='bytes={}-'.format(self.received))
+        kwargs = {'headers': headers}
+        if self.timeout:
+            kwargs['timeout'] = self.timeout
+        self.response = urlopen_with_retry(self.url, **kwargs)
+        self.response.raise_for_status()
+        if self.received and self.response.status_code != 206:
+            raise IOError('cannot resume {}'.format(self.url))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        for i in range(self.retries):
+            try:
+                n = self.response.raw.readinto(b)
+                break
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                logging.debug('PartReader: {}'.format(e))
+                self.response.close()
+                if i + 1 == self.retries:
+                    raise
+                self.connect()
+        self.received += n
+        throttle(n)
+        if self.bar and n:
+            self.bar.update_received(n)
+        return n
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+        super().close()
+
+
+def remove_files(*paths):
+    # of those that exist, while other threads may remove them too
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def replace_file(src, dst):
+    if os.access(dst, os.W_OK):
         # on Windows rename could fail if destination filepath exists
-        os.remove(filepath)
-    os.rename(temp_filepath, filepath)
+        os.remove(dst)
+    os.rename(src, dst)
 
 
 class SimpleProgressBar:
     term_size = term.get_terminal_size()[1]
 
     def __init__(self, total_size, total_pieces=1):
+        # within a scheduler, its job shows the progress of all of them
+        self.job = current_job()
+        if self.job:
+            self.job.expect(total_size)
         self.displayed = False
         self.total_size = total_size
         self.total_pieces = total_pieces
@@ -487,6 +956,8 @@ class SimpleProgressBar:
         )
 
     def update(self):
+        if self.job:
+            return
         self.displayed = True
         bar_size = self.bar_size
         percent = round(self.received * 100 / self.total_size, 1)
@@ -509,6 +980,8 @@ class SimpleProgressBar:
         sys.stdout.flush()
 
     def update_received(self, n):
+        if self.job:
+            self.job.update_received(n)
         self.received += n
         time_diff = time.time() - self.last_updated
         bytes_ps = n / time_diff if time_diff else 0
@@ -534,6 +1007,9 @@ class SimpleProgressBar:
 
 class PiecesProgressBar:
     def __init__(self, total_size, total_pieces=1):
+        self.job = current_job()
+        if self.job:
+            self.job.expect(total_size)
         self.displayed = False
         self.total_size = total_size
         self.total_pieces = total_pieces
@@ -541,6 +1017,8 @@ class PiecesProgressBar:
         self.received = 0
 
     def update(self):
+        if self.job:
+            return
         self.displayed = True
         bar = '{0:>5}%[{1:<40}] {2}/{3}'.format(
             '', '=' * 40, self.current_piece, self.total_pieces
@@ -549,6 +1027,40 @@ class PiecesProgressBar:
         sys.stdout.flush()
 
     def update_received(self, n):
+        if self.job:
+            self.job.update_received(n)
+        self.received += n
+        self.update()
+
+    def update_piece(self, n):
+        self.current_piece = n
+
+    def done(self):
+        if self.displayed:
+            print()
+            self.displayed = False
+
+
+class LiveProgressBar:
+    def __init__(self, *args):
+        self.job = current_job()
+        self.displayed = False
+        self.current_piece = 0
+        self.received = 0
+
+    def update(self):
+        if self.job:
+            return
+        self.displayed = True
+        bar = '{:>8}MB recorded [{} segments]'.format(
+            round(self.received / 1048576, 1), self.current_piece
+        )
+        sys.stdout.write('\r' + bar)
+        sys.stdout.flush()
+
+    def update_received(self, n):
+        if self.job:
+            self.job.update_received(n)
         self.received += n
         self.update()
 
@@ -561,6 +1073,94 @@ class PiecesProgressBar:
             self.displayed = False
 
 
+class FFmpegProgressBar:
+    """Shows the progress of an FFmpeg merge after label: the percent done,
+    the speed and the bitrate FFmpeg reports (see lulu.processor.ffmpeg).
+    """
+    def __init__(self, label='Merging video parts... '):
+        self.label = label
+        self.job = current_job()
+        self.displayed = False
+
+    def update_ffmpeg(self, progress):
+        if self.job:
+            return
+        self.displayed = True
+        fields = [
+            '' if value is None else template.format(value)
+            for template, value in (
+                ('{:.1f}%', progress.percent),
+                ('{:.1f}x', progress.speed),
+                ('{:.0f} kbit/s', progress.bitrate),
+            )
+        ]
+        sys.stdout.write('\r{}{:>6} {:>7} {:>13}'.format(self.label, *fields))
+        sys.stdout.flush()
+
+    def done(self):
+        if self.displayed:
+            print()
+            self.displayed = False
+
+
+class JobsProgressBar:
+    """Shows the progress of all the jobs of a scheduler at once, every
+    interval seconds from start() to done().
+    """
+    def __init__(self, scheduler, interval=1):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.displayed = False
+        self.received = 0
+        self.last_updated = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def update(self):
+        progress = self.scheduler.progress()
+        now = time.time()
+        speed = (progress['received'] - self.received) / \
+            max(now - self.last_updated, 1e-3)
+        self.received = progress['received']
+        self.last_updated = now
+        self.displayed = True
+        sys.stdout.write(
+            '\r[{}/{} done, {} failed, {} running] {:.1f}/{:.1f}MB '
+            '{:6.0f} kB/s'.format(
+                progress['done'], progress['jobs'], progress['failed'],
+                progress['extracting'] + progress['downloading'],
+                progress['received'] / 1048576,
+                progress['total_size'] / 1048576, speed / 1024
+            )
+        )
+        sys.stdout.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.update()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def done(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.update()
+        print()
+
+
+def start_transfer():
+    """Tells the scheduler job of the current thread, if any, that it starts
+    to download: it waits for its turn.
+    """
+    job = current_job()
+    if job:
+        job.start_transfer()
+
+
 class DummyProgressBar:
     def __init__(self, *args):
         pass
@@ -587,20 +1187,79 @@ def get_output_filename(urls, title, ext, output_dir, merge):
     if (len(urls) > 1) and merge:
         from .processor.ffmpeg import has_ffmpeg_installed
         if ext in ['flv', 'f4v']:
-            if has_ffmpeg_installed():
-                merged_ext = 'mp4'
-            else:
-                merged_ext = 'flv'
+            # remuxed by FFmpeg, or by remux_flv without it
+            merged_ext = 'mp4'
         elif ext == 'mp4':
             merged_ext = 'mp4'
         elif ext == 'ts':
+            # remuxed to MKV by FFmpeg, or to MP4 by remux_ts without it
             if has_ffmpeg_installed():
                 merged_ext = 'mkv'
             else:
-                merged_ext = 'ts'
+                merged_ext = 'mp4'
     return '{}.{}'.format(title, merged_ext)
 
 
+def thread_cpu_time():
+    """The CPU time of the current thread so far, None where it cannot be
+    told.
+    """
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    try:
+        import resource
+        return sum(resource.getrusage(resource.RUSAGE_THREAD)[:2])
+    except (ImportError, AttributeError, OSError):
+        return None
+
+
+def merge_av(parts, output_filepath, ext):
+    """Merges the video and audio files parts into output_filepath.
+
+    The streams are copied as they are by lulu.processor.mux_av when the
+    files are of the container of ext, else by FFmpeg if it is installed,
+    which re-encodes the audio only if ext cannot hold it. The CPU time of
+    the merge, of the thread muxing or of FFmpeg, is reported with the
+    result; other jobs of the process do not count.
+
+    Returns:
+        Whether the files were merged.
+    """
+    from .processor.mux_av import can_mux, mux_av
+    merged = False
+    cpu_time = None
+    if can_mux(parts, ext):
+        start = thread_cpu_time()
+        try:
+            mux_av(parts, output_filepath)
+            merged = True
+            if start is not None:
+                cpu_time = thread_cpu_time() - start
+        except ValueError as e:
+            log.w('{}, merging with FFmpeg'.format(e))
+            if os.path.exists(output_filepath):
+                os.remove(output_filepath)
+    if not merged:
+        from .processor.ffmpeg import has_ffmpeg_installed
+        if not has_ffmpeg_installed():
+            return False
+        from .processor.ffmpeg import ffmpeg_concat_av
+        bar = FFmpegProgressBar()
+        job = ffmpeg_concat_av(
+            parts, output_filepath, ext, progress=bar.update_ffmpeg
+        )
+        bar.done()
+        merged = job.returncode == 0
+        cpu_time = job.cpu_time
+    if merged:
+        print('Merged into {}{}'.format(
+            os.path.basename(output_filepath),
+            '' if cpu_time is None else
+            ' ({:.2f}s of CPU time)'.format(cpu_time)
+        ))
+    return merged
+
+
 def download_urls(
     urls, title, ext, total_size, output_dir='.', refer=None, merge=True,
     headers={}, thread=0, **kwargs
@@ -620,6 +1279,8 @@ def download_urls(
         launch_player(player, urls, refer=refer)
         return
 
+    start_transfer()
+    stats = connection_stats()
     if not total_size:
         try:
             total_size = urls_size(urls, headers=headers)
@@ -633,7 +1294,10 @@ def download_urls(
     output_filepath = os.path.join(output_dir, output_file)
 
     if total_size:
+        # with a journal, the output may be the remains of a merge which
+        # did not end
         if not force and os.path.exists(output_filepath) \
+                and not journal_exists(output_filepath) \
                 and os.path.getsize(output_filepath) >= total_size * 0.9:
             print('Skipping {}: file already exists'.format(output_filepath))
             print()
@@ -642,15 +1306,49 @@ def download_urls(
     else:
         bar = PiecesProgressBar(total_size, len(urls))
 
+    journal = Journal.open(
+        output_filepath, {
+            'extractor': getattr(_extraction, 'extractor', None),
+            'stream_id': kwargs.get('stream_id'),
+            'ext': ext,
+        }, len(urls), info={
+            'url': getattr(_extraction, 'url', None), 'title': title,
+        }, fresh=force
+    )
+
+    streamed = False
     if len(urls) == 1:
         url = urls[0]
         print('Downloading {} ...'.format(tr(output_file)))
         bar.update()
         url_save(
-            url, output_filepath, bar, refer=refer, headers=headers, **kwargs
+            url, output_filepath, bar, refer=refer, headers=headers,
+            thread=thread, part=journal.part(0), **kwargs
         )
         bar.done()
-    else:
+        journal.remove()
+        log_connection_stats('download_urls', stats)
+    elif stream_merge and merge and ext in ['ts', 'flv', 'f4v'] \
+            and not kwargs.get('av'):
+        print('Downloading {} ...'.format(tr(output_file)))
+        parts = [
+            os.path.join(output_dir, '{}[{:0>2d}].{}'.format(title, i, ext))
+            for i in range(len(urls))
+        ]
+        bar.update()
+        streamed = download_urls_streamed(
+            urls, parts, output_filepath, ext, bar, refer=refer,
+            headers=headers, thread=thread, total_size=total_size, **kwargs
+        )
+        if streamed:
+            bar.done()
+            log_connection_stats('download_urls', stats)
+            print('Merged into {}'.format(output_file))
+        else:
+            # what was streamed is downloaded again
+            bar.update_received(-bar.received)
+    if len(urls) > 1 and not streamed:
+        # not merged on the fly: the parts are merged once downloaded
         print('Downloading {}.{} ...'.format(tr(title), ext))
         parts = [''] * len(urls)
         bar.update()
@@ -665,10 +1363,19 @@ def download_urls(
             parts[index] = filepath  # 防止多线程环境下文件顺序会乱
             piece += 1
             bar.update_piece(piece)
+            part = journal.part(index)
+            if not force and part.is_done(filepath):
+                # no need to ask the server
+                bar.update_received(part.size)
+                return
             url_save(
                 url, filepath, bar, refer=refer, is_part=True, headers=headers,
-                **kwargs
+                part=part, **kwargs
             )
+        if kwargs.get('av'):
+            # the video and audio tracks are fetched at the same time, so
+            # that the download takes as long as the slower one
+            thread = thread or len(urls)
         if thread:
             with Pool(processes=thread) as pool:
                 pool.map(_download, urls)
@@ -676,30 +1383,45 @@ def download_urls(
             for url in urls:
                 _download(url)
         bar.done()
+        log_connection_stats('download_urls', stats)
 
         if not merge:
+            journal.remove()
             print()
             return
 
+        journal.set_state('merging')
+        merged = True
         if 'av' in kwargs and kwargs['av']:
-            from .processor.ffmpeg import has_ffmpeg_installed
-            if has_ffmpeg_installed():
-                from .processor.ffmpeg import ffmpeg_concat_av
-                ret = ffmpeg_concat_av(parts, output_filepath, ext)
-                print('Merged into {}'.format(output_file))
-                if ret == 0:
-                    for part in parts:
-                        os.remove(part)
+            merged = merge_av(parts, output_filepath, ext)
+            if merged:
+                for part in parts:
+                    os.remove(part)
 
         elif ext in ['flv', 'f4v']:
             try:
                 from .processor.ffmpeg import has_ffmpeg_installed
                 if has_ffmpeg_installed():
                     from .processor.ffmpeg import ffmpeg_concat_flv_to_mp4
-                    ffmpeg_concat_flv_to_mp4(parts, output_filepath)
+                    bar = FFmpegProgressBar()
+                    ffmpeg_concat_flv_to_mp4(
+                        parts, output_filepath, progress=bar.update_ffmpeg
+                    )
+                    bar.done()
                 else:
-                    from .processor.join_flv import concat_flv
-                    concat_flv(parts, output_filepath)
+                    from .processor.remux_flv import remux_flv
+                    try:
+                        remux_flv(parts, output_filepath)
+                    except ValueError as e:
+                        # codecs other than H.264 and AAC stay in FLV
+                        log.w('{}, merging into FLV'.format(e))
+                        output_file = os.path.splitext(output_file)[0] + \
+                            '.flv'
+                        output_filepath = os.path.join(
+                            output_dir, output_file
+                        )
+                        from .processor.join_flv import concat_flv
+                        concat_flv(parts, output_filepath)
                 print('Merged into {}'.format(output_file))
             except Exception:
                 raise
@@ -712,19 +1434,47 @@ def download_urls(
                 from .processor.ffmpeg import has_ffmpeg_installed
                 if has_ffmpeg_installed():
                     from .processor.ffmpeg import ffmpeg_concat_mp4_to_mp4
-                    ffmpeg_concat_mp4_to_mp4(parts, output_filepath)
+                    bar = FFmpegProgressBar()
+                    ffmpeg_concat_mp4_to_mp4(
+                        parts, output_filepath, progress=bar.update_ffmpeg
+                    )
+                    bar.done()
                 else:
-                    print('Merged into {}'.format(output_file))
-                    try:
-                        from .processor.join_mp4 import concat_mp4
-                        concat_mp4(parts, output_filepath)
-                    except Exception:
+                    # some sites serve FLV or MPEG-TS parts as .mp4
+                    with open(parts[0], 'rb') as f:
+                        magic = f.read(3)
+                    if magic == b'FLV':
+                        from .processor.remux_flv import remux_flv
                         try:
+                            remux_flv(parts, output_filepath)
+                        except ValueError as e:
+                            # codecs other than H.264 and AAC stay in FLV
+                            log.w('{}, merging into FLV'.format(e))
+                            output_file = \
+                                os.path.splitext(output_file)[0] + '.flv'
+                            output_filepath = os.path.join(
+                                output_dir, output_file
+                            )
                             from .processor.join_flv import concat_flv
                             concat_flv(parts, output_filepath)
-                        except Exception:
+                    elif magic[:1] == b'\x47':
+                        from .processor.remux_ts import remux_ts
+                        try:
+                            remux_ts(parts, output_filepath)
+                        except ValueError as e:
+                            # codecs other than H.264 and AAC stay in MPEG-TS
+                            log.w('{}, merging into MPEG-TS'.format(e))
+                            output_file = \
+                                os.path.splitext(output_file)[0] + '.ts'
+                            output_filepath = os.path.join(
+                                output_dir, output_file
+                            )
                             from .processor.join_ts import concat_ts
                             concat_ts(parts, output_filepath)
+                    else:
+                        from .processor.join_mp4 import concat_mp4
+                        concat_mp4(parts, output_filepath)
+                    print('Merged into {}'.format(output_file))
             except Exception:
                 raise
             else:
@@ -736,10 +1486,25 @@ def download_urls(
                 from .processor.ffmpeg import has_ffmpeg_installed
                 if has_ffmpeg_installed():
                     from .processor.ffmpeg import ffmpeg_concat_ts_to_mkv
-                    ffmpeg_concat_ts_to_mkv(parts, output_filepath)
+                    bar = FFmpegProgressBar()
+                    ffmpeg_concat_ts_to_mkv(
+                        parts, output_filepath, progress=bar.update_ffmpeg
+                    )
+                    bar.done()
                 else:
-                    from .processor.join_ts import concat_ts
-                    concat_ts(parts, output_filepath)
+                    from .processor.remux_ts import remux_ts
+                    try:
+                        remux_ts(parts, output_filepath)
+                    except ValueError as e:
+                        # codecs other than H.264 and AAC stay in MPEG-TS
+                        log.w('{}, merging into MPEG-TS'.format(e))
+                        output_file = os.path.splitext(output_file)[0] + \
+                            '.ts'
+                        output_filepath = os.path.join(
+                            output_dir, output_file
+                        )
+                        from .processor.join_ts import concat_ts
+                        concat_ts(parts, output_filepath)
                 print('Merged into {}'.format(output_file))
             except Exception:
                 raise
@@ -749,10 +1514,153 @@ def download_urls(
 
         else:
             print("Can't merge {} files".format(ext))
+            merged = False
+        if merged:
+            journal.remove()
 
     print()
 
 
+def download_urls_streamed(
+    urls, parts, output_filepath, ext, bar, refer=None, headers=None,
+    thread=0, timeout=None, total_size=None, **kwargs
+):
+    """Downloads the FLV or MPEG-TS parts of a video and merges them on the
+    fly, into output_filepath.
+
+    The parts are fed in order to the joiner, through the stdin of an FFmpeg
+    remuxing them when FFmpeg is installed; without it, they are remuxed to
+    MP4 by FLVRemuxer or TSRemuxer. The part being fed is read right
+    off the network; the thread - 1 parts after it are fetched at the same
+    time into their part files (parts), which are fed and removed in their
+    turn. So every byte is written to disk once at most; the remuxers
+    leave room for the moov before the samples by total_size, so it is not
+    moved after them unless it does not fit.
+
+    Returns:
+        False if the parts are of codecs the remuxers cannot put into MP4
+        (see remux_flv and remux_ts): nothing is merged then, and the parts
+        the prefetches downloaded are left for the caller to merge once the
+        others are downloaded too. True once merged.
+    """
+    from .processor.ffmpeg import has_ffmpeg_installed
+    if ext == 'ts':
+        input_format, output_format = 'mpegts', 'matroska'
+    else:
+        input_format, output_format = 'flv', 'mp4'
+    tmp_headers = headers.copy() if headers else FAKE_HEADERS.copy()
+    if refer:
+        tmp_headers['Referer'] = refer
+
+    temp_filepath = output_filepath + '.download'
+    process = None
+    if has_ffmpeg_installed():
+        from .processor.ffmpeg import ffmpeg_open_concat_pipe
+        if ext == 'ts':
+            from .processor.join_ts import TSJoiner as Joiner
+        else:
+            from .processor.join_flv import FLVJoiner as Joiner
+        process = ffmpeg_open_concat_pipe(
+            input_format, output_format, temp_filepath
+        )
+        out = process.stdin
+    else:
+        out = open(temp_filepath, 'wb')
+        from .processor.mp4_writer import moov_reserve
+        reserve = moov_reserve(total_size)
+        if ext == 'ts':
+            from .processor.remux_ts import TSRemuxer as Joiner
+        else:
+            from .processor.remux_flv import FLVRemuxer as Joiner
+
+    # who fetches each part: 'stream' (the joiner) or 'disk' (a prefetch)
+    claims = [None] * len(urls)
+    lock = threading.Lock()
+    # set once the merge failed: the prefetches give up and clean up
+    stop = threading.Event()
+
+    def prefetch(i):
+        with lock:
+            if claims[i] is not None or stop.is_set():
+                return
+            claims[i] = 'disk'
+        try:
+            url_save(
+                urls[i], parts[i], bar, refer=refer, is_part=True,
+                headers=headers, timeout=timeout
+            )
+        finally:
+            if stop.is_set():
+                remove_files(parts[i], parts[i] + '.download')
+
+    window = max(thread, 1) - 1
+    executor = ThreadPoolExecutor(max_workers=window) if window else None
+    futures = {}
+    remuxed = True
+    try:
+        # FFmpeg is waited for on the way out, and killed on an error
+        with process or out:
+            joiner = Joiner(out) if process else Joiner(out, reserve)
+            for i, url in enumerate(urls):
+                bar.update_piece(i + 1)
+                for j in range(i + 1, min(i + 1 + window, len(urls))):
+                    if j not in futures:
+                        futures[j] = executor.submit(prefetch, j)
+                with lock:
+                    streamed = claims[i] is None
+                    if streamed:
+                        claims[i] = 'stream'
+                if streamed:
+                    with io.BufferedReader(
+                        PartReader(url, tmp_headers, bar, timeout),
+                        CHUNK_SIZE
+                    ) as stream:
+                        joiner.add(stream)
+                else:
+                    futures[i].result()
+                    with open(parts[i], 'rb') as stream:
+                        joiner.add(stream)
+                    os.remove(parts[i])
+            moov_first = joiner.close()
+    except ValueError as e:
+        if process:
+            stop.set()
+            raise
+        # codecs other than H.264 and AAC
+        log.w('{}, merging once downloaded'.format(e))
+        remuxed = False
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        if executor:
+            for future in futures.values():
+                future.cancel()
+            # the parts being prefetched are kept for a merge after all, or
+            # dropped without waiting for them
+            executor.shutdown(wait=not stop.is_set())
+        if stop.is_set() or not remuxed:
+            remove_files(temp_filepath)
+        if stop.is_set():
+            with lock:
+                remove_files(*[
+                    parts[i] for i, claim in enumerate(claims)
+                    if claim == 'disk'
+                ])
+    if not remuxed:
+        return False
+    if process and process.returncode != 0:
+        raise IOError('FFmpeg failed to merge into {}'.format(
+            output_filepath
+        ))
+    if process is None and not moov_first:
+        # it did not fit before the samples
+        from .processor.join_mp4 import faststart_mp4
+        faststart_mp4(temp_filepath)
+    replace_file(temp_filepath, output_filepath)
+    return True
+
+
 def download_rtmp_url(
     url, title, ext, params={}, total_size=0, output_dir='.', refer=None,
     merge=True
@@ -773,13 +1681,22 @@ def download_rtmp_url(
         has_rtmpdump_installed, download_rtmpdump_stream
     )
     assert has_rtmpdump_installed(), 'RTMPDump not installed.'
+    start_transfer()
     download_rtmpdump_stream(url, title, ext, params, output_dir)
 
 
 def download_url_ffmpeg(
     url, title, ext, params={}, total_size=0, output_dir='.', refer=None,
-    merge=True, stream=True, **kwargs
+    merge=True, stream=None, **kwargs
 ):
+    """Downloads a stream with FFmpeg.
+
+    Args:
+        stream: Whether to read the input at its native frame rate (-re),
+        which only makes sense for live streams. None decides from the HLS
+        playlist behind url; anything that is not an HLS playlist is taken as
+        live.
+    """
     assert url
     if dry_run:
         print('Real URL:\n%s\n' % [url])
@@ -793,6 +1710,7 @@ def download_url_ffmpeg(
 
     from .processor.ffmpeg import has_ffmpeg_installed, ffmpeg_download_stream
     assert has_ffmpeg_installed(), 'FFmpeg not installed.'
+    start_transfer()
 
     global output_filename
     if output_filename:
@@ -805,11 +1723,163 @@ def download_url_ffmpeg(
 
     title = tr(get_filename(title))
 
+    if stream is None:
+        from .hls import classify_playlist
+        headers = FAKE_HEADERS.copy()
+        if refer:
+            headers['Referer'] = refer
+        kind = classify_playlist(url, headers)
+        stream = kind != 'vod'
+        logging.debug('download_url_ffmpeg: {} stream, {}'.format(
+            kind or 'unknown',
+            'paced at native frame rate' if stream else 'read at full speed'
+        ))
+
     ffmpeg_download_stream(
         url, title, ext, params, output_dir, stream=stream, **kwargs
     )
 
 
+def download_url_hls(
+    url, title, output_dir='.', refer=None, headers=None, thread=0, **kwargs
+):
+    """Downloads an HLS stream natively, see lulu.hls.
+
+    VOD streams are saved as MP4: fragmented MP4 segments as they are,
+    MPEG-TS segments remuxed on the way, unless their codecs are not H.264
+    and AAC. Live streams are recorded, in the container the segments are
+    in, until they end or the user interrupts, into files rotated by
+    rotate_size and rotate_time.
+    """
+    assert url
+    if json_output:
+        json_output_.download_urls(
+            urls=[url], title=title, ext='m3u8', total_size=None, refer=refer
+        )
+        return
+    if dry_run:
+        print('Real URL:\n%s\n' % [url])
+        return
+
+    if player:
+        launch_player(player, [url], refer=refer)
+        return
+
+    start_transfer()
+    from .hls import load_playlist, download_hls, record_hls
+    headers = headers.copy() if headers else FAKE_HEADERS.copy()
+    if refer:
+        headers['Referer'] = refer
+    playlist = load_playlist(url, headers)
+    fragmented = bool(playlist.segments and playlist.segments[0].init)
+    ext = 'mp4' if fragmented or not playlist.is_live else 'ts'
+    if output_filename:
+        title = os.path.splitext(output_filename)[0]
+    title = tr(get_filename(title))
+    output_file = '{}.{}'.format(title, ext)
+    output_filepath = os.path.join(output_dir, output_file)
+    if playlist.is_live:
+        # an existing recording is never overwritten, the recorder numbers
+        # its files instead
+        print('Recording {} ...'.format(tr(output_file)))
+        bar = LiveProgressBar()
+        bar.update()
+        filepaths = record_hls(
+            url, output_filepath, headers, bar=bar, thread=thread,
+            playlist=playlist, rotate_size=rotate_size,
+            rotate_time=rotate_time
+        )
+        bar.done()
+        for filepath in filepaths:
+            print('Saved {}'.format(filepath))
+        print()
+        return
+
+    if not force and os.path.exists(output_filepath):
+        print('Skipping {}: file already exists'.format(output_filepath))
+        print()
+        return
+
+    print('Downloading {} ...'.format(tr(output_file)))
+    bar = PiecesProgressBar(0, len(playlist.segments))
+    bar.update()
+    download_hls(
+        url, output_filepath, headers, bar=bar, thread=thread,
+        playlist=playlist, remux=not fragmented
+    )
+    bar.done()
+    print()
+
+
+def download_url_dash(
+    url, title, output_dir='.', refer=None, headers=None, thread=0,
+    merge=True, **kwargs
+):
+    """Downloads a DASH stream natively, see lulu.dash.
+
+    The best video and audio tracks are fetched at the same time, and merged
+    by merge_av. Live streams are left to FFmpeg.
+    """
+    assert url
+    if json_output:
+        json_output_.download_urls(
+            urls=[url], title=title, ext='mpd', total_size=None, refer=refer
+        )
+        return
+    if dry_run:
+        print('Real URL:\n%s\n' % [url])
+        return
+
+    if player:
+        launch_player(player, [url], refer=refer)
+        return
+
+    start_transfer()
+    from .dash import load_manifest, download_dash, select_tracks
+    headers = headers.copy() if headers else FAKE_HEADERS.copy()
+    if refer:
+        headers['Referer'] = refer
+    manifest = load_manifest(url, headers)
+    if manifest.is_live:
+        logging.debug('download_url_dash: live stream, handed to FFmpeg')
+        download_url_ffmpeg(
+            url, title, 'mp4', output_dir=output_dir, refer=refer,
+            stream=True, **kwargs
+        )
+        return
+
+    representations = select_tracks(manifest)
+    ext = representations[0].container
+    if output_filename:
+        title = os.path.splitext(output_filename)[0]
+    title = tr(get_filename(title))
+    output_file = '{}.{}'.format(title, ext)
+    output_filepath = os.path.join(output_dir, output_file)
+    if not force and os.path.exists(output_filepath):
+        print('Skipping {}: file already exists'.format(output_filepath))
+        print()
+        return
+
+    print('Downloading {} ...'.format(tr(output_file)))
+    bar = PiecesProgressBar(
+        0, sum(len(r.segments) for r in representations)
+    )
+    bar.update()
+    parts = download_dash(
+        url, output_filepath, headers, bar=bar, thread=thread,
+        manifest=manifest
+    )
+    bar.done()
+
+    if len(parts) == 1:
+        replace_file(parts[0], output_filepath)
+    elif merge:
+        if merge_av(parts, output_filepath, ext):
+            for part in parts:
+                os.remove(part)
+    print()
+
+
 def playlist_not_supported(name):
     def f(*args, **kwargs):
         raise NotImplementedError('Playlist is not supported for ' + name)
@@ -891,13 +1961,15 @@ def print_info(site_info, title, type, size, **kwargs):
                 type_info = 'M3U8 Master {}'.format(type)
         else:
             type_info = 'M3U8 Playlist {}'.format(type)
+    elif type in ['mpd']:
+        type_info = 'MPEG-DASH manifest ({})'.format(type)
     else:
         type_info = 'Unknown type (%s)' % type
 
     maybe_print('Site:      ', site_info)
     maybe_print('Title:     ', unescape(tr(title)))
     print('Type:      ', type_info)
-    if type != 'm3u8':
+    if type not in ['m3u8', 'mpd']:
         print(
             'Size:      ', round(size / 1048576, 2),
             'MiB (' + str(size) + ' Bytes)'
@@ -944,15 +2016,74 @@ def unset_proxy():
     session.proxies = {}
 
 
-def download_main(download, download_playlist, urls, playlist, **kwargs):
-    for url in urls:
-        if re.match(r'https?://', url) is None:
-            url = 'http://' + url
+def make_job(url, playlist=False, **kwargs):
+    """A scheduler Job for url, downloaded with kwargs.
+    """
+    if re.match(r'https?://', url) is None:
+        url = 'http://' + url
+    return Job(url, url_site(url), playlist, kwargs)
+
 
-        if playlist:
-            download_playlist(url, **kwargs)
+def job_runner(download, download_playlist):
+    """What runs a Job: download, or download_playlist for playlists.
+    """
+    def run(job):
+        if job.playlist:
+            download_playlist(job.url, **job.options)
         else:
-            download(url, **kwargs)
+            download(job.url, **job.options)
+    return run
+
+
+def download_main(
+    download, download_playlist, urls, playlist, jobs=1, site_jobs=None,
+    **kwargs
+):
+    """Downloads urls (an iterable, read as they are needed) one after
+    another, or jobs at once through a Scheduler (see lulu.scheduler).
+    """
+    jobs_of_urls = (make_job(url, playlist, **kwargs) for url in urls)
+    run = job_runner(download, download_playlist)
+    if jobs <= 1:
+        for job in jobs_of_urls:
+            run(job)
+        return
+
+    scheduler = Scheduler(run, jobs=jobs, site_jobs=site_jobs)
+    bar = JobsProgressBar(scheduler).start()
+    try:
+        scheduler.run(jobs_of_urls)
+    finally:
+        bar.done()
+    failed = scheduler.progress()['failed']
+    if failed:
+        log.wtf('{} of {} downloads failed'.format(
+            failed, len(scheduler.all)
+        ))
+
+
+def read_urls(file):
+    """The URLs of an input file, one a line, read as they are needed.
+    """
+    with file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def parse_site_jobs(value):
+    """Parses [SITE=]N of --site-jobs into (the extractor module of SITE, or
+    None for every site, N).
+    """
+    site, _, n = value.rpartition('=')
+    try:
+        n = int(n)
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a number of jobs: ' + value)
+    if n < 1:
+        raise argparse.ArgumentTypeError('not a number of jobs: ' + value)
+    return SITES.get(site, site) or None, n
 
 
 def load_cookies(cookiefile):
@@ -1093,6 +2224,13 @@ def script_main(download, download_playlist, **kwargs):
         '-I', '--input-file', metavar='FILE', type=argparse.FileType('r'),
         help='Read non-playlist URLs from FILE'
     )
+    download_grp.add_argument(
+        '--serve', metavar='[HOST:]PORT', nargs='?', const='8765',
+        help=(
+            'Keep running, and download the URLs sent to the HTTP API at '
+            'HOST:PORT (default: localhost:8765), see lulu.server'
+        )
+    )
     download_grp.add_argument(
         '-P', '--password', help='Set video visit password to PASSWORD'
     )
@@ -1103,10 +2241,57 @@ def script_main(download, download_playlist, **kwargs):
     download_grp.add_argument(
         '-T', '--thread', type=int, default=0,
         help=(
-            'Use multithreading to download (only works for multiple-parts '
-            'video)'
+            'Use multithreading to download (parts of multiple-parts video '
+            'or byte ranges of single-part video)'
+        )
+    )
+
+    download_grp.add_argument(
+        '-j', '--jobs', metavar='N', type=int, default=1,
+        help='Download N URLs at once'
+    )
+    download_grp.add_argument(
+        '--site-jobs', metavar='[SITE=]N', type=parse_site_jobs,
+        action='append', default=[],
+        help=(
+            'Download N URLs of SITE (or of every site) at once, with '
+            '--jobs (default: 1)'
+        )
+    )
+    download_grp.add_argument(
+        '--limit-rate', metavar='RATE', type=ratelimit.parse_size,
+        help=(
+            'Download at RATE bytes per second at most, in all (500K, 2M, '
+            '...)'
+        )
+    )
+    download_grp.add_argument(
+        '--request-rate', metavar='[DOMAIN=]N', type=ratelimit.parse_host_rate,
+        action='append', default=[],
+        help=(
+            'Send N requests per second at most to the hosts of DOMAIN, or '
+            'to each host'
+        )
+    )
+    download_grp.add_argument(
+        '--ffmpeg-processes', metavar='N', type=int,
+        help='Run N FFmpeg processes at most at once (default: one per CPU)'
+    )
+    download_grp.add_argument(
+        '--stream-merge', action='store_true',
+        help=(
+            'Merge FLV and MPEG-TS parts while they are downloaded, instead '
+            'of saving them all first'
         )
     )
+    download_grp.add_argument(
+        '--rotate-size', metavar='MB', type=int,
+        help='Start a new file every MB megabytes when recording a live stream'
+    )
+    download_grp.add_argument(
+        '--rotate-time', metavar='SECONDS', type=int,
+        help='Start a new file every SECONDS when recording a live stream'
+    )
 
     proxy_grp = parser.add_argument_group('Proxy options')
     proxy_grp = proxy_grp.add_mutually_exclusive_group()
@@ -1151,8 +2336,22 @@ def script_main(download, download_playlist, **kwargs):
     global player
     global extractor_proxy
     global output_filename
-
+    global rotate_size
+    global rotate_time
+    global stream_merge
+
+    stream_merge = args.stream_merge
+    # a connection for every thread of every job downloading at once
+    mount_adapters(max(args.thread, 1) * args.jobs)
+    ratelimit.bandwidth.set_rate(args.limit_rate)
+    ratelimit.request_rate.set_rates(dict(args.request_rate))
+    if args.ffmpeg_processes:
+        from .processor.ffmpeg import set_max_processes
+        set_max_processes(args.ffmpeg_processes)
     output_filename = args.output_filename
+    if args.rotate_size:
+        rotate_size = args.rotate_size * 1024 * 1024
+    rotate_time = args.rotate_time
     extractor_proxy = args.extractor_proxy
 
     info_only = args.info
@@ -1183,7 +2382,28 @@ def script_main(download, download_playlist, **kwargs):
     if args.socks_proxy:
         set_socks_proxy(args.socks_proxy)
 
-    URLs = []
+    extra = {}
+    if extractor_proxy:
+        extra['extractor_proxy'] = extractor_proxy
+    if stream_id:
+        extra['stream_id'] = stream_id
+    options = dict(
+        output_dir=args.output_dir, merge=not args.no_merge,
+        info_only=info_only, json_output=json_output, caption=caption,
+        password=args.password, thread=args.thread, **extra
+    )
+
+    if args.serve:
+        from .server import serve, parse_address
+        socket.setdefaulttimeout(args.timeout)
+        serve(
+            parse_address(args.serve), job_runner(download, download_playlist),
+            make_job, options, jobs=args.jobs,
+            site_jobs=dict(args.site_jobs)
+        )
+        return
+
+    URLs = args.URL
     if args.input_file:
         logging.debug('you are trying to load urls from %s', args.input_file)
         if args.playlist:
@@ -1192,29 +2412,18 @@ def script_main(download, download_playlist, **kwargs):
                 "and won't make your life easier"
             )
             sys.exit(2)
-        URLs.extend(args.input_file.read().splitlines())
-        args.input_file.close()
-    URLs.extend(args.URL)
-
-    if not URLs:
+        URLs = itertools.chain(read_urls(args.input_file), args.URL)
+    elif not URLs:
         parser.print_help()
         sys.exit()
 
     socket.setdefaulttimeout(args.timeout)
 
     try:
-        extra = {}
-        if extractor_proxy:
-            extra['extractor_proxy'] = extractor_proxy
-        if stream_id:
-            extra['stream_id'] = stream_id
         download_main(
             download, download_playlist,
-            URLs, args.playlist,
-            output_dir=args.output_dir, merge=not args.no_merge,
-            info_only=info_only, json_output=json_output, caption=caption,
-            password=args.password, thread=args.thread,
-            **extra
+            URLs, args.playlist, jobs=args.jobs,
+            site_jobs=dict(args.site_jobs), **options
         )
     except KeyboardInterrupt:
         if args.debug:
@@ -1276,6 +2485,23 @@ def google_search(url):
     return(videos[0][0])
 
 
+def site_key(video_host):
+    """The key in SITES of the site at video_host.
+    """
+    if video_host.endswith('.com.cn') or video_host.endswith('.ac.cn'):
+        video_host = video_host[:-3]
+    domain = match1(video_host, r'(\.[^.]+\.[^.]+)$') or video_host
+    return domain and match1(domain, r'([^.]+)')
+
+
+def url_site(url):
+    """The extractor module which url_to_module would find for url, without
+    the requests it may make; 'universal' for the sites not in SITES.
+    """
+    video_host = match1(url, r'https?://([^/]+)/')
+    return SITES.get(video_host and site_key(video_host), 'universal')
+
+
 def url_to_module(url):
     try:
         video_host = match1(url, r'https?://([^/]+)/')
@@ -1286,27 +2512,18 @@ def url_to_module(url):
         video_host = match1(url, r'https?://([^/]+)/')
         video_url = match1(url, r'https?://[^/]+(.*)')
 
-    if video_host.endswith('.com.cn') or video_host.endswith('.ac.cn'):
-        video_host = video_host[:-3]
-    domain = match1(video_host, r'(\.[^.]+\.[^.]+)$') or video_host
-    assert domain, 'unsupported url: ' + url
-
-    k = match1(domain, r'([^.]+)')
+    k = site_key(video_host)
+    assert k, 'unsupported url: ' + url
     if k in SITES:
         return (
             import_module('.'.join(['lulu', 'extractors', SITES[k]])),
             url
         )
     else:
-        import http.client
-        video_host = match1(url, r'https?://([^/]+)/')  # .cn could be removed
-        if url.startswith('https://'):
-            conn = http.client.HTTPSConnection(video_host)
-        else:
-            conn = http.client.HTTPConnection(video_host)
-        conn.request('HEAD', video_url, headers=FAKE_HEADERS)
-        res = conn.getresponse()
-        location = res.getheader('location')
+        with closing(urlopen_with_retry(
+            url, method='head', headers=FAKE_HEADERS, allow_redirects=False
+        )) as res:
+            location = res.headers.get('location')
         if location and location != url and not location.startswith('/'):
             return url_to_module(location)
         else:
@@ -1315,11 +2532,15 @@ def url_to_module(url):
 
 def any_download(url, **kwargs):
     m, url = url_to_module(url)
+    _extraction.extractor = m.__name__.split('.')[-1]
+    _extraction.url = url
     m.download(url, **kwargs)
 
 
 def any_download_playlist(url, **kwargs):
     m, url = url_to_module(url)
+    _extraction.extractor = m.__name__.split('.')[-1]
+    _extraction.url = url
     m.download_playlist(url, **kwargs)
 
 
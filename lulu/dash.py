@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+import io
+import os
+import re
+import math
+import logging
+import threading
+from urllib import parse
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import iterparse
+
+from lulu import common
+from lulu.config import FAKE_HEADERS
+from lulu.hls import (
+    HLS_WORKERS,
+    Segment,
+    SegmentFetcher,
+    write_segments,
+)
+
+
+##################################################
+# manifest
+##################################################
+
+
+class Representation:
+    def __init__(self, id, mime_type, codecs, bandwidth, width, height):
+        self.id = id
+        self.mime_type = mime_type
+        self.codecs = codecs
+        self.bandwidth = bandwidth
+        self.width = width
+        self.height = height
+        # the size advertised next to a single BaseURL (yt:contentLength)
+        self.size = None
+        # hls.Segment, each with the init section of the representation
+        self.segments = []
+
+    @property
+    def content_type(self):
+        return (self.mime_type or '').split('/')[0]
+
+    @property
+    def container(self):
+        subtype = (self.mime_type or '').split('/')[-1]
+        if subtype == 'webm':
+            return 'webm'
+        return 'mp4' if self.content_type == 'video' else 'm4a'
+
+    def __repr__(self):
+        return '<Representation({}):{}>'.format(self.id, self.mime_type)
+
+
+class Manifest:
+    def __init__(self, url):
+        self.url = url
+        self.type = 'static'
+        self.duration = None
+        self.representations = []
+
+    @property
+    def is_live(self):
+        return self.type == 'dynamic'
+
+
+def parse_duration(text):
+    """Parses an ISO 8601 duration (PT1H2M3.5S) into seconds."""
+    match = re.match(
+        r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?$',
+        text or ''
+    )
+    if not match:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    return (
+        int(days or 0) * 86400 + int(hours or 0) * 3600 +
+        int(minutes or 0) * 60 + float(seconds or 0)
+    )
+
+
+def parse_range(text):
+    """Turns a byte range attribute (first-last) into (length, offset)."""
+    if not text:
+        return None
+    first, last = text.split('-')
+    return int(last) - int(first) + 1, int(first)
+
+
+def fill_template(template, representation, number=None, time=None):
+    def sub(match):
+        name, width = match.groups()
+        if not name:
+            return '$'
+        value = {
+            'RepresentationID': representation.id,
+            'Number': number,
+            'Time': time,
+            'Bandwidth': representation.bandwidth,
+        }[name]
+        if width:
+            return '{:0{}d}'.format(value, int(width))
+        return str(value)
+    return re.sub(r'\$(\w*)(?:%0(\d+)d)?\$', sub, template)
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def template_segments(template, representation, base_url, duration):
+    """Lists the segments a SegmentTemplate describes."""
+    init = None
+    if template.get('initialization'):
+        init = {
+            'uri': parse.urljoin(base_url, fill_template(
+                template['initialization'], representation
+            )),
+            'byterange': None,
+        }
+    media = template['media']
+    timescale = int(template.get('timescale', 1))
+    number = int(template.get('startNumber', 1))
+    segments = []
+    if template.get('timeline'):
+        time = 0
+        for s in template['timeline']:
+            time = int(s.get('t', time))
+            d = int(s['d'])
+            for _ in range(int(s.get('r', 0)) + 1):
+                segments.append(Segment(
+                    parse.urljoin(base_url, fill_template(
+                        media, representation, number, time
+                    )),
+                    d / timescale, number, init=init
+                ))
+                number += 1
+                time += d
+    elif template.get('duration') and duration:
+        d = int(template['duration'])
+        count = math.ceil(duration * timescale / d)
+        for i in range(count):
+            segments.append(Segment(
+                parse.urljoin(base_url, fill_template(
+                    media, representation, number + i, i * d
+                )),
+                d / timescale, number + i, init=init
+            ))
+    return segments
+
+
+def list_segments(segment_list, base_url):
+    """Lists the segments a SegmentList describes."""
+    init = None
+    if segment_list.get('init'):
+        source = segment_list['init']
+        init = {
+            'uri': parse.urljoin(base_url, source.get('sourceURL', '')),
+            'byterange': parse_range(source.get('range')),
+        }
+    timescale = int(segment_list.get('timescale', 1))
+    duration = int(segment_list.get('duration', 0)) / timescale
+    return [
+        Segment(
+            parse.urljoin(base_url, url.get('media', '')), duration, i,
+            init=init, byterange=parse_range(url.get('mediaRange'))
+        )
+        for i, url in enumerate(segment_list['urls'])
+    ]
+
+
+def parse_mpd(source, url):
+    """Parses the first period of an MPD manifest.
+
+    The manifest is read as a stream of elements, so that nothing after the
+    first period is parsed, nor kept in memory.
+
+    Args:
+        source: The manifest, as bytes, str or a binary file object.
+        url: The URL of the manifest, relative URLs are resolved against it.
+
+    Returns:
+        A Manifest.
+    """
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    manifest = Manifest(url)
+    # one dict per open element: attributes, BaseURL, segment information
+    stack = []
+    for event, element in iterparse(source, events=('start', 'end')):
+        tag = local_name(element.tag)
+        if event == 'start':
+            node = {
+                'tag': tag,
+                'attrib': {
+                    local_name(k): v for k, v in element.attrib.items()
+                },
+            }
+            stack.append(node)
+            if tag == 'MPD':
+                manifest.type = node['attrib'].get('type', 'static')
+                manifest.duration = parse_duration(
+                    node['attrib'].get('mediaPresentationDuration')
+                )
+            elif tag == 'S' and len(stack) >= 3:
+                stack[-3].setdefault('timeline', []).append(node['attrib'])
+            continue
+
+        node = stack.pop()
+        parent = stack[-1] if stack else None
+        if tag == 'BaseURL':
+            parent['base_url'] = (element.text or '').strip()
+            parent['size'] = node['attrib'].get('contentLength')
+        elif tag == 'SegmentTemplate':
+            parent['template'] = dict(node['attrib'])
+            if node.get('timeline'):
+                parent['template']['timeline'] = node['timeline']
+        elif tag == 'Initialization' and parent['tag'] in (
+            'SegmentList', 'SegmentBase'
+        ):
+            parent['init'] = node['attrib']
+        elif tag == 'SegmentURL':
+            parent.setdefault('urls', []).append(node['attrib'])
+        elif tag == 'SegmentList':
+            parent['list'] = dict(
+                node['attrib'], init=node.get('init'),
+                urls=node.get('urls', [])
+            )
+        elif tag == 'SegmentBase':
+            parent['base'] = dict(node['attrib'], init=node.get('init'))
+        elif tag == 'Representation':
+            manifest.representations.append(
+                make_representation(manifest, stack + [node])
+            )
+        elif tag == 'Period':
+            break
+        element.clear()
+    return manifest
+
+
+def make_representation(manifest, nodes):
+    """Builds a Representation from the elements it is nested in (MPD,
+    Period, AdaptationSet, Representation), which it inherits attributes
+    and segment information from.
+    """
+    attrib = {}
+    base_url = manifest.url
+    template = None
+    segment_list = None
+    segment_base = None
+    duration = manifest.duration
+    for node in nodes:
+        if node['tag'] in ('AdaptationSet', 'Representation'):
+            attrib.update(node['attrib'])
+        if node['tag'] == 'Period' and node['attrib'].get('duration'):
+            duration = parse_duration(node['attrib']['duration'])
+        if node.get('base_url'):
+            base_url = parse.urljoin(base_url, node['base_url'])
+        if node.get('template'):
+            template = dict(template or {}, **node['template'])
+        if node.get('list'):
+            segment_list = node['list']
+        if node.get('base'):
+            segment_base = node['base']
+    mime_type = attrib.get('mimeType')
+    if not mime_type and attrib.get('contentType'):
+        mime_type = '{}/mp4'.format(attrib['contentType'])
+    representation = Representation(
+        attrib.get('id'), mime_type, attrib.get('codecs'),
+        int(attrib.get('bandwidth', 0)), int(attrib.get('width', 0)),
+        int(attrib.get('height', 0))
+    )
+    if template and template.get('media'):
+        representation.segments = template_segments(
+            template, representation, base_url, duration
+        )
+    elif segment_list:
+        representation.segments = list_segments(segment_list, base_url)
+    else:
+        # a single file, its index (SegmentBase) is of no use to us
+        size = nodes[-1].get('size')
+        representation.size = int(size) if size else None
+        representation.segments = [Segment(base_url, duration, 0)]
+        if segment_base:
+            logging.debug('parse_mpd: {} is a single file'.format(base_url))
+    return representation
+
+
+def select_representations(manifest, max_bandwidth=None):
+    """Picks the video representation with the highest bandwidth (not above
+    max_bandwidth if it is given), and the best audio representation in the
+    same container.
+
+    Returns:
+        (video, audio), either may be None.
+    """
+    def best(representations):
+        representations = sorted(representations, key=lambda r: r.bandwidth)
+        if not representations:
+            return None
+        if max_bandwidth:
+            fitting = [
+                r for r in representations if r.bandwidth <= max_bandwidth
+            ]
+            return fitting[-1] if fitting else representations[0]
+        return representations[-1]
+
+    videos = [
+        r for r in manifest.representations if r.content_type == 'video'
+    ]
+    audios = [
+        r for r in manifest.representations if r.content_type == 'audio'
+    ]
+    video = best(videos)
+    if video is not None:
+        subtype = video.mime_type.split('/')[-1]
+        audios = [
+            r for r in audios if r.mime_type.split('/')[-1] == subtype
+        ] or audios
+    return video, best(audios)
+
+
+def load_manifest(url, headers=FAKE_HEADERS):
+    with common.urlopen_with_retry(url, headers=headers) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return parse_mpd(response.raw, url)
+
+
+##################################################
+# download
+##################################################
+
+
+class SharedProgressBar:
+    """Lets the tracks downloaded at the same time report to a single bar,
+    where a piece is any segment of any track.
+    """
+    def __init__(self, bar):
+        self.bar = bar
+        self.lock = threading.Lock()
+        self.pieces = 0
+
+    def update_piece(self, n):
+        pass
+
+    def update_received(self, n):
+        with self.lock:
+            self.pieces += 1
+            self.bar.update_piece(self.pieces)
+            self.bar.update_received(n)
+
+
+def download_track(
+    representation, filepath, headers=FAKE_HEADERS, bar=None,
+    workers=HLS_WORKERS, timeout=None
+):
+    temp_filepath = filepath + '.download'
+    with open(temp_filepath, 'wb') as output:
+        write_segments(
+            representation.segments, output,
+            SegmentFetcher(headers, timeout=timeout), bar=bar,
+            workers=workers
+        )
+    common.replace_file(temp_filepath, filepath)
+
+
+def select_tracks(manifest, max_bandwidth=None):
+    """The representations of select_representations() that are there, video
+    first.
+
+    Raises:
+        ValueError: there is neither, or one has no segments, such as one of a
+            SegmentTemplate of a duration in a manifest of no duration.
+    """
+    representations = [
+        r for r in select_representations(manifest, max_bandwidth)
+        if r is not None
+    ]
+    if not representations:
+        raise ValueError(
+            'no audio or video representation in ' + manifest.url
+        )
+    for r in representations:
+        if not r.segments:
+            raise ValueError('no segments for representation {} in {}'.format(
+                r.id, manifest.url
+            ))
+    return representations
+
+
+def download_dash(
+    url, output_filepath, headers=FAKE_HEADERS, bar=None, thread=0,
+    max_bandwidth=None, manifest=None, timeout=None
+):
+    """Downloads the best video and audio representations of a DASH
+    manifest, both at once, each into a file of its own.
+
+    The thread (HLS_WORKERS by default) connections are shared by the
+    tracks, so that the download takes as long as the slower of them.
+
+    Returns:
+        The files written, video first; output_filepath without its
+        extension, followed by .video.<ext> and .audio.<ext>.
+    """
+    if manifest is None:
+        manifest = load_manifest(url, headers)
+    tracks = [
+        (r, '{}.{}.{}'.format(
+            os.path.splitext(output_filepath)[0], r.content_type, r.container
+        ))
+        for r in select_tracks(manifest, max_bandwidth)
+    ]
+    workers = max(1, (thread or HLS_WORKERS) // len(tracks))
+    shared_bar = bar and SharedProgressBar(bar)
+    with ThreadPoolExecutor(max_workers=len(tracks)) as executor:
+        futures = [
+            executor.submit(
+                download_track, representation, filepath, headers,
+                shared_bar, workers, timeout
+            )
+            for representation, filepath in tracks
+        ]
+        for future in futures:
+            future.result()
+    return [filepath for _, filepath in tracks]
@@ -4,7 +4,6 @@ import os
 from copy import copy
 
 from lulu.common import (
-    match1,
     dry_run,
     url_size,
     urls_size,
@@ -15,8 +14,7 @@ from lulu.common import (
     maybe_print,
     get_filename,
     download_urls,
-    download_url_ffmpeg,
-    general_m3u8_extractor,
+    download_url_hls,
 )
 from lulu import config
 from lulu.util import log
@@ -239,35 +237,19 @@ class VideoExtractor:
 
             if not urls:
                 log.wtf('[Failed] Cannot extract video source.')
-
+            # for the resume journal
+            kwargs['stream_id'] = stream_id
+
+            headers = copy(config.FAKE_HEADERS)
+            if self.ua is not None:
+                headers['User-Agent'] = self.ua
+            if self.referer is not None:
+                headers['Referer'] = self.referer
             if ext == 'm3u8':
-                ffmpeg_kwargs = {}
-                if 'iqiyi' in self.name:
-                    # ffmpeg_kwargs['override'] = True
-                    # ffmpeg_kwargs['params'] = {
-                    #     '-c:a': 'copy', '-bsf:a': 'aac_adtstoasc'
-                    # }
-                    m3u8_urls = general_m3u8_extractor(urls[0])
-                    size = sum([
-                        int(match1(url, r'contentlength=(\d+)'))
-                        for url in m3u8_urls
-                    ])
-                    download_urls(
-                        m3u8_urls, self.title, 'mp4', size, **kwargs
-                    )
-                else:
-                    download_url_ffmpeg(
-                        urls[0], self.title, 'mp4',
-                        output_dir=kwargs['output_dir'],
-                        merge=kwargs['merge'], stream=False,
-                        **ffmpeg_kwargs
-                    )
+                download_url_hls(
+                    urls[0], self.title, headers=headers, **kwargs
+                )
             else:
-                headers = copy(config.FAKE_HEADERS)
-                if self.ua is not None:
-                    headers['User-Agent'] = self.ua
-                if self.referer is not None:
-                    headers['Referer'] = self.referer
                 download_urls(
                     urls,
                     self.title,
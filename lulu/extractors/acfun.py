@@ -15,7 +15,7 @@ from lulu.common import (
     rc4,
     match1,
     dry_run,
-    url_info,
+    urls_info,
     print_info,
     get_content,
     get_filename,
@@ -114,12 +114,11 @@ def acfun_download_by_vid(
                 preferred = yk_streams[t]
                 break
         # total_size in the json could be incorrect(F.I. 0)
-        size = 0
-        for url in preferred[0]:
-            _, _, seg_size = url_info(
-                url, refer='https://www.acfun.cn/av{}'.format(vid)
+        size = sum(
+            seg_size for _, _, seg_size in urls_info(
+                preferred[0], refer='https://www.acfun.cn/av{}'.format(vid)
             )
-            size += seg_size
+        )
         # fallback to flvhd is not quite possible
         print_info(site_info, title, 'mp4', size)
         if not info_only:
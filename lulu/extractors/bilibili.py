@@ -5,7 +5,6 @@ import json
 import socket
 import hashlib
 import urllib.parse
-import urllib.request
 
 from lulu.common import (
     match1,
@@ -5,6 +5,7 @@ from xml.etree import cElementTree as ET
 
 from lulu.common import (
     url_info,
+    urls_size,
     print_info,
     get_content,
     download_urls,
@@ -85,8 +86,7 @@ def ckplayer_download_by_xml(
     if 'size' in video_info:
         size = int(video_info['size'])
     else:
-        for i in video_info['links'][1:]:  # save 1st one
-            size += url_info(i)[2]
+        size += urls_size(video_info['links'][1:])  # save 1st one
 
     print_info(site_info, title, type_, size)
     if not info_only:
@@ -11,9 +11,8 @@ from lulu.common import (
     match1,
     print_info,
     get_content,
-    download_urls,
+    download_url_hls,
     download_url_ffmpeg,
-    general_m3u8_extractor,
     playlist_not_supported,
 )
 
@@ -47,10 +46,7 @@ def douyutv_video_download(
     m3u8_url = meta['data']['video_url']
     print_info(site_info, title, 'm3u8', 0, m3u8_url=m3u8_url)
     if not info_only:
-        urls = general_m3u8_extractor(m3u8_url)
-        download_urls(
-            urls, title, 'ts', 0, output_dir=output_dir, merge=merge, **kwargs
-        )
+        download_url_hls(m3u8_url, title, output_dir=output_dir, **kwargs)
 
 
 def douyutv_download(
@@ -5,12 +5,11 @@ import json
 import time
 import base64
 import random
-import urllib
+import urllib.parse
 import hashlib
 
 from lulu.common import (
     match1,
-    url_info,
     urls_size,
     print_info,
     get_content,
@@ -108,10 +107,7 @@ def video_info(vid, **kwargs):
 
 def letv_download_by_vid(vid, title, info_only=False, **kwargs):
     ext, urls = video_info(vid, **kwargs)
-    size = 0
-    for i in urls:
-        _, _, tmp = url_info(i)
-        size += tmp
+    size = urls_size(urls)
 
     print_info(site_info, title, ext, size)
     if not info_only:
@@ -129,7 +125,7 @@ def letvcloud_download_by_vu(vu, uu, title=None, info_only=False, **kwargs):
         [i + argumet_dict[i] for i in sorted(argumet_dict)]
     ) + sign_key
     sign = hashlib.md5(str2Hash.encode('utf-8')).hexdigest()
-    request_info = urllib.request.Request(
+    response = urlopen_with_retry(
         'http://api.letvcloud.com/gpc.php?{}&sign={}'.format(
             '&'.join(
                 ['{}={}'.format(i, argumet_dict[i]) for i in argumet_dict]
@@ -137,9 +133,7 @@ def letvcloud_download_by_vu(vu, uu, title=None, info_only=False, **kwargs):
             sign
         )
     )
-    response = urllib.request.urlopen(request_info)
-    data = response.read()
-    info = json.loads(data.decode('utf-8'))
+    info = json.loads(response.content.decode('utf-8'))
     type_available = []
     for video_type in info['data']['video_info']['media']:
         type_available.append({
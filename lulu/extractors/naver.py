@@ -3,7 +3,6 @@
 import re
 import json
 import urllib.parse
-import urllib.request
 
 from lulu.util import log
 from lulu.common import (
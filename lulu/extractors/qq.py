@@ -11,6 +11,8 @@ from lulu.common import (
     match1,
     matchall,
     url_info,
+    probe_url,
+    urls_info,
     print_info,
     get_content,
     url_locations,
@@ -44,7 +46,6 @@ def qq_download_by_vid(
     part_format_id = streams[-1]['id']
 
     part_urls = []
-    total_size = 0
     for part in range(1, seg_cnt+1):
         filename = '{}.p{}.{}.mp4'.format(
             fn_pre, str(part_format_id % 10000), str(part)
@@ -75,8 +76,12 @@ def qq_download_by_vid(
             break
 
         part_urls.append(url)
-        _, ext, size = url_info(url)
-        total_size += size
+        # size the part while the key of the next one is requested
+        probe_url(url)
+
+    infos = urls_info(part_urls)
+    ext = infos[-1][1]
+    total_size = sum(size for _, _, size in infos)
 
     print_info(site_info, title, ext, total_size)
     if not info_only:
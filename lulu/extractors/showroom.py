@@ -9,7 +9,7 @@ from lulu.common import (
     url_info,
     print_info,
     get_content,
-    download_url_ffmpeg,
+    download_url_hls,
     playlist_not_supported,
 )
 from lulu.util import log
@@ -48,8 +48,7 @@ def showroom_download_by_room_id(room_id, info_only=False, **kwargs):
         log.w('The live show is currently offline.')
         sleep(1)
 
-    # This is mainly for testing the M3U FFmpeg parser so I would ignore
-    # any non-m3u ones
+    # only the HLS streams are recorded
     stream_url = [
         i['url'] for i in html['streaming_url_list']
         if i['is_default'] and i['type'] == 'hls'
@@ -70,9 +69,7 @@ def showroom_download_by_room_id(room_id, info_only=False, **kwargs):
     type_, ext, size = url_info(stream_url)
     print_info(site_info, title, type_, size)
     if not info_only:
-        download_url_ffmpeg(
-            url=stream_url, title=title, ext='mp4', **kwargs
-        )
+        download_url_hls(stream_url, title, **kwargs)
 
 
 def showroom_download(url, info_only=False, **kwargs):
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import re
-import urllib
 
 from lulu.common import (
     match1,
@@ -9,6 +8,7 @@ from lulu.common import (
     print_info,
     get_content,
     download_urls,
+    urlopen_with_retry,
     playlist_not_supported,
 )
 
@@ -28,10 +28,11 @@ def suntv_download(url, info_only=False, **kwargs):
 
         data = str(values).replace("'", '"')
         data = data.encode('utf-8')
-        req = urllib.request.Request(API_URL, data)
-        req.add_header('AjaxPro-Method', 'ToPlay')  # important!
-        resp = urllib.request.urlopen(req)
-        respData = resp.read()
+        resp = urlopen_with_retry(
+            API_URL, method='post', data=data,
+            headers={'AjaxPro-Method': 'ToPlay'}  # important!
+        )
+        respData = resp.content
         respData = respData.decode('ascii').strip('"')  # Ahhhhhhh!
 
         video_url = 'http://www.isuntv.com' + str(respData)
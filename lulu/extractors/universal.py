@@ -8,10 +8,12 @@ from lulu.common import (
     match1,
     get_head,
     url_info,
+    probe_url,
     print_info,
     get_content,
     download_urls,
-    download_url_ffmpeg,
+    download_url_hls,
+    download_url_dash,
     playlist_not_supported,
 )
 from lulu.config import FAKE_HEADERS
@@ -59,13 +61,26 @@ def universal_download(
             r'(https?://[^;"\'\\]+' + '\.m3u8?' + r'[^;"\'\\]*)', page
         )
         if hls_urls:
+            for hls_url in hls_urls:
+                probe_url(hls_url)
             for hls_url in hls_urls:
                 type_, ext, size = url_info(hls_url)
                 print_info(site_info, page_title, type_, size)
                 if not info_only:
-                    download_url_ffmpeg(
-                        url=hls_url, title=page_title, ext='mp4',
-                        output_dir=output_dir
+                    download_url_hls(
+                        url=hls_url, title=page_title, output_dir=output_dir
+                    )
+            return
+
+        # MPEG-DASH MPD
+        mpd_urls = re.findall(r'src="(https?://[^"]+\.mpd)"', page)
+        if mpd_urls:
+            for mpd_url in mpd_urls:
+                print_info(site_info, page_title, 'mpd', 0)
+                if not info_only:
+                    download_url_dash(
+                        url=mpd_url, title=page_title, output_dir=output_dir,
+                        merge=merge
                     )
             return
 
@@ -101,13 +116,6 @@ def universal_download(
         urls += re.findall(r'href="(https?://[^"]+\.png)"', page, re.I)
         urls += re.findall(r'href="(https?://[^"]+\.gif)"', page, re.I)
 
-        # MPEG-DASH MPD
-        mpd_urls = re.findall(r'src="(https?://[^"]+\.mpd)"', page)
-        for mpd_url in mpd_urls:
-            cont = get_content(mpd_url)
-            base_url = match1(cont, r'<BaseURL>(.*)</BaseURL>')
-            urls += [match1(mpd_url, r'(.*/)[^/]*') + base_url]
-
         # have some candy!
         candies = []
         i = 1
@@ -123,6 +131,8 @@ def universal_download(
                 'url': url, 'title': title
             })
 
+        for candy in candies:
+            probe_url(candy['url'])
         for candy in candies:
             try:
                 mime, ext, size = url_info(candy['url'])
@@ -3,14 +3,15 @@
 import re
 import time
 import json
-import urllib.request
 import urllib.parse
+from contextlib import closing
 
 from lulu.util import log
 from lulu.extractor import VideoExtractor
 from lulu.common import (
     cookies,
     get_content,
+    urlopen_with_retry,
 )
 
 
@@ -27,14 +28,10 @@ def fetch_cna():
                 log.i('Found cna in imported cookies. Use it')
                 return quote_cna(cookie.value)
     url = 'http://log.mmstat.com/eg.js'
-    req = urllib.request.urlopen(url)
-    headers = req.getheaders()
-    for header in headers:
-        if header[0].lower() == 'set-cookie':
-            n_v = header[1].split(';')[0]
-            name, value = n_v.split('=')
-            if name == 'cna':
-                return quote_cna(value)
+    with closing(urlopen_with_retry(url)) as response:
+        value = response.cookies.get('cna')
+    if value:
+        return quote_cna(value)
     log.w(
         'It seems that the client failed to fetch a cna cookie. '
         'Please load your own cookie if possible'
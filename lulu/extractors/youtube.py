@@ -9,6 +9,7 @@ from xml.dom.minidom import parseString
 from lulu.common import (
     match1,
     url_size,
+    probe_url,
     urls_size,
     get_content,
     mime_to_container,
@@ -16,6 +17,7 @@ from lulu.common import (
     download_url_ffmpeg,
 )
 from lulu.util import log
+from lulu.dash import parse_mpd
 from lulu.config import YOUTUBE_CODECS
 from lulu.extractor import VideoExtractor
 
@@ -333,75 +335,41 @@ class YouTube(VideoExtractor):
         # Prepare DASH streams
         try:
             dashmpd = ytplayer_config['args']['dashmpd']
-            dash_xml = parseString(get_content(dashmpd))
-            for aset in dash_xml.getElementsByTagName('AdaptationSet'):
-                mimeType = aset.getAttribute('mimeType')
-                if mimeType == 'audio/mp4':
-                    rep = aset.getElementsByTagName('Representation')[-1]
-                    burls = rep.getElementsByTagName('BaseURL')
-                    dash_mp4_a_url = burls[0].firstChild.nodeValue
-                    dash_mp4_a_size = burls[0].getAttribute('yt:contentLength')
-                    if not dash_mp4_a_size:
-                        try:
-                            dash_mp4_a_size = url_size(dash_mp4_a_url)
-                        except Exception:
-                            continue
-                elif mimeType == 'audio/webm':
-                    rep = aset.getElementsByTagName('Representation')[-1]
-                    burls = rep.getElementsByTagName('BaseURL')
-                    dash_webm_a_url = burls[0].firstChild.nodeValue
-                    dash_webm_a_size = burls[0].getAttribute(
-                        'yt:contentLength'
-                    )
-                    if not dash_webm_a_size:
-                        try:
-                            dash_webm_a_size = url_size(dash_webm_a_url)
-                        except Exception:
-                            continue
-                elif mimeType == 'video/mp4':
-                    for rep in aset.getElementsByTagName('Representation'):
-                        w = int(rep.getAttribute('width'))
-                        h = int(rep.getAttribute('height'))
-                        itag = rep.getAttribute('id')
-                        burls = rep.getElementsByTagName('BaseURL')
-                        dash_url = burls[0].firstChild.nodeValue
-                        dash_size = burls[0].getAttribute('yt:contentLength')
-                        if not dash_size:
-                            try:
-                                dash_size = url_size(dash_url)
-                            except Exception:
-                                continue
-                        self.dash_streams[itag] = {
-                            'quality': '{}x{}'.format(w, h),
-                            'itag': itag,
-                            'type': mimeType,
-                            'mime': mimeType,
-                            'container': 'mp4',
-                            'src': [dash_url, dash_mp4_a_url],
-                            'size': int(dash_size) + int(dash_mp4_a_size)
-                        }
-                elif mimeType == 'video/webm':
-                    for rep in aset.getElementsByTagName('Representation'):
-                        w = int(rep.getAttribute('width'))
-                        h = int(rep.getAttribute('height'))
-                        itag = rep.getAttribute('id')
-                        burls = rep.getElementsByTagName('BaseURL')
-                        dash_url = burls[0].firstChild.nodeValue
-                        dash_size = burls[0].getAttribute('yt:contentLength')
-                        if not dash_size:
-                            try:
-                                dash_size = url_size(dash_url)
-                            except Exception:
-                                continue
-                        self.dash_streams[itag] = {
-                            'quality': '%sx%s' % (w, h),
-                            'itag': itag,
-                            'type': mimeType,
-                            'mime': mimeType,
-                            'container': 'webm',
-                            'src': [dash_url, dash_webm_a_url],
-                            'size': int(dash_size) + int(dash_webm_a_size)
-                        }
+            manifest = parse_mpd(get_content(dashmpd), dashmpd)
+            # size every representation without a yt:contentLength at once
+            for rep in manifest.representations:
+                if not rep.size:
+                    probe_url(rep.segments[0].uri)
+            # the last audio representation of each container
+            dash_audio = {}
+            for rep in manifest.representations:
+                if rep.mime_type in ('audio/mp4', 'audio/webm'):
+                    try:
+                        size = rep.size or url_size(rep.segments[0].uri)
+                    except Exception:
+                        continue
+                    dash_audio[rep.mime_type] = (rep.segments[0].uri, size)
+            for rep in manifest.representations:
+                if rep.mime_type == 'video/mp4':
+                    audio = dash_audio['audio/mp4']
+                elif rep.mime_type == 'video/webm':
+                    audio = dash_audio['audio/webm']
+                else:
+                    continue
+                dash_url = rep.segments[0].uri
+                try:
+                    dash_size = rep.size or url_size(dash_url)
+                except Exception:
+                    continue
+                self.dash_streams[rep.id] = {
+                    'quality': '{}x{}'.format(rep.width, rep.height),
+                    'itag': rep.id,
+                    'type': rep.mime_type,
+                    'mime': rep.mime_type,
+                    'container': rep.container,
+                    'src': [dash_url, audio[0]],
+                    'size': int(dash_size) + int(audio[1])
+                }
         except Exception:
             # VEVO
             if not self.html5player:
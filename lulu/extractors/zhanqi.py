@@ -8,7 +8,7 @@ from lulu.common import (
     print_info,
     get_content,
     download_urls,
-    download_url_ffmpeg,
+    download_url_hls,
     general_m3u8_extractor,
     playlist_not_supported,
 )
@@ -66,9 +66,7 @@ def zhanqi_live(
         site_info, title, 'm3u8', 0, m3u8_url=m3u8_url, m3u8_type='master'
     )
     if not info_only:
-        download_url_ffmpeg(
-            m3u8_url, title, 'mp4', output_dir=output_dir, merge=merge
-        )
+        download_url_hls(m3u8_url, title, output_dir=output_dir, **kwargs)
 
 
 def zhanqi_video(
@@ -0,0 +1,608 @@
+#!/usr/bin/env python
+
+import io
+import os
+import re
+import time
+import logging
+import threading
+from urllib import parse
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+from lulu import common
+from lulu.util import log
+from lulu.config import FAKE_HEADERS
+
+
+# how many media segments are fetched at the same time
+HLS_WORKERS = 8
+
+
+##################################################
+# playlist
+##################################################
+
+
+class Segment:
+    def __init__(
+        self, uri, duration, sequence, key=None, init=None, byterange=None,
+        discontinuity=False
+    ):
+        self.uri = uri
+        self.duration = duration
+        self.sequence = sequence
+        # {'method': 'AES-128', 'uri': ..., 'iv': bytes or None} or None
+        self.key = key
+        # {'uri': ..., 'byterange': (length, offset) or None} or None
+        self.init = init
+        # (length, offset) or None
+        self.byterange = byterange
+        self.discontinuity = discontinuity
+
+    def __repr__(self):
+        return '<Segment({}):{}>'.format(self.sequence, self.uri)
+
+
+class Playlist:
+    def __init__(self, url):
+        self.url = url
+        # master playlist: [{'bandwidth': int, 'resolution': str,
+        # 'codecs': str, 'uri': str}]
+        self.variants = []
+        # media playlist
+        self.segments = []
+        self.target_duration = None
+        self.media_sequence = 0
+        self.playlist_type = None
+        self.endlist = False
+
+    @property
+    def is_master(self):
+        return bool(self.variants)
+
+    @property
+    def is_live(self):
+        return not self.endlist and self.playlist_type != 'VOD'
+
+
+def parse_attributes(text):
+    attributes = {}
+    for k, v in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text):
+        attributes[k] = v[1:-1] if v.startswith('"') else v
+    return attributes
+
+
+def parse_byterange(text, next_offset):
+    length, _, offset = text.partition('@')
+    return int(length), int(offset) if offset else next_offset
+
+
+def parse_m3u8(content, url):
+    """Parses the text of a master or media M3U8 playlist.
+
+    Args:
+        content: The playlist text.
+        url: The URL of the playlist, relative URIs are resolved against it.
+
+    Returns:
+        A Playlist.
+    """
+    playlist = Playlist(url)
+    duration = 0
+    key = None
+    init = None
+    byterange = None
+    discontinuity = False
+    variant = None
+    # a byte range without an offset starts where the last one of the same
+    # URI ended
+    next_offsets = {}
+    sequence = None
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith('#'):
+            uri = parse.urljoin(url, line)
+            if variant is not None:
+                variant['uri'] = uri
+                playlist.variants.append(variant)
+                variant = None
+                continue
+            if sequence is None:
+                sequence = playlist.media_sequence
+            if byterange is not None:
+                byterange = parse_byterange(
+                    byterange, next_offsets.get(uri, 0)
+                )
+                next_offsets[uri] = byterange[0] + byterange[1]
+            playlist.segments.append(Segment(
+                uri, duration, sequence, key=key, init=init,
+                byterange=byterange, discontinuity=discontinuity
+            ))
+            sequence += 1
+            duration = 0
+            byterange = None
+            discontinuity = False
+            continue
+
+        tag, _, value = line.partition(':')
+        if tag == '#EXTINF':
+            duration = float(value.split(',')[0])
+        elif tag == '#EXT-X-STREAM-INF':
+            attributes = parse_attributes(value)
+            variant = {
+                'bandwidth': int(attributes.get('BANDWIDTH', 0)),
+                'resolution': attributes.get('RESOLUTION'),
+                'codecs': attributes.get('CODECS'),
+            }
+        elif tag == '#EXT-X-BYTERANGE':
+            byterange = value
+        elif tag == '#EXT-X-KEY':
+            attributes = parse_attributes(value)
+            if attributes.get('METHOD', 'NONE') == 'NONE':
+                key = None
+            else:
+                iv = attributes.get('IV')
+                key = {
+                    'method': attributes['METHOD'],
+                    'uri': parse.urljoin(url, attributes['URI']),
+                    'iv': bytes.fromhex(iv[2:].zfill(32)) if iv else None,
+                }
+        elif tag == '#EXT-X-MAP':
+            attributes = parse_attributes(value)
+            init = {
+                'uri': parse.urljoin(url, attributes['URI']),
+                'byterange': attributes.get('BYTERANGE') and
+                parse_byterange(attributes['BYTERANGE'], 0),
+            }
+        elif tag == '#EXT-X-MEDIA-SEQUENCE':
+            playlist.media_sequence = int(value)
+        elif tag == '#EXT-X-TARGETDURATION':
+            playlist.target_duration = float(value)
+        elif tag == '#EXT-X-PLAYLIST-TYPE':
+            playlist.playlist_type = value.upper()
+        elif tag == '#EXT-X-DISCONTINUITY':
+            discontinuity = True
+        elif tag == '#EXT-X-ENDLIST':
+            playlist.endlist = True
+    return playlist
+
+
+def select_variant(playlist, max_bandwidth=None):
+    """Picks the variant with the highest bandwidth, not above max_bandwidth
+    if it is given (the lowest one is picked if none fits).
+    """
+    variants = sorted(playlist.variants, key=lambda v: v['bandwidth'])
+    if max_bandwidth:
+        fitting = [v for v in variants if v['bandwidth'] <= max_bandwidth]
+        return fitting[-1] if fitting else variants[0]
+    return variants[-1]
+
+
+def load_playlist(url, headers=FAKE_HEADERS, max_bandwidth=None):
+    """Fetches and parses a playlist, following a master playlist to the
+    media playlist of its best variant.
+    """
+    playlist = parse_m3u8(common.get_content(url, headers=headers), url)
+    while playlist.is_master:
+        variant = select_variant(playlist, max_bandwidth)
+        logging.debug('load_playlist: variant {}'.format(variant))
+        playlist = parse_m3u8(
+            common.get_content(variant['uri'], headers=headers),
+            variant['uri']
+        )
+    return playlist
+
+
+def classify_playlist(url, headers=FAKE_HEADERS):
+    """Tells a live HLS stream from a VOD one, by EXT-X-ENDLIST and
+    EXT-X-PLAYLIST-TYPE of its media playlist.
+
+    Returns:
+        'live' or 'vod', or None if url is not an HLS playlist or cannot be
+        fetched.
+    """
+    if not parse.urlparse(url).path.endswith(('.m3u8', '.m3u')):
+        return None
+    try:
+        playlist = load_playlist(url, headers)
+    except Exception as e:
+        logging.debug('classify_playlist: {}'.format(e))
+        return None
+    if not playlist.segments:
+        return None
+    return 'live' if playlist.is_live else 'vod'
+
+
+##################################################
+# download
+##################################################
+
+
+def fetch(url, headers, byterange=None, timeout=None):
+    if byterange:
+        length, offset = byterange
+        headers = dict(headers, Range='bytes={}-{}'.format(
+            offset, offset + length - 1
+        ))
+    kwargs = {'headers': headers}
+    if timeout:
+        kwargs['timeout'] = timeout
+    with closing(common.urlopen_with_retry(url, **kwargs)) as response:
+        response.raise_for_status()
+        data = response.content
+    common.throttle(len(data))
+    return data
+
+
+def decrypt_aes128(data, key, iv):
+    from cryptography.hazmat.primitives.ciphers import (
+        Cipher, algorithms, modes
+    )
+    from cryptography.hazmat.backends import default_backend
+    decryptor = Cipher(
+        algorithms.AES(key), modes.CBC(iv), backend=default_backend()
+    ).decryptor()
+    data = decryptor.update(data) + decryptor.finalize()
+    # PKCS7 padding
+    return data[:-data[-1]] if data else data
+
+
+class SegmentFetcher:
+    """Fetches, and decrypts if needed, the media segments of a playlist,
+    caching keys and init sections that segments share.
+    """
+    def __init__(self, headers=FAKE_HEADERS, timeout=None):
+        self.headers = headers
+        self.timeout = timeout
+        self.keys = {}
+
+    def key(self, uri):
+        if uri not in self.keys:
+            self.keys[uri] = fetch(uri, self.headers, timeout=self.timeout)
+        return self.keys[uri]
+
+    def init(self, segment):
+        return fetch(
+            segment.init['uri'], self.headers, segment.init['byterange'],
+            timeout=self.timeout
+        )
+
+    def __call__(self, segment):
+        data = fetch(
+            segment.uri, self.headers, segment.byterange, timeout=self.timeout
+        )
+        if segment.key is not None:
+            if segment.key['method'] != 'AES-128':
+                raise ValueError('unsupported encryption: {}'.format(
+                    segment.key['method']
+                ))
+            iv = segment.key['iv'] or segment.sequence.to_bytes(16, 'big')
+            data = decrypt_aes128(data, self.key(segment.key['uri']), iv)
+        return data
+
+
+def write_segments(
+    segments, output, fetcher, bar=None, workers=HLS_WORKERS, init=None
+):
+    """Fetches segments concurrently and writes them in order to output.
+
+    At most 2 * workers segments are fetched ahead of the one being written,
+    which bounds the memory to that many segments.
+
+    Args:
+        init: The init section already written to output, if any.
+
+    Returns:
+        The init section last written to output.
+    """
+    window = 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(fetcher, segment) for segment in segments[:window]
+        ]
+        for i, segment in enumerate(segments):
+            if i + window < len(segments):
+                futures.append(executor.submit(fetcher, segments[i + window]))
+            data = futures[i].result()
+            futures[i] = None
+            if segment.init is not None and segment.init != init:
+                init = segment.init
+                output.write(fetcher.init(segment))
+            output.write(data)
+            if bar:
+                bar.update_piece(i + 1)
+                bar.update_received(len(data))
+    return init
+
+
+class SegmentRemuxer:
+    """Remuxes the MPEG-TS segments written into it to MP4, into output,
+    by a TSRemuxer that takes each segment as a file. If the first segment
+    has streams TSRemuxer cannot remux, all of them are written as they are
+    instead, and remuxed is False.
+
+    Room is left for the moov before the samples by the size of the first
+    segment times segments, the number of them, see MP4Writer; moov_first
+    tells whether it fitted there once closed.
+    """
+    def __init__(self, output, segments=0):
+        self.output = output
+        self.segments = segments
+        self.moov_first = None
+        self.remuxer = None
+        self.remuxed = None
+
+    def write(self, data):
+        if self.remuxed is None:
+            from lulu.processor.mp4_writer import moov_reserve
+            from lulu.processor.remux_ts import TSRemuxer, is_remuxable
+            self.remuxed = is_remuxable(data)
+            if self.remuxed:
+                self.remuxer = TSRemuxer(
+                    self.output, moov_reserve(len(data) * self.segments)
+                )
+        if self.remuxed:
+            self.remuxer.add(io.BytesIO(data))
+        else:
+            self.output.write(data)
+
+    def close(self):
+        if self.remuxer is not None:
+            self.moov_first = self.remuxer.close()
+
+
+def download_hls(
+    url, output_filepath, headers=FAKE_HEADERS, bar=None, thread=0,
+    max_bandwidth=None, playlist=None, timeout=None, remux=False
+):
+    """Downloads a VOD HLS stream into a single file.
+
+    Segments are fetched over thread (HLS_WORKERS by default) concurrent
+    connections, AES-128 segments are decrypted in process, and everything
+    is written in playlist order straight into output_filepath.
+
+    Args:
+        remux: Whether MPEG-TS segments are remuxed to MP4 on the way, see
+            SegmentRemuxer; those that cannot be are saved as MPEG-TS, with
+            the extension of output_filepath changed to .ts.
+
+    Returns:
+        The file written.
+    """
+    if playlist is None:
+        playlist = load_playlist(url, headers, max_bandwidth)
+    fetcher = SegmentFetcher(headers, timeout=timeout)
+    temp_filepath = output_filepath + '.download'
+    with open(temp_filepath, 'wb') as output:
+        if remux:
+            output = SegmentRemuxer(output, len(playlist.segments))
+        write_segments(
+            playlist.segments, output, fetcher, bar=bar,
+            workers=thread or HLS_WORKERS
+        )
+        if remux:
+            output.close()
+    if remux and output.remuxed:
+        if not output.moov_first:
+            # it did not fit before the samples
+            from lulu.processor.join_mp4 import faststart_mp4
+            faststart_mp4(temp_filepath)
+    elif remux:
+        log.w('Segments kept in MPEG-TS, their codecs are not H.264 and AAC')
+        output_filepath = os.path.splitext(output_filepath)[0] + '.ts'
+    common.replace_file(temp_filepath, output_filepath)
+    return output_filepath
+
+
+##################################################
+# live
+##################################################
+
+
+class LiveRecorder:
+    """Records a live HLS stream into growing files.
+
+    The media playlist is polled at its target duration (half of it when it
+    has not changed since the last poll), new segments are told apart by
+    their media sequence numbers, fetched concurrently while the recorder
+    waits for the next poll, and appended in order.
+
+    A new file is started at every discontinuity, where timestamps and
+    codec parameters may change, and whenever the current one has reached
+    rotate_size bytes or rotate_time seconds of media. The first file is
+    output_filepath, the next ones are numbered: name.1.ts, name.2.ts, ...
+    """
+    # consecutive failed polls after which the stream is taken as over
+    POLL_RETRIES = 3
+
+    def __init__(
+        self, url, output_filepath, headers=FAKE_HEADERS, bar=None,
+        workers=HLS_WORKERS, max_bandwidth=None, rotate_size=None,
+        rotate_time=None, timeout=None, stop=None
+    ):
+        self.url = url
+        self.headers = headers
+        self.bar = bar
+        self.workers = workers
+        self.max_bandwidth = max_bandwidth
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.stop = stop or threading.Event()
+        self.fetcher = SegmentFetcher(headers, timeout=timeout)
+        self.root, self.ext = os.path.splitext(output_filepath)
+        # the files written so far
+        self.filepaths = []
+        self.filepath = None
+        self.output = None
+        self.init = None
+        self.duration = 0
+        self.segments = 0
+        self.last_sequence = None
+
+    def next_filepath(self):
+        index = 0
+        while True:
+            filepath = '{}{}{}'.format(
+                self.root, '.{}'.format(index) if index else '', self.ext
+            )
+            if not (
+                os.path.exists(filepath) or
+                os.path.exists(filepath + '.download')
+            ):
+                return filepath
+            index += 1
+
+    def open(self):
+        self.filepath = self.next_filepath()
+        logging.debug('LiveRecorder: writing {}'.format(self.filepath))
+        self.output = open(self.filepath + '.download', 'wb')
+        self.init = None
+        self.duration = 0
+
+    def close(self):
+        if self.output is None:
+            return
+        self.output.close()
+        self.output = None
+        common.replace_file(self.filepath + '.download', self.filepath)
+        self.filepaths.append(self.filepath)
+
+    def is_full(self):
+        if self.rotate_size and self.output.tell() >= self.rotate_size:
+            return True
+        return bool(self.rotate_time and self.duration >= self.rotate_time)
+
+    def write(self, segment, data):
+        if self.output is not None and (
+            segment.discontinuity or self.is_full()
+        ):
+            self.close()
+        if self.output is None:
+            self.open()
+        if segment.init is not None and segment.init != self.init:
+            self.init = segment.init
+            self.output.write(self.fetcher.init(segment))
+        self.output.write(data)
+        self.output.flush()
+        self.duration += segment.duration
+        self.segments += 1
+        if self.bar:
+            self.bar.update_piece(self.segments)
+            self.bar.update_received(len(data))
+
+    def new_segments(self, playlist):
+        """Returns the segments of playlist that were not seen before."""
+        segments = playlist.segments
+        if self.last_sequence is not None and segments:
+            if segments[-1].sequence < self.last_sequence:
+                logging.debug('LiveRecorder: media sequence started over')
+                segments[0].discontinuity = True
+            else:
+                segments = [
+                    s for s in segments if s.sequence > self.last_sequence
+                ]
+                if segments and segments[0].sequence > self.last_sequence + 1:
+                    log.w('{} segments were gone before being fetched'.format(
+                        segments[0].sequence - self.last_sequence - 1
+                    ))
+                    segments[0].discontinuity = True
+        if segments:
+            self.last_sequence = segments[-1].sequence
+        return segments
+
+    def flush(self, pending, deadline=None):
+        """Writes the fetched segments at the head of pending, waiting for
+        them until deadline (for ever if it is None).
+        """
+        while pending:
+            segment, future = pending[0]
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            try:
+                data = future.result(timeout)
+            except FuturesTimeoutError:
+                return
+            except Exception as e:
+                log.w('Segment {} skipped: {}'.format(segment.sequence, e))
+                data = None
+            pending.popleft()
+            if data is not None:
+                self.write(segment, data)
+
+    def poll(self, url):
+        failures = 0
+        while True:
+            try:
+                return parse_m3u8(
+                    common.get_content(url, headers=self.headers), url
+                )
+            except Exception as e:
+                failures += 1
+                if failures >= self.POLL_RETRIES:
+                    raise
+                logging.debug('LiveRecorder: poll failed: {}'.format(e))
+                if self.stop.wait(1):
+                    return None
+
+    def run(self, playlist=None):
+        """Records until the playlist ends, stop is set or the user
+        interrupts, and returns the files written.
+        """
+        if playlist is None:
+            playlist = load_playlist(
+                self.url, self.headers, self.max_bandwidth
+            )
+        # load_playlist may have followed a master playlist
+        media_url = playlist.url
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while playlist is not None:
+                segments = self.new_segments(playlist)
+                for segment in segments:
+                    pending.append(
+                        (segment, executor.submit(self.fetcher, segment))
+                    )
+                if playlist.endlist:
+                    break
+                interval = playlist.target_duration or 10
+                if not segments:
+                    interval /= 2
+                deadline = time.time() + interval
+                self.flush(pending, deadline)
+                if self.stop.wait(max(0, deadline - time.time())):
+                    break
+                playlist = self.poll(media_url)
+            self.flush(pending)
+        except KeyboardInterrupt:
+            log.w('Recording interrupted.')
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+            self.close()
+        return self.filepaths
+
+
+def record_hls(
+    url, output_filepath, headers=FAKE_HEADERS, bar=None, thread=0,
+    max_bandwidth=None, playlist=None, rotate_size=None, rotate_time=None,
+    timeout=None, stop=None
+):
+    """Records a live HLS stream, see LiveRecorder.
+
+    Returns:
+        The files written.
+    """
+    recorder = LiveRecorder(
+        url, output_filepath, headers, bar=bar, workers=thread or HLS_WORKERS,
+        max_bandwidth=max_bandwidth, rotate_size=rotate_size,
+        rotate_time=rotate_time, timeout=timeout, stop=stop
+    )
+    return recorder.run(playlist)
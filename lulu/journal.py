@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""The resume journal of a download: a JSON sidecar next to its output,
+output + '.journal', kept until the parts are downloaded and merged.
+
+It records what the parts are (the extractor and the stream they come from)
+and, for each part, its final size, its ETag and Last-Modified, how many
+bytes of it are safely on disk with their CRC-32, and whether it is done.
+The part being written is synced to disk before the journal records its
+progress, and the journal is replaced atomically, so that after a crash
+the journal never claims more than what is on disk.
+
+A rerun extracts again (signed URLs expire), and then:
+
+- skips the parts that are done without a request;
+- resumes a part from the bytes the journal vouches for, once their CRC
+  matches, unless the server now has another file (another size, ETag or
+  Last-Modified), in which case the part starts over;
+- never takes a half-merged output for a complete one.
+"""
+
+import os
+import json
+import zlib
+import logging
+import threading
+
+
+JOURNAL_VERSION = 1
+# bytes written to a part between two records of its progress
+CHECKPOINT_INTERVAL = 16 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+PENDING = 'pending'
+PARTIAL = 'partial'
+DONE = 'done'
+# left by a journal of another stream: nothing on disk can be trusted
+STALE = 'stale'
+
+
+def journal_path(output_filepath):
+    return output_filepath + '.journal'
+
+
+def exists(output_filepath):
+    return os.path.exists(journal_path(output_filepath))
+
+
+def fsync_dir(path):
+    # makes a rename in path durable; directories cannot be opened on
+    # Windows, where there is nothing to do
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path))
+
+
+def file_checksum(path, size):
+    """CRC-32 of the first size bytes of path.
+    """
+    checksum = 0
+    with open(path, 'rb') as f:
+        while size > 0:
+            data = f.read(min(READ_SIZE, size))
+            if not data:
+                break
+            checksum = zlib.crc32(data, checksum)
+            size -= len(data)
+    return checksum
+
+
+class Part:
+    """The journal entry of one part.
+    """
+    def __init__(self, journal, state=PENDING, size=None, received=0,
+                 checksum=0, etag=None, last_modified=None):
+        self.journal = journal
+        self.state = state
+        self.size = size
+        self.received = received
+        self.checksum = checksum
+        self.etag = etag
+        self.last_modified = last_modified
+        self.unsaved = 0
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'size': self.size,
+            'received': self.received,
+            'checksum': self.checksum,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+        }
+
+    def is_done(self, filepath):
+        """Whether the part is in filepath already, as the journal has it.
+        """
+        return self.state == DONE and os.path.isfile(filepath) and \
+            os.path.getsize(filepath) == self.size
+
+    def resume(self, temp_filepath):
+        """Where to resume the part from, in temp_filepath: what the journal
+        vouches for, cut down to that, or what a download from before the
+        journals left. 0 to start over.
+        """
+        size = os.path.getsize(temp_filepath)
+        if self.state == PENDING:
+            self.received = size
+            self.checksum = file_checksum(temp_filepath, size)
+        elif self.state == PARTIAL and self.checksum is not None and \
+                size >= self.received and \
+                file_checksum(temp_filepath, self.received) == self.checksum:
+            if size > self.received:
+                # written after the last record, maybe not in full
+                with open(temp_filepath, 'r+b') as f:
+                    f.truncate(self.received)
+        else:
+            logging.debug('journal: cannot resume {}'.format(temp_filepath))
+            self.reset()
+        return self.received
+
+    def matches(self, response, file_size):
+        """Whether the server still has the file the part was taken from.
+        """
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        return not (
+            self.size is not None and file_size != float('inf') and
+            file_size != self.size or
+            self.etag and etag and etag != self.etag or
+            self.last_modified and last_modified and
+            last_modified != self.last_modified
+        )
+
+    def reset(self):
+        self.state = PENDING
+        self.received = 0
+        self.checksum = 0
+        self.unsaved = 0
+
+    def start(self, response, file_size):
+        self.state = PARTIAL
+        if file_size != float('inf'):
+            self.size = file_size
+        self.etag = response.headers.get('etag')
+        self.last_modified = response.headers.get('last-modified')
+
+    def update(self, data, output):
+        """Takes in data, just written to output; records the progress every
+        CHECKPOINT_INTERVAL bytes.
+        """
+        self.received += len(data)
+        if self.checksum is not None:
+            self.checksum = zlib.crc32(data, self.checksum)
+        self.unsaved += len(data)
+        if self.unsaved >= CHECKPOINT_INTERVAL:
+            self.checkpoint(output)
+
+    def checkpoint(self, output):
+        output.flush()
+        os.fsync(output.fileno())
+        self.unsaved = 0
+        self.journal.save()
+
+    def written_out_of_order(self):
+        # by range requests (see common.url_save_segmented), whose own
+        # state resumes them
+        self.checksum = None
+
+    def finish(self, size):
+        self.state = DONE
+        self.size = self.received = size
+        self.journal.save()
+
+
+class Journal:
+    """The journal of the download into output_filepath of count parts, of
+    the stream key (a dict: its extractor, stream id and the like).
+    """
+    def __init__(self, output_filepath, key, count, info=None):
+        self.path = journal_path(output_filepath)
+        self.key = key
+        self.info = info or {}
+        self.state = 'downloading'
+        self.parts = [Part(self) for _ in range(count)]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, output_filepath, key, count, info=None, fresh=False):
+        """The journal of output_filepath, as left by a previous run of the
+        same stream, or a new one.
+        """
+        journal = cls(output_filepath, key, count, info)
+        try:
+            with open(journal.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return journal
+        if fresh or data.get('version') != JOURNAL_VERSION or \
+                data.get('key') != key or len(data.get('parts', ())) != count:
+            logging.debug('journal: {} is of another download'.format(
+                journal.path
+            ))
+            for part in journal.parts:
+                part.state = STALE
+            return journal
+        journal.parts = [Part(journal, **part) for part in data['parts']]
+        return journal
+
+    def part(self, index):
+        return self.parts[index]
+
+    def set_state(self, state):
+        self.state = state
+        self.save()
+
+    def save(self):
+        with self._lock:
+            data = {
+                'version': JOURNAL_VERSION,
+                'key': self.key,
+                'info': self.info,
+                'state': self.state,
+                'parts': [part.to_dict() for part in self.parts],
+            }
+            write_atomic(self.path, json.dumps(data).encode('utf-8'))
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""What the external programs (FFmpeg, FFprobe, RTMPDump) can do, detected
+by running them once and remembered on disk.
+
+The cache is keyed by the resolved path of the program together with its
+mtime and size, so that a program is run again only once it has been
+replaced or upgraded. A program which is not on the PATH is never run.
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+from subprocess import DEVNULL
+
+
+# bumped whenever what is cached changes, to drop the old entries
+CACHE_VERSION = 1
+CACHE_NAME = 'capabilities.json'
+
+_lock = threading.Lock()
+# the cache as loaded from disk, once per process
+_entries = None
+
+
+def cache_dir():
+    """The directory lulu caches in: $LULU_CACHE_DIR, or the user cache
+    directory of the platform.
+    """
+    path = os.environ.get('LULU_CACHE_DIR')
+    if path:
+        return path
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.expanduser('~/.cache')
+    return os.path.join(base, 'lulu')
+
+
+def cache_path():
+    return os.path.join(cache_dir(), CACHE_NAME)
+
+
+def load_cache():
+    try:
+        with open(cache_path(), encoding='utf-8') as f:
+            cache = json.load(f)
+        if cache.get('version') == CACHE_VERSION:
+            return cache['programs']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+def save_cache(entries):
+    # written aside and renamed over, so that lulus running at once never
+    # read half a cache; a cache which cannot be written is only slower
+    path = cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(
+            prefix=CACHE_NAME, dir=os.path.dirname(path)
+        )
+        with open(fd, 'w', encoding='utf-8') as f:
+            json.dump({'version': CACHE_VERSION, 'programs': entries}, f)
+        os.replace(temp, path)
+    except OSError:
+        pass
+
+
+def resolve(cmd):
+    """The real path of the program cmd, or None if it is not found.
+    """
+    path = shutil.which(cmd)
+    return os.path.realpath(path) if path else None
+
+
+def probe(cmd, detect):
+    """Capabilities of the program cmd, as detect(path) finds them, from the
+    cache if the program has not changed since.
+
+    Returns:
+        What detect returned, None for a program which is not usable.
+    """
+    global _entries
+    path = resolve(cmd)
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = '{}:{}'.format(detect.__name__, path)
+    stamp = [stat.st_mtime, stat.st_size]
+    with _lock:
+        if _entries is None:
+            _entries = load_cache()
+        entry = _entries.get(key)
+        if entry and entry['stamp'] == stamp:
+            return entry['capabilities']
+        capabilities = detect(path)
+        _entries[key] = {'stamp': stamp, 'capabilities': capabilities}
+        # merged with what other lulus found meanwhile
+        entries = load_cache()
+        entries[key] = _entries[key]
+        save_cache(entries)
+    return capabilities
+
+
+def run(args):
+    """The stdout and stderr of args, as text; None if it cannot run.
+    """
+    try:
+        p = subprocess.Popen(
+            args, stdin=DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        out, err = p.communicate()
+    except OSError:
+        return None
+    return str(out, 'utf-8', 'replace'), str(err, 'utf-8', 'replace')
+
+
+def parse_version(text):
+    """[4, 4, 2] of '4.4.2-0ubuntu0.22.04.1' or 'n4.4.2'; None for nightly
+    builds ('N-86111-ga441aa90e8').
+    """
+    match = re.match(r'n?(\d+(?:\.\d+)*)', text)
+    if match is None:
+        return None
+    return [int(i) for i in match.group(1).split('.')]
+
+
+def parse_bitstream_filters(text):
+    # "Bitstream filters:" and a name on each line
+    return [
+        line.strip() for line in text.splitlines()[1:] if line.strip()
+    ]
+
+
+def parse_demuxers(text):
+    # a legend, "--", then " D  name,alias  Description", where a device is
+    # flagged with a d of its own
+    demuxers = []
+    lines = iter(text.splitlines())
+    for line in lines:
+        if line.strip() == '--':
+            break
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 2 or 'D' not in fields[0]:
+            continue
+        names = fields[2] if fields[1] == 'd' and len(fields) > 2 \
+            else fields[1]
+        demuxers.extend(names.split(','))
+    return demuxers
+
+
+def detect_ffmpeg(path):
+    """Which of FFmpeg or Libav path is, its version, bitstream filters and
+    demuxers; None if it is neither.
+    """
+    output = run([path, '-version'])
+    if output is None:
+        return None
+    fields = output[0].split('\n')[0].split()
+    if len(fields) < 3 or fields[0] not in ('ffmpeg', 'avconv'):
+        return None
+    if fields[0] == 'ffmpeg' and fields[2][0] == '0':
+        # too old
+        return None
+    lists = [run([path, option]) for option in ('-bsfs', '-demuxers')]
+    return {
+        'name': fields[0],
+        'version': parse_version(fields[2]),
+        'bitstream_filters': parse_bitstream_filters(lists[0][0])
+        if lists[0] else [],
+        'demuxers': parse_demuxers(lists[1][0]) if lists[1] else [],
+    }
+
+
+def detect_ffprobe(path):
+    output = run([path, '-version'])
+    if output is None:
+        return None
+    fields = output[0].split('\n')[0].split()
+    if len(fields) < 3:
+        return None
+    return {'name': fields[0], 'version': parse_version(fields[2])}
+
+
+def detect_rtmpdump(path):
+    # the usage, on stderr, starts with "RTMPDump v2.4"
+    output = run([path])
+    if output is None:
+        return None
+    match = re.search(r'RTMPDump v(\S+)', output[1])
+    return {'version': parse_version(match.group(1)) if match else None}
+
+
+def probe_ffmpeg(cmd):
+    return probe(cmd, detect_ffmpeg)
+
+
+def probe_ffprobe(cmd):
+    return probe(cmd, detect_ffprobe)
+
+
+def probe_rtmpdump(cmd):
+    return probe(cmd, detect_rtmpdump)
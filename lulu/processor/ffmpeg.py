@@ -1,37 +1,55 @@
 #!/usr/bin/env python
 
+import os
+import time
 import logging
-import os.path
+import threading
 import subprocess
 from subprocess import DEVNULL
+from collections import deque
+from contextlib import contextmanager
 
 from lulu.util.strings import parameterize
+from lulu.processor.mux_av import can_copy
+from lulu.processor.capabilities import probe_ffmpeg, probe_ffprobe
 
 
 def get_usable_ffmpeg(cmd):
-    try:
-        p = subprocess.Popen(
-            [cmd, '-version'], stdin=DEVNULL, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        out, err = p.communicate()
-        vers = str(out, 'utf-8').split('\n')[0].split()
-        assert (vers[0] == 'ffmpeg' and vers[2][0] > '0') or \
-            (vers[0] == 'avconv')
-        # set version to 1.0 for nightly build and print warning
-        try:
-            version = [int(i) for i in vers[2].split('.')]
-        except Exception:
-            print('It seems that your ffmpeg is a nightly build.')
-            print('Please switch to the latest stable if merging failed.')
-            version = [1, 0]
-        return cmd, 'ffprobe', version
-    except Exception:
+    capabilities = probe_ffmpeg(cmd)
+    if capabilities is None:
         return None
+    version = capabilities['version']
+    # set version to 1.0 for nightly build and print warning
+    if version is None:
+        print('It seems that your ffmpeg is a nightly build.')
+        print('Please switch to the latest stable if merging failed.')
+        version = [1, 0]
+    return cmd, 'ffprobe' if probe_ffprobe('ffprobe') else None, version
+
 
+# found on first use (see detect()), once per binary, then read from the
+# cache; a value set before that is kept
+_UNDETECTED = object()
+FFMPEG = FFPROBE = FFMPEG_VERSION = _UNDETECTED
+_detect_lock = threading.Lock()
 
-FFMPEG, FFPROBE, FFMPEG_VERSION = get_usable_ffmpeg('ffmpeg') or \
-    get_usable_ffmpeg('avconv') or (None, None, None)
+
+def detect():
+    """Sets FFMPEG, FFPROBE and FFMPEG_VERSION, those not set yet, from the
+    FFmpeg (or else Libav's avconv) and FFprobe installed, None without.
+    """
+    global FFMPEG, FFPROBE, FFMPEG_VERSION
+    with _detect_lock:
+        if _UNDETECTED not in (FFMPEG, FFPROBE, FFMPEG_VERSION):
+            return
+        found = get_usable_ffmpeg('ffmpeg') or \
+            get_usable_ffmpeg('avconv') or (None, None, None)
+        if FFMPEG is _UNDETECTED:
+            FFMPEG = found[0]
+        if FFPROBE is _UNDETECTED:
+            FFPROBE = found[1]
+        if FFMPEG_VERSION is _UNDETECTED:
+            FFMPEG_VERSION = found[2]
 
 if logging.getLogger().isEnabledFor(logging.DEBUG):
     LOGLEVEL = ['-loglevel', 'info']
@@ -42,9 +60,301 @@ else:
 
 
 def has_ffmpeg_installed():
+    detect()
     return FFMPEG is not None
 
 
+def get_capabilities():
+    """What the FFmpeg in use can do (see capabilities.detect_ffmpeg), None
+    without one.
+    """
+    detect()
+    return probe_ffmpeg(FFMPEG) if FFMPEG else None
+
+
+def has_bitstream_filter(name):
+    capabilities = get_capabilities()
+    return capabilities is not None and \
+        name in capabilities['bitstream_filters']
+
+
+def has_demuxer(name):
+    capabilities = get_capabilities()
+    return capabilities is not None and name in capabilities['demuxers']
+
+
+def has_concat_demuxer():
+    detect()
+    if FFMPEG != 'ffmpeg':
+        return False
+    if get_capabilities()['demuxers']:
+        return has_demuxer('concat')
+    # not listed: FFmpeg >= 1.1
+    return FFMPEG_VERSION >= [1, 1]
+
+
+##################################################
+# runner
+##################################################
+
+# FFmpeg processes running at once at most, by default one per CPU: merges
+# which copy the streams are bound by the disk, those which encode by the
+# CPUs
+MAX_PROCESSES = os.cpu_count() or 1
+_slots = threading.BoundedSemaphore(MAX_PROCESSES)
+# the last jobs run, for their timings
+runs = deque(maxlen=64)
+
+
+def set_max_processes(n):
+    """Sets how many FFmpeg processes may run at once. Processes already
+    running count against the limit they were started under.
+    """
+    global MAX_PROCESSES, _slots
+    MAX_PROCESSES = max(1, n)
+    _slots = threading.BoundedSemaphore(MAX_PROCESSES)
+
+
+def parse_number(value, unit=''):
+    # None for N/A and the like
+    value = value.strip()
+    if unit and value.endswith(unit):
+        value = value[:-len(unit)]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class FFmpegProgress:
+    """The progress FFmpeg reports with -progress, a block of key=value lines
+    at a time: the time of the output written so far (seconds), its size
+    (bytes), its bitrate (kbit/s) and the speed (times real time), each None
+    until reported.
+
+    percent is known when the duration (seconds) or the size (bytes) the
+    output is expected to have is.
+    """
+    def __init__(self, duration=None, expected_size=None):
+        self.duration = duration
+        self.expected_size = expected_size
+        self.time = None
+        self.size = None
+        self.bitrate = None
+        self.speed = None
+        self.ended = False
+
+    def update(self, line):
+        """Takes a line of the report; returns True at the end of a
+        block.
+        """
+        key, _, value = line.strip().partition('=')
+        if key in ('out_time_us', 'out_time_ms'):
+            # both in microseconds
+            time = parse_number(value)
+            if time is not None:
+                self.time = time / 1000000
+        elif key == 'total_size':
+            size = parse_number(value)
+            if size is not None:
+                self.size = int(size)
+        elif key == 'bitrate':
+            self.bitrate = parse_number(value, 'kbits/s')
+        elif key == 'speed':
+            self.speed = parse_number(value, 'x')
+        elif key == 'progress':
+            self.ended = value.strip() == 'end'
+            return True
+        return False
+
+    @property
+    def percent(self):
+        if self.ended:
+            return 100.0
+        if self.duration and self.time is not None:
+            return min(100.0, self.time * 100 / self.duration)
+        if self.expected_size and self.size is not None:
+            return min(100.0, self.size * 100 / self.expected_size)
+        return None
+
+
+def wait_process(process):
+    """Waits for process to exit.
+
+    Returns:
+        (returncode, cpu_time): the user and system time of the process,
+        None where os.wait4 is missing.
+    """
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # reaped already
+        return process.wait(), None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+
+class FFmpegJob:
+    """An FFmpeg process (or ffprobe, of program), of the arguments args,
+    run under the limit of MAX_PROCESSES processes at once, unless not
+    limited: recordings and pipes, which run for as long as their input
+    lasts, would hold a slot for that long.
+
+    FFmpeg reports its progress on its stdout, which is read into
+    self.progress as it goes and handed to the callback progress after each
+    block. Once the process has exited, returncode, wall_time and cpu_time
+    are set, and the job is logged and kept in runs. With capture, the
+    output of the program is kept in output instead.
+
+    As a context manager, it is started on entering, and always waited for
+    on leaving, which gives its slot back: its piped stdin is closed first,
+    and the process is killed if an exception leaves the block.
+    """
+    def __init__(self, args, program=None, progress=None, duration=None,
+                 expected_size=None, stdin=None, capture=False,
+                 limited=True):
+        detect()
+        self.program = program or FFMPEG
+        self.args = args
+        self.callback = progress
+        self.progress = FFmpegProgress(duration, expected_size)
+        self.stdin_source = STDIN if stdin is None else stdin
+        self.capture = capture
+        self.limited = limited
+        # Libav and ffprobe do not report their progress
+        self.reports_progress = not capture and self.program == FFMPEG and \
+            not os.path.basename(FFMPEG).startswith('avconv')
+        self.process = None
+        self.reader = None
+        self.slots = None
+        self.output = None
+        self.returncode = None
+        self.wall_time = None
+        self.cpu_time = None
+
+    def command(self):
+        params = [self.program]
+        if self.reports_progress:
+            params += ['-progress', 'pipe:1']
+            if self.callback:
+                params.append('-nostats')
+        return params + self.args
+
+    @property
+    def stdin(self):
+        return self.process.stdin
+
+    def start(self):
+        if self.limited:
+            self.slots = _slots
+            self.slots.acquire()
+        self.start_time = time.perf_counter()
+        try:
+            self.process = subprocess.Popen(
+                self.command(), stdin=self.stdin_source,
+                stdout=subprocess.PIPE if self.capture or
+                self.reports_progress else None,
+                stderr=subprocess.STDOUT if self.capture else None
+            )
+        except Exception:
+            self.release()
+            raise
+        if self.reports_progress:
+            self.reader = threading.Thread(target=self.read_progress)
+            self.reader.daemon = True
+            self.reader.start()
+        return self
+
+    def read_progress(self):
+        for line in self.process.stdout:
+            if self.progress.update(line.decode('utf-8', 'replace')) and \
+                    self.callback:
+                self.callback(self.progress)
+
+    def release(self):
+        if self.slots:
+            self.slots.release()
+            self.slots = None
+
+    def wait(self):
+        """Waits for the process to exit, and returns its return code."""
+        if self.returncode is not None:
+            return self.returncode
+        if self.capture:
+            self.output = self.process.stdout.read()
+        self.returncode, self.cpu_time = wait_process(self.process)
+        self.wall_time = time.perf_counter() - self.start_time
+        self.release()
+        if self.reader:
+            self.reader.join()
+        if self.process.stdout:
+            self.process.stdout.close()
+        runs.append(self)
+        logging.debug('{}: exit {} after {:.2f}s, {} of CPU time'.format(
+            os.path.basename(self.program), self.returncode, self.wall_time,
+            'unknown' if self.cpu_time is None else
+            '{:.2f}s'.format(self.cpu_time)
+        ))
+        return self.returncode
+
+    def kill(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+
+    def __enter__(self):
+        return self if self.process else self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.kill()
+        if self.stdin_source == subprocess.PIPE:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                # FFmpeg gave up reading already
+                pass
+        self.wait()
+
+    def check(self):
+        """Waits for the process to exit.
+
+        Raises:
+            subprocess.CalledProcessError: it failed.
+        """
+        if self.wait() != 0:
+            raise subprocess.CalledProcessError(
+                self.returncode, self.command()
+            )
+
+
+def run_ffmpeg(args, check=False, **kwargs):
+    """Runs an FFmpegJob of args (and kwargs) to its end, and returns it.
+
+    Raises:
+        subprocess.CalledProcessError: it failed, if check.
+    """
+    job = FFmpegJob(args, **kwargs).start()
+    if check:
+        job.check()
+    else:
+        job.wait()
+    return job
+
+
+def files_size(files):
+    return sum(os.path.getsize(x) for x in files if os.path.isfile(x))
+
+
+##################################################
+# helpers
+##################################################
+
+
 # Given a list of segments and the output path, generates the concat
 # list and returns the path to the concat list.
 def generate_concat_list(files, output):
@@ -58,77 +368,97 @@ def generate_concat_list(files, output):
     return concat_list_path
 
 
-def ffmpeg_concat_av(files, output, ext):
+@contextmanager
+def temporary_files(*paths):
+    """Removes the files of paths, those that exist, on exit: the concat
+    lists and intermediate files of the helpers, whether FFmpeg succeeded
+    or not.
+    """
+    try:
+        yield paths
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def concat_with_demuxer(files, output, codec_params, progress=None):
+    # the concat demuxer, FFmpeg >= 1.1
+    with temporary_files(generate_concat_list(files, output)) as (
+        concat_list,
+    ):
+        run_ffmpeg(
+            LOGLEVEL + [
+                '-y', '-f', 'concat', '-safe', '-1', '-i', concat_list
+            ] + codec_params + [output],
+            check=True, progress=progress, expected_size=files_size(files)
+        )
+
+
+def ffmpeg_concat_av(files, output, ext, progress=None):
+    """Muxes the video and audio files into output.
+
+    Returns:
+        The FFmpegJob, ended: its returncode and its cpu_time.
+    """
     print('Merging video parts... ', end="", flush=True)
-    params = [FFMPEG] + LOGLEVEL
+    params = list(LOGLEVEL)
     for file in files:
         if os.path.isfile(file):
             params.extend(['-i', file])
-    params.extend(['-c:v', 'copy'])
-    if ext == 'mp4':
-        params.extend(['-c:a', 'aac'])
-    elif ext == 'webm':
-        params.extend(['-c:a', 'vorbis'])
-    params.extend(['-strict', 'experimental'])
+    if can_copy(files, ext):
+        # the streams go in the output as they are
+        params.extend(['-c', 'copy'])
+    else:
+        params.extend(['-c:v', 'copy'])
+        if ext == 'mp4':
+            params.extend(['-c:a', 'aac'])
+        elif ext == 'webm':
+            params.extend(['-c:a', 'vorbis'])
+        params.extend(['-strict', 'experimental'])
     params.append(output)
-    return subprocess.call(params, stdin=STDIN)
+    return run_ffmpeg(
+        params, progress=progress, expected_size=files_size(files)
+    )
 
 
 def ffmpeg_convert_ts_to_mkv(files, output='output.mkv'):
     for file in files:
         if os.path.isfile(file):
-            params = [FFMPEG] + LOGLEVEL
-            params.extend(['-y', '-i', file, output])
-            subprocess.call(params, stdin=STDIN)
+            run_ffmpeg(LOGLEVEL + ['-y', '-i', file, output])
     return
 
 
 def ffmpeg_concat_mp4_to_mpg(files, output='output.mpg'):
-    # Use concat demuxer on FFmpeg >= 1.1
-    if FFMPEG == 'ffmpeg' and (
-        FFMPEG_VERSION[0] >= 2 or (
-            FFMPEG_VERSION[0] == 1 and FFMPEG_VERSION[1] >= 1
-        )
-    ):
-        concat_list = generate_concat_list(files, output)
-        params = [FFMPEG] + LOGLEVEL + [
-            '-y', '-f', 'concat', '-safe', '-1', '-i', concat_list, '-c',
-            'copy', output
-        ]
-        if subprocess.call(params, stdin=STDIN) == 0:
-            os.remove(output + '.txt')
-            return True
-        else:
-            raise
-
-    for file in files:
-        if os.path.isfile(file):
-            params = [FFMPEG] + LOGLEVEL + ['-y', '-i']
-            params.extend([file, file + '.mpg'])
-            subprocess.call(params, stdin=STDIN)
-
-    inputs = [open(file + '.mpg', 'rb') for file in files]
-    with open(output + '.mpg', 'wb') as o:
-        for input in inputs:
-            o.write(input.read())
-
-    params = [FFMPEG] + LOGLEVEL + ['-y', '-i']
-    params.append(output + '.mpg')
-    params += ['-vcodec', 'copy', '-acodec', 'copy']
-    params.append(output)
+    if has_concat_demuxer():
+        concat_with_demuxer(files, output, ['-c', 'copy'])
+        return True
 
-    if subprocess.call(params, stdin=STDIN) == 0:
+    with temporary_files(
+        *[file + '.mpg' for file in files] + [output + '.mpg']
+    ):
         for file in files:
-            os.remove(file + '.mpg')
-        os.remove(output + '.mpg')
-        return True
-    else:
-        raise
+            if os.path.isfile(file):
+                run_ffmpeg(LOGLEVEL + ['-y', '-i', file, file + '.mpg'])
+
+        with open(output + '.mpg', 'wb') as o:
+            for file in files:
+                with open(file + '.mpg', 'rb') as input:
+                    o.write(input.read())
+
+        run_ffmpeg(
+            LOGLEVEL + [
+                '-y', '-i', output + '.mpg', '-vcodec', 'copy', '-acodec',
+                'copy', output
+            ],
+            check=True
+        )
+    return True
 
 
-def ffmpeg_concat_ts_to_mkv(files, output='output.mkv'):
+def ffmpeg_concat_ts_to_mkv(files, output='output.mkv', progress=None):
     print('Merging video parts... ', end='', flush=True)
-    params = [FFMPEG] + LOGLEVEL + ['-isync', '-y', '-i']
+    params = LOGLEVEL + ['-isync', '-y', '-i']
     params.append('concat:')
     for file in files:
         if os.path.isfile(file):
@@ -136,104 +466,76 @@ def ffmpeg_concat_ts_to_mkv(files, output='output.mkv'):
     params += ['-f', 'matroska', '-c', 'copy', output]
 
     try:
-        if subprocess.call(params, stdin=STDIN) == 0:
-            return True
-        else:
-            return False
+        return run_ffmpeg(
+            params, progress=progress, expected_size=files_size(files)
+        ).returncode == 0
     except Exception:
         return False
 
 
-def ffmpeg_concat_flv_to_mp4(files, output='output.mp4'):
-    print('Merging video parts... ', end='', flush=True)
-    # Use concat demuxer on FFmpeg >= 1.1
-    if FFMPEG == 'ffmpeg' and (
-        FFMPEG_VERSION[0] >= 2 or (
-            FFMPEG_VERSION[0] == 1 and FFMPEG_VERSION[1] >= 1
-        )
-    ):
-        concat_list = generate_concat_list(files, output)
-        params = [FFMPEG] + LOGLEVEL + [
-            '-y', '-f', 'concat', '-safe', '-1', '-i', concat_list, '-c',
-            'copy', '-bsf:a', 'aac_adtstoasc', output
-        ]
-        subprocess.check_call(params, stdin=STDIN)
-        os.remove(output + '.txt')
-        return True
-
-    for file in files:
-        if os.path.isfile(file):
-            params = [FFMPEG] + LOGLEVEL + ['-y', '-i']
-            params.append(file)
-            params += [
-                '-map', '0', '-c', 'copy', '-f', 'mpegts', '-bsf:v',
-                'h264_mp4toannexb'
-            ]
-            params.append(file + '.ts')
-
-            subprocess.call(params, stdin=STDIN)
+def ffmpeg_open_concat_pipe(input_format, output_format, output):
+    """Starts an FFmpeg that remuxes, without re-encoding, what is written to
+    its stdin into output.
 
-    params = [FFMPEG] + LOGLEVEL + ['-y', '-i']
-    params.append('concat:')
-    for file in files:
-        f = file + '.ts'
-        if os.path.isfile(f):
-            params[-1] += f + '|'
-    if FFMPEG == 'avconv':
-        params += ['-c', 'copy', output]
-    else:
-        params += ['-c', 'copy', '-absf', 'aac_adtstoasc', output]
+    Returns:
+        The FFmpegJob of FFmpeg; close its stdin and wait for it.
+    """
+    params = LOGLEVEL + [
+        '-y', '-f', input_format, '-i', 'pipe:0', '-c', 'copy'
+    ]
+    if input_format == 'flv':
+        params += ['-bsf:a', 'aac_adtstoasc']
+    params += ['-f', output_format, output]
+    return FFmpegJob(params, stdin=subprocess.PIPE, limited=False).start()
+
+
+def concat_with_ts(files, output, map_params, progress=None):
+    # remuxed to MPEG-TS one at a time, and joined with the concat protocol
+    with temporary_files(*[file + '.ts' for file in files]):
+        for file in files:
+            if os.path.isfile(file):
+                run_ffmpeg(LOGLEVEL + ['-y', '-i', file] + map_params + [
+                    '-c', 'copy', '-f', 'mpegts', '-bsf:v',
+                    'h264_mp4toannexb', file + '.ts'
+                ])
 
-    if subprocess.call(params, stdin=STDIN) == 0:
+        params = LOGLEVEL + ['-y', '-i']
+        params.append('concat:')
         for file in files:
-            os.remove(file + '.ts')
-        return True
-    else:
-        raise
+            f = file + '.ts'
+            if os.path.isfile(f):
+                params[-1] += f + '|'
+        if FFMPEG == 'avconv':
+            params += ['-c', 'copy', output]
+        else:
+            params += ['-c', 'copy', '-absf', 'aac_adtstoasc', output]
+        run_ffmpeg(
+            params, check=True, progress=progress,
+            expected_size=files_size(files)
+        )
 
 
-def ffmpeg_concat_mp4_to_mp4(files, output='output.mp4'):
+def ffmpeg_concat_flv_to_mp4(files, output='output.mp4', progress=None):
     print('Merging video parts... ', end='', flush=True)
-    # Use concat demuxer on FFmpeg >= 1.1
-    if FFMPEG == 'ffmpeg' and (
-        FFMPEG_VERSION[0] >= 2 or (
-            FFMPEG_VERSION[0] == 1 and FFMPEG_VERSION[1] >= 1
+    if has_concat_demuxer():
+        concat_with_demuxer(
+            files, output, ['-c', 'copy', '-bsf:a', 'aac_adtstoasc'],
+            progress
         )
-    ):
-        concat_list = generate_concat_list(files, output)
-        params = [FFMPEG] + LOGLEVEL + [
-            '-y', '-f', 'concat', '-safe', '-1', '-i', concat_list, '-c',
-            'copy', '-bsf:a', 'aac_adtstoasc', output
-        ]
-        subprocess.check_call(params, stdin=STDIN)
-        os.remove(output + '.txt')
-        return True
-
-    for file in files:
-        if os.path.isfile(file):
-            params = [FFMPEG] + LOGLEVEL + ['-y', '-i']
-            params.append(file)
-            params += [
-                '-c', 'copy', '-f', 'mpegts', '-bsf:v', 'h264_mp4toannexb'
-            ]
-            params.append(file + '.ts')
+    else:
+        concat_with_ts(files, output, ['-map', '0'], progress)
+    return True
 
-            subprocess.call(params, stdin=STDIN)
 
-    params = [FFMPEG] + LOGLEVEL + ['-y', '-i']
-    params.append('concat:')
-    for file in files:
-        f = file + '.ts'
-        if os.path.isfile(f):
-            params[-1] += f + '|'
-    if FFMPEG == 'avconv':
-        params += ['-c', 'copy', output]
+def ffmpeg_concat_mp4_to_mp4(files, output='output.mp4', progress=None):
+    print('Merging video parts... ', end='', flush=True)
+    if has_concat_demuxer():
+        concat_with_demuxer(
+            files, output, ['-c', 'copy', '-bsf:a', 'aac_adtstoasc'],
+            progress
+        )
     else:
-        params += ['-c', 'copy', '-absf', 'aac_adtstoasc', output]
-
-    subprocess.check_call(params, stdin=STDIN)
-    for file in files:
-        os.remove(file + '.ts')
+        concat_with_ts(files, output, [], progress)
     return True
 
 
@@ -256,11 +558,12 @@ def ffmpeg_download_stream(
         'recording...'
     )
     if stream:
-        ffmpeg_params = [FFMPEG] + ['-y', '-re', '-i']
+        ffmpeg_params = ['-y', '-re', '-i']
     else:
-        ffmpeg_params = [FFMPEG] + ['-y', '-i']
+        ffmpeg_params = ['-y', '-i']
     ffmpeg_params.append(files)  # not the same here!!!!
 
+    detect()
     if FFMPEG == 'avconv':  # who cares?
         ffmpeg_params += ['-c', 'copy', output]
     elif kwargs.get('override'):
@@ -276,24 +579,30 @@ def ffmpeg_download_stream(
 
     ffmpeg_params.append(output)
 
-    print(' '.join(ffmpeg_params))
+    job = FFmpegJob(
+        ffmpeg_params, progress=kwargs.get('progress'),
+        stdin=subprocess.PIPE, limited=False
+    )
+    print(' '.join(job.command()))
 
+    job.start()
     try:
-        a = subprocess.Popen(ffmpeg_params, stdin=subprocess.PIPE)
-        a.communicate()
+        job.wait()
     except KeyboardInterrupt:
         try:
-            a.stdin.write('q'.encode('utf-8'))
+            job.stdin.write('q'.encode('utf-8'))
+            job.stdin.close()
         except Exception:
             pass
+        job.wait()
 
     return True
 
 
-def ffmpeg_concat_audio_and_video(files, output, ext):
+def ffmpeg_concat_audio_and_video(files, output, ext, progress=None):
     print('Merging video and audio parts... ', end='', flush=True)
-    if has_ffmpeg_installed:
-        params = [FFMPEG] + LOGLEVEL
+    if has_ffmpeg_installed():
+        params = list(LOGLEVEL)
         params.extend(['-f', 'concat'])
         params.extend(['-safe', '0'])
         for file in files:
@@ -303,18 +612,21 @@ def ffmpeg_concat_audio_and_video(files, output, ext):
         params.extend(['-c:a', 'aac'])
         params.extend(['-strict', 'experimental'])
         params.append('{}.{}'.format(output, ext))
-        return subprocess.call(params, stdin=STDIN)
+        return run_ffmpeg(params, progress=progress).returncode
     else:
         raise EnvironmentError('No ffmpeg found')
 
 
 def ffprobe_get_media_duration(file):
+    detect()
+    if FFPROBE is None:
+        raise EnvironmentError('No ffprobe found')
     print('Getting {} duration'.format(file))
-    params = [FFPROBE]
+    params = []
     params.extend(['-i', file])
     params.extend(['-show_entries', 'format=duration'])
     params.extend(['-v', 'quiet'])
     params.extend(['-of', 'csv=p=0'])
-    return subprocess.check_output(
-        params, stdin=STDIN, stderr=subprocess.STDOUT
-    ).decode().strip()
+    return run_ffmpeg(
+        params, check=True, program=FFPROBE, capture=True
+    ).output.decode().strip()
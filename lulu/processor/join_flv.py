@@ -1,9 +1,20 @@
 #!/usr/bin/env python
 
+import mmap
 import struct
 from io import BytesIO
 
+TAG_TYPE_VIDEO = 9
 TAG_TYPE_METADATA = 18
+FRAME_TYPE_KEY = 1
+
+# previous tag size, type and body size, timestamp and its extension
+TAG_HEADER = struct.Struct('>III')
+# bytes of tags put together before they are written out
+REWRITE_CHUNK_SIZE = 8 * 1024 * 1024
+# keyframes the index of the metadata has room for, when the joiner is not
+# told: one a second for an hour, 64 KB of metadata
+KEYFRAME_INDEX_SIZE = 3600
 
 ##################################################
 # AMF0
@@ -302,6 +313,255 @@ def write_meta_tag(stream, meta_type, meta_data):
     write_tag(stream, (TAG_TYPE_METADATA, 0, len(body), body, 0))
 
 
+##################################################
+# keyframe index
+##################################################
+
+
+class KeyframeIndex:
+    """The times and file positions of the keyframes of an FLV file, for
+    the keyframes object of its metadata, with room for up to size of them.
+
+    When the index is full, every other keyframe is dropped from it, and
+    from then on only every other keyframe is added; players seek from the
+    nearest keyframe before, so a sparser index only costs precision.
+    """
+    def __init__(self, size):
+        self.size = max(size, 1)
+        self.times = []
+        self.positions = []
+        self.count = 0
+        self.step = 1
+
+    def add(self, timestamp, position):
+        if self.count % self.step == 0:
+            self.times.append(timestamp / 1000)
+            self.positions.append(float(position))
+            if len(self.times) > self.size:
+                del self.times[1::2]
+                del self.positions[1::2]
+                self.step *= 2
+        self.count += 1
+
+    def keyframes(self, size=None):
+        """Returns the keyframes object, with size (all of them by default)
+        slots in each array; empty slots are zeros.
+        """
+        padding = [0.0] * ((size or len(self.times)) - len(self.times))
+        return {
+            'filepositions': self.positions + padding,
+            'times': self.times + padding,
+        }
+
+
+def meta_body(meta_type, meta_data):
+    buffer = BytesIO()
+    write_amf(buffer, meta_type)
+    write_amf(buffer, meta_data)
+    return buffer.getvalue()
+
+
+def index_size(flvs):
+    """Returns the size of a keyframe index for the FLV files flvs joined,
+    from their own indexes, or else one keyframe a second.
+    """
+    size = 0
+    for flv in flvs:
+        with open(flv, 'rb') as stream:
+            read_flv_header(stream)
+            meta_type, meta_data = read_meta_tag(read_tag(stream))
+        keyframes = meta_data.get('keyframes') \
+            if 'keyframes' in meta_data.keys() else None
+        if isinstance(keyframes, dict) and 'times' in keyframes:
+            size += len(keyframes['times'])
+        else:
+            size += int(meta_data.get('duration')) + 1
+    return size
+
+
+##################################################
+# fast path
+##################################################
+
+
+def write_chunk(view, start, end, patches, out):
+    if not patches:
+        out.write(view[start:end])
+        return
+    chunk = bytearray(view[start:end])
+    for offset, timestamp in patches:
+        chunk[offset:offset + 3] = (timestamp & 0xffffff).to_bytes(3, 'big')
+        chunk[offset + 3] = timestamp >> 24 & 0xff
+    out.write(chunk)
+
+
+def rewrite_tags(data, start, out, timestamp_start, index=None, position=0):
+    """Writes the tags of the FLV in data (a buffer, like a memory map) from
+    start on to out, timestamp_start added to their timestamps. The
+    keyframes go to index, if any, at their position in out, where data
+    from start on is written at position.
+
+    Only the tag headers, and the first byte of the video tags if there is
+    an index, are read. Runs of whole tags are copied at once, into a buffer
+    where their timestamps are patched if there is anything to add, so the
+    bodies are never looked at one by one.
+
+    Returns:
+        (timestamp, previous_tag_size) of the last tag, or None if there are
+        no tags.
+    """
+    last = None
+    end = len(data)
+    with memoryview(data) as view:
+        pos = chunk_start = start
+        patches = []
+        while end - pos > 4:
+            assert end - pos >= 15, 'truncated tag header'
+            previous_tag_size, type_size, x = TAG_HEADER.unpack_from(
+                view, pos
+            )
+            body_size = type_size & 0xffffff
+            assert body_size < 1024 * 1024 * 128, \
+                'tag body size too big (> 128MB)'
+            timestamp = (x >> 8 | (x & 0xff) << 24) + timestamp_start
+            if timestamp_start:
+                patches.append((pos + 8 - chunk_start, timestamp))
+            if index is not None and type_size >> 24 == TAG_TYPE_VIDEO and \
+                    body_size and view[pos + 15] >> 4 == FRAME_TYPE_KEY:
+                # the tag starts after the previous tag size
+                index.add(timestamp, position + pos + 4 - start)
+            last = timestamp, previous_tag_size
+            pos += 15 + body_size
+            assert pos <= end, 'truncated tag body'
+            if pos - chunk_start >= REWRITE_CHUNK_SIZE:
+                write_chunk(view, chunk_start, pos, patches, out)
+                if hasattr(data, 'madvise'):
+                    # what is written is not read again, keep memory flat
+                    page_start = chunk_start - chunk_start % mmap.PAGESIZE
+                    data.madvise(
+                        mmap.MADV_DONTNEED, page_start, pos - page_start
+                    )
+                chunk_start = pos
+                patches = []
+        write_chunk(view, chunk_start, pos, patches, out)
+    return last
+
+
+##################################################
+# streaming
+##################################################
+
+
+class FLVJoiner:
+    """Concatenates FLV files fed one at a time, from any readable stream,
+    into out, which may be a pipe.
+
+    The metadata of the first file is written as soon as it is read. When
+    out is seekable, room is left in it for a keyframe index of index_size
+    keyframes, and close() writes the total duration, the file size and the
+    index of the keyframes that went by, so that players can seek without
+    another pass over the file.
+
+    Files on disk are memory mapped and go through rewrite_tags, other
+    streams are read tag by tag.
+    """
+    def __init__(self, out, index_size=KEYFRAME_INDEX_SIZE):
+        self.out = out
+        self.meta_type = None
+        self.meta_data = None
+        self.duration = 0
+        self.index = None
+        # where the metadata tag body is in out and its size, to rewrite it
+        self.meta_offset = None
+        self.meta_size = 0
+        self.index_size = index_size
+        self.timestamp_start = 0
+        self.previous_tag_size = 0
+
+    def make_meta_data(self, filesize, keyframes):
+        meta_data = ECMAObject(0)
+        for k, v in self.meta_data:
+            if k not in ('duration', 'filesize', 'keyframes'):
+                meta_data.put(k, v)
+        meta_data.put('duration', float(self.duration))
+        meta_data.put('filesize', float(filesize))
+        meta_data.put('keyframes', keyframes)
+        meta_data.max_number = len(meta_data.data)
+        return meta_data
+
+    def write_meta_tag(self, meta_type, meta_data):
+        write_flv_header(self.out)
+        if not self.out.seekable():
+            write_meta_tag(self.out, meta_type, meta_data)
+            return
+        if isinstance(meta_data, ECMAObject):
+            self.meta_data = meta_data.data
+        else:
+            self.meta_data = list(meta_data.items())
+        self.index = KeyframeIndex(self.index_size)
+        body = meta_body(meta_type, self.make_meta_data(
+            0, self.index.keyframes(self.index_size)
+        ))
+        # previous tag size and tag header: 15 bytes
+        self.meta_offset = self.out.tell() + 15
+        self.meta_size = len(body)
+        write_tag(self.out, (TAG_TYPE_METADATA, 0, len(body), body, 0))
+
+    def add(self, stream):
+        read_flv_header(stream)
+        meta_type, meta_data = read_meta_tag(read_tag(stream))
+        if self.meta_type is None:
+            self.meta_type = meta_type
+            self.write_meta_tag(meta_type, meta_data)
+        assert meta_type == self.meta_type
+        self.duration += meta_data.get('duration')
+
+        try:
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # io.UnsupportedOperation, for in-memory and network streams
+            data = None
+        if data is not None:
+            with data:
+                last = rewrite_tags(
+                    data, stream.tell(), self.out, self.timestamp_start,
+                    self.index,
+                    self.out.tell() if self.index is not None else 0
+                )
+            if last is not None:
+                self.timestamp_start, self.previous_tag_size = last
+            return
+
+        timestamp = self.timestamp_start
+        while True:
+            tag = read_tag(stream)
+            if not tag:
+                break
+            data_type, timestamp, body_size, body, previous_tag_size = tag
+            timestamp += self.timestamp_start
+            if self.index is not None and data_type == TAG_TYPE_VIDEO and \
+                    body and body[0] >> 4 == FRAME_TYPE_KEY:
+                self.index.add(timestamp, self.out.tell() + 4)
+            write_tag(self.out, (
+                data_type, timestamp, body_size, body, previous_tag_size
+            ))
+            self.previous_tag_size = previous_tag_size
+        self.timestamp_start = timestamp
+
+    def close(self):
+        write_uint(self.out, self.previous_tag_size)
+        if self.meta_offset is not None:
+            end = self.out.tell()
+            body = meta_body(self.meta_type, self.make_meta_data(
+                end, self.index.keyframes()
+            ))
+            # the AMF values end before the body does
+            body += bytes(self.meta_size - len(body))
+            self.out.seek(self.meta_offset)
+            self.out.write(body)
+            self.out.seek(end)
+
+
 ##################################################
 # main
 ##################################################
@@ -326,37 +586,15 @@ def concat_flv(flvs, output=None):
         output = os.path.join(output, guess_output(flvs))
 
     print('Merging video parts...')
-    ins = [open(flv, 'rb') for flv in flvs]
-    for stream in ins:
-        read_flv_header(stream)
-    meta_tags = map(read_tag, ins)
-    metas = list(map(read_meta_tag, meta_tags))
-    meta_types, metas = zip(*metas)
-    assert len(set(meta_types)) == 1
-    meta_type = meta_types[0]
-
-    # must merge fields: duration
-    # TODO: check other meta info, update other meta info
-    total_duration = sum(meta.get('duration') for meta in metas)
-    meta_data = metas[0]
-    meta_data.set('duration', total_duration)
-
-    out = open(output, 'wb')
-    write_flv_header(out)
-    write_meta_tag(out, meta_type, meta_data)
-    timestamp_start = 0
-    for stream in ins:
-        while True:
-            tag = read_tag(stream)
-            if tag:
-                data_type, timestamp, body_size, body, previous_tag_size = tag
-                timestamp += timestamp_start
-                tag = data_type, timestamp, body_size, body, previous_tag_size
-                write_tag(out, tag)
-            else:
-                break
-        timestamp_start = timestamp
-    write_uint(out, previous_tag_size)
+    # duration, filesize and keyframes are those of the joined file (see
+    # FLVJoiner); the other metadata fields, such as the dimensions and data
+    # rates, are the first part's, unchecked against the other parts
+    with open(output, 'wb') as out:
+        joiner = FLVJoiner(out, index_size(flvs))
+        for flv in flvs:
+            with open(flv, 'rb') as stream:
+                joiner.add(stream)
+        joiner.close()
 
     return output
 
@@ -6,9 +6,14 @@
 # reader and writer
 ##################################################
 
+import sys
 import struct
+import logging
+from array import array
 from io import BytesIO
 
+from lulu.util.fs import copy_data, move_data
+
 def skip(stream, n):
     stream.seek(stream.tell() + n)
 
@@ -37,13 +42,31 @@ def read_byte(stream):
     return ord(stream.read(1))
 
 def copy_stream(source, target, n):
-    buffer_size = 1024 * 1024
-    while n > 0:
-        to_read = min(buffer_size, n)
-        s = source.read(to_read)
-        assert len(s) == to_read, 'no enough data'
-        target.write(s)
-        n -= to_read
+    copy_data(source, target, n)
+
+# sample tables are kept as flat arrays of native uint32 (uint64 for co64),
+# entries of several fields (stts, stsc, ctts) one field after another
+assert array('I').itemsize == 4
+assert array('Q').itemsize == 8
+
+def read_uint_array(stream, n, typecode='I'):
+    values = array(typecode)
+    data = stream.read(n * values.itemsize)
+    assert len(data) == n * values.itemsize
+    values.frombytes(data)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+def write_uint_array(stream, values):
+    if sys.byteorder == 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    stream.write(values.tobytes())
+
+def shift_uint_array(values, n, typecode=None):
+    # one pass in C, no list of ints in between
+    return array(typecode or values.typecode, map(n.__add__, values))
 
 class Atom:
     def __init__(self, type, size, body):
@@ -131,9 +154,10 @@ class VariableAtom(Atom):
             raise Exception('field not found: '+k)
 
 def read_raw(stream, size, left, type):
-    assert size == left + 8
     body = stream.read(left)
-    return Atom(type, size, body)
+    assert len(body) == left
+    # written back with a 32-bit size
+    return Atom(type, left + 8, body)
 
 def read_udta(stream, size, left, type):
     assert size == left + 8
@@ -165,15 +189,25 @@ def read_full_atom2(stream):
 
 def read_mvhd(stream, size, left, type):
     body, stream = read_body_stream(stream, left)
-    value = read_full_atom(stream)
+    ver, value = read_full_atom2(stream)
     left -= 4
     
     # new Date(movieTime * 1000 - 2082850791998L); 
-    creation_time = read_uint(stream)
-    modification_time = read_uint(stream)
-    time_scale = read_uint(stream)
-    duration = read_uint(stream)
-    left -= 16
+    if ver == 1:
+        creation_time = read_ulong(stream)
+        modification_time = read_ulong(stream)
+        time_scale = read_uint(stream)
+        duration = read_ulong(stream)
+        var = [('time_scale', 20, time_scale, 4), ('duration', 24, duration, 8)]
+        left -= 28
+    else:
+        assert ver == 0, "ver=%d" % ver
+        creation_time = read_uint(stream)
+        modification_time = read_uint(stream)
+        time_scale = read_uint(stream)
+        duration = read_uint(stream)
+        var = [('time_scale', 12, time_scale, 4), ('duration', 16, duration, 4)]
+        left -= 16
     
     qt_preferred_fate = read_uint(stream)
     qt_preferred_volume = read_ushort(stream)
@@ -194,22 +228,34 @@ def read_mvhd(stream, size, left, type):
     qt_selectionDuration = read_uint(stream)
     qt_currentTime = read_uint(stream)
     nextTrackID = read_uint(stream)
+    var.append(('next_track_id', len(body) - 4, nextTrackID, 4))
     left -= 80
     assert left == 0
-    return VariableAtom(b'mvhd', size, body, [('duration', 16, duration, 4)])
+    return VariableAtom(b'mvhd', size, body, var)
 
 def read_tkhd(stream, size, left, type):
     body, stream = read_body_stream(stream, left)
-    value = read_full_atom(stream)
+    ver, value = read_full_atom2(stream)
     left -= 4
     
     # new Date(movieTime * 1000 - 2082850791998L); 
-    creation_time = read_uint(stream)
-    modification_time = read_uint(stream)
-    track_id = read_uint(stream)
-    assert stream.read(4) == b'\x00' * 4
-    duration = read_uint(stream)
-    left -= 20
+    if ver == 1:
+        creation_time = read_ulong(stream)
+        modification_time = read_ulong(stream)
+        track_id = read_uint(stream)
+        assert stream.read(4) == b'\x00' * 4
+        duration = read_ulong(stream)
+        var = [('track_id', 20, track_id, 4), ('duration', 28, duration, 8)]
+        left -= 32
+    else:
+        assert ver == 0, "ver=%d" % ver
+        creation_time = read_uint(stream)
+        modification_time = read_uint(stream)
+        track_id = read_uint(stream)
+        assert stream.read(4) == b'\x00' * 4
+        duration = read_uint(stream)
+        var = [('track_id', 12, track_id, 4), ('duration', 20, duration, 4)]
+        left -= 20
     
     assert stream.read(8) == b'\x00' * 8
     qt_layer = read_ushort(stream)
@@ -231,7 +277,7 @@ def read_tkhd(stream, size, left, type):
     height = qt_track_height >> 16
     left -= 60
     assert left == 0
-    return VariableAtom(b'tkhd', size, body, [('duration', 20, duration, 4)])
+    return VariableAtom(b'tkhd', size, body, var)
 
 def read_mdhd(stream, size, left, type):
     body, stream = read_body_stream(stream, left)
@@ -243,7 +289,7 @@ def read_mdhd(stream, size, left, type):
         modification_time = read_ulong(stream)
         time_scale = read_uint(stream)
         duration = read_ulong(stream)
-        var = [('duration', 24, duration, 8)]
+        var = [('time_scale', 20, time_scale, 4), ('duration', 24, duration, 8)]
         left -= 28
     else: 
         assert ver == 0, "ver=%d" % ver
@@ -251,7 +297,7 @@ def read_mdhd(stream, size, left, type):
         modification_time = read_uint(stream)
         time_scale = read_uint(stream)
         duration = read_uint(stream)
-        var = [('duration', 16, duration, 4)]
+        var = [('time_scale', 12, time_scale, 4), ('duration', 16, duration, 4)]
         left -= 16
     
     packed_language = read_ushort(stream)
@@ -352,107 +398,48 @@ def read_avcC(stream, size, left, type):
     stream.read(left)
     return Atom(b'avcC', size, None)
 
-def read_stts(stream, size, left, type):
-    value = read_full_atom(stream)
+def read_table(stream, size, left, type, fields):
+    ver, value = read_full_atom2(stream)
+    assert ver == 0 or type == b'ctts' and ver == 1, "ver=%d" % ver
     left -= 4
     
     entry_count = read_uint(stream)
-    #assert entry_count == 1
     left -= 4
     
-    samples = []
-    for i in range(entry_count):
-        sample_count = read_uint(stream)
-        sample_duration = read_uint(stream)
-        samples.append((sample_count, sample_duration))
-        left -= 8
-
+    typecode = table_atom.typecodes.get(type, 'I')
+    entries = read_uint_array(stream, entry_count * fields, typecode)
+    left -= len(entries) * entries.itemsize
+    
     assert left == 0
-    #return Atom('stts', size, None)
-    class stts_atom(Atom):
-        def __init__(self, type, size, body):
-            Atom.__init__(self, type, size, body)
-        def write(self, stream):
-            self.write1(stream)
-            write_uint(stream, self.body[0])
-            write_uint(stream, len(self.body[1]))
-            for sample_count, sample_duration in self.body[1]:
-                write_uint(stream, sample_count)
-                write_uint(stream, sample_duration)
-        def calsize(self):
-            #oldsize = self.size # TODO: remove
-            self.size = 8 + 4 + 4 + len(self.body[1]) * 8
-            #assert oldsize == self.size, '%s: %d, %d' % (self.type, oldsize, self.size) # TODO: remove
-            return self.size
-    return stts_atom(b'stts', size, (value, samples))
+    return table_atom(type, size, (value, entries))
+
+class table_atom(Atom):
+    # full atom of entry_count followed by the entries (value, entries)
+    fields = {b'stts': 2, b'stss': 1, b'stsc': 3, b'stco': 1, b'co64': 1, b'ctts': 2}
+    typecodes = {b'co64': 'Q'}
+    def __init__(self, type, size, body):
+        Atom.__init__(self, type, size, body)
+    def write(self, stream):
+        assert self.body[1].typecode == self.typecodes.get(self.type, 'I')
+        self.write1(stream)
+        write_uint(stream, self.body[0])
+        write_uint(stream, len(self.body[1]) // self.fields[self.type])
+        write_uint_array(stream, self.body[1])
+    def calsize(self):
+        self.size = 8 + 4 + 4 + len(self.body[1]) * self.body[1].itemsize
+        return self.size
+
+def read_stts(stream, size, left, type):
+    # sample_count, sample_duration
+    return read_table(stream, size, left, type, 2)
 
 def read_stss(stream, size, left, type):
-    value = read_full_atom(stream)
-    left -= 4
-    
-    entry_count = read_uint(stream)
-    left -= 4
-    
-    samples = []
-    for i in range(entry_count):
-            sample = read_uint(stream)
-            samples.append(sample)
-            left -= 4
-    
-    assert left == 0
-    #return Atom('stss', size, None)
-    class stss_atom(Atom):
-        def __init__(self, type, size, body):
-            Atom.__init__(self, type, size, body)
-        def write(self, stream):
-            self.write1(stream)
-            write_uint(stream, self.body[0])
-            write_uint(stream, len(self.body[1]))
-            for sample in self.body[1]:
-                write_uint(stream, sample)
-        def calsize(self):
-            self.size = 8 + 4 + 4 + len(self.body[1]) * 4
-            return self.size
-    return stss_atom(b'stss', size, (value, samples))
+    # sample_number
+    return read_table(stream, size, left, type, 1)
 
 def read_stsc(stream, size, left, type):
-    value = read_full_atom(stream)
-    left -= 4
-    
-    entry_count = read_uint(stream)
-    left -= 4
-    
-    chunks = []
-    for i in range(entry_count):
-        first_chunk = read_uint(stream)
-        samples_per_chunk = read_uint(stream)
-        sample_description_index = read_uint(stream)
-        assert sample_description_index == 1 # what is it?
-        chunks.append((first_chunk, samples_per_chunk, sample_description_index))
-        left -= 12
-    #chunks, samples = zip(*chunks)
-    #total = 0
-    #for c, s in zip(chunks[1:], samples):
-    #	total += c*s
-    #print 'total', total
-    
-    assert left == 0
-    #return Atom('stsc', size, None)
-    class stsc_atom(Atom):
-        def __init__(self, type, size, body):
-            Atom.__init__(self, type, size, body)
-        def write(self, stream):
-            self.write1(stream)
-            write_uint(stream, self.body[0])
-            write_uint(stream, len(self.body[1]))
-            for first_chunk, samples_per_chunk, sample_description_index in self.body[1]:
-                write_uint(stream, first_chunk)
-                write_uint(stream, samples_per_chunk)
-                write_uint(stream, sample_description_index)
-        def calsize(self):
-            self.size = 8 + 4 + 4 + len(self.body[1]) * 12
-            return self.size
-    return stsc_atom(b'stsc', size, (value, chunks))
+    # first_chunk, samples_per_chunk, sample_description_index
+    return read_table(stream, size, left, type, 3)
 
 def read_stsz(stream, size, left, type):
     value = read_full_atom(stream)
@@ -462,91 +449,54 @@ def read_stsz(stream, size, left, type):
     sample_count = read_uint(stream)
     left -= 8
     
-    assert sample_size == 0
-    total = 0
-    sizes = []
-    if sample_size == 0:
-        for i in range(sample_count):
-            entry_size = read_uint(stream)
-            sizes.append(entry_size)
-            total += entry_size
-            left -= 4
+    # no table when all samples have the same size
+    sizes = read_uint_array(stream, 0 if sample_size else sample_count)
+    left -= len(sizes) * 4
     
     assert left == 0
     #return Atom('stsz', size, None)
-    class stsz_atom(Atom):
-        def __init__(self, type, size, body):
-            Atom.__init__(self, type, size, body)
-        def write(self, stream):
-            self.write1(stream)
-            write_uint(stream, self.body[0])
-            write_uint(stream, self.body[1])
-            write_uint(stream, self.body[2])
-            for entry_size in self.body[3]:
-                write_uint(stream, entry_size)
-        def calsize(self):
-            self.size = 8 + 4 + 8 + len(self.body[3]) * 4
-            return self.size
     return stsz_atom(b'stsz', size, (value, sample_size, sample_count, sizes))
 
+class stsz_atom(Atom):
+    # (value, sample_size, sample_count, sizes)
+    def __init__(self, type, size, body):
+        Atom.__init__(self, type, size, body)
+    def write(self, stream):
+        self.write1(stream)
+        write_uint(stream, self.body[0])
+        write_uint(stream, self.body[1])
+        write_uint(stream, self.body[2])
+        write_uint_array(stream, self.body[3])
+    def calsize(self):
+        self.size = 8 + 4 + 8 + len(self.body[3]) * 4
+        return self.size
+
 def read_stco(stream, size, left, type):
-    value = read_full_atom(stream)
-    left -= 4
-    
-    entry_count = read_uint(stream)
-    left -= 4
-    
-    offsets = []
-    for i in range(entry_count):
-        chunk_offset = read_uint(stream)
-        offsets.append(chunk_offset)
-        left -= 4
-    
-    assert left == 0
-    #return Atom('stco', size, None)
-    class stco_atom(Atom):
-        def __init__(self, type, size, body):
-            Atom.__init__(self, type, size, body)
-        def write(self, stream):
-            self.write1(stream)
-            write_uint(stream, self.body[0])
-            write_uint(stream, len(self.body[1]))
-            for chunk_offset in self.body[1]:
-                write_uint(stream, chunk_offset)
-        def calsize(self):
-            self.size = 8 + 4 + 4 + len(self.body[1]) * 4
-            return self.size
-    return stco_atom(b'stco', size, (value, offsets))
+    # chunk_offset
+    return read_table(stream, size, left, type, 1)
+
+def read_co64(stream, size, left, type):
+    # chunk_offset, 64-bit
+    return read_table(stream, size, left, type, 1)
 
 def read_ctts(stream, size, left, type):
-    value = read_full_atom(stream)
-    left -= 4
-    
+    # sample_count, sample_offset (signed in version 1)
+    return read_table(stream, size, left, type, 2)
+
+def read_elst(stream, size, left, type):
+    body, stream = read_body_stream(stream, left)
+    ver, value = read_full_atom2(stream)
     entry_count = read_uint(stream)
-    left -= 4
-    
-    samples = []
-    for i in range(entry_count):
-        sample_count = read_uint(stream)
-        sample_offset = read_uint(stream)
-        samples.append((sample_count, sample_offset))
-        left -= 8
-    
-    assert left == 0
-    class ctts_atom(Atom):
-        def __init__(self, type, size, body):
-            Atom.__init__(self, type, size, body)
-        def write(self, stream):
-            self.write1(stream)
-            write_uint(stream, self.body[0])
-            write_uint(stream, len(self.body[1]))
-            for sample_count, sample_offset in self.body[1]:
-                write_uint(stream, sample_count)
-                write_uint(stream, sample_offset)
-        def calsize(self):
-            self.size = 8 + 4 + 4 + len(self.body[1]) * 8
-            return self.size
-    return ctts_atom(b'ctts', size, (value, samples))
+    entry_size = 20 if ver == 1 else 12
+    assert left == 8 + entry_count * entry_size
+    var = []
+    if entry_count:
+        # the last edit plays the media to its end, it grows with the track
+        offset = 8 + (entry_count - 1) * entry_size
+        bsize = 8 if ver == 1 else 4
+        duration = struct.unpack_from('>Q' if ver == 1 else '>I', body, offset)[0]
+        var = [('duration', offset, duration, bsize)]
+    return VariableAtom(b'elst', size, body, var)
 
 def read_smhd(stream, size, left, type):
     body, stream = read_body_stream(stream, left)
@@ -638,7 +588,9 @@ atom_readers = {
     b'stsc': read_stsc, # merge # sample numbers
     b'stsz': read_stsz, # merge # samples
     b'stco': read_stco, # merge # chunk offsets
+    b'co64': read_co64, # merge # chunk offsets
     b'ctts': read_ctts, # merge
+    b'elst': read_elst, # merge duration
     b'smhd': read_smhd, # nothing
     b'mp4a': read_mp4a, # nothing
     b'esds': read_esds, # noting
@@ -654,7 +606,7 @@ atom_readers = {
     b'iods': read_raw,
     b'dref': read_raw,
     b'free': read_raw,
-    b'edts': read_raw,
+    b'edts': read_composite_atom,
     b'pasp': read_raw,
 
     b'mdat': read_mdat,
@@ -685,19 +637,23 @@ def read_atom(stream):
     assert len(header) == 8
     n = 0
     size = struct.unpack('>I', header[:4])[0]
-    assert size > 0
     n += 4
     type = header[4:8]
     n += 4
-    assert type != b'uuid'
     if size == 1:
         size = read_ulong(stream)
         n += 8
+    elif size == 0:
+        # the last atom of the file, up to its end
+        start = stream.tell()
+        size = stream.seek(0, 2) - start + n
+        stream.seek(start)
     
     left = size - n
     if type in atom_readers:
         return atom_readers[type](stream, size, left, type)
-    raise NotImplementedError('%s: %d' % (type, left))
+    # anything else (uuid, sgpd, sbgp, meta...) goes through untouched
+    return read_raw(stream, size, left, type)
 
 def write_atom(stream, atom):
     atom.write(stream)
@@ -713,179 +669,265 @@ def parse_atoms(stream):
     return atoms
 
 def read_mp4(stream):
-    print(stream.name)
+    logging.debug('reading {}'.format(stream.name))
     atoms = parse_atoms(stream)
     moov = list(filter(lambda x: x.type == b'moov', atoms))
-    mdat = list(filter(lambda x: x.type == b'mdat', atoms))
-    assert len(moov) == 1
-    assert len(mdat) == 1
+    mdats = list(filter(lambda x: x.type == b'mdat', atoms))
+    if len(moov) != 1 or not mdats:
+        raise ValueError('%s: not an MP4 file (%d moov, %d mdat)' % (stream.name, len(moov), len(mdats)))
     moov = moov[0]
-    mdat = mdat[0]
-    return atoms, moov, mdat
+    if moov.get_all(b'mvex'):
+        raise ValueError('%s: fragmented MP4 files are not supported' % stream.name)
+    return atoms, moov, mdats
 
 ##################################################
 # merge
 ##################################################
 
-def merge_stts(samples_list):
-    sample_list = []
-    for samples in samples_list:
-        #assert len(samples) == 1
-        #sample_list.append(samples[0])
-        sample_list += samples
-    counts, durations = zip(*sample_list)
-    #assert len(set(durations)) == 1, 'not all durations equal'
-    if len(set(durations)) == 1:
-        return [(sum(counts), durations[0])]
-    return sample_list
-
-def merge_stss(samples, sample_number_list):
-    results = []
-    start = 0
-    for samples, sample_number_list in zip(samples, sample_number_list):
-        results.extend(map(lambda x: start + x, samples))
-        start += sample_number_list
-    return results
-
-def merge_stsc(chunks_list, total_chunk_number_list):
-    results = []
-    chunk_index = 1
-    for chunks, total in zip(chunks_list, total_chunk_number_list):
-        for i in range(len(chunks)):
-            if i < len(chunks) - 1:
-                chunk_number = chunks[i + 1][0] - chunks[i][0]
-            else:
-                chunk_number = total + 1 - chunks[i][0]
-            sample_number = chunks[i][1]
-            description = chunks[i][2]
-            results.append((chunk_index, sample_number, description))
-            chunk_index += chunk_number
-    return results
-
-def merge_stco(offsets_list, mdats):
-    offset = 0
-    results = []
-    for offsets, mdat in zip(offsets_list, mdats):
-        results.extend(offset + x - mdat.body[1] for x in offsets)
-        offset += mdat.size - 8
-    return results
-
-def merge_stsz(sizes_list):
-    return sum(sizes_list, [])
-
-def merge_mdats(mdats):
-    total_size = sum(x.size - 8 for x in mdats) + 8
-    class multi_mdat_atom(Atom):
-        def __init__(self, type, size, body):
-            Atom.__init__(self, type, size, body)
-        def write(self, stream):
-            self.write1(stream)
-            self.write2(stream)
-        def write2(self, stream):
-            for mdat in self.body:
-                mdat.write2(stream)
-        def calsize(self):
-            return self.size
-    return multi_mdat_atom(b'mdat', total_size, mdats)
-
-def merge_moov(moovs, mdats):
-    mvhd_duration = 0
-    for x in moovs:
-        mvhd_duration += x.get(b'mvhd').get('duration')
-    tkhd_durations = [0, 0]
-    mdhd_durations = [0, 0]
-    for x in moovs:
-        traks = x.get_all(b'trak')
-        assert len(traks) == 2
-        tkhd_durations[0] += traks[0].get(b'tkhd').get('duration')
-        tkhd_durations[1] += traks[1].get(b'tkhd').get('duration')
-        mdhd_durations[0] += traks[0].get(b'mdia', b'mdhd').get('duration')
-        mdhd_durations[1] += traks[1].get(b'mdia', b'mdhd').get('duration')
-    #mvhd_duration = min(mvhd_duration, tkhd_durations)
-    
-    trak0s = [x.get_all(b'trak')[0] for x in moovs]
-    trak1s = [x.get_all(b'trak')[1] for x in moovs]
-    
-    stts0 = merge_stts(x.get(b'mdia', b'minf', b'stbl', b'stts').body[1] for x in trak0s)
-    stts1 = merge_stts(x.get(b'mdia', b'minf', b'stbl', b'stts').body[1] for x in trak1s)
-    
-    stss = merge_stss((x.get(b'mdia', b'minf', b'stbl', b'stss').body[1] for x in trak0s), (len(x.get(b'mdia', b'minf', b'stbl', b'stsz').body[3]) for x in trak0s))
-    
-    stsc0 = merge_stsc((x.get(b'mdia', b'minf', b'stbl', b'stsc').body[1] for x in trak0s), (len(x.get(b'mdia', b'minf', b'stbl', b'stco').body[1]) for x in trak0s))
-    stsc1 = merge_stsc((x.get(b'mdia', b'minf', b'stbl', b'stsc').body[1] for x in trak1s), (len(x.get(b'mdia', b'minf', b'stbl', b'stco').body[1]) for x in trak1s))
-    
-    stco0 = merge_stco((x.get(b'mdia', b'minf', b'stbl', b'stco').body[1] for x in trak0s), mdats)
-    stco1 = merge_stco((x.get(b'mdia', b'minf', b'stbl', b'stco').body[1] for x in trak1s), mdats)
-    
-    stsz0 = merge_stsz((x.get(b'mdia', b'minf', b'stbl', b'stsz').body[3] for x in trak0s))
-    stsz1 = merge_stsz((x.get(b'mdia', b'minf', b'stbl', b'stsz').body[3] for x in trak1s))
-    
-    ctts = sum((x.get(b'mdia', b'minf', b'stbl', b'ctts').body[1] for x in trak0s), [])
-    
-    moov = moovs[0]
-    
-    moov.get(b'mvhd').set('duration', mvhd_duration)
-    trak0 = moov.get_all(b'trak')[0]
-    trak1 = moov.get_all(b'trak')[1]
-    trak0.get(b'tkhd').set('duration', tkhd_durations[0])
-    trak1.get(b'tkhd').set('duration', tkhd_durations[1])
-    trak0.get(b'mdia', b'mdhd').set('duration', mdhd_durations[0])
-    trak1.get(b'mdia', b'mdhd').set('duration', mdhd_durations[1])
-    
-    stts_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stts')
-    stts_atom.body = stts_atom.body[0], stts0
-    stts_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stts')
-    stts_atom.body = stts_atom.body[0], stts1
-    
-    stss_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stss')
-    stss_atom.body = stss_atom.body[0], stss
-    
-    stsc_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stsc')
-    stsc_atom.body = stsc_atom.body[0], stsc0
-    stsc_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stsc')
-    stsc_atom.body = stsc_atom.body[0], stsc1
-    
-    stco_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stco')
-    stco_atom.body = stss_atom.body[0], stco0
-    stco_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stco')
-    stco_atom.body = stss_atom.body[0], stco1
-    
-    stsz_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stsz')
-    stsz_atom.body = stsz_atom.body[0], stsz_atom.body[1], len(stsz0), stsz0
-    stsz_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stsz')
-    stsz_atom.body = stsz_atom.body[0], stsz_atom.body[1], len(stsz1), stsz1
-    
-    ctts_atom = trak0.get(b'mdia', b'minf', b'stbl', b'ctts')
-    ctts_atom.body = ctts_atom.body[0], ctts
-    
-    old_moov_size = moov.size
-    new_moov_size = moov.calsize()
-    new_mdat_start = mdats[0].body[1] + new_moov_size - old_moov_size
-    stco0 = list(map(lambda x: x + new_mdat_start, stco0))
-    stco1 = list(map(lambda x: x + new_mdat_start, stco1))
-    stco_atom = trak0.get(b'mdia', b'minf', b'stbl', b'stco')
-    stco_atom.body = stss_atom.body[0], stco0
-    stco_atom = trak1.get(b'mdia', b'minf', b'stbl', b'stco')
-    stco_atom.body = stss_atom.body[0], stco1
-    
-    return moov
-
-def merge_mp4s(files, output):
+# beyond it, chunk offsets are written in a co64
+STCO_MAX_OFFSET = 0xffffffff
+
+# tables with an entry per sample, of no use once the samples they describe
+# are out of step with the merged track
+per_sample_atoms = {b'sbgp', b'subs', b'stps', b'stsh', b'padb', b'stdp', b'sdtp'}
+
+def get_table(stbl, type):
+    tables = stbl.get_all(type)
+    return tables[0].body[1] if tables else None
+
+def set_table(stbl, type, entries, value=0):
+    # replaces the table of the first file, or the table of its kind
+    for i, atom in enumerate(stbl.body):
+        if atom.type == type or {atom.type, type} == {b'stco', b'co64'}:
+            if atom.type == type:
+                value = atom.body[0]
+            stbl.body[i] = table_atom(type, 0, (value, entries))
+            return
+    stbl.body.append(table_atom(type, 0, (value, entries)))
+
+class TrackMerger:
+    # the sample tables of a track, merged one file at a time; chunk offsets
+    # are relative to the merged mdat payload until it is laid out
+    def __init__(self, trak):
+        self.trak = trak
+        self.handler = trak.get(b'mdia', b'hdlr').body[8:12]
+        self.time_scale = trak.get(b'mdia', b'mdhd').get('time_scale')
+        self.tkhd_duration = 0
+        self.mdhd_duration = 0
+        self.stts = array('I')
+        self.stss = None
+        self.stsc = array('I')
+        self.ctts = None
+        self.sample_size = None
+        self.sizes = array('I')
+        self.sample_count = 0
+        self.offsets = array('Q')
+    def add(self, trak, data_offset):
+        if trak.get(b'mdia', b'hdlr').body[8:12] != self.handler:
+            raise ValueError('tracks of different kinds: %s, %s' % (self.handler, trak.get(b'mdia', b'hdlr').body[8:12]))
+        if trak.get(b'mdia', b'mdhd').get('time_scale') != self.time_scale:
+            raise ValueError('tracks of different time scales')
+        self.tkhd_duration += trak.get(b'tkhd').get('duration')
+        self.mdhd_duration += trak.get(b'mdia', b'mdhd').get('duration')
+        stbl = trak.get(b'mdia', b'minf', b'stbl')
+        if not stbl.get_all(b'stsz'):
+            raise ValueError('tracks without stsz are not supported')
+        value, sample_size, sample_count, sizes = stbl.get(b'stsz').body
+        
+        self.stts += stbl.get(b'stts').body[1]
+        
+        # no stss: every sample is a sync sample
+        stss = get_table(stbl, b'stss')
+        if stss is not None and self.stss is None:
+            self.stss = array('I', range(1, self.sample_count + 1))
+        if self.stss is not None:
+            if stss is None:
+                stss = range(1, sample_count + 1)
+            self.stss += shift_uint_array(stss, self.sample_count, 'I')
+        
+        # no ctts: no composition offsets
+        ctts = get_table(stbl, b'ctts')
+        if ctts is not None and self.ctts is None:
+            self.ctts = array('I', [self.sample_count, 0] if self.sample_count else [])
+        if self.ctts is not None:
+            self.ctts += ctts if ctts is not None else array('I', [sample_count, 0])
+        
+        chunks = array('I', stbl.get(b'stsc').body[1])
+        chunks[0::3] = shift_uint_array(chunks[0::3], len(self.offsets))
+        self.stsc += chunks
+        
+        # a sample size for all samples, until the files disagree
+        if self.sample_size is None:
+            self.sample_size = sample_size
+        elif self.sample_size != sample_size:
+            if self.sample_size:
+                self.sizes = array('I', [self.sample_size]) * self.sample_count
+            self.sample_size = 0
+        if self.sample_size == 0:
+            self.sizes += sizes if sample_size == 0 else array('I', [sample_size]) * sample_count
+        self.sample_count += sample_count
+        
+        offsets = get_table(stbl, b'stco')
+        if offsets is None:
+            offsets = get_table(stbl, b'co64')
+        # the shift may be negative, the offsets it gives never are
+        self.offsets += shift_uint_array(offsets, data_offset, 'Q')
+    def last_offset(self):
+        return max(self.offsets) if self.offsets else 0
+    def write_tables(self, data_start, co64):
+        # installs the merged tables in the trak of the first file
+        trak = self.trak
+        elst = trak.get_all(b'edts') and trak.get(b'edts').get_all(b'elst')
+        if elst and elst[0].variables and elst[0].get('duration'):
+            elst[0].set('duration', elst[0].get('duration') + self.tkhd_duration - trak.get(b'tkhd').get('duration'))
+        trak.get(b'tkhd').set('duration', self.tkhd_duration)
+        trak.get(b'mdia', b'mdhd').set('duration', self.mdhd_duration)
+        
+        stbl = trak.get(b'mdia', b'minf', b'stbl')
+        stbl.body = [x for x in stbl.body if x.type not in per_sample_atoms]
+        set_table(stbl, b'stts', merge_stts(self.stts))
+        if self.stss is not None:
+            set_table(stbl, b'stss', self.stss)
+        if self.ctts is not None:
+            set_table(stbl, b'ctts', self.ctts)
+        set_table(stbl, b'stsc', self.stsc)
+        stsz = stbl.get(b'stsz')
+        stsz.body = stsz.body[0], self.sample_size, self.sample_count, self.sizes
+        if co64:
+            set_table(stbl, b'co64', shift_uint_array(self.offsets, data_start))
+        else:
+            set_table(stbl, b'stco', shift_uint_array(self.offsets, data_start, 'I'))
+
+def merge_stts(samples):
+    durations = set(samples[1::2])
+    #assert len(durations) == 1, 'not all durations equal'
+    if len(durations) == 1:
+        return array('I', [sum(samples[0::2]), durations.pop()])
+    return samples
+
+class MP4Merger:
+    # merges the moov of the files one at a time, keeping the atoms of the
+    # first file and where the mdat payload of each file is, which is only
+    # read when the output is written
+    def __init__(self):
+        self.atoms = None
+        self.moov = None
+        self.tracks = []
+        self.duration = 0
+        self.payloads = []
+        self.payload_size = 0
+    def add(self, path):
+        with open(path, 'rb') as stream:
+            atoms, moov, mdats = read_mp4(stream)
+        if self.moov is None:
+            self.atoms = atoms
+            self.moov = moov
+            self.time_scale = moov.get(b'mvhd').get('time_scale')
+            self.tracks = [TrackMerger(trak) for trak in moov.get_all(b'trak')]
+        traks = moov.get_all(b'trak')
+        if len(traks) != len(self.tracks):
+            raise ValueError('%s: %d tracks, not %d' % (path, len(traks), len(self.tracks)))
+        if moov.get(b'mvhd').get('time_scale') != self.time_scale:
+            raise ValueError('%s: movies of different time scales' % path)
+        self.duration += moov.get(b'mvhd').get('duration')
+        # the payload runs from the first mdat to the end of the last one
+        start = mdats[0].body[1]
+        end = mdats[-1].body[1] + mdats[-1].body[2]
+        for merger, trak in zip(self.tracks, traks):
+            merger.add(trak, self.payload_size - start)
+        self.payloads.append((path, start, end - start))
+        self.payload_size += end - start
+    def mdat_header_size(self):
+        return 8 if self.payload_size + 8 <= 0xffffffff else 16
+    def faststart(self):
+        # the moov right before the mdat, for playback to start before the
+        # whole file is downloaded
+        self.atoms.remove(self.moov)
+        i = [x.type for x in self.atoms].index(b'mdat')
+        self.atoms.insert(i, self.moov)
+    def split(self):
+        # the atoms written before the payloads and after them; those between
+        # the first and the last mdat are part of the payload of the first file
+        types = [x.type for x in self.atoms]
+        first = types.index(b'mdat')
+        last = len(types) - 1 - types[::-1].index(b'mdat')
+        tail = self.atoms[last + 1:]
+        if self.moov in self.atoms[first:last]:
+            tail.insert(0, self.moov)
+        return self.atoms[:first], tail
+    def layout(self):
+        # chunk offsets are 64-bit once the 32-bit ones overflow, which
+        # makes the moov and with it the offsets bigger, never smaller
+        self.moov.get(b'mvhd').set('duration', self.duration)
+        last_offset = max([x.last_offset() for x in self.tracks] + [0])
+        co64 = last_offset > STCO_MAX_OFFSET
+        while True:
+            for x in self.tracks:
+                x.write_tables(0, co64)
+            data_start = self.mdat_header_size()
+            for atom in self.split()[0]:
+                data_start += atom.calsize()
+            if co64 or data_start + last_offset <= STCO_MAX_OFFSET:
+                break
+            co64 = True
+        for x in self.tracks:
+            x.write_tables(data_start, co64)
+        self.moov.calsize()
+    def write_head(self, stream):
+        # up to the mdat payloads, which are all in one mdat
+        for x in self.split()[0]:
+            x.write(stream)
+        if self.mdat_header_size() == 8:
+            write_uint(stream, 8 + self.payload_size)
+            stream.write(b'mdat')
+        else:
+            write_uint(stream, 1)
+            stream.write(b'mdat')
+            write_ulong(stream, 16 + self.payload_size)
+    def write_tail(self, stream):
+        for x in self.split()[1]:
+            x.write(stream)
+    def write(self, stream):
+        self.layout()
+        self.write_head(stream)
+        for path, start, size in self.payloads:
+            with open(path, 'rb') as source:
+                source.seek(start)
+                copy_stream(source, stream, size)
+        self.write_tail(stream)
+
+def merge_mp4s(files, output, faststart=True):
     assert files
-    ins = [open(mp4, 'rb') for mp4 in files]
-    mp4s = list(map(read_mp4, ins))
-    moovs = list(map(lambda x: x[1], mp4s))
-    mdats = list(map(lambda x: x[2], mp4s))
-    moov = merge_moov(moovs, mdats)
-    mdat = merge_mdats(mdats)
+    merger = MP4Merger()
+    for mp4 in files:
+        merger.add(mp4)
+    if faststart:
+        merger.faststart()
     with open(output, 'wb') as output:
-        for x in mp4s[0][0]:
-            if x.type == b'moov':
-                moov.write(output)
-            elif x.type == b'mdat':
-                mdat.write(output)
-            else:
-                x.write(output)
+        merger.write(output)
+
+def faststart_mp4(path):
+    # moves the moov of a file before its mdat, in place: the payload is
+    # moved once, towards the end of the file, by the size of the moov. The
+    # file is broken if this is interrupted.
+    merger = MP4Merger()
+    merger.add(path)
+    types = [x.type for x in merger.atoms]
+    if types.index(b'moov') < types.index(b'mdat'):
+        return False
+    merger.faststart()
+    merger.layout()
+    head = BytesIO()
+    merger.write_head(head)
+    _, start, size = merger.payloads[0]
+    with open(path, 'r+b') as f:
+        move_data(f, start, len(head.getvalue()), size)
+        f.seek(0)
+        f.write(head.getvalue())
+        f.seek(len(head.getvalue()) + size)
+        merger.write_tail(f)
+        f.truncate()
+    return True
 
 ##################################################
 # main
@@ -902,7 +944,7 @@ def guess_output(inputs):
             return inputs[0][:i] + '.mp4'
     return 'output.mp4'
 
-def concat_mp4(mp4s, output = None):
+def concat_mp4(mp4s, output = None, faststart = True):
     assert mp4s, 'no mp4 file found'
     import os.path
     if not output:
@@ -911,27 +953,31 @@ def concat_mp4(mp4s, output = None):
         output = os.path.join(output, guess_output(mp4s))
     
     print('Merging video parts...')
-    merge_mp4s(mp4s, output)
+    merge_mp4s(mp4s, output, faststart)
     
     return output
 
 def usage():
     print('Usage: [python3] join_mp4.py --output TARGET.mp4 mp4...')
+    print('       [python3] join_mp4.py --faststart mp4...')
 
 def main():
     import sys, getopt
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "ho:", ["help", "output="])
+        opts, args = getopt.getopt(sys.argv[1:], "ho:", ["help", "output=", "faststart"])
     except getopt.GetoptError as err:
         usage()
         sys.exit(1)
     output = None
+    faststart = False
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
             sys.exit()
         elif o in ("-o", "--output"):
             output = a
+        elif o == "--faststart":
+            faststart = True
         else:
             usage()
             sys.exit(1)
@@ -939,6 +985,14 @@ def main():
         usage()
         sys.exit(1)
     
+    if faststart:
+        # moov first, in place
+        for mp4 in args:
+            if faststart_mp4(mp4):
+                print('%s: moov moved before mdat' % mp4)
+            else:
+                print('%s: moov already before mdat' % mp4)
+        return
     concat_mp4(args, output)
 
 if __name__ == '__main__':
@@ -1,5 +1,331 @@
 #!/usr/bin/env python
 
+import sys
+import mmap
+import traceback
+
+PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PID_NULL = 0x1fff
+# bytes of packets looked at and written out at once
+REWRITE_CHUNK_SIZE = PACKET_SIZE * 32 * 1024
+# PTS, DTS and the PCR base count a 90 kHz clock on 33 bits
+TIMESTAMP_WRAP = 1 << 33
+# a jump between parts bigger than a second is a new timeline
+MAX_TIMESTAMP_GAP = 90000
+# PES streams with no optional header, and so no timestamps: program
+# stream map, padding, private stream 2, ECM, EMM, directory, DSMCC, H.222.1
+# type E
+PES_NO_HEADER = {0xbc, 0xbe, 0xbf, 0xf0, 0xf1, 0xff, 0xf2, 0xf8}
+
+# to pick bits of a column of header bytes with bytes.translate()
+PID_HIGH = bytes(b & 0x1f for b in range(256))
+UNIT_START = bytes(b >> 6 & 1 for b in range(256))
+ADAPTATION_FIELD = bytes(b >> 5 & 1 for b in range(256))
+LOW_NIBBLE = bytes(b & 0x0f for b in range(256))
+HIGH_NIBBLE = bytes(b & 0xf0 for b in range(256))
+
+
+##################################################
+# packets
+##################################################
+
+
+def read_timestamp(data, pos):
+    b = data[pos:pos + 5]
+    return (b[0] >> 1 & 0x07) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | \
+        b[3] << 7 | b[4] >> 1
+
+
+def write_timestamp(data, pos, timestamp):
+    # the 4 bits before it tell PTS from DTS, and the marker bits stay set
+    data[pos] = data[pos] & 0xf0 | (timestamp >> 29 & 0x0e) | 1
+    data[pos + 1:pos + 5] = (
+        (timestamp >> 15 & 0x7fff) << 17 | 1 << 16 |
+        (timestamp & 0x7fff) << 1 | 1
+    ).to_bytes(4, 'big')
+
+
+def read_pcr_base(data, pos):
+    return int.from_bytes(data[pos:pos + 5], 'big') >> 7
+
+
+def write_pcr_base(data, pos, base):
+    data[pos:pos + 4] = (base >> 1).to_bytes(4, 'big')
+    data[pos + 4] = (base & 1) << 7 | data[pos + 4] & 0x7f
+
+
+def payload_start(data, pos):
+    """Returns where the payload of the packet at pos starts, or None if it
+    has none.
+    """
+    flags = data[pos + 3]
+    if not flags & 0x10:
+        return None
+    if flags & 0x20:
+        return pos + 5 + data[pos + 4]
+    return pos + 4
+
+
+def column_int(column, table):
+    return int.from_bytes(column.translate(table), 'big')
+
+
+class Packets:
+    """A run of whole TS packets, with their PIDs in pids, for the packets
+    of a PID to be found without looking at them one by one.
+
+    Columns of header bytes, one byte a packet, are turned into big
+    integers for arithmetic on all the packets at once: with values below
+    16 in each byte, sums never carry from a byte to the next.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.high = bytes(data[1::PACKET_SIZE]).translate(PID_HIGH)
+        self.low = bytes(data[2::PACKET_SIZE])
+        # the PIDs, as native 16-bit integers
+        self.keys = bytearray(2 * len(self.high))
+        if sys.byteorder == 'little':
+            self.keys[0::2], self.keys[1::2] = self.low, self.high
+        else:
+            self.keys[0::2], self.keys[1::2] = self.high, self.low
+        self.pids = memoryview(self.keys).cast('H')
+
+    def mask(self, pid):
+        """Returns a column of ones for the packets of pid, zeros for the
+        others, as an integer."""
+        high = bytes(int(b == pid >> 8) for b in range(256))
+        low = bytes(int(b == pid & 0xff) for b in range(256))
+        return column_int(self.high, high) & column_int(self.low, low)
+
+    def add_counters(self, deltas):
+        """Adds to the continuity counters of the packets of each pid of
+        deltas its delta, modulo 16, in data.
+        """
+        column = bytes(self.data[3::PACKET_SIZE])
+        add = 0
+        for pid, delta in deltas:
+            add += self.mask(pid) * delta
+        counters = column_int(column, LOW_NIBBLE) + add
+        counters = counters.to_bytes(len(column), 'big')
+        self.data[3::PACKET_SIZE] = (
+            column_int(column, HIGH_NIBBLE) | column_int(counters, LOW_NIBBLE)
+        ).to_bytes(len(column), 'big')
+
+    def __len__(self):
+        return len(self.pids)
+
+    def find(self, pid, start=0):
+        """Returns the index of the first packet of pid from start on, or
+        -1."""
+        key = pid.to_bytes(2, sys.byteorder)
+        i = self.keys.find(key, 2 * start)
+        while i > 0 and i % 2:
+            i = self.keys.find(key, i + 1)
+        return i // 2 if i >= 0 else -1
+
+    def rfind(self, pid):
+        """Returns the index of the last packet of pid, or -1."""
+        key = pid.to_bytes(2, sys.byteorder)
+        i = self.keys.rfind(key)
+        while i > 0 and i % 2:
+            i = self.keys.rfind(key, 0, i + 1)
+        return i // 2 if i >= 0 else -1
+
+    def flagged(self, column, table):
+        """Yields the positions of the packets whose byte at column has the
+        bit of table set.
+        """
+        flags = bytes(self.data[column::PACKET_SIZE]).translate(table)
+        i = flags.find(1)
+        while i >= 0:
+            yield i * PACKET_SIZE
+            i = flags.find(1, i + 1)
+
+
+##################################################
+# streaming
+##################################################
+
+
+class TSJoiner:
+    """Concatenates MPEG-TS files fed one at a time, from any readable
+    stream, into out, which may be a pipe.
+
+    The continuity counters of a file go on from those of the files before
+    it, and when its timestamps jump away from where those of the files
+    before it end, its PTS, DTS and PCR are moved to follow on; parts of a
+    stream cut with continuous timestamps keep theirs.
+
+    Packets are looked at a chunk at a time: the PIDs, the packets starting
+    a PES and those with an adaptation field are found by columns of header
+    bytes, and the continuity counters rewritten a column at a time, so
+    that only the PES headers and the PCRs are read one by one. Chunks
+    with nothing to change are written out as they are. Files on disk are
+    memory mapped, other streams read a chunk at a time; anything that is
+    not whole packets goes through untouched.
+    """
+    def __init__(self, out):
+        self.out = out
+        # continuity counter of the last packet written, by PID
+        self.counters = {}
+        # last DTS written and the gap before it, by PID
+        self.timestamps = {}
+        # of the file being added: what to add to its continuity counters,
+        # by PID, and to its timestamps, once they are known
+        self.deltas = {}
+        self.offset = None
+
+    def add(self, stream):
+        self.deltas = {}
+        self.offset = None
+        try:
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # io.UnsupportedOperation, for in-memory and network streams
+            data = None
+        if data is None:
+            while True:
+                chunk = read_chunk(stream, REWRITE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.rewrite(chunk)
+            return
+
+        with data, memoryview(data) as view:
+            try:
+                for start in range(0, len(data), REWRITE_CHUNK_SIZE):
+                    end = min(start + REWRITE_CHUNK_SIZE, len(data))
+                    self.rewrite(view[start:end])
+                    if hasattr(data, 'madvise'):
+                        # written, and not read again: keep memory flat
+                        page_start = start - start % mmap.PAGESIZE
+                        data.madvise(
+                            mmap.MADV_DONTNEED, page_start, end - page_start
+                        )
+            except Exception as e:
+                # the frames of the traceback hold slices of view, which
+                # would keep it from being released: a BufferError would
+                # take the place of the error (TSRemuxer's ValueError)
+                traceback.clear_frames(e.__traceback__)
+                raise
+
+    def rewrite(self, chunk):
+        whole = len(chunk) - len(chunk) % PACKET_SIZE
+        if whole < len(chunk):
+            self.rewrite(chunk[:whole])
+            self.out.write(chunk[whole:])
+            return
+        sync = bytes(chunk[0::PACKET_SIZE])
+        if not chunk or sync.count(SYNC_BYTE) != len(sync):
+            self.out.write(chunk)
+            return
+
+        packets = Packets(chunk)
+        timestamps = self.find_timestamps(packets)
+        counters = self.find_counters(packets)
+        if not self.offset and not counters:
+            self.out.write(chunk)
+            return
+
+        data = packets.data = bytearray(chunk)
+        if self.offset:
+            for pos in timestamps:
+                timestamp = read_timestamp(data, pos)
+                write_timestamp(
+                    data, pos, (timestamp + self.offset) % TIMESTAMP_WRAP
+                )
+            for pos in packets.flagged(3, ADAPTATION_FIELD):
+                if data[pos + 4] >= 7 and data[pos + 5] & 0x10:
+                    base = read_pcr_base(data, pos + 6)
+                    write_pcr_base(
+                        data, pos + 6, (base + self.offset) % TIMESTAMP_WRAP
+                    )
+        if counters:
+            packets.add_counters(counters)
+        self.out.write(data)
+
+    def find_timestamps(self, packets):
+        """Returns where the PTS and DTS of the PES headers starting in
+        packets are, deciding the offset of the file from the first one and
+        keeping track of the last DTS of each PID.
+        """
+        data = packets.data
+        positions = []
+        for pos in packets.flagged(1, UNIT_START):
+            start = payload_start(data, pos)
+            if start is None or start + 19 > pos + PACKET_SIZE or \
+                    data[start:start + 3] != b'\x00\x00\x01' or \
+                    data[start + 3] in PES_NO_HEADER:
+                continue
+            flags = data[start + 7] >> 6
+            if not flags & 2:
+                continue
+            positions.append(start + 9)
+            if flags == 3:
+                positions.append(start + 14)
+            dts = read_timestamp(data, positions[-1])
+            if self.offset is None:
+                self.offset = self.find_offset(dts)
+            dts = (dts + self.offset) % TIMESTAMP_WRAP
+            pid = packets.pids[pos // PACKET_SIZE]
+            last, gap = self.timestamps.get(pid, (None, 0))
+            if last is not None:
+                gap = (dts - last) % TIMESTAMP_WRAP
+                if gap > MAX_TIMESTAMP_GAP:
+                    gap = 0
+            self.timestamps[pid] = dts, gap
+        return positions
+
+    def find_offset(self, timestamp):
+        if not self.timestamps:
+            return 0
+        end = max(last + gap for last, gap in self.timestamps.values())
+        offset = (end - timestamp) % TIMESTAMP_WRAP
+        if offset > TIMESTAMP_WRAP // 2:
+            offset -= TIMESTAMP_WRAP
+        if abs(offset) <= MAX_TIMESTAMP_GAP:
+            return 0
+        return offset
+
+    def find_counters(self, packets):
+        """Returns (pid, delta) for the PIDs of packets whose continuity
+        counters are to be moved by delta, keeping track of the last
+        counter written for each PID.
+        """
+        data = packets.data
+        counters = []
+        for pid in set(packets.pids):
+            if pid == PID_NULL:
+                continue
+            if pid not in self.deltas:
+                pos = packets.find(pid) * PACKET_SIZE + 3
+                delta = 0
+                if pid in self.counters:
+                    # a packet with no payload repeats the last counter
+                    expected = self.counters[pid] + (data[pos] >> 4 & 1)
+                    delta = (expected - data[pos]) & 0x0f
+                self.deltas[pid] = delta
+            delta = self.deltas[pid]
+            pos = packets.rfind(pid) * PACKET_SIZE + 3
+            self.counters[pid] = (data[pos] + delta) & 0x0f
+            if delta:
+                counters.append((pid, delta))
+        return counters
+
+    def close(self):
+        pass
+
+
+def read_chunk(stream, size):
+    chunk = stream.read(size)
+    while chunk and len(chunk) < size:
+        more = stream.read(size - len(chunk))
+        if not more:
+            break
+        chunk += more
+    return chunk
+
 
 ##################################################
 # main
@@ -26,13 +352,12 @@ def concat_ts(ts_parts, output=None):
 
     print('Merging video parts...')
 
-    ts_out_file = open(output, "wb")
-    for ts_in in ts_parts:
-        ts_in_file = open(ts_in, "rb")
-        ts_in_data = ts_in_file.read()
-        ts_in_file.close()
-        ts_out_file.write(ts_in_data)
-    ts_out_file.close()
+    with open(output, 'wb') as ts_out_file:
+        joiner = TSJoiner(ts_out_file)
+        for ts_in in ts_parts:
+            with open(ts_in, 'rb') as ts_in_file:
+                joiner.add(ts_in_file)
+        joiner.close()
     return output
 
 
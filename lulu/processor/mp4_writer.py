@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+
+import struct
+from array import array
+from io import BytesIO
+
+from lulu.processor.join_mp4 import (
+    Atom,
+    CompositeAtom,
+    stsz_atom,
+    table_atom,
+    write_uint,
+    write_ulong,
+)
+
+# the time scale of the movie, tkhd and mvhd durations are in it
+MOVIE_TIME_SCALE = 1000
+
+MATRIX = struct.pack(
+    '>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000
+)
+
+# room left for the moov before the mdat, as a share of the samples: its
+# tables take some 25 bytes a sample, under 1% of H.264 at 1 Mbps and over
+MOOV_RESERVE_RATIO = 0.01
+MOOV_RESERVE_MIN = 64 * 1024
+
+AAC_SAMPLE_RATES = [
+    96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000,
+    11025, 8000, 7350,
+]
+
+
+##################################################
+# codecs
+##################################################
+
+
+class BitReader:
+    def __init__(self, data):
+        self.value = int.from_bytes(data, 'big')
+        self.left = len(data) * 8
+
+    def u(self, n):
+        if n > self.left:
+            raise ValueError('not enough bits')
+        self.left -= n
+        return self.value >> self.left & ((1 << n) - 1)
+
+    def ue(self):
+        # Exp-Golomb
+        zeros = 0
+        while not self.u(1):
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        k = self.ue()
+        return (k + 1) // 2 if k % 2 else -(k // 2)
+
+
+def unescape_rbsp(nal):
+    # drops the emulation prevention bytes (00 00 03)
+    return nal.replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+def parse_sps(sps):
+    """Reads the picture size out of an H.264 sequence parameter set (a NAL
+    unit, with its header byte).
+
+    Returns:
+        (width, height), cropped.
+    """
+    r = BitReader(unescape_rbsp(sps[1:]))
+    profile_idc = r.u(8)
+    r.u(16)  # constraint flags, level_idc
+    r.ue()  # seq_parameter_set_id
+    chroma_format_idc = 1
+    if profile_idc in (
+        100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135
+    ):
+        chroma_format_idc = r.ue()
+        if chroma_format_idc == 3:
+            r.u(1)  # separate_colour_plane_flag
+        r.ue()  # bit_depth_luma_minus8
+        r.ue()  # bit_depth_chroma_minus8
+        r.u(1)  # qpprime_y_zero_transform_bypass_flag
+        if r.u(1):  # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if r.u(1):
+                    last = next_scale = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_scale:
+                            next_scale = (last + r.se()) % 256
+                        last = next_scale or last
+    r.ue()  # log2_max_frame_num_minus4
+    pic_order_cnt_type = r.ue()
+    if pic_order_cnt_type == 0:
+        r.ue()  # log2_max_pic_order_cnt_lsb_minus4
+    elif pic_order_cnt_type == 1:
+        r.u(1)  # delta_pic_order_always_zero_flag
+        r.se()  # offset_for_non_ref_pic
+        r.se()  # offset_for_top_to_bottom_field
+        for _ in range(r.ue()):
+            r.se()  # offset_for_ref_frame
+    r.ue()  # max_num_ref_frames
+    r.u(1)  # gaps_in_frame_num_value_allowed_flag
+    width_in_mbs = r.ue() + 1
+    height_in_map_units = r.ue() + 1
+    frame_mbs_only_flag = r.u(1)
+    if not frame_mbs_only_flag:
+        r.u(1)  # mb_adaptive_frame_field_flag
+    r.u(1)  # direct_8x8_inference_flag
+    left = right = top = bottom = 0
+    if r.u(1):  # frame_cropping_flag
+        left, right, top, bottom = r.ue(), r.ue(), r.ue(), r.ue()
+    if chroma_format_idc == 0:
+        crop_x, crop_y = 1, 2 - frame_mbs_only_flag
+    else:
+        crop_x = 2 if chroma_format_idc in (1, 2) else 1
+        crop_y = (2 if chroma_format_idc == 1 else 1) * \
+            (2 - frame_mbs_only_flag)
+    width = width_in_mbs * 16 - crop_x * (left + right)
+    height = (2 - frame_mbs_only_flag) * height_in_map_units * 16 - \
+        crop_y * (top + bottom)
+    return width, height
+
+
+def parse_avcc(avcc):
+    """Reads the picture size out of the first sequence parameter set of an
+    AVCDecoderConfigurationRecord.
+    """
+    if len(avcc) < 8 or not avcc[5] & 0x1f:
+        raise ValueError('no sequence parameter set in avcC')
+    size, = struct.unpack_from('>H', avcc, 6)
+    return parse_sps(avcc[8:8 + size])
+
+
+def make_avcc(sps, pps):
+    """Builds an AVCDecoderConfigurationRecord of a sequence and a picture
+    parameter set (NAL units, with their header byte), for NAL units with
+    4-byte sizes.
+    """
+    return bytes([1, sps[1], sps[2], sps[3], 0xff, 0xe1]) + \
+        struct.pack('>H', len(sps)) + sps + b'\x01' + \
+        struct.pack('>H', len(pps)) + pps
+
+
+def make_audio_specific_config(object_type, sample_rate_index, channels):
+    """Builds the 2-byte AudioSpecificConfig of an AAC stream."""
+    return struct.pack(
+        '>H', object_type << 11 | sample_rate_index << 7 | channels << 3
+    )
+
+
+def parse_audio_specific_config(config):
+    """Returns (sample rate, channels) of an AAC AudioSpecificConfig."""
+    r = BitReader(config)
+    if r.u(5) == 31:
+        r.u(6)  # audioObjectTypeExt
+    index = r.u(4)
+    if index == 15:
+        sample_rate = r.u(24)
+    elif index < len(AAC_SAMPLE_RATES):
+        sample_rate = AAC_SAMPLE_RATES[index]
+    else:
+        raise ValueError('bad AAC sample rate index: {}'.format(index))
+    return sample_rate, r.u(4)
+
+
+##################################################
+# atoms
+##################################################
+
+
+def atom_bytes(type, *parts):
+    body = b''.join(parts)
+    return struct.pack('>I', 8 + len(body)) + type + body
+
+
+def raw_atom(type, *parts):
+    body = b''.join(parts)
+    return Atom(type, 8 + len(body), body)
+
+
+def composite_atom(type, *children):
+    atom = CompositeAtom(type, 0, list(children))
+    atom.calsize()
+    return atom
+
+
+def descriptor(tag, *parts):
+    # an MPEG-4 descriptor, with its size in 4 bytes of 7 bits
+    body = b''.join(parts)
+    size = len(body)
+    return bytes([
+        tag, size >> 21 & 0x7f | 0x80, size >> 14 & 0x7f | 0x80,
+        size >> 7 & 0x7f | 0x80, size & 0x7f,
+    ]) + body
+
+
+def avc1_entry(avcc, width, height):
+    """The sample description of an H.264 track, of its
+    AVCDecoderConfigurationRecord.
+    """
+    return atom_bytes(
+        b'avc1', bytes(6), struct.pack('>H', 1), bytes(16),
+        struct.pack('>HHII', width, height, 72 << 16, 72 << 16), bytes(4),
+        struct.pack('>H', 1), bytes(32), struct.pack('>Hh', 24, -1),
+        atom_bytes(b'avcC', avcc)
+    )
+
+
+def mp4a_entry(config):
+    """The sample description of an AAC track, of its AudioSpecificConfig.
+    """
+    sample_rate, channels = parse_audio_specific_config(config)
+    esds = descriptor(
+        3, struct.pack('>HB', 0, 0),
+        descriptor(
+            4, struct.pack('>BB', 0x40, 0x15), bytes(3),
+            struct.pack('>II', 0, 0), descriptor(5, config)
+        ),
+        descriptor(6, b'\x02')
+    )
+    return atom_bytes(
+        b'mp4a', bytes(6), struct.pack('>H', 1), bytes(8),
+        struct.pack('>HH', channels, 16), bytes(4),
+        struct.pack('>H', sample_rate if sample_rate < 0x10000 else 0),
+        bytes(2), atom_bytes(b'esds', bytes(4), esds)
+    )
+
+
+def header_times(duration, fields):
+    # creation and modification times, the fields between them and the
+    # duration; 64-bit (version 1) only when the duration needs it
+    if duration > 0xffffffff:
+        return 1, struct.pack('>QQ', 0, 0) + fields + \
+            struct.pack('>Q', duration)
+    return 0, struct.pack('>II', 0, 0) + fields + struct.pack('>I', duration)
+
+
+##################################################
+# writer
+##################################################
+
+
+def moov_reserve(payload_size):
+    """The room to leave for the moov of an MP4Writer that is to write
+    about payload_size bytes of samples; 0 if that is not known.
+    """
+    if not payload_size:
+        return 0
+    return MOOV_RESERVE_MIN + int(payload_size * MOOV_RESERVE_RATIO)
+
+
+class MP4Track:
+    """A track of an MP4Writer, whose samples are in time_scale units.
+
+    Args:
+        handler: b'vide' or b'soun'.
+        sample_entry: The sample description, an atom as bytes; see
+            avc1_entry, mp4a_entry.
+
+    Attributes:
+        delay: How long after the start of the movie the track starts, in
+            MOVIE_TIME_SCALE units; an edit list puts it off if set.
+    """
+    def __init__(self, handler, time_scale, sample_entry, width=0, height=0):
+        self.handler = handler
+        self.time_scale = time_scale
+        self.delay = 0
+        self.sample_entries = [sample_entry]
+        # of the samples to come, from 1
+        self.description = 1
+        self.width = width
+        self.height = height
+        self.id = None
+        self.sizes = array('I')
+        self.decode_times = array('Q')
+        # signed, ctts is written in version 1 if any is negative
+        self.composition_offsets = array('i')
+        self.sync_samples = array('I')
+        self.chunk_offsets = array('Q')
+        # first_chunk, samples_per_chunk, sample_description_index
+        self.stsc = array('I')
+        # samples in the chunk being written, none if it is over
+        self.chunk_samples = 0
+
+    def set_sample_entry(self, sample_entry):
+        """Switches the samples to come to another sample description,
+        when the parameters of the codec change.
+        """
+        if sample_entry not in self.sample_entries:
+            self.sample_entries.append(sample_entry)
+        description = self.sample_entries.index(sample_entry) + 1
+        if description != self.description:
+            # a chunk has samples of one description
+            self.end_chunk()
+            self.description = description
+
+    def end_chunk(self):
+        if not self.chunk_samples:
+            return
+        if not self.stsc or self.stsc[-2] != self.chunk_samples or \
+                self.stsc[-1] != self.description:
+            self.stsc.extend(
+                (len(self.chunk_offsets), self.chunk_samples, self.description)
+            )
+        self.chunk_samples = 0
+
+    def durations(self):
+        """The sample durations (stts entries) and the track duration; the
+        last sample lasts as long as the one before it.
+        """
+        times = self.decode_times
+        stts = array('I')
+        for i in range(1, len(times)):
+            delta = times[i] - times[i - 1]
+            if stts and stts[-1] == delta:
+                stts[-2] += 1
+            else:
+                stts.extend((1, delta))
+        if stts:
+            stts[-2] += 1
+        elif times:
+            stts.extend((1, 0))
+        duration = times[-1] - times[0] + stts[-1] if times else 0
+        return stts, duration
+
+    def trak(self, co64, stts, duration):
+        movie_duration = duration * MOVIE_TIME_SCALE // self.time_scale
+        stbl = [
+            raw_atom(
+                b'stsd', struct.pack('>II', 0, len(self.sample_entries)),
+                *self.sample_entries
+            ),
+            table_atom(b'stts', 0, (0, stts)),
+        ]
+        if len(self.sync_samples) < len(self.sizes):
+            stbl.append(table_atom(b'stss', 0, (0, self.sync_samples)))
+        if any(self.composition_offsets):
+            stbl.append(self.ctts())
+        stbl += [
+            table_atom(b'stsc', 0, (0, self.stsc)),
+            stsz_atom(b'stsz', 0, (0, 0, len(self.sizes), self.sizes)),
+            table_atom(b'co64', 0, (0, self.chunk_offsets)) if co64 else
+            table_atom(b'stco', 0, (0, array('I', self.chunk_offsets))),
+        ]
+        video = self.handler == b'vide'
+        # track_ID, reserved
+        version, tkhd = header_times(
+            self.delay + movie_duration, struct.pack('>II', self.id, 0)
+        )
+        mdhd_version, mdhd = header_times(
+            duration, struct.pack('>I', self.time_scale)
+        )
+        edts = []
+        if self.delay:
+            # an empty edit, then the media from its start at rate 1
+            edts.append(composite_atom(b'edts', raw_atom(
+                b'elst', struct.pack(
+                    '>IIIiIIiI', 0, 2, self.delay, -1, 0x10000,
+                    movie_duration, 0, 0x10000
+                )
+            )))
+        return composite_atom(
+            b'trak',
+            raw_atom(
+                # enabled, in movie and in preview
+                b'tkhd', struct.pack('>I', version << 24 | 3), tkhd,
+                bytes(8), struct.pack('>HHH', 0, 0, 0 if video else 0x100),
+                bytes(2), MATRIX,
+                struct.pack('>II', self.width << 16, self.height << 16)
+            ),
+            *edts,
+            composite_atom(
+                b'mdia',
+                raw_atom(
+                    b'mdhd', struct.pack('>I', mdhd_version << 24), mdhd,
+                    struct.pack('>HH', 0x55c4, 0)
+                ),
+                raw_atom(
+                    b'hdlr', bytes(8), self.handler, bytes(12),
+                    b'VideoHandler\x00' if video else b'SoundHandler\x00'
+                ),
+                composite_atom(
+                    b'minf',
+                    raw_atom(b'vmhd', struct.pack('>I', 1), bytes(8))
+                    if video else raw_atom(b'smhd', bytes(8)),
+                    # the samples are in this file
+                    composite_atom(b'dinf', raw_atom(
+                        b'dref', struct.pack('>II', 0, 1),
+                        atom_bytes(b'url ', struct.pack('>I', 1))
+                    )),
+                    composite_atom(b'stbl', *stbl),
+                ),
+            ),
+        )
+
+    def ctts(self):
+        offsets = self.composition_offsets
+        version = 1 if min(offsets) < 0 else 0
+        entries = array('I')
+        for i in range(len(offsets)):
+            offset = offsets[i] & 0xffffffff
+            if entries and entries[-1] == offset:
+                entries[-2] += 1
+            else:
+                entries.extend((1, offset))
+        return table_atom(b'ctts', 0, (version << 24, entries))
+
+
+class MP4Writer:
+    """Writes an MP4 file sample by sample into stream, a seekable file.
+
+    The samples go straight into the mdat, which has a 64-bit size patched
+    by close(); the sample tables are kept in arrays meanwhile and written
+    in the moov. That goes before the mdat, into a free atom of reserve
+    bytes left for it (see moov_reserve), if it fits there, and at the end
+    of the file otherwise. A run of samples of one track is a chunk.
+    """
+    def __init__(self, stream, reserve=0):
+        self.stream = stream
+        self.tracks = []
+        self.current = None
+        stream.write(atom_bytes(
+            b'ftyp', b'isom', struct.pack('>I', 0x200), b'isomiso2avc1mp41'
+        ))
+        self.reserve_offset = stream.tell()
+        self.reserve = reserve if reserve >= 8 else 0
+        if self.reserve:
+            write_uint(stream, self.reserve)
+            stream.write(b'free')
+            stream.write(bytes(self.reserve - 8))
+        self.mdat_offset = stream.tell()
+        write_uint(stream, 1)
+        stream.write(b'mdat')
+        write_ulong(stream, 0)
+        self.position = stream.tell()
+
+    def add_track(self, track):
+        track.id = len(self.tracks) + 1
+        self.tracks.append(track)
+        return track
+
+    def write_sample(self, track, data, decode_time, composition_offset=0,
+                     sync=True):
+        """Appends a sample to track.
+
+        Args:
+            decode_time: In the time scale of the track; it is raised to the
+                one of the sample before, if it is earlier.
+            composition_offset: Presentation time - decode time.
+        """
+        if track is not self.current:
+            if self.current is not None:
+                self.current.end_chunk()
+            self.current = track
+        if not track.chunk_samples:
+            track.chunk_offsets.append(self.position)
+        times = track.decode_times
+        if times and decode_time < times[-1]:
+            decode_time = times[-1]
+        times.append(decode_time)
+        track.sizes.append(len(data))
+        track.composition_offsets.append(composition_offset)
+        track.chunk_samples += 1
+        if sync:
+            track.sync_samples.append(len(track.sizes))
+        self.stream.write(data)
+        self.position += len(data)
+
+    def close(self):
+        """Patches the size of the mdat and writes the moov.
+
+        Returns:
+            True if the moov went before the mdat.
+        """
+        if self.current is not None:
+            self.current.end_chunk()
+        end = self.stream.tell()
+        self.stream.seek(self.mdat_offset + 8)
+        write_ulong(self.stream, end - self.mdat_offset)
+        self.stream.seek(end)
+
+        co64 = any(
+            t.chunk_offsets and t.chunk_offsets[-1] > 0xffffffff
+            for t in self.tracks
+        )
+        traks = []
+        duration = 0
+        for track in self.tracks:
+            stts, track_duration = track.durations()
+            traks.append(track.trak(co64, stts, track_duration))
+            duration = max(
+                duration, track.delay +
+                track_duration * MOVIE_TIME_SCALE // track.time_scale
+            )
+        version, times = header_times(
+            duration, struct.pack('>I', MOVIE_TIME_SCALE)
+        )
+        moov = composite_atom(
+            b'moov',
+            raw_atom(
+                b'mvhd', struct.pack('>I', version << 24), times,
+                struct.pack('>IH', 0x10000, 0x100), bytes(10), MATRIX,
+                bytes(24), struct.pack('>I', len(self.tracks) + 1)
+            ),
+            *traks
+        )
+        data = BytesIO()
+        moov.write(data)
+        data = data.getvalue()
+        left = self.reserve - len(data)
+        if left != 0 and left < 8:
+            # no room for it, or for a free atom after it
+            moov.write(self.stream)
+            return False
+        self.stream.seek(self.reserve_offset)
+        self.stream.write(data)
+        if left:
+            write_uint(self.stream, left)
+            self.stream.write(b'free')
+        self.stream.seek(end)
+        return True
@@ -0,0 +1,828 @@
+#!/usr/bin/env python
+
+import heapq
+import struct
+from contextlib import ExitStack
+
+from lulu.util.fs import copy_data
+from lulu.processor.join_mp4 import (
+    Atom,
+    MP4Merger,
+    TrackMerger,
+    read_atom,
+    read_mp4,
+    read_ulong,
+)
+
+# atoms an MP4 file may start with
+MP4_ATOMS = {
+    b'ftyp', b'styp', b'moov', b'mdat', b'free', b'skip', b'wide', b'sidx',
+}
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+
+# the container of the files of each extension, whose streams are muxed as
+# they are; Matroska takes any codec, only FFmpeg puts MP4 streams in it
+CONTAINERS = {
+    'mp4': 'mp4', 'm4a': 'mp4', 'm4v': 'mp4', 'mov': 'mp4',
+    'webm': 'matroska', 'mkv': 'matroska', 'mka': 'matroska',
+}
+
+# tfhd flags
+TFHD_BASE_DATA_OFFSET = 0x000001
+
+# EBML element IDs, length markers included
+EBML = 0x1a45dfa3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114d9b74
+SEEK = 0x4dbb
+SEEK_ID = 0x53ab
+SEEK_POSITION = 0x53ac
+INFO = 0x1549a966
+TIMECODE_SCALE = 0x2ad7b1
+DURATION = 0x4489
+TRACKS = 0x1654ae6b
+TRACK_ENTRY = 0xae
+TRACK_NUMBER = 0xd7
+TRACK_UID = 0x73c5
+TRACK_TYPE = 0x83
+CLUSTER = 0x1f43b675
+TIMECODE = 0xe7
+SIMPLE_BLOCK = 0xa3
+BLOCK_GROUP = 0xa0
+BLOCK = 0xa1
+REFERENCE_BLOCK = 0xfb
+CUES = 0x1c53bb6b
+CUE_POINT = 0xbb
+CUE_TIME = 0xb3
+CUE_TRACK_POSITIONS = 0xb7
+CUE_TRACK = 0xf7
+CUE_CLUSTER_POSITION = 0xf1
+# top-level elements of the first file that are copied as they are
+EXTRA_ELEMENTS = {
+    0x1254c367,  # Tags
+    0x1043a770,  # Chapters
+    0x1941a469,  # Attachments
+}
+
+TRACK_TYPE_VIDEO = 1
+DEFAULT_TIMECODE_SCALE = 1000000
+# SimpleBlock flags
+KEYFRAME = 0x80
+
+
+##################################################
+# probing
+##################################################
+
+
+def probe_container(path):
+    """Returns the container of the file at path, 'mp4' or 'matroska' (WebM
+    included), or None for anything else.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    if head[:4] == EBML_MAGIC:
+        return 'matroska'
+    if head[4:8] in MP4_ATOMS:
+        return 'mp4'
+    return None
+
+
+def can_mux(files, ext):
+    """Whether mux_av can put the streams of files in a file of extension
+    ext, which is so when they are all of the container of ext.
+    """
+    container = CONTAINERS.get(ext)
+    return container is not None and all(
+        probe_container(path) == container for path in files
+    )
+
+
+def can_copy(files, ext):
+    """Whether the streams of files go in a file of extension ext as they
+    are, with FFmpeg.
+    """
+    return ext == 'mkv' or can_mux(files, ext)
+
+
+##################################################
+# MP4
+##################################################
+
+
+def scan_atoms(stream):
+    """Yields the type, start and size of the top-level atoms of stream."""
+    end = stream.seek(0, 2)
+    start = 0
+    while start + 8 <= end:
+        stream.seek(start)
+        size, type = struct.unpack('>I4s', stream.read(8))
+        if size == 1:
+            size = read_ulong(stream)
+        elif size == 0:
+            size = end - start
+        if size < 8:
+            raise ValueError('%s: bad atom size %d' % (stream.name, size))
+        yield type, start, size
+        start += size
+
+
+def child_atoms(data, start, end):
+    """Yields the type, start and end of the atoms (of 32-bit sizes) in
+    data[start:end].
+    """
+    while start + 8 <= end:
+        size, type = struct.unpack_from('>I4s', data, start)
+        if size < 8 or start + size > end:
+            raise ValueError('bad %s atom size %d' % (type, size))
+        yield type, start, start + size
+        start += size
+
+
+def is_fragmented(path):
+    with open(path, 'rb') as stream:
+        return any(type == b'moof' for type, _, _ in scan_atoms(stream))
+
+
+def retime_trak(trak, time_scale, movie_time_scale):
+    # the durations of the tkhd and of the edit list are in the time scale
+    # of the movie
+    if time_scale == movie_time_scale:
+        return
+    atoms = [trak.get(b'tkhd')]
+    if trak.get_all(b'edts'):
+        atoms += [x for x in trak.get(b'edts').get_all(b'elst') if x.variables]
+    for atom in atoms:
+        atom.set(
+            'duration', atom.get('duration') * movie_time_scale // time_scale
+        )
+
+
+class MP4Muxer(MP4Merger):
+    """Muxes the tracks of MP4 files, added one at a time, into one movie.
+
+    The tracks of a file follow those of the files before it, renumbered,
+    and their samples are copied as they are: the payload of each file is
+    copied whole and the chunk offsets shifted, as MP4Merger does for the
+    files it joins.
+    """
+    def add(self, path):
+        with open(path, 'rb') as stream:
+            atoms, moov, mdats = read_mp4(stream)
+        time_scale = moov.get(b'mvhd').get('time_scale')
+        traks = moov.get_all(b'trak')
+        if self.moov is None:
+            self.atoms = atoms
+            self.moov = moov
+            self.time_scale = time_scale
+        else:
+            # after the last track of the first file
+            i = self.moov.body.index(self.moov.get_all(b'trak')[-1]) + 1
+            self.moov.body[i:i] = traks
+        start = mdats[0].body[1]
+        end = mdats[-1].body[1] + mdats[-1].body[2]
+        for trak in traks:
+            retime_trak(trak, time_scale, self.time_scale)
+            trak.get(b'tkhd').set('track_id', len(self.tracks) + 1)
+            self.duration = max(
+                self.duration, trak.get(b'tkhd').get('duration')
+            )
+            merger = TrackMerger(trak)
+            merger.add(trak, self.payload_size - start)
+            self.tracks.append(merger)
+        self.payloads.append((path, start, end - start))
+        self.payload_size += end - start
+
+    def layout(self):
+        self.moov.get(b'mvhd').set('next_track_id', len(self.tracks) + 1)
+        MP4Merger.layout(self)
+
+
+def read_moof(data):
+    """Reads the moof atom data.
+
+    Returns:
+        (sequence, trafs): where the sequence number of the moof is, and for
+        each of its trafs where its track ID is, where its base data offset
+        is (None without) and its decode time (None without tfdt).
+    """
+    header = 16 if struct.unpack_from('>I', data)[0] == 1 else 8
+    sequence = None
+    trafs = []
+    for type, start, end in child_atoms(data, header, len(data)):
+        if type == b'mfhd':
+            sequence = start + 12
+        if type != b'traf':
+            continue
+        track = base = time = None
+        for type, start, _ in child_atoms(data, start + 8, end):
+            if type == b'tfhd':
+                track = start + 12
+                flags = int.from_bytes(data[start + 9:start + 12], 'big')
+                if flags & TFHD_BASE_DATA_OFFSET:
+                    base = start + 16
+            elif type == b'tfdt':
+                size = 8 if data[start + 8] == 1 else 4
+                time = int.from_bytes(
+                    data[start + 12:start + 12 + size], 'big'
+                )
+        if track is None:
+            raise ValueError('traf without tfhd')
+        trafs.append((track, base, time))
+    if sequence is None:
+        raise ValueError('moof without mfhd')
+    return sequence, trafs
+
+
+class FragmentedMP4Muxer:
+    """Muxes the tracks of fragmented MP4 files, an init segment followed by
+    moof and mdat fragments as DASH tracks are, into one fragmented movie.
+
+    The fragments of all files are interleaved by decode time and copied as
+    they are, with their sequence and track numbers (and their base data
+    offsets, when they have some) rewritten. Segment indexes (sidx, mfra) are
+    dropped, their offsets would be wrong.
+    """
+    def __init__(self):
+        self.ftyp = None
+        self.moov = None
+        self.time_scale = None
+        self.duration = 0
+        self.fragment_duration = None
+        self.trex = []
+        self.paths = []
+        # per file, old track ID to new one
+        self.track_ids = []
+        # per file, (time, file index, start, moof, sequence, trafs, tail)
+        self.fragments = []
+
+    def add(self, path):
+        index = len(self.paths)
+        with open(path, 'rb') as stream:
+            moov = None
+            fragments = []
+            for type, start, size in scan_atoms(stream):
+                if type == b'ftyp' and self.ftyp is None:
+                    stream.seek(start)
+                    self.ftyp = stream.read(size)
+                elif type == b'moov':
+                    stream.seek(start)
+                    moov = read_atom(stream)
+                elif type == b'moof':
+                    if moov is None:
+                        raise ValueError('%s: moof before moov' % path)
+                    stream.seek(start)
+                    fragments.append([start, stream.read(size)])
+                elif type == b'mdat' and fragments:
+                    # the mdats of a fragment and what is between them
+                    fragments[-1][2:] = [start + size - fragments[-1][0]]
+        if moov is None or not fragments:
+            raise ValueError('%s: not a fragmented MP4 file' % path)
+        time_scales = self.add_moov(moov)
+
+        time = 0
+        for i, fragment in enumerate(fragments):
+            if len(fragment) < 3:
+                raise ValueError('%s: moof without mdat' % path)
+            start, data, size = fragment
+            sequence, trafs = read_moof(data)
+            # the time of the first track with one, else that of the
+            # fragment before
+            for track, _, decode_time in trafs:
+                track_id = struct.unpack_from('>I', data, track)[0]
+                if track_id not in time_scales:
+                    raise ValueError('%s: no track %d' % (path, track_id))
+                if decode_time is not None:
+                    time = decode_time / time_scales[track_id]
+                    break
+            fragments[i] = (
+                time, index, start, data, sequence, trafs, size - len(data)
+            )
+        self.paths.append(path)
+        self.fragments.append(fragments)
+
+    def add_moov(self, moov):
+        # returns the time scales of the tracks, by their IDs in the file
+        time_scale = moov.get(b'mvhd').get('time_scale')
+        if self.moov is None:
+            self.moov = moov
+            self.time_scale = time_scale
+        traks = moov.get_all(b'trak')
+        if moov is not self.moov:
+            i = self.moov.body.index(self.moov.get_all(b'trak')[-1]) + 1
+            self.moov.body[i:i] = traks
+        self.duration = max(
+            self.duration,
+            moov.get(b'mvhd').get('duration') * self.time_scale // time_scale
+        )
+
+        track_ids = {}
+        time_scales = {}
+        for trak in traks:
+            tkhd = trak.get(b'tkhd')
+            track_id = tkhd.get('track_id')
+            track_ids[track_id] = len(self.trex) + len(track_ids) + 1
+            time_scales[track_id] = trak.get(b'mdia', b'mdhd').get(
+                'time_scale'
+            )
+            retime_trak(trak, time_scale, self.time_scale)
+            tkhd.set('track_id', track_ids[track_id])
+        self.track_ids.append(track_ids)
+
+        mvex = moov.get(b'mvex').body
+        for type, start, end in child_atoms(mvex, 0, len(mvex)):
+            if type == b'trex':
+                trex = bytearray(mvex[start:end])
+                track_id = struct.unpack_from('>I', trex, 12)[0]
+                if track_id in track_ids:
+                    struct.pack_into('>I', trex, 12, track_ids[track_id])
+                    self.trex.append(bytes(trex))
+            elif type == b'mehd':
+                size = 8 if mvex[start + 8] == 1 else 4
+                duration = int.from_bytes(
+                    mvex[start + 12:start + 12 + size], 'big'
+                ) * self.time_scale // time_scale
+                self.fragment_duration = max(
+                    self.fragment_duration or 0, duration
+                )
+        if len(self.trex) != sum(map(len, self.track_ids)):
+            raise ValueError('tracks without trex')
+        return time_scales
+
+    def make_moov(self):
+        self.moov.get(b'mvhd').set('duration', self.duration)
+        self.moov.get(b'mvhd').set('next_track_id', len(self.trex) + 1)
+        mvex = b''.join(self.trex)
+        if self.fragment_duration is not None:
+            mvex = struct.pack(
+                '>I4sIQ', 20, b'mehd', 1 << 24, self.fragment_duration
+            ) + mvex
+        i = self.moov.body.index(self.moov.get(b'mvex'))
+        self.moov.body[i] = Atom(b'mvex', 8 + len(mvex), mvex)
+        self.moov.calsize()
+        return self.moov
+
+    def write(self, stream):
+        if self.ftyp:
+            stream.write(self.ftyp)
+        self.make_moov().write(stream)
+        with ExitStack() as stack:
+            sources = [
+                stack.enter_context(open(path, 'rb')) for path in self.paths
+            ]
+            fragments = heapq.merge(*self.fragments)
+            for number, fragment in enumerate(fragments, 1):
+                _, index, start, data, sequence, trafs, tail = fragment
+                moof = bytearray(data)
+                struct.pack_into('>I', moof, sequence, number)
+                for track, base, _ in trafs:
+                    track_id = struct.unpack_from('>I', moof, track)[0]
+                    struct.pack_into(
+                        '>I', moof, track, self.track_ids[index][track_id]
+                    )
+                    if base is not None:
+                        offset = struct.unpack_from('>Q', moof, base)[0]
+                        struct.pack_into(
+                            '>Q', moof, base, offset - start + stream.tell()
+                        )
+                stream.write(moof)
+                sources[index].seek(start + len(data))
+                copy_data(sources[index], stream, tail)
+
+
+##################################################
+# Matroska
+##################################################
+
+
+def vint_length(first):
+    if not first:
+        raise ValueError('bad EBML variable size integer')
+    return 9 - first.bit_length()
+
+
+def read_vint(data, pos):
+    # (value without its length marker, length)
+    if pos >= len(data):
+        raise ValueError('truncated EBML element')
+    n = vint_length(data[pos])
+    if pos + n > len(data):
+        raise ValueError('truncated EBML element')
+    return int.from_bytes(data[pos:pos + n], 'big') & ((1 << 7 * n) - 1), n
+
+
+def read_element(data, pos):
+    """Reads the header of the EBML element at pos of data.
+
+    Returns:
+        (id, size, body): its ID, the size of its body (None if unknown) and
+        where its body starts.
+    """
+    n = vint_length(data[pos]) if pos < len(data) else 0
+    id = int.from_bytes(data[pos:pos + n], 'big')
+    size, m = read_vint(data, pos + n)
+    if size == (1 << 7 * m) - 1:
+        size = None
+    return id, size, pos + n + m
+
+
+def children(data, start, end):
+    """Yields the ID, start, body start and end of the elements in
+    data[start:end].
+    """
+    while start < end:
+        id, size, body = read_element(data, start)
+        if size is None or body + size > end:
+            raise ValueError('bad size of EBML element %x' % id)
+        yield id, start, body, body + size
+        start = body + size
+
+
+def scan_elements(stream, start, end):
+    """Yields the ID, start, body start and end of the elements of stream
+    from start to end.
+    """
+    while start < end:
+        stream.seek(start)
+        id, size, body = read_element(stream.read(12), 0)
+        if size is None:
+            raise ValueError(
+                '%s: EBML elements of unknown size are not supported'
+                % stream.name
+            )
+        yield id, start, start + body, start + body + size
+        start += body + size
+
+
+def encode_vint(n, length=None):
+    if length is None:
+        length = 1
+        while n >= (1 << 7 * length) - 1:
+            length += 1
+    elif n >= (1 << 7 * length) - 1:
+        raise ValueError('%d does not fit in %d bytes' % (n, length))
+    return ((1 << 7 * length) | n).to_bytes(length, 'big')
+
+
+def encode_id(id):
+    return id.to_bytes((id.bit_length() + 7) // 8, 'big')
+
+
+def element(id, *parts):
+    body = b''.join(parts)
+    return encode_id(id) + encode_vint(len(body)) + body
+
+
+def uint_element(id, n, length=None):
+    return element(id, n.to_bytes(length or (n.bit_length() + 7) // 8 or 1,
+                                  'big'))
+
+
+def read_uint_element(data, start, end):
+    return int.from_bytes(data[start:end], 'big')
+
+
+def read_block(data, pos):
+    # the track number, time and flags of the (Simple)Block at pos
+    track, n = read_vint(data, pos)
+    time, flags = struct.unpack_from('>hB', data, pos + n)
+    return track, time, flags
+
+
+def renumber_blocks(cluster, body, numbers):
+    """Rewrites in place the track numbers of the blocks of the cluster
+    (a bytearray, whose body starts at body), by numbers, old to new.
+    """
+    for id, _, start, end in children(cluster, body, len(cluster)):
+        if id == SIMPLE_BLOCK:
+            blocks = [start]
+        elif id == BLOCK_GROUP:
+            blocks = [
+                x for i, _, x, _ in children(cluster, start, end)
+                if i == BLOCK
+            ]
+        else:
+            continue
+        for block in blocks:
+            track, n = read_vint(cluster, block)
+            if track in numbers:
+                cluster[block:block + n] = encode_vint(numbers[track], n)
+
+
+class WebMMuxer:
+    """Muxes the tracks of WebM (and Matroska) files, added one at a time,
+    into one file.
+
+    The tracks of a file follow those of the files before it, renumbered if
+    their numbers are taken. The clusters of all files are interleaved by
+    timecode and copied as they are, but for the track numbers of their
+    blocks. The Cues are rebuilt, a cue point per cluster starting with a
+    video keyframe, and the SeekHead with them.
+
+    Raises:
+        ValueError: from add(), for files of different timecode scales, or
+            elements of unknown size (live streams).
+    """
+    def __init__(self):
+        self.header = None
+        self.info = None
+        self.timecode_scale = None
+        self.duration = 0.0
+        self.entries = []
+        self.numbers = set()
+        self.uids = set()
+        self.extras = []
+        self.paths = []
+        # per file, old track number to new one
+        self.renumbered = []
+        # per file, (timecode, file index, start, end, cue)
+        self.clusters = []
+
+    def add(self, path):
+        index = len(self.paths)
+        with open(path, 'rb') as stream:
+            end = stream.seek(0, 2)
+            stream.seek(0)
+            id, size, body = read_element(stream.read(12), 0)
+            if id != EBML or size is None:
+                raise ValueError('%s: not an EBML file' % path)
+            stream.seek(0)
+            header = stream.read(body + size)
+            id, size, body = read_element(stream.read(12), 0)
+            if id != SEGMENT:
+                raise ValueError('%s: no Segment' % path)
+            start = len(header) + body
+            if size is not None:
+                end = min(end, start + size)
+            if self.header is None:
+                self.header = header
+
+            track_types = {}
+            clusters = []
+            for id, start, body, end in scan_elements(stream, start, end):
+                if id == INFO:
+                    stream.seek(body)
+                    self.add_info(stream.read(end - body), path)
+                elif id == TRACKS:
+                    stream.seek(body)
+                    track_types = self.add_tracks(stream.read(end - body))
+                elif id == CLUSTER:
+                    stream.seek(body)
+                    clusters.append(self.read_cluster(
+                        stream, index, start, body, end, track_types
+                    ))
+                elif id in EXTRA_ELEMENTS and index == 0:
+                    stream.seek(start)
+                    self.extras.append(stream.read(end - start))
+        if not track_types:
+            raise ValueError('%s: no Tracks' % path)
+        self.paths.append(path)
+        self.clusters.append(clusters)
+
+    def add_info(self, info, path):
+        timecode_scale = DEFAULT_TIMECODE_SCALE
+        kept = []
+        for id, start, body, end in children(info, 0, len(info)):
+            if id == DURATION:
+                self.duration = max(self.duration, struct.unpack(
+                    '>f' if end - body == 4 else '>d', info[body:end]
+                )[0])
+                continue
+            if id == TIMECODE_SCALE:
+                timecode_scale = read_uint_element(info, body, end)
+            kept.append(info[start:end])
+        if self.timecode_scale is None:
+            self.timecode_scale = timecode_scale
+            self.info = kept
+        elif timecode_scale != self.timecode_scale:
+            raise ValueError('%s: timecode scale %d, not %d' % (
+                path, timecode_scale, self.timecode_scale
+            ))
+
+    def add_tracks(self, tracks):
+        # returns the types of the tracks, by their new numbers
+        numbers = {}
+        track_types = {}
+        for id, _, start, end in children(tracks, 0, len(tracks)):
+            if id != TRACK_ENTRY:
+                continue
+            entry = []
+            number = track_type = None
+            for id, child, body, end in children(tracks, start, end):
+                if id == TRACK_NUMBER:
+                    number = read_uint_element(tracks, body, end)
+                    numbers[number] = number
+                    while numbers[number] in self.numbers:
+                        numbers[number] += 1
+                    self.numbers.add(numbers[number])
+                    entry.append(uint_element(TRACK_NUMBER, numbers[number]))
+                elif id == TRACK_UID:
+                    uid = read_uint_element(tracks, body, end)
+                    while uid in self.uids:
+                        uid += 1
+                    self.uids.add(uid)
+                    entry.append(uint_element(TRACK_UID, uid))
+                else:
+                    if id == TRACK_TYPE:
+                        track_type = read_uint_element(tracks, body, end)
+                    entry.append(tracks[child:end])
+            if number is None:
+                raise ValueError('TrackEntry without TrackNumber')
+            track_types[numbers[number]] = track_type
+            self.entries.append(element(TRACK_ENTRY, *entry))
+        self.renumbered.append({
+            old: new for old, new in numbers.items() if old != new
+        })
+        return track_types
+
+    def read_cluster(self, stream, index, start, body, end, track_types):
+        # its timecode, and the cue point of its first block if that is a
+        # video keyframe: the headers of the elements up to the first block
+        # are enough
+        timecode = None
+        pos = body
+        while pos < end:
+            stream.seek(pos)
+            data = stream.read(64)
+            id, size, child = read_element(data, 0)
+            if size is None:
+                raise ValueError(
+                    '%s: clusters of unknown size are not supported'
+                    % stream.name
+                )
+            if id == TIMECODE:
+                timecode = read_uint_element(data, child, child + size)
+            elif id in (SIMPLE_BLOCK, BLOCK_GROUP):
+                break
+            pos += child + size
+        else:
+            id = None
+        if timecode is None:
+            raise ValueError('%s: cluster without timecode' % stream.name)
+
+        cue = None
+        if id == SIMPLE_BLOCK:
+            track, time, flags = read_block(data, child)
+            key = flags & KEYFRAME
+        elif id == BLOCK_GROUP:
+            stream.seek(pos + child)
+            group = stream.read(size)
+            blocks = {i: x for i, _, x, _ in children(group, 0, size)}
+            if BLOCK not in blocks:
+                raise ValueError('%s: BlockGroup without Block' % stream.name)
+            track, time, _ = read_block(group, blocks[BLOCK])
+            key = REFERENCE_BLOCK not in blocks
+        if id is not None:
+            track = self.renumbered[index].get(track, track)
+            if key and track_types.get(track) == TRACK_TYPE_VIDEO:
+                cue = (track, max(0, timecode + time))
+        return timecode, index, start, end, cue
+
+    def make_seek_head(self, positions):
+        return element(SEEK_HEAD, *[
+            element(
+                SEEK, element(SEEK_ID, encode_id(id)),
+                uint_element(SEEK_POSITION, position, 8)
+            )
+            for id, position in positions
+        ])
+
+    def write(self, stream):
+        clusters = list(heapq.merge(*self.clusters))
+        head = [
+            element(INFO, *self.info + [
+                element(DURATION, struct.pack('>d', self.duration))
+            ]),
+            element(TRACKS, *self.entries),
+        ] + self.extras
+        ids = [read_element(x, 0)[0] for x in head]
+        if any(cluster[4] for cluster in clusters):
+            ids.append(CUES)
+        # positions in the segment; the SeekHead is of the same size
+        # whatever they are
+        size = len(self.make_seek_head([(id, 0) for id in ids]))
+        positions = []
+        for id, data in zip(ids, head):
+            positions.append((id, size))
+            size += len(data)
+
+        cue_points = []
+        for _, _, start, end, cue in clusters:
+            if cue:
+                track, time = cue
+                cue_points.append(element(
+                    CUE_POINT, uint_element(CUE_TIME, time),
+                    element(
+                        CUE_TRACK_POSITIONS, uint_element(CUE_TRACK, track),
+                        uint_element(CUE_CLUSTER_POSITION, size)
+                    )
+                ))
+            size += end - start
+        cues = b''
+        if cue_points:
+            positions.append((CUES, size))
+            cues = element(CUES, *cue_points)
+        seek_head = self.make_seek_head(positions)
+        size += len(cues)
+
+        stream.write(self.header)
+        stream.write(encode_id(SEGMENT) + encode_vint(size, 8))
+        stream.write(seek_head)
+        for data in head:
+            stream.write(data)
+        with ExitStack() as stack:
+            sources = [
+                stack.enter_context(open(path, 'rb')) for path in self.paths
+            ]
+            for _, index, start, end, _ in clusters:
+                source = sources[index]
+                source.seek(start)
+                if not self.renumbered[index]:
+                    copy_data(source, stream, end - start)
+                    continue
+                cluster = bytearray(source.read(end - start))
+                renumber_blocks(
+                    cluster, read_element(cluster, 0)[2],
+                    self.renumbered[index]
+                )
+                stream.write(cluster)
+        stream.write(cues)
+
+
+##################################################
+# main
+##################################################
+
+
+def mux_av(files, output):
+    """Muxes the tracks of files, the video first, into the file output.
+
+    The streams are copied as they are, so the files must be of one
+    container: MP4 (fragmented or not, not both), or WebM and Matroska,
+    which output must be of too.
+
+    Raises:
+        ValueError: for files that cannot be muxed this way.
+    """
+    assert files, 'no file to mux'
+    containers = set(map(probe_container, files))
+    if containers == {'mp4'}:
+        fragmented = set(map(is_fragmented, files))
+        if fragmented == {True}:
+            muxer = FragmentedMP4Muxer()
+        elif fragmented == {False}:
+            muxer = MP4Muxer()
+        else:
+            raise ValueError('fragmented and unfragmented MP4 files')
+    elif containers == {'matroska'}:
+        muxer = WebMMuxer()
+    else:
+        raise ValueError('cannot mux files of containers {}'.format(
+            ', '.join(sorted(map(str, containers)))
+        ))
+    print('Merging video parts...')
+    try:
+        for path in files:
+            muxer.add(path)
+    except (AssertionError, struct.error) as e:
+        # the atom readers of join_mp4 assert what they read
+        raise ValueError('{}: cannot read {}'.format(e, path))
+    if isinstance(muxer, MP4Muxer):
+        # the moov first, as concat_mp4 writes it
+        muxer.faststart()
+    with open(output, 'wb') as out:
+        muxer.write(out)
+    return output
+
+
+def usage():
+    print('Usage: [python3] mux_av.py --output TARGET video audio...')
+
+
+def main():
+    import sys
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ho:', ['help', 'output='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    output = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-o', '--output'):
+            output = a
+        else:
+            usage()
+            sys.exit(1)
+    if not args or not output:
+        usage()
+        sys.exit(1)
+
+    mux_av(args, output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import os
+
+from lulu.processor.join_flv import read_flv_header, read_tag
+from lulu.processor.join_mp4 import faststart_mp4
+from lulu.processor.mp4_writer import (
+    MP4Track,
+    MP4Writer,
+    moov_reserve,
+    avc1_entry,
+    mp4a_entry,
+    parse_avcc,
+    parse_audio_specific_config,
+)
+
+TAG_TYPE_AUDIO = 8
+TAG_TYPE_VIDEO = 9
+
+CODEC_ID_AVC = 7
+FRAME_TYPE_KEY = 1
+FRAME_TYPE_INFO = 5
+SOUND_FORMAT_AAC = 10
+# AVCPacketType and AACPacketType
+PACKET_TYPE_SEQUENCE_HEADER = 0
+PACKET_TYPE_DATA = 1
+
+# samples per AAC frame
+AAC_FRAME_SIZE = 1024
+# FLV timestamps are in milliseconds
+FLV_TIME_SCALE = 1000
+
+
+##################################################
+# streaming
+##################################################
+
+
+class FLVRemuxer:
+    """Remuxes FLV files of H.264 and AAC, fed one at a time from any
+    readable stream, into an MP4 file written to out, which must be
+    seekable. The samples are copied as they are. The moov goes before
+    them if it fits in the reserve bytes left for it, see MP4Writer.
+
+    The sample tables are built as the tags go by, so that the files are
+    joined and remuxed in one pass. Each file starts where the longer of
+    the tracks of the file before it ends, both tracks at once, so that
+    they do not drift apart over the files. Within a file the audio is
+    timed by its frames, which all last AAC_FRAME_SIZE samples, unless the
+    tag timestamps leave a gap.
+
+    Raises:
+        ValueError: from add(), for codecs other than H.264 and AAC.
+    """
+    def __init__(self, out, reserve=0):
+        self.writer = MP4Writer(out, reserve)
+        self.video = None
+        self.audio = None
+        # where the audio of the file started, in samples, and its frames
+        # since then
+        self.audio_start = None
+        self.audio_frames = 0
+        self.timestamp_start = 0
+        # where the last video sample ends, and the one before it starts
+        self.video_end = 0
+        self.last_timestamp = None
+
+    def add(self, stream):
+        read_flv_header(stream)
+        self.timestamp_start = max(self.video_end, self.audio_end())
+        self.last_timestamp = None
+        self.audio_start = None
+        while True:
+            tag = read_tag(stream)
+            if not tag:
+                break
+            data_type, timestamp, body_size, body, previous_tag_size = tag
+            if data_type == TAG_TYPE_VIDEO:
+                self.add_video(body, self.timestamp_start + timestamp)
+            elif data_type == TAG_TYPE_AUDIO:
+                self.add_audio(body, self.timestamp_start + timestamp)
+
+    def add_video(self, body, timestamp):
+        if len(body) < 5 or body[0] >> 4 == FRAME_TYPE_INFO:
+            return
+        if body[0] & 0x0f != CODEC_ID_AVC:
+            raise ValueError(
+                'unsupported FLV video codec: {}'.format(body[0] & 0x0f)
+            )
+        if body[1] == PACKET_TYPE_SEQUENCE_HEADER:
+            # AVCDecoderConfigurationRecord
+            avcc = bytes(body[5:])
+            width, height = parse_avcc(avcc)
+            entry = avc1_entry(avcc, width, height)
+            if self.video is None:
+                self.video = self.writer.add_track(MP4Track(
+                    b'vide', FLV_TIME_SCALE, entry, width, height
+                ))
+            else:
+                self.video.set_sample_entry(entry)
+        elif body[1] == PACKET_TYPE_DATA and self.video is not None:
+            composition_time = int.from_bytes(body[2:5], 'big', signed=True)
+            self.writer.write_sample(
+                self.video, body[5:], timestamp, composition_time,
+                sync=body[0] >> 4 == FRAME_TYPE_KEY
+            )
+            if self.last_timestamp is not None:
+                self.video_end = timestamp + timestamp - self.last_timestamp
+            else:
+                self.video_end = timestamp
+            self.last_timestamp = timestamp
+
+    def audio_end(self):
+        # where the last audio sample ends, in milliseconds, rounded up
+        if self.audio is None or not self.audio.decode_times:
+            return 0
+        end = self.audio.decode_times[-1] + AAC_FRAME_SIZE
+        return -(-end * FLV_TIME_SCALE // self.audio.time_scale)
+
+    def add_audio(self, body, timestamp):
+        if len(body) < 2:
+            return
+        if body[0] >> 4 != SOUND_FORMAT_AAC:
+            raise ValueError(
+                'unsupported FLV audio format: {}'.format(body[0] >> 4)
+            )
+        if body[1] == PACKET_TYPE_SEQUENCE_HEADER:
+            # AudioSpecificConfig
+            config = bytes(body[2:])
+            sample_rate, channels = parse_audio_specific_config(config)
+            if self.audio is None:
+                self.audio = self.writer.add_track(MP4Track(
+                    b'soun', sample_rate, mp4a_entry(config)
+                ))
+            elif sample_rate != self.audio.time_scale:
+                raise ValueError('the AAC sample rate changes')
+            else:
+                self.audio.set_sample_entry(mp4a_entry(config))
+        elif body[1] == PACKET_TYPE_DATA and self.audio is not None:
+            tag_time = timestamp * self.audio.time_scale // FLV_TIME_SCALE
+            if self.audio_start is None:
+                time = None
+            else:
+                time = self.audio_start + self.audio_frames * AAC_FRAME_SIZE
+            if time is None or tag_time - time > AAC_FRAME_SIZE:
+                self.audio_start, self.audio_frames = tag_time, 0
+                time = tag_time
+            self.writer.write_sample(self.audio, body[2:], time)
+            self.audio_frames += 1
+
+    def close(self):
+        return self.writer.close()
+
+
+##################################################
+# main
+##################################################
+
+
+def remux_flv(flvs, output):
+    """Joins FLV files of H.264 and AAC into the MP4 file output."""
+    assert flvs, 'no flv file found'
+    print('Merging video parts...')
+    reserve = moov_reserve(sum(map(os.path.getsize, flvs)))
+    # written aside, so that output is never left half done
+    temp = output + '.download'
+    try:
+        with open(temp, 'wb') as out:
+            remuxer = FLVRemuxer(out, reserve)
+            for flv in flvs:
+                with open(flv, 'rb') as stream:
+                    remuxer.add(stream)
+            moov_first = remuxer.close()
+        if not moov_first:
+            # the moov first, as concat_mp4 writes it
+            faststart_mp4(temp)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    os.replace(temp, output)
+    return output
+
+
+def usage():
+    print('Usage: [python3] remux_flv.py --output TARGET.mp4 flv...')
+
+
+def main():
+    import sys
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ho:', ['help', 'output='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    output = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-o', '--output'):
+            output = a
+        else:
+            usage()
+            sys.exit(1)
+    if not args or not output:
+        usage()
+        sys.exit(1)
+
+    remux_flv(args, output)
+
+
+if __name__ == '__main__':
+    main()
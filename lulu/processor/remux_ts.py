@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+
+import os
+import struct
+
+from lulu.processor.join_mp4 import faststart_mp4
+from lulu.processor.join_ts import (
+    PACKET_SIZE,
+    SYNC_BYTE,
+    TIMESTAMP_WRAP,
+    TSJoiner,
+    payload_start,
+    read_timestamp,
+)
+from lulu.processor.mp4_writer import (
+    MOVIE_TIME_SCALE,
+    AAC_SAMPLE_RATES,
+    MP4Track,
+    MP4Writer,
+    moov_reserve,
+    avc1_entry,
+    make_audio_specific_config,
+    make_avcc,
+    mp4a_entry,
+    parse_sps,
+)
+
+# PES timestamps count a 90 kHz clock
+TS_TIME_SCALE = 90000
+# samples per AAC frame
+AAC_FRAME_SIZE = 1024
+
+STREAM_TYPE_AAC = 0x0f
+STREAM_TYPE_H264 = 0x1b
+# audio and video stream types remux_ts cannot put in an MP4 file: MPEG-1
+# and MPEG-2 video and audio, MPEG-4 visual, LATM AAC, HEVC, AC-3, E-AC-3
+# and DTS; other streams, like ID3 tags, are dropped
+UNSUPPORTED_STREAM_TYPES = {
+    0x01, 0x02, 0x03, 0x04, 0x10, 0x11, 0x24, 0x81, 0x82, 0x87,
+}
+
+NAL_TYPE_IDR = 5
+NAL_TYPE_SPS = 7
+NAL_TYPE_PPS = 8
+NAL_TYPE_AUD = 9
+
+
+##################################################
+# demuxing
+##################################################
+
+
+def read_section(payload):
+    """Returns the PSI section starting in the payload of a packet, without
+    its CRC, or None if it does not fit in the packet.
+    """
+    start = 1 + payload[0]
+    if start + 3 > len(payload):
+        return None
+    length = (payload[start + 1] & 0x0f) << 8 | payload[start + 2]
+    end = start + 3 + length - 4
+    if length < 9 or end > len(payload):
+        return None
+    return payload[start:end]
+
+
+def read_pat(payload):
+    """Returns the PID of the PMT of the first program in the PAT."""
+    section = read_section(payload)
+    if section is None or section[0] != 0:
+        return None
+    for pos in range(8, len(section) - 3, 4):
+        program, pid = struct.unpack_from('>HH', section, pos)
+        if program:
+            return pid & 0x1fff
+    return None
+
+
+def read_pmt(payload):
+    """Returns the stream types of the elementary streams in the PMT, by
+    PID.
+    """
+    section = read_section(payload)
+    if section is None or section[0] != 2:
+        return None
+    streams = {}
+    pos = 12 + ((section[10] & 0x0f) << 8 | section[11])
+    while pos + 5 <= len(section):
+        stream_type, pid, info_length = struct.unpack_from(
+            '>BHH', section, pos
+        )
+        streams[pid & 0x1fff] = stream_type
+        pos += 5 + (info_length & 0x0fff)
+    return streams
+
+
+def probe_ts(data):
+    """Returns the stream types of the first program of the MPEG-TS in data
+    (whole packets), by PID, or None if its PMT is not in data.
+    """
+    pmt = None
+    for pos in range(0, len(data) - PACKET_SIZE + 1, PACKET_SIZE):
+        if data[pos] != SYNC_BYTE or not data[pos + 1] & 0x40:
+            continue
+        pid = (data[pos + 1] & 0x1f) << 8 | data[pos + 2]
+        start = payload_start(data, pos)
+        if start is None:
+            continue
+        payload = data[start:pos + PACKET_SIZE]
+        if pid == 0:
+            pmt = read_pat(payload)
+        elif pid == pmt:
+            return read_pmt(payload)
+    return None
+
+
+def is_remuxable(data):
+    """Tells whether the MPEG-TS in data has streams for TSRemuxer, and
+    none it cannot remux.
+    """
+    streams = probe_ts(data)
+    if not streams:
+        return False
+    types = set(streams.values())
+    return bool(types & {STREAM_TYPE_H264, STREAM_TYPE_AAC}) and \
+        not types & UNSUPPORTED_STREAM_TYPES
+
+
+def split_nal_units(data):
+    """Splits an H.264 Annex B byte stream into its NAL units."""
+    for nal in data.split(b'\x00\x00\x01'):
+        # the zero byte of the next 4-byte start code, and trailing zeros
+        nal = nal.rstrip(b'\x00')
+        if nal:
+            yield nal
+
+
+def read_adts(data):
+    """Yields (AudioSpecificConfig, sample rate index, frame) for the ADTS
+    frames in data, up to the first thing that is not one.
+    """
+    pos = 0
+    while pos + 7 <= len(data):
+        header = data[pos:pos + 7]
+        if header[0] != 0xff or header[1] & 0xf6 != 0xf0:
+            break
+        object_type = (header[2] >> 6) + 1
+        index = header[2] >> 2 & 0x0f
+        channels = (header[2] & 0x01) << 2 | header[3] >> 6
+        size = (header[3] & 0x03) << 11 | header[4] << 3 | header[5] >> 5
+        # with a CRC when protection_absent is not set
+        header_size = 7 if header[1] & 0x01 else 9
+        if size < header_size or index >= len(AAC_SAMPLE_RATES) or \
+                pos + size > len(data):
+            break
+        config = make_audio_specific_config(object_type, index, channels)
+        yield config, index, data[pos + header_size:pos + size]
+        pos += size
+
+
+class Stream:
+    """An elementary stream of an MPEG-TS, whose PES packets are put
+    together from the payloads of its TS packets.
+    """
+    def __init__(self, pid, stream_type):
+        self.pid = pid
+        self.stream_type = stream_type
+        self.payloads = []
+        self.track = None
+        # the last DTS, unwrapped, and what is added to unwrap them
+        self.last_timestamp = None
+        self.wraps = 0
+        # the H.264 parameter sets, and what the sample description in use
+        # was made of: (SPS, PPS) or an AudioSpecificConfig
+        self.sps = self.pps = None
+        self.config = None
+        # AAC frames written, and when the first one is in the track
+        self.audio_frames = 0
+        self.audio_start = 0
+
+    def unwrap(self, timestamp):
+        timestamp += self.wraps
+        if self.last_timestamp is not None and \
+                timestamp < self.last_timestamp - TIMESTAMP_WRAP // 2:
+            self.wraps += TIMESTAMP_WRAP
+            timestamp += TIMESTAMP_WRAP
+        self.last_timestamp = timestamp
+        return timestamp
+
+
+##################################################
+# streaming
+##################################################
+
+
+class TSRemuxer:
+    """Remuxes the H.264 and AAC streams of MPEG-TS files, fed one at a
+    time from any readable stream, into an MP4 file written to out, which
+    must be seekable. The samples are copied as they are, but for the H.264
+    parameter sets that go into the sample description.
+
+    The files go through a TSJoiner, so that their timestamps follow on,
+    which writes their packets back into write(). There the PES packets of
+    each stream are put together and turned into MP4 samples as the TS
+    packets go by: the NAL units of H.264 access units get 4-byte sizes in
+    place of their start codes, and the ADTS headers of AAC frames are
+    stripped. Only the first program is remuxed. The MP4 file is started
+    with the first sample, so that unsupported streams fail before anything
+    is written. The moov goes before the samples if it fits in the reserve
+    bytes left for it, see MP4Writer.
+
+    Raises:
+        ValueError: from add(), for streams of codecs other than H.264 and
+            AAC, and from close(), if there is nothing to remux.
+    """
+    def __init__(self, out, reserve=0):
+        self.out = out
+        self.reserve = reserve
+        self.joiner = TSJoiner(self)
+        self.writer = None
+        self.buffer = b''
+        self.pmt = None
+        self.streams = {}
+        # the first DTS in the file, and the first of each track, unwrapped
+        self.start = None
+        self.starts = {}
+
+    def add(self, stream):
+        self.joiner.add(stream)
+
+    def write(self, data):
+        data = self.buffer + bytes(data)
+        pos = 0
+        end = len(data) - PACKET_SIZE
+        while pos <= end:
+            if data[pos] != SYNC_BYTE:
+                # lost sync, on to the next packet
+                pos = data.find(SYNC_BYTE, pos + 1)
+                if pos < 0:
+                    pos = len(data)
+                continue
+            self.read_packet(data, pos)
+            pos += PACKET_SIZE
+        self.buffer = data[pos:]
+
+    def read_packet(self, data, pos):
+        pid = (data[pos + 1] & 0x1f) << 8 | data[pos + 2]
+        start = payload_start(data, pos)
+        if start is None or start >= pos + PACKET_SIZE:
+            return
+        unit_start = data[pos + 1] & 0x40
+        stream = self.streams.get(pid)
+        if stream is not None:
+            if unit_start:
+                self.read_pes(stream)
+            stream.payloads.append(data[start:pos + PACKET_SIZE])
+        elif unit_start and pid == 0:
+            self.pmt = read_pat(data[start:pos + PACKET_SIZE])
+        elif unit_start and pid == self.pmt:
+            streams = read_pmt(data[start:pos + PACKET_SIZE]) or {}
+            for es_pid, stream_type in streams.items():
+                if stream_type in UNSUPPORTED_STREAM_TYPES:
+                    raise ValueError(
+                        'unsupported MPEG-TS stream type: 0x{:02x}'.format(
+                            stream_type
+                        )
+                    )
+                if stream_type in (STREAM_TYPE_H264, STREAM_TYPE_AAC) and \
+                        es_pid not in self.streams:
+                    self.streams[es_pid] = Stream(es_pid, stream_type)
+
+    def read_pes(self, stream):
+        """Turns the PES packet put together for stream into samples."""
+        pes = b''.join(stream.payloads)
+        stream.payloads = []
+        if len(pes) < 9 or pes[:3] != b'\x00\x00\x01':
+            return
+        flags = pes[7] >> 6
+        data = pes[9 + pes[8]:]
+        if not flags & 2:
+            # no timestamps, the PES packet goes on from the one before
+            if stream.last_timestamp is None:
+                return
+            pts = dts = stream.last_timestamp - stream.wraps
+        else:
+            pts = dts = read_timestamp(pes, 9)
+            if flags == 3:
+                dts = read_timestamp(pes, 14)
+        composition_offset = (pts - dts) % TIMESTAMP_WRAP
+        dts = stream.unwrap(dts)
+        if self.start is None:
+            self.start = dts
+        if stream.stream_type == STREAM_TYPE_H264:
+            self.add_video(stream, data, dts, composition_offset)
+        else:
+            self.add_audio(stream, data, dts)
+
+    def add_track(self, stream, track, timestamp):
+        if self.writer is None:
+            self.writer = MP4Writer(self.out, self.reserve)
+        stream.track = self.writer.add_track(track)
+        self.starts[stream.track] = timestamp
+        return stream.track
+
+    def add_video(self, stream, data, timestamp, composition_offset):
+        sample = []
+        sync = False
+        for nal in split_nal_units(data):
+            nal_type = nal[0] & 0x1f
+            if nal_type == NAL_TYPE_SPS:
+                stream.sps = nal
+            elif nal_type == NAL_TYPE_PPS:
+                stream.pps = nal
+            elif nal_type != NAL_TYPE_AUD:
+                sync = sync or nal_type == NAL_TYPE_IDR
+                sample += [struct.pack('>I', len(nal)), nal]
+        if stream.sps is None or stream.pps is None:
+            # nothing can be decoded before the parameter sets
+            return
+        config = stream.sps, stream.pps
+        if config != stream.config:
+            stream.config = config
+            width, height = parse_sps(stream.sps)
+            entry = avc1_entry(make_avcc(*config), width, height)
+            if stream.track is None:
+                self.add_track(stream, MP4Track(
+                    b'vide', TS_TIME_SCALE, entry, width, height
+                ), timestamp)
+            else:
+                stream.track.set_sample_entry(entry)
+        if sample:
+            self.writer.write_sample(
+                stream.track, b''.join(sample),
+                timestamp - self.starts[stream.track], composition_offset,
+                sync=sync
+            )
+
+    def add_audio(self, stream, data, timestamp):
+        frames = list(read_adts(data))
+        if not frames:
+            return
+        config, sample_rate = frames[0][0], AAC_SAMPLE_RATES[frames[0][1]]
+        if config != stream.config:
+            stream.config = config
+            if stream.track is None:
+                self.add_track(stream, MP4Track(
+                    b'soun', sample_rate, mp4a_entry(config)
+                ), timestamp)
+            elif sample_rate != stream.track.time_scale:
+                raise ValueError('the AAC sample rate changes')
+            else:
+                stream.track.set_sample_entry(mp4a_entry(config))
+        # timed by the frames, unless the PES timestamps leave a gap
+        time = stream.audio_start + stream.audio_frames * AAC_FRAME_SIZE
+        pes_time = (timestamp - self.starts[stream.track]) * sample_rate // \
+            TS_TIME_SCALE
+        if pes_time - time > AAC_FRAME_SIZE:
+            stream.audio_start, stream.audio_frames = pes_time, 0
+            time = pes_time
+        for _, _, frame in frames:
+            self.writer.write_sample(stream.track, frame, time)
+            time += AAC_FRAME_SIZE
+        stream.audio_frames += len(frames)
+
+    def close(self):
+        self.joiner.close()
+        for stream in self.streams.values():
+            self.read_pes(stream)
+        if self.writer is None:
+            raise ValueError('no H.264 or AAC stream to remux')
+        for track, start in self.starts.items():
+            # the tracks start at their first DTS
+            track.delay = (start - self.start) * MOVIE_TIME_SCALE // \
+                TS_TIME_SCALE
+        return self.writer.close()
+
+
+##################################################
+# main
+##################################################
+
+
+def remux_ts(ts_parts, output):
+    """Joins MPEG-TS files of H.264 and AAC into the MP4 file output."""
+    assert ts_parts, 'no ts files found'
+    print('Merging video parts...')
+    reserve = moov_reserve(sum(map(os.path.getsize, ts_parts)))
+    # written aside, so that output is never left half done
+    temp = output + '.download'
+    try:
+        with open(temp, 'wb') as out:
+            remuxer = TSRemuxer(out, reserve)
+            for ts in ts_parts:
+                with open(ts, 'rb') as stream:
+                    remuxer.add(stream)
+            moov_first = remuxer.close()
+        if not moov_first:
+            # the moov first, as concat_mp4 writes it
+            faststart_mp4(temp)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    os.replace(temp, output)
+    return output
+
+
+def usage():
+    print('Usage: [python3] remux_ts.py --output TARGET.mp4 ts...')
+
+
+def main():
+    import sys
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ho:', ['help', 'output='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    output = None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-o', '--output'):
+            output = a
+        else:
+            usage()
+            sys.exit(1)
+    if not args or not output:
+        usage()
+        sys.exit(1)
+
+    remux_ts(args, output)
+
+
+if __name__ == '__main__':
+    main()
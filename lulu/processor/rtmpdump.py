@@ -1,24 +1,32 @@
 #!/usr/bin/env python
 
 import os.path
+import threading
 import subprocess
 
+from lulu.processor.capabilities import probe_rtmpdump
+
 
 def get_usable_rtmpdump(cmd):
-    try:
-        p = subprocess.Popen(
-            [cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        out, err = p.communicate()
-        return cmd
-    except Exception:
-        return None
+    return cmd if probe_rtmpdump(cmd) is not None else None
+
+
+# found on first use (see detect()), then read from the cache; a value set
+# before that is kept
+_UNDETECTED = object()
+RTMPDUMP = _UNDETECTED
+_detect_lock = threading.Lock()
 
 
-RTMPDUMP = get_usable_rtmpdump('rtmpdump')
+def detect():
+    global RTMPDUMP
+    with _detect_lock:
+        if RTMPDUMP is _UNDETECTED:
+            RTMPDUMP = get_usable_rtmpdump('rtmpdump')
 
 
 def has_rtmpdump_installed():
+    detect()
     return RTMPDUMP is not None
 
 
@@ -31,6 +39,7 @@ def download_rtmpdump_stream(url, title, ext, params={}, output_dir='.'):
     filename = '%s.%s' % (title, ext)
     filepath = os.path.join(output_dir, filename)
 
+    detect()
     cmdline = [RTMPDUMP, '-r']
     cmdline.append(url)
     cmdline.append('-o')
@@ -50,6 +59,7 @@ def download_rtmpdump_stream(url, title, ext, params={}, output_dir='.'):
 
 def play_rtmpdump_stream(player, url, params={}):
     # construct left side of pipe
+    detect()
     cmdline = [RTMPDUMP, '-r']
     cmdline.append(url)
 
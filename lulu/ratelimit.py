@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""Limits on what lulu takes of the network, shared by all the threads and
+jobs of the process, and changeable while it runs (see lulu.server):
+
+- bandwidth, a token bucket of bytes per second, which every read loop of a
+  download draws from (see common.throttle);
+- request_rate, requests per second by host, which urlopen_with_retry
+  waits for, against the 412 and 429 of API endpoints.
+
+Both are off until set.
+"""
+
+import re
+import time
+import threading
+from urllib import parse
+
+
+class TokenBucket:
+    """Lets through rate tokens a second, with bursts of up to capacity (a
+    second's worth if not given); no limit for a rate of None.
+
+    Takers may go into debt, to take more than capacity at once: they wait
+    until it is paid back, so that waiting is first come, first served.
+    """
+    def __init__(self, rate=None, capacity=None):
+        self._lock = threading.Lock()
+        self.set_rate(rate, capacity)
+
+    def set_rate(self, rate, capacity=None):
+        with self._lock:
+            self.rate = rate or None
+            self.capacity = capacity or self.rate
+            self.tokens = self.capacity or 0
+            self.updated = time.monotonic()
+
+    def consume(self, n=1):
+        """Takes n tokens, waiting for them as long as needed.
+        """
+        with self._lock:
+            if self.rate is None:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class HostRateLimiter:
+    """Limits the requests per second to hosts.
+
+    The rates are by domain: a rate for bilibili.com applies to
+    api.bilibili.com too, all its hosts sharing it; the rate of the None
+    domain applies to every other host, each on its own.
+    """
+    def __init__(self, rates=None):
+        self._lock = threading.Lock()
+        self.set_rates(rates or {})
+
+    def set_rates(self, rates):
+        with self._lock:
+            self.rates = {
+                domain and domain.lower(): rate
+                for domain, rate in rates.items() if rate
+            }
+            self.buckets = {}
+
+    def bucket(self, host):
+        host = (host or '').lower()
+        domains = [
+            domain for domain in self.rates
+            if domain and (host == domain or host.endswith('.' + domain))
+        ]
+        if domains:
+            key = max(domains, key=len)
+            rate = self.rates[key]
+        elif None in self.rates:
+            key, rate = host, self.rates[None]
+        else:
+            return None
+        with self._lock:
+            if key not in self.buckets:
+                # no bursts: requests go out evenly
+                self.buckets[key] = TokenBucket(rate, 1)
+            return self.buckets[key]
+
+    def wait(self, url):
+        """Waits for the turn of a request to url.
+        """
+        bucket = self.rates and self.bucket(parse.urlparse(url).hostname)
+        return bucket.consume() if bucket else 0
+
+
+bandwidth = TokenBucket()
+request_rate = HostRateLimiter()
+
+
+def parse_size(value):
+    """Parses a number of bytes, such as 500K or 1.5M (binary multiples).
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*$', value, re.I)
+    if match is None:
+        raise ValueError('not a size: ' + value)
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmg'.index(unit.lower() or ' '))
+
+
+def parse_host_rate(value):
+    """Parses [DOMAIN=]N, N requests per second, into (DOMAIN or None, N).
+    """
+    domain, _, rate = value.rpartition('=')
+    rate = float(rate)
+    if rate <= 0:
+        raise ValueError('not a rate: ' + value)
+    return domain or None, rate
+
+
+def get_limits():
+    return {
+        'bandwidth': bandwidth.rate,
+        'request_rates': {
+            domain or '*': rate
+            for domain, rate in request_rate.rates.items()
+        },
+    }
+
+
+def set_limits(limits):
+    """Sets the limits of a dict like get_limits() returns; keys left out
+    are left as they are.
+
+    Raises:
+        ValueError: A limit is not a number (or a size, for bandwidth); no
+            limit is set then.
+    """
+    def check(rate, name):
+        if rate is not None and (
+            not isinstance(rate, (int, float)) or rate < 0
+        ):
+            raise ValueError('not a {}: {!r}'.format(name, rate))
+        return rate
+
+    if 'bandwidth' in limits:
+        rate = limits['bandwidth']
+        if isinstance(rate, str):
+            rate = parse_size(rate)
+        rate = check(rate, 'bandwidth')
+    if 'request_rates' in limits:
+        if not isinstance(limits['request_rates'] or {}, dict):
+            raise ValueError('request_rates are by domain')
+        rates = {
+            None if domain == '*' else domain: check(rate, 'request rate')
+            for domain, rate in (limits['request_rates'] or {}).items()
+        }
+        request_rate.set_rates(rates)
+    if 'bandwidth' in limits:
+        bandwidth.set_rate(rate)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""Runs the downloads of many URLs at once (see common.download_main).
+
+A job is the download of one URL by its extractor, from the start to the
+end: it extracts, downloads (from start_transfer on), then merges. Jobs are
+started in the order they come, as long as
+
+- no more than `jobs` of them are downloading, and no more than `jobs +
+  ahead` are running at all: the next jobs extract while the others
+  download, and wait for their turn to download;
+- no more jobs of a site are running than the site allows. Sites are the
+  extractor modules, as config.SITES names them; most extractors keep their
+  state in one instance per module, so a site runs one job at a time
+  unless told otherwise.
+"""
+
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+
+from lulu.util import log
+
+
+QUEUED = 'queued'
+EXTRACTING = 'extracting'
+DOWNLOADING = 'downloading'
+DONE = 'done'
+FAILED = 'failed'
+
+# jobs read ahead of those running, so that the jobs of the other sites can
+# start while those of a busy site wait
+MAX_PENDING = 1000
+
+_local = threading.local()
+
+
+def current_job():
+    """The job the current thread runs, None outside of a scheduler.
+    """
+    return getattr(_local, 'job', None)
+
+
+class Job:
+    """The download of url, of the extractor module site, as a playlist or
+    not, with the keyword arguments options.
+
+    Its progress bars report to it (see update_received) instead of showing
+    themselves.
+    """
+    def __init__(self, url, site=None, playlist=False, options=None):
+        self.id = None
+        self.url = url
+        self.site = site
+        self.playlist = playlist
+        self.options = options or {}
+        self.state = QUEUED
+        self.error = None
+        self.total_size = 0
+        self.received = 0
+        self.started = None
+        self.finished = None
+        self.scheduler = None
+        self.transferring = False
+        self._lock = threading.Lock()
+
+    def expect(self, size):
+        with self._lock:
+            self.total_size += size or 0
+
+    def update_received(self, n):
+        with self._lock:
+            self.received += n
+
+    def start_transfer(self):
+        """Waits for the job's turn to download; once per job.
+        """
+        if self.transferring or self.scheduler is None:
+            return
+        self.scheduler._transfers.acquire()
+        self.transferring = True
+        self.state = DOWNLOADING
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'url': self.url,
+            'site': self.site,
+            'playlist': self.playlist,
+            'state': self.state,
+            'error': None if self.error is None else
+            str(self.error) or type(self.error).__name__,
+            'received': self.received,
+            'total_size': self.total_size,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class Scheduler:
+    """Runs jobs with run(job) on threads of their own.
+
+    Args:
+        jobs: How many jobs may download at once.
+        site_jobs: How many jobs of a site may run at once, by site; the None
+            key for the sites not in it, 1 if not given.
+        ahead: How many jobs may extract and wait for a download to end
+            besides, jobs if not given.
+    """
+    def __init__(self, run, jobs=1, site_jobs=None, ahead=None):
+        self.run_job = run
+        self.jobs = max(1, jobs)
+        self.ahead = self.jobs if ahead is None else max(0, ahead)
+        self.site_jobs = {None: 1}
+        self.site_jobs.update(site_jobs or {})
+        self.all = []
+        self._ids = itertools.count(1)
+        self._pending = deque()
+        self._running = {}
+        self._active = 0
+        self._transfers = threading.BoundedSemaphore(self.jobs)
+        self._cond = threading.Condition()
+
+    def site_limit(self, site):
+        return self.site_jobs.get(site, self.site_jobs[None])
+
+    def submit(self, job):
+        with self._cond:
+            job.id = next(self._ids)
+            job.scheduler = self
+            self.all.append(job)
+            self._pending.append(job)
+            self._dispatch()
+        return job
+
+    def _dispatch(self):
+        # with self._cond held
+        for job in list(self._pending):
+            if self._active >= self.jobs + self.ahead:
+                break
+            if self._running.get(job.site, 0) >= self.site_limit(job.site):
+                continue
+            self._pending.remove(job)
+            self._active += 1
+            self._running[job.site] = self._running.get(job.site, 0) + 1
+            job.state = EXTRACTING
+            threading.Thread(
+                target=self._work, args=(job,), daemon=True
+            ).start()
+
+    def _work(self, job):
+        _local.job = job
+        job.started = time.time()
+        try:
+            self.run_job(job)
+            job.state = DONE
+        except (Exception, SystemExit) as e:
+            # extractors give up with sys.exit too (log.wtf)
+            job.error = e
+            job.state = FAILED
+            log.e('{}: {}'.format(job.url, e or type(e).__name__))
+            logging.debug('job failed', exc_info=True)
+        finally:
+            _local.job = None
+            job.finished = time.time()
+            if job.transferring:
+                self._transfers.release()
+            with self._cond:
+                self._active -= 1
+                self._running[job.site] -= 1
+                self._dispatch()
+                self._cond.notify_all()
+
+    def run(self, jobs):
+        """Submits the jobs of an iterable, reading it only as far as there
+        is room for, and waits for all of them.
+        """
+        for job in jobs:
+            with self._cond:
+                while len(self._pending) >= MAX_PENDING:
+                    # timed, to stay interruptible
+                    self._cond.wait(1)
+            self.submit(job)
+        self.wait()
+
+    def get(self, id):
+        with self._cond:
+            for job in self.all:
+                if job.id == id:
+                    return job
+        return None
+
+    def forget(self, keep):
+        """Forgets the jobs which ended but the last keep of them.
+        """
+        with self._cond:
+            finished = [job for job in self.all if job.finished]
+            forgotten = set(finished[:max(0, len(finished) - keep)])
+            self.all = [job for job in self.all if job not in forgotten]
+
+    def wait(self):
+        with self._cond:
+            while self._pending or self._active:
+                self._cond.wait(1)
+
+    def progress(self):
+        """How many jobs are in which state, and the bytes they received out
+        of the bytes they expect.
+        """
+        with self._cond:
+            jobs = list(self.all)
+        progress = {
+            state: 0
+            for state in (QUEUED, EXTRACTING, DOWNLOADING, DONE, FAILED)
+        }
+        progress.update(jobs=len(jobs), received=0, total_size=0)
+        for job in jobs:
+            progress[job.state] += 1
+            progress['received'] += job.received
+            progress['total_size'] += job.total_size
+        return progress
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""lulu --serve: one lulu process which keeps running, and downloads the URLs
+it is sent over HTTP, through a Scheduler (see lulu.scheduler).
+
+The extractors it loaded, its connections (common.session) and its cookies
+stay warm from one job to the next. The API speaks JSON:
+
+    POST /jobs          {"url": URL, "playlist": false, "options": {...}},
+                        or {"urls": [URL, ...], ...}: the jobs queued
+    GET  /jobs          all the jobs, with their state and progress
+    GET  /jobs/ID       one job
+    GET  /progress      how many jobs are in which state, bytes received
+    GET  /limits        the limits of lulu.ratelimit
+    PUT  /limits        {"bandwidth": BYTES_PER_SECOND or "2M" or null,
+                         "request_rates": {DOMAIN or "*": N}}: sets them
+
+The options are those of the command line, by their names in download():
+output_dir, merge, caption, password, thread and stream_id.
+"""
+
+import json
+import logging
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from lulu import ratelimit
+from lulu.scheduler import Scheduler
+
+
+DEFAULT_ADDRESS = ('127.0.0.1', 8765)
+# options a request may set, over those of the command line
+OPTIONS = {'output_dir', 'merge', 'caption', 'password', 'thread',
+           'stream_id'}
+# jobs which ended kept for their status
+KEEP_FINISHED = 1000
+
+
+def parse_address(value):
+    """Parses [HOST:]PORT; only the loopback interface for a port alone.
+    """
+    host, _, port = value.rpartition(':')
+    return host or DEFAULT_ADDRESS[0], int(port)
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Handler(BaseHTTPRequestHandler):
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('serve: ' + format, *args)
+
+    def do_GET(self):
+        scheduler = self.server.scheduler
+        path = self.path.rstrip('/')
+        if path == '/jobs':
+            self.send_json(200, [job.to_dict() for job in scheduler.all])
+        elif path == '/progress':
+            self.send_json(200, scheduler.progress())
+        elif path == '/limits':
+            self.send_json(200, ratelimit.get_limits())
+        elif path.startswith('/jobs/'):
+            try:
+                job = scheduler.get(int(path[len('/jobs/'):]))
+            except ValueError:
+                job = None
+            if job is None:
+                self.send_json(404, {'error': 'no such job'})
+            else:
+                self.send_json(200, job.to_dict())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            jobs = self.server.submit(self.read_json())
+        except (ValueError, BadRequest) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(201, [job.to_dict() for job in jobs])
+
+    def do_PUT(self):
+        if self.path.rstrip('/') != '/limits':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            limits = self.read_json()
+            if not isinstance(limits, dict):
+                raise BadRequest('expected an object')
+            ratelimit.set_limits(limits)
+        except (ValueError, BadRequest) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(200, ratelimit.get_limits())
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    """Serves the API at address, running the jobs with run(job) (see
+    common.job_runner) and making them with make_job(url, playlist,
+    **options) (see common.make_job).
+
+    Args:
+        options: What the options of the jobs are, but for those a request
+            sets.
+        scheduler_options: The arguments of the Scheduler.
+    """
+    daemon_threads = True
+
+    def __init__(
+        self, address, run, make_job, options=None, **scheduler_options
+    ):
+        super().__init__(address, Handler)
+        self.make_job = make_job
+        self.options = options or {}
+        self.scheduler = Scheduler(run, **scheduler_options)
+
+    def submit(self, request):
+        if not isinstance(request, dict):
+            raise BadRequest('expected an object')
+        urls = request.get('urls') or [request.get('url')]
+        if not all(isinstance(url, str) and url for url in urls):
+            raise BadRequest('expected url or urls')
+        options = request.get('options') or {}
+        if not isinstance(options, dict) or not OPTIONS.issuperset(options):
+            raise BadRequest(
+                'options are among: ' + ', '.join(sorted(OPTIONS))
+            )
+        options = dict(self.options, **options)
+        playlist = bool(request.get('playlist'))
+        self.scheduler.forget(KEEP_FINISHED)
+        return [
+            self.scheduler.submit(self.make_job(url, playlist, **options))
+            for url in urls
+        ]
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+
+def serve(address, run, make_job, options=None, **scheduler_options):
+    """Serves until interrupted.
+    """
+    server = Server(address, run, make_job, options, **scheduler_options)
+    print('Serving on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
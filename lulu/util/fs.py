@@ -1,8 +1,20 @@
 #!/usr/bin/env python
 
+import os
+import stat
+import errno
 import platform
 
 
+# bytes copied at a time, by the kernel or through the buffer
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# errors telling that the kernel cannot copy between these two files
+_COPY_UNSUPPORTED = {
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.ENOTSOCK,
+    getattr(errno, 'EOPNOTSUPP', errno.EINVAL),
+}
+
+
 def legitimize(text, os=platform.system()):
     """Converts a string to a valid filename.
     """
@@ -44,3 +56,121 @@ def legitimize(text, os=platform.system()):
 
     text = text[:80]  # Trim to 82 Unicode characters long
     return text
+
+
+def _fileno(f):
+    try:
+        return f.fileno()
+    except (AttributeError, OSError, ValueError):
+        # io.UnsupportedOperation, for in-memory and network streams
+        return None
+
+
+def _copy_in_kernel(src_fd, dst_fd, offset, size, target):
+    copied = 0
+    dst_seekable = target.seekable()
+    dst_offset = target.tell() if dst_seekable else None
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        if method == 'copy_file_range' and not dst_seekable:
+            continue
+        if dst_seekable:
+            # sendfile writes at the position of dst_fd
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+        try:
+            while copied < size:
+                n = min(COPY_CHUNK_SIZE, size - copied)
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(
+                        src_fd, dst_fd, n, offset + copied,
+                        dst_offset + copied
+                    )
+                else:
+                    n = os.sendfile(dst_fd, src_fd, offset + copied, n)
+                if not n:
+                    break
+                copied += n
+            break
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED:
+                raise
+    if dst_seekable:
+        target.seek(dst_offset + copied)
+    return copied
+
+
+def _copy_buffered(source, target, size):
+    buffer = bytearray(COPY_CHUNK_SIZE if size is None else min(
+        COPY_CHUNK_SIZE, size
+    ))
+    view = memoryview(buffer)
+    copied = 0
+    while size is None or copied < size:
+        to_read = len(buffer) if size is None else min(
+            len(buffer), size - copied
+        )
+        n = source.readinto(view[:to_read])
+        if not n:
+            break
+        target.write(view[:n])
+        copied += n
+    return copied
+
+
+def copy_data(source, target, size=None):
+    """Copies size bytes (all that is left if size is None) from the current
+    position of the file object source to target.
+
+    The data is copied by the kernel, with os.copy_file_range or os.sendfile,
+    when the files allow it; otherwise through one reused buffer. Either way
+    memory use does not depend on size.
+
+    Returns:
+        The number of bytes copied.
+
+    Raises:
+        EOFError: source ended before size bytes.
+    """
+    copied = 0
+    src_fd, dst_fd = _fileno(source), _fileno(target)
+    if src_fd is not None and dst_fd is not None and size != 0 \
+            and source.seekable():
+        offset = source.tell()
+        if size is None and stat.S_ISREG(os.fstat(src_fd).st_mode):
+            size = max(0, os.fstat(src_fd).st_size - offset)
+        if size is not None:
+            target.flush()
+            copied = _copy_in_kernel(src_fd, dst_fd, offset, size, target)
+            source.seek(offset + copied)
+    copied += _copy_buffered(
+        source, target, None if size is None else size - copied
+    )
+    if size is not None and copied < size:
+        raise EOFError('not enough data: {} of {} bytes'.format(copied, size))
+    return copied
+
+
+def move_data(f, source, target, size):
+    """Moves size bytes of the file object f from offset source to offset
+    target, which may overlap, through one reused buffer.
+
+    The bytes are moved from the end when target is past source, so that
+    none is overwritten before it is moved; the file is not consistent
+    until the move is over.
+    """
+    if source == target or not size:
+        return
+    buffer = bytearray(min(COPY_CHUNK_SIZE, size))
+    view = memoryview(buffer)
+    done = 0
+    while done < size:
+        n = min(len(buffer), size - done)
+        # from the end when moving forward
+        offset = size - done - n if target > source else done
+        f.seek(source + offset)
+        if f.readinto(view[:n]) != n:
+            raise EOFError('not enough data at {}'.format(source + offset))
+        f.seek(target + offset)
+        f.write(view[:n])
+        done += n
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""Benchmarks the copies of the joiners over synthetic parts.
+
+Each method concatenates the same parts in a process of its own, which
+reports its wall time and peak memory:
+
+    python -m tests.bench_processor --size 2048 --parts 3
+    python -m tests.bench_processor --format flv --size 2048
+    python -m tests.bench_processor --format mp4 --size 1024
+
+Not collected by the test runner; the parts take size * parts MB of disk.
+"""
+
+import os
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+from lulu.util.fs import copy_data
+from lulu.processor import join_flv, join_mp4
+from lulu.processor.join_ts import concat_ts
+from tests.test_processor import make_mp4, make_ts
+
+
+def make_parts(directory, size, count):
+    # 1 MB of packets, video frames of 11 KB, from a timeline each part
+    # starts over: all the parts after the first have their timestamps and
+    # continuity counters rewritten
+    block = make_ts(90, frame_packets=60)
+    parts = []
+    for i in range(count):
+        part = os.path.join(directory, 'part{}.ts'.format(i))
+        with open(part, 'wb') as f:
+            for _ in range(size):
+                f.write(block)
+        parts.append(part)
+    return parts
+
+
+def make_flv_parts(directory, size, count):
+    # tags of 8 KB, about what a video frame takes
+    body = os.urandom(8192 - 15)
+    parts = []
+    for i in range(count):
+        part = os.path.join(directory, 'part{}.flv'.format(i))
+        with open(part, 'wb') as f:
+            join_flv.write_flv_header(f)
+            meta = join_flv.ECMAObject(1)
+            meta.put('duration', float(size))
+            join_flv.write_meta_tag(f, 'onMetaData', meta)
+            for n in range(size * 128):
+                join_flv.write_tag(f, (9, n * 40, len(body), body, 0))
+            join_flv.write_uint(f, 11 + len(body))
+        parts.append(part)
+    return parts
+
+
+def make_mp4_parts(directory, size, count):
+    # 384 video samples of 2 KB and 512 audio samples of 512 B per MB, the
+    # sample tables of 1024 MB are those of a 3 hour video at 60 fps
+    parts = []
+    for i in range(count):
+        part = os.path.join(directory, 'part{}.mp4'.format(i))
+        with open(part, 'wb') as f:
+            make_mp4(f, [2048] * size * 384, [512] * size * 512)
+        parts.append(part)
+    return parts
+
+
+def cat(parts, output):
+    with open(output, 'wb') as f:
+        subprocess.check_call(['cat'] + parts, stdout=f)
+
+
+def read_whole(parts, output):
+    # how concat_ts used to copy
+    with open(output, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as f:
+                out.write(f.read())
+
+
+def read_chunks(parts, output):
+    # how join_mp4.copy_stream used to copy
+    with open(output, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as f:
+                while True:
+                    s = f.read(1024 * 1024)
+                    if not s:
+                        break
+                    out.write(s)
+
+
+def buffered(parts, output):
+    # copy_data, without the kernel copies
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    for name in ('copy_file_range', 'sendfile'):
+        if hasattr(os, name):
+            delattr(os, name)
+    try:
+        with open(output, 'wb') as out:
+            for part in parts:
+                with open(part, 'rb') as f:
+                    copy_data(f, out)
+    finally:
+        if copy_file_range:
+            os.copy_file_range = copy_file_range
+        if sendfile:
+            os.sendfile = sendfile
+
+
+def join_ts(parts, output):
+    concat_ts(parts, output)
+
+
+def tag_loop(parts, output):
+    # how concat_flv used to rewrite the tags
+    with open(output, 'wb') as out:
+        timestamp_start = 0
+        for part in parts:
+            with open(part, 'rb') as stream:
+                join_flv.read_flv_header(stream)
+                join_flv.read_tag(stream)
+                while True:
+                    tag = join_flv.read_tag(stream)
+                    if not tag:
+                        break
+                    data_type, timestamp, body_size, body, previous = tag
+                    timestamp += timestamp_start
+                    join_flv.write_tag(out, (
+                        data_type, timestamp, body_size, body, previous
+                    ))
+                timestamp_start = timestamp
+
+
+def concat_flv(parts, output):
+    join_flv.concat_flv(parts, output)
+
+
+def merge_moov(parts, output):
+    # the sample tables alone: parsed, merged and written
+    merger = join_mp4.MP4Merger()
+    for part in parts:
+        merger.add(part)
+    merger.layout()
+    with open(output, 'wb') as out:
+        merger.moov.write(out)
+
+
+def concat_mp4(parts, output):
+    join_mp4.concat_mp4(parts, output)
+
+
+METHODS = {
+    'ts': (make_parts, [cat, read_whole, read_chunks, buffered, join_ts]),
+    'flv': (make_flv_parts, [cat, tag_loop, concat_flv]),
+    'mp4': (make_mp4_parts, [cat, merge_moov, concat_mp4]),
+}
+
+
+def run(method, parts, output, queue):
+    start = time.perf_counter()
+    method(parts, output)
+    with open(output, 'rb+') as f:
+        os.fsync(f.fileno())
+    elapsed = time.perf_counter() - start
+    # kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((elapsed, peak))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--size', type=int, default=1024, help='Size of a part, in MB'
+    )
+    parser.add_argument('--parts', type=int, default=3, help='Parts')
+    parser.add_argument(
+        '--format', choices=sorted(METHODS), default='ts',
+        help='Format of the parts'
+    )
+    parser.add_argument(
+        '--dir', default=None, help='Where to put the parts (a temp dir)'
+    )
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        make, methods = METHODS[args.format]
+        parts = make(directory, args.size, args.parts)
+        output = os.path.join(directory, 'output.' + args.format)
+        total = args.size * args.parts
+        print('{} parts of {} MB'.format(args.parts, args.size))
+        print('{:<12} {:>10} {:>10} {:>12}'.format(
+            'method', 'seconds', 'MB/s', 'peak RSS MB'
+        ))
+        for method in methods:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run, args=(method, parts, output, queue)
+            )
+            process.start()
+            elapsed, peak = queue.get()
+            process.join()
+            os.remove(output)
+            print('{:<12} {:>10.2f} {:>10.0f} {:>12.1f}'.format(
+                method.__name__, elapsed, total / elapsed, peak
+            ))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,12 @@ import unittest
 TEST_MODULES = [
     'tests.test_util',
     'tests.test_common',
+    'tests.test_hls',
+    'tests.test_dash',
+    'tests.test_processor',
+    'tests.test_scheduler',
+    'tests.test_server',
+    'tests.test_ratelimit',
     'tests.test_extractors',
 ]
 
@@ -1,9 +1,34 @@
 #!/usr/bin/env python
 
+import io
+import os
+import time
+import zlib
+import shutil
+import tempfile
 import unittest
+from contextlib import redirect_stdout
 
+import requests
+
+from lulu import common
+from lulu import journal
+from lulu.processor import ffmpeg
 from lulu.common import (
     match1,
+    url_info,
+    url_save,
+    urls_size,
+)
+from lulu.processor.mux_av import mux_av
+from lulu.processor.remux_flv import remux_flv
+from lulu.processor.remux_ts import remux_ts
+from tests.util import start_http_server
+from tests.test_processor import (
+    FAKE_FFMPEG,
+    make_av_ts,
+    make_avc_flv,
+    make_fragmented_mp4,
 )
 
 
@@ -23,5 +48,554 @@ class TestCommon(unittest.TestCase):
         )
 
 
+class TestUrlSave(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        self.server = start_http_server({'/video.mp4': self.data})
+        self.url = self.server.url + '/video.mp4'
+        self.output_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.output_dir, 'video.mp4')
+        self.segment_min_size = common.SEGMENT_MIN_SIZE
+        common.SEGMENT_MIN_SIZE = 1024 * 1024
+
+    def tearDown(self):
+        common.SEGMENT_MIN_SIZE = self.segment_min_size
+        self.server.stop()
+        shutil.rmtree(self.output_dir)
+
+    def read_output(self):
+        with open(self.filepath, 'rb') as f:
+            return f.read()
+
+    def test_single_connection(self):
+        url_save(self.url, self.filepath, None)
+        self.assertEqual(self.read_output(), self.data)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_resume(self):
+        with open(self.filepath + '.download', 'wb') as f:
+            f.write(self.data[:1000])
+        url_save(self.url, self.filepath, None)
+        self.assertEqual(self.read_output(), self.data)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0][2]['Range'], 'bytes=1000-')
+
+    def test_resume_without_range_support(self):
+        self.server.accept_ranges = False
+        with open(self.filepath + '.download', 'wb') as f:
+            f.write(b'x' * 1000)
+        url_save(self.url, self.filepath, None)
+        self.assertEqual(self.read_output(), self.data)
+
+    def test_resume_past_the_end(self):
+        # the file shrank since the partial download: a 416 of another size
+        temp_filepath = self.filepath + '.download'
+        with open(temp_filepath, 'wb') as f:
+            f.write(b'x' * (len(self.data) + 1000))
+        url_save(self.url, self.filepath, None)
+        self.assertEqual(self.read_output(), self.data)
+        self.assertFalse(os.path.exists(temp_filepath))
+        self.assertEqual(
+            [headers['Range'] for _, _, headers in self.server.requests],
+            ['bytes={}-'.format(len(self.data) + 1000), None]
+        )
+
+    def test_resume_complete(self):
+        with open(self.filepath + '.download', 'wb') as f:
+            f.write(self.data)
+        url_save(self.url, self.filepath, None)
+        self.assertEqual(self.read_output(), self.data)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_skip_existing(self):
+        with open(self.filepath, 'wb') as f:
+            f.write(self.data)
+        url_save(self.url, self.filepath, None, is_part=True)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertFalse(os.path.exists(self.filepath + '.download'))
+
+    def test_segmented(self):
+        url_save(self.url, self.filepath, None, thread=8)
+        self.assertEqual(self.read_output(), self.data)
+        ranges = [
+            headers['Range'] for _, _, headers in self.server.requests
+            if headers['Range']
+        ]
+        # the first range is served by the response that told the size
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(len(ranges), 3)
+        self.assertFalse(os.path.exists(self.filepath + '.download.ranges'))
+
+    def test_segmented_resume(self):
+        temp_filepath = self.filepath + '.download'
+        ranges = common.split_ranges(len(self.data), 3)
+        ranges[1][2] = 1000
+        with open(temp_filepath, 'wb') as f:
+            f.truncate(len(self.data))
+            f.seek(ranges[1][0])
+            f.write(self.data[ranges[1][0]:ranges[1][0] + 1000])
+        common.save_segment_state(
+            temp_filepath + '.ranges', len(self.data), ranges
+        )
+        url_save(self.url, self.filepath, None, thread=3)
+        self.assertEqual(self.read_output(), self.data)
+        self.assertIn(
+            'bytes={}-{}'.format(ranges[1][0] + 1000, ranges[1][1]),
+            [headers['Range'] for _, _, headers in self.server.requests]
+        )
+
+    def test_segmented_without_range_support(self):
+        self.server.accept_ranges = False
+        url_save(self.url, self.filepath, None, thread=4)
+        self.assertEqual(self.read_output(), self.data)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.data = [os.urandom(100000 + i) for i in range(3)]
+        files = {}
+        for i, data in enumerate(self.data):
+            # as signed URLs, which expire
+            files['/{}.ts'.format(i)] = files['/{}.ts?e=2'.format(i)] = data
+        self.server = start_http_server(files)
+        self.urls = [
+            self.server.url + '/{}.ts'.format(i) for i in range(3)
+        ]
+        self.output_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.output_dir, 'video.ts')
+        self.parts = [
+            os.path.join(self.output_dir, 'video[{:0>2d}].ts'.format(i))
+            for i in range(3)
+        ]
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.output_dir)
+
+    def open_journal(self):
+        return journal.Journal.open(self.output, {
+            'extractor': None, 'stream_id': None, 'ext': 'ts'
+        }, 3)
+
+    def write(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def ranges(self):
+        return [
+            (path, headers['Range'])
+            for _, path, headers in self.server.requests
+        ]
+
+    def test_resume(self):
+        # the bytes after those the journal vouches for are dropped
+        j = self.open_journal()
+        part = j.part(1)
+        part.state = journal.PARTIAL
+        part.received = 1000
+        part.checksum = zlib.crc32(self.data[1][:1000])
+        j.save()
+        self.write(self.parts[1] + '.download', self.data[1][:1000] + b'x')
+        url_save(self.urls[1], self.parts[1], None, part=j.part(1))
+        self.assertEqual(self.read(self.parts[1]), self.data[1])
+        self.assertEqual(self.ranges(), [('/1.ts', 'bytes=1000-')])
+        self.assertEqual(part.state, journal.DONE)
+        self.assertEqual(part.checksum, zlib.crc32(self.data[1]))
+
+        # not what was downloaded: start over
+        part.state = journal.PARTIAL
+        self.write(self.parts[1] + '.download', b'x' * 1000)
+        os.remove(self.parts[1])
+        url_save(self.urls[1], self.parts[1], None, part=part)
+        self.assertEqual(self.read(self.parts[1]), self.data[1])
+        self.assertEqual(self.ranges()[1], ('/1.ts', None))
+
+    def test_changed(self):
+        self.server.etags['/0.ts'] = '"new"'
+        part = self.open_journal().part(0)
+        part.state = journal.PARTIAL
+        part.received = 1000
+        part.checksum = zlib.crc32(b'y' * 1000)
+        part.etag = '"old"'
+        self.write(self.parts[0] + '.download', b'y' * 1000)
+        url_save(self.urls[0], self.parts[0], None, part=part)
+        self.assertEqual(self.read(self.parts[0]), self.data[0])
+        self.assertEqual(
+            self.ranges(), [('/0.ts', 'bytes=1000-'), ('/0.ts', None)]
+        )
+        self.assertEqual(part.etag, '"new"')
+
+    def test_download_urls(self):
+        # a run which crashed while merging: the first part done, the second
+        # half done, the third not started
+        j = self.open_journal()
+        self.write(self.parts[0], self.data[0])
+        j.part(0).finish(len(self.data[0]))
+        self.write(self.parts[1] + '.download', self.data[1][:500])
+        part = j.part(1)
+        part.state = journal.PARTIAL
+        part.received = 500
+        part.checksum = zlib.crc32(self.data[1][:500])
+        j.set_state('merging')
+        self.write(self.output, b''.join(self.data))
+
+        # fresh URLs, same files
+        self.urls = [url + '?e=2' for url in self.urls]
+        common.download_urls(
+            self.urls, 'video', 'ts', sum(map(len, self.data)),
+            output_dir=self.output_dir, merge=False
+        )
+        self.assertEqual(self.ranges(), [
+            ('/1.ts?e=2', 'bytes=500-'), ('/2.ts?e=2', None)
+        ])
+        for path, data in zip(self.parts, self.data):
+            self.assertEqual(self.read(path), data)
+        self.assertFalse(journal.exists(self.output))
+
+    def test_stale(self):
+        # the journal of another stream
+        journal.Journal(self.output, {'stream_id': 'hd'}, 3).save()
+        self.write(self.parts[2] + '.download', b'z' * 10)
+        part = self.open_journal().part(2)
+        self.assertEqual(part.state, journal.STALE)
+        url_save(self.urls[2], self.parts[2], None, part=part)
+        self.assertEqual(self.read(self.parts[2]), self.data[2])
+        self.assertEqual(self.ranges(), [('/2.ts', None)])
+
+
+class CountingProgressBar(common.DummyProgressBar):
+    received = 0
+
+    def update_received(self, n):
+        self.received += n
+
+
+class TestStreamMerge(unittest.TestCase):
+    def setUp(self):
+        # parts of 400 KB, each from a timeline of its own
+        self.data = [
+            make_av_ts(400 + i, i * 90000, frame_size=500)[0]
+            for i in range(4)
+        ]
+        files = {}
+        for i, data in enumerate(self.data):
+            # as signed URLs, which expire
+            files['/{}.ts'.format(i)] = files['/{}.ts?e=2'.format(i)] = data
+        self.server = start_http_server(files)
+        self.urls = [
+            self.server.url + '/{}.ts'.format(i) for i in range(4)
+        ]
+        self.output_dir = tempfile.mkdtemp()
+        self.parts = [
+            os.path.join(self.output_dir, 'video[{:0>2d}].ts'.format(i))
+            for i in range(4)
+        ]
+        self.ffmpeg = ffmpeg.FFMPEG
+        ffmpeg.FFMPEG = None
+
+    def tearDown(self):
+        ffmpeg.FFMPEG = self.ffmpeg
+        self.server.stop()
+        shutil.rmtree(self.output_dir)
+
+    def download(self, thread):
+        output = os.path.join(self.output_dir, 'video.mp4')
+        bar = CountingProgressBar()
+        total_size = sum(map(len, self.data))
+        common.download_urls_streamed(
+            self.urls, self.parts, output, 'ts', bar, thread=thread,
+            total_size=total_size
+        )
+        self.assertEqual(bar.received, total_size)
+        self.assertEqual(os.listdir(self.output_dir), ['video.mp4'])
+
+        # remuxed as the parts would be once downloaded
+        expected_dir = tempfile.mkdtemp()
+        try:
+            parts = []
+            for i, data in enumerate(self.data):
+                parts.append(os.path.join(expected_dir, '{}.ts'.format(i)))
+                with open(parts[-1], 'wb') as f:
+                    f.write(data)
+            remux_ts(parts, os.path.join(expected_dir, 'video.mp4'))
+            with open(os.path.join(expected_dir, 'video.mp4'), 'rb') as f:
+                expected = f.read()
+        finally:
+            shutil.rmtree(expected_dir)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_sequential(self):
+        self.download(thread=0)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_prefetch(self):
+        self.download(thread=3)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_unsupported_codecs(self):
+        # HEVC, which MP4 cannot take without FFmpeg: merged as MPEG-TS,
+        # once downloaded
+        for i in range(4):
+            self.data[i] = make_av_ts(
+                400 + i, i * 90000, (0x24, 0x0f), frame_size=500
+            )[0]
+            self.server.files['/{}.ts'.format(i)] = self.data[i]
+        stream_merge = common.stream_merge
+        common.stream_merge = True
+        try:
+            common.download_urls(
+                self.urls, 'video', 'ts', sum(map(len, self.data)),
+                output_dir=self.output_dir, thread=3
+            )
+        finally:
+            common.stream_merge = stream_merge
+        self.assertEqual(os.listdir(self.output_dir), ['video.ts'])
+        with open(os.path.join(self.output_dir, 'video.ts'), 'rb') as f:
+            self.assertTrue(f.read().startswith(self.data[0][:188]))
+
+    def test_failure(self):
+        # the prefetched parts are dropped along with the output
+        self.urls[0] = self.server.url + '/missing.ts'
+        with self.assertRaises(requests.HTTPError):
+            common.download_urls_streamed(
+                self.urls, self.parts,
+                os.path.join(self.output_dir, 'video.mp4'), 'ts',
+                CountingProgressBar(), thread=3
+            )
+        for _ in range(100):
+            if not os.listdir(self.output_dir):
+                break
+            time.sleep(0.05)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+
+class TestMergeWithoutFFmpeg(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.server = start_http_server({})
+        self.ffmpeg = ffmpeg.FFMPEG
+        ffmpeg.FFMPEG = None
+
+    def tearDown(self):
+        ffmpeg.FFMPEG = self.ffmpeg
+        self.server.stop()
+        shutil.rmtree(self.output_dir)
+
+    def download(self, parts, ext):
+        urls = []
+        for i, data in enumerate(parts):
+            self.server.files['/{}.{}'.format(i, ext)] = data
+            urls.append('{}/{}.{}'.format(self.server.url, i, ext))
+        common.download_urls(
+            urls, 'video', ext, sum(map(len, parts)),
+            output_dir=self.output_dir
+        )
+        return os.listdir(self.output_dir)
+
+    def test_flv_as_mp4(self):
+        # FLV parts served as .mp4 are remuxed
+        parts = [
+            make_avc_flv([i * 40 for i in range(10)], 0, 12),
+            make_avc_flv([i * 40 for i in range(5)], 10, 7),
+        ]
+        expected_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i, data in enumerate(parts):
+                paths.append(os.path.join(expected_dir, '{}.flv'.format(i)))
+                with open(paths[-1], 'wb') as f:
+                    f.write(data)
+            remux_flv(paths, os.path.join(expected_dir, 'video.mp4'))
+            with open(os.path.join(expected_dir, 'video.mp4'), 'rb') as f:
+                expected = f.read()
+        finally:
+            shutil.rmtree(expected_dir)
+        self.assertEqual(self.download(parts, 'mp4'), ['video.mp4'])
+        with open(os.path.join(self.output_dir, 'video.mp4'), 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_unsupported_flv_as_mp4(self):
+        # MP3 audio stays in FLV
+        parts = [
+            make_avc_flv([i * 40 for i in range(10)], i * 10, 12).replace(
+                b'\xaf\x00\x12\x10', b'\x2f\x00\x12\x10'
+            )
+            for i in range(2)
+        ]
+        self.assertEqual(self.download(parts, 'mp4'), ['video.flv'])
+        with open(os.path.join(self.output_dir, 'video.flv'), 'rb') as f:
+            self.assertEqual(f.read(3), b'FLV')
+
+    def test_unsupported_ts_as_mp4(self):
+        # MPEG-2 video stays in MPEG-TS
+        parts = [
+            make_av_ts(3, i * 90000, stream_types=(0x02, 0x0f))[0]
+            for i in range(2)
+        ]
+        self.assertEqual(self.download(parts, 'mp4'), ['video.ts'])
+        with open(os.path.join(self.output_dir, 'video.ts'), 'rb') as f:
+            self.assertTrue(f.read().startswith(parts[0][:188]))
+
+
+class TestAVMerge(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.parts = []
+        files = {}
+        for track, name in ((1, 'video.mp4'), (2, 'audio.m4a')):
+            self.parts.append(os.path.join(self.output_dir, name))
+            with open(self.parts[-1], 'w+b') as f:
+                make_fragmented_mp4(
+                    f, track, [(i, [100 * track] * 5) for i in range(3)]
+                )
+                f.seek(0)
+                files['/' + name] = f.read()
+        self.server = start_http_server(files)
+        self.ffmpeg = ffmpeg.FFMPEG
+        ffmpeg.FFMPEG = None
+
+    def tearDown(self):
+        ffmpeg.FFMPEG = self.ffmpeg
+        self.server.stop()
+        shutil.rmtree(self.output_dir)
+
+    def test_download(self):
+        # muxed without FFmpeg, as mux_av muxes the tracks
+        expected = os.path.join(self.output_dir, 'expected.mp4')
+        mux_av(self.parts, expected)
+        with open(expected, 'rb') as f:
+            expected = f.read()
+        output_dir = os.path.join(self.output_dir, 'output')
+        os.mkdir(output_dir)
+        common.download_urls(
+            [self.server.url + '/video.mp4', self.server.url + '/audio.m4a'],
+            'video', 'mp4', None, output_dir=output_dir, av=True
+        )
+        self.assertEqual(os.listdir(output_dir), ['video.mp4'])
+        with open(os.path.join(output_dir, 'video.mp4'), 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_merge_av(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertTrue(common.merge_av(
+                self.parts, os.path.join(self.output_dir, 'av.mp4'), 'mp4'
+            ))
+        self.assertRegex(
+            output.getvalue(), r'Merged into av.mp4 \(\d+\.\d\ds of CPU time\)'
+        )
+
+        # by an FFmpeg which fails
+        fake = os.path.join(self.output_dir, 'ffmpeg')
+        with open(fake, 'w') as f:
+            f.write(FAKE_FFMPEG)
+        os.chmod(fake, 0o755)
+        ffmpeg.FFMPEG = fake
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertFalse(common.merge_av(
+                self.parts, os.path.join(self.output_dir, 'av.fail'), 'webm'
+            ))
+        self.assertNotIn('Merged into', output.getvalue())
+
+
+class TestProbe(unittest.TestCase):
+    def setUp(self):
+        self.server = start_http_server({
+            '/{}.mp4'.format(i): b'x' * i for i in range(1, 6)
+        })
+        common.clear_probe_cache()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_urls_size(self):
+        urls = [
+            '{}/{}.mp4'.format(self.server.url, i) for i in range(1, 6)
+        ]
+        self.assertEqual(urls_size(urls + urls), 30)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(
+            set(method for method, _, _ in self.server.requests), {'HEAD'}
+        )
+
+    def test_cache(self):
+        url = self.server.url + '/1.mp4'
+        urls_size([url])
+        # another Referer, another answer maybe
+        urls_size([url], headers=dict(common.FAKE_HEADERS, Referer='x'))
+        self.assertEqual(len(self.server.requests), 2)
+        urls_size([url])
+        self.assertEqual(len(self.server.requests), 2)
+
+        ttl, size = common.PROBE_CACHE_TTL, common.PROBE_CACHE_SIZE
+        common.PROBE_CACHE_TTL, common.PROBE_CACHE_SIZE = -1, 2
+        try:
+            urls_size([url])
+            self.assertEqual(len(self.server.requests), 3)
+            urls_size([
+                '{}/{}.mp4'.format(self.server.url, i) for i in range(2, 6)
+            ])
+            self.assertEqual(len(common._probes), 2)
+        finally:
+            common.PROBE_CACHE_TTL, common.PROBE_CACHE_SIZE = ttl, size
+
+    def test_url_info(self):
+        self.assertEqual(
+            url_info(self.server.url + '/3.mp4', refer='http://example.com'),
+            ('video/mp4', 'mp4', 3)
+        )
+        self.assertEqual(
+            self.server.requests[0][2]['Referer'], 'http://example.com'
+        )
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.server = start_http_server({'/page': b'<html></html>'})
+
+    def tearDown(self):
+        common.mount_adapters()
+        self.server.stop()
+
+    def test_mount_adapters(self):
+        common.mount_adapters(32)
+        for prefix in ('http://', 'https://'):
+            adapter = common.session.get_adapter(prefix + 'example.com')
+            self.assertEqual(
+                adapter._pool_maxsize, 32 + common.PROBE_WORKERS
+            )
+            self.assertEqual(
+                adapter.max_retries.total, common.CONNECT_RETRIES
+            )
+        common.mount_adapters()
+        self.assertEqual(
+            common.session.get_adapter('http://example.com')._pool_maxsize,
+            common.POOL_SIZE
+        )
+
+    def test_url_to_module(self):
+        # the HEAD of an unknown site and the extraction after it share a
+        # connection of the session
+        url = self.server.url + '/page'
+        before = common.connection_stats()
+        module, _ = common.url_to_module(url)
+        self.assertEqual(module.__name__, 'lulu.extractors.universal')
+        common.get_content(url)
+        self.assertEqual(
+            [method for method, _, _ in self.server.requests],
+            ['HEAD', 'GET']
+        )
+        num_requests, num_connections = common.connection_stats()
+        self.assertEqual(
+            (num_requests - before[0], num_connections - before[1]), (2, 1)
+        )
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lulu import dash
+from tests.util import start_http_server
+
+
+MPD = '''<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011"
+     xmlns:yt="http://youtube.com/yt/2012/10/10"
+     type="static" mediaPresentationDuration="PT5S">
+  <BaseURL>media/</BaseURL>
+  <Period>
+    <AdaptationSet mimeType="video/mp4">
+      <SegmentTemplate timescale="1000" startNumber="1"
+                       initialization="$RepresentationID$/init.mp4"
+                       media="$RepresentationID$/$Number%03d$.m4s">
+        <SegmentTimeline>
+          <S t="0" d="2000" r="1"/>
+          <S d="1000"/>
+        </SegmentTimeline>
+      </SegmentTemplate>
+      <Representation id="v360" bandwidth="500000" width="640" height="360"/>
+      <Representation id="v720" bandwidth="2000000" width="1280" height="720"/>
+    </AdaptationSet>
+    <AdaptationSet mimeType="audio/mp4">
+      <Representation id="a128" bandwidth="128000">
+        <BaseURL>audio.m4a</BaseURL>
+        <SegmentList timescale="1" duration="3">
+          <Initialization sourceURL="audio.m4a" range="0-9"/>
+          <SegmentURL mediaRange="10-29"/>
+          <SegmentURL mediaRange="30-39"/>
+        </SegmentList>
+      </Representation>
+    </AdaptationSet>
+    <AdaptationSet mimeType="audio/webm">
+      <Representation id="251" bandwidth="160000">
+        <BaseURL yt:contentLength="1234">https://example.com/251.webm</BaseURL>
+        <SegmentBase indexRange="0-99"/>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+  <Period>
+    <AdaptationSet mimeType="video/mp4"/>
+  </Period>
+</MPD>
+'''
+
+
+class TestDASH(unittest.TestCase):
+    def test_parse_mpd(self):
+        manifest = dash.parse_mpd(MPD, 'http://example.com/v/index.mpd')
+        self.assertFalse(manifest.is_live)
+        self.assertEqual(manifest.duration, 5)
+        v360, v720, a128, webm = manifest.representations
+        self.assertEqual((v720.width, v720.height), (1280, 720))
+        self.assertEqual(
+            [s.uri for s in v720.segments],
+            ['http://example.com/v/media/v720/{:03d}.m4s'.format(i)
+             for i in range(1, 4)]
+        )
+        self.assertEqual(
+            v720.segments[0].init['uri'],
+            'http://example.com/v/media/v720/init.mp4'
+        )
+        self.assertEqual(
+            [s.byterange for s in a128.segments], [(20, 10), (10, 30)]
+        )
+        self.assertEqual(a128.segments[0].init['byterange'], (10, 0))
+        self.assertEqual(
+            a128.segments[0].uri, 'http://example.com/v/media/audio.m4a'
+        )
+        self.assertEqual(webm.size, 1234)
+        self.assertEqual(
+            [s.uri for s in webm.segments], ['https://example.com/251.webm']
+        )
+        self.assertEqual(
+            dash.select_representations(manifest), (v720, a128)
+        )
+        self.assertEqual(
+            dash.select_representations(manifest, max_bandwidth=1000000),
+            (v360, a128)
+        )
+
+    def test_download_dash(self):
+        audio = os.urandom(40)
+        video = {
+            '/media/v720/init.mp4': os.urandom(10),
+            '/media/v720/001.m4s': os.urandom(1000),
+            '/media/v720/002.m4s': os.urandom(1000),
+            '/media/v720/003.m4s': os.urandom(500),
+        }
+        files = {'/index.mpd': MPD.encode(), '/media/audio.m4a': audio}
+        files.update(video)
+        server = start_http_server(files)
+        output_dir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(output_dir, 'video.mp4')
+            parts = dash.download_dash(server.url + '/index.mpd', output)
+            self.assertEqual(parts, [
+                os.path.join(output_dir, 'video.video.mp4'),
+                os.path.join(output_dir, 'video.audio.m4a'),
+            ])
+            with open(parts[0], 'rb') as f:
+                self.assertEqual(f.read(), b''.join(
+                    video[k] for k in sorted(video, key=lambda k: (
+                        not k.endswith('init.mp4'), k
+                    ))
+                ))
+            with open(parts[1], 'rb') as f:
+                self.assertEqual(f.read(), audio)
+        finally:
+            server.stop()
+            shutil.rmtree(output_dir)
+
+    def test_nothing_to_download(self):
+        # a template of a duration, but no duration to divide
+        no_duration = MPD.replace(' mediaPresentationDuration="PT5S"', '')
+        no_duration = no_duration.replace('''
+        <SegmentTimeline>
+          <S t="0" d="2000" r="1"/>
+          <S d="1000"/>
+        </SegmentTimeline>
+      </SegmentTemplate>''', '''
+      </SegmentTemplate>''').replace(
+            'startNumber="1"', 'startNumber="1" duration="2000"'
+        )
+        # subtitles only
+        subtitles = '''<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static">
+  <Period>
+    <AdaptationSet mimeType="text/vtt">
+      <Representation id="en" bandwidth="100">
+        <BaseURL>en.vtt</BaseURL>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+'''
+        output_dir = tempfile.mkdtemp()
+        try:
+            for mpd in (no_duration, subtitles):
+                manifest = dash.parse_mpd(mpd, 'http://example.com/index.mpd')
+                with self.assertRaises(ValueError):
+                    dash.download_dash(
+                        manifest.url, os.path.join(output_dir, 'video.mp4'),
+                        manifest=manifest
+                    )
+            self.assertEqual(os.listdir(output_dir), [])
+        finally:
+            shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
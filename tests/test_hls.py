@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lulu import hls
+from lulu.processor.remux_ts import remux_ts
+from tests.util import start_http_server
+from tests.test_processor import make_av_ts
+
+
+MASTER = '''#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360
+low/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720,CODECS="avc1,mp4a"
+high/index.m3u8
+'''
+
+MEDIA = '''#EXTM3U
+#EXT-X-TARGETDURATION:10
+#EXT-X-MEDIA-SEQUENCE:7
+#EXT-X-PLAYLIST-TYPE:VOD
+#EXTINF:10.0,
+seg0.ts
+#EXT-X-KEY:METHOD=AES-128,URI="/key.bin"
+#EXTINF:10.0,
+seg1.ts
+#EXT-X-KEY:METHOD=NONE
+#EXT-X-BYTERANGE:100@0
+#EXTINF:5.0,
+all.ts
+#EXT-X-DISCONTINUITY
+#EXT-X-BYTERANGE:50
+#EXTINF:2.5,
+all.ts
+#EXT-X-ENDLIST
+'''
+
+
+def encrypt_aes128(data, key, iv):
+    from cryptography.hazmat.primitives.ciphers import (
+        Cipher, algorithms, modes
+    )
+    from cryptography.hazmat.backends import default_backend
+    pad = 16 - len(data) % 16
+    data += bytes([pad]) * pad
+    encryptor = Cipher(
+        algorithms.AES(key), modes.CBC(iv), backend=default_backend()
+    ).encryptor()
+    return encryptor.update(data) + encryptor.finalize()
+
+
+class TestHLS(unittest.TestCase):
+    def test_parse_master(self):
+        playlist = hls.parse_m3u8(MASTER, 'http://example.com/v/master.m3u8')
+        self.assertTrue(playlist.is_master)
+        self.assertEqual(
+            hls.select_variant(playlist)['uri'],
+            'http://example.com/v/high/index.m3u8'
+        )
+        self.assertEqual(
+            hls.select_variant(playlist, max_bandwidth=1000000)['resolution'],
+            '640x360'
+        )
+
+    def test_parse_media(self):
+        playlist = hls.parse_m3u8(MEDIA, 'http://example.com/v/index.m3u8')
+        self.assertFalse(playlist.is_master)
+        self.assertFalse(playlist.is_live)
+        segments = playlist.segments
+        self.assertEqual([s.sequence for s in segments], [7, 8, 9, 10])
+        self.assertIsNone(segments[0].key)
+        self.assertEqual(segments[1].key['uri'], 'http://example.com/key.bin')
+        self.assertIsNone(segments[1].key['iv'])
+        self.assertIsNone(segments[2].key)
+        self.assertEqual(segments[2].byterange, (100, 0))
+        self.assertEqual(segments[3].byterange, (50, 100))
+        self.assertTrue(segments[3].discontinuity)
+
+    def test_classify_playlist(self):
+        live = MEDIA.replace('#EXT-X-PLAYLIST-TYPE:VOD\n', '').replace(
+            '#EXT-X-ENDLIST\n', ''
+        )
+        server = start_http_server({
+            '/master.m3u8': MASTER.encode(),
+            '/high/index.m3u8': MEDIA.encode(),
+            '/live.m3u8': live.encode(),
+        })
+        try:
+            self.assertEqual(
+                hls.classify_playlist(server.url + '/master.m3u8'), 'vod'
+            )
+            self.assertEqual(
+                hls.classify_playlist(server.url + '/live.m3u8'), 'live'
+            )
+            self.assertIsNone(hls.classify_playlist(server.url + '/a.flv'))
+            self.assertIsNone(hls.classify_playlist(server.url + '/404.m3u8'))
+        finally:
+            server.stop()
+
+    def test_record(self):
+        def live(first, last, endlist=False):
+            lines = [
+                '#EXTM3U', '#EXT-X-TARGETDURATION:0.05',
+                '#EXT-X-MEDIA-SEQUENCE:{}'.format(first),
+            ]
+            for sequence in range(first, last + 1):
+                if sequence == 5:
+                    lines.append('#EXT-X-DISCONTINUITY')
+                lines += ['#EXTINF:1.0,', 'seg{}.ts'.format(sequence)]
+            if endlist:
+                lines.append('#EXT-X-ENDLIST')
+            return '\n'.join(lines).encode()
+
+        # the sliding window of the playlist at each poll, segment 3 is gone
+        # before being seen
+        windows = [
+            live(0, 1), live(0, 1), live(1, 2), live(4, 6),
+            live(5, 7, endlist=True),
+        ]
+        segments = {
+            '/seg{}.ts'.format(i): bytes([i]) * 100 for i in range(8)
+        }
+        files = {'/live.m3u8': lambda: windows.pop(0) if len(windows) > 1
+                 else windows[0]}
+        files.update(segments)
+        server = start_http_server(files)
+        output_dir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(output_dir, 'live.ts')
+            filepaths = hls.record_hls(
+                server.url + '/live.m3u8', output, rotate_time=2
+            )
+            self.assertEqual(filepaths, [
+                output, os.path.join(output_dir, 'live.1.ts'),
+                os.path.join(output_dir, 'live.2.ts'),
+                os.path.join(output_dir, 'live.3.ts'),
+                os.path.join(output_dir, 'live.4.ts'),
+            ])
+            contents = []
+            for filepath in filepaths:
+                with open(filepath, 'rb') as f:
+                    contents.append(f.read())
+            seg = [bytes([i]) * 100 for i in range(8)]
+            # rotated every 2 seconds, at the gap and at the discontinuity,
+            # and never twice the same segment
+            self.assertEqual(contents, [
+                seg[0] + seg[1], seg[2], seg[4], seg[5] + seg[6], seg[7],
+            ])
+        finally:
+            server.stop()
+            shutil.rmtree(output_dir)
+
+    def test_download(self):
+        key = os.urandom(16)
+        all_ts = os.urandom(150)
+        seg0, seg1 = os.urandom(1000), os.urandom(999)
+        server = start_http_server({
+            '/master.m3u8': MASTER.encode(),
+            '/high/index.m3u8': MEDIA.encode(),
+            '/high/seg0.ts': seg0,
+            '/high/seg1.ts': encrypt_aes128(
+                seg1, key, (8).to_bytes(16, 'big')
+            ),
+            '/high/all.ts': all_ts,
+            '/key.bin': key,
+        })
+        output_dir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(output_dir, 'video.ts')
+            hls.download_hls(server.url + '/master.m3u8', output, thread=2)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), seg0 + seg1 + all_ts)
+        finally:
+            server.stop()
+            shutil.rmtree(output_dir)
+
+    def test_unsupported_encryption(self):
+        server = start_http_server({'/seg0.ts': b'x' * 16})
+        try:
+            segment = hls.Segment(
+                server.url + '/seg0.ts', 10.0, 0,
+                key={'method': 'SAMPLE-AES', 'uri': None, 'iv': None}
+            )
+            with self.assertRaises(ValueError):
+                hls.SegmentFetcher()(segment)
+        finally:
+            server.stop()
+
+    def test_download_remux(self):
+        segments = [make_av_ts(20, i * 60000)[0] for i in range(3)]
+        playlist = '#EXTM3U\n#EXT-X-TARGETDURATION:1\n' + ''.join(
+            '#EXTINF:0.7,\n{}.ts\n'.format(i) for i in range(3)
+        ) + '#EXT-X-ENDLIST\n'
+        server = start_http_server(dict(
+            [('/index.m3u8', playlist.encode())] +
+            [('/{}.ts'.format(i), s) for i, s in enumerate(segments)] +
+            [('/other.m3u8', playlist.replace('.ts', '.bin').encode())] +
+            [('/{}.bin'.format(i), os.urandom(188)) for i in range(3)]
+        ))
+        output_dir = tempfile.mkdtemp()
+        try:
+            parts = []
+            for i, segment in enumerate(segments):
+                parts.append(os.path.join(output_dir, '{}.ts'.format(i)))
+                with open(parts[-1], 'wb') as f:
+                    f.write(segment)
+            expected = os.path.join(output_dir, 'expected.mp4')
+            remux_ts(parts, expected)
+            output = os.path.join(output_dir, 'video.mp4')
+            self.assertEqual(hls.download_hls(
+                server.url + '/index.m3u8', output, remux=True
+            ), output)
+            with open(output, 'rb') as f, open(expected, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+            # segments that are not H.264 and AAC are kept as they are
+            self.assertEqual(hls.download_hls(
+                server.url + '/other.m3u8', output, remux=True
+            ), os.path.join(output_dir, 'video.ts'))
+        finally:
+            server.stop()
+            shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1560 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import struct
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+from io import BytesIO
+
+from lulu.processor import (
+    capabilities, ffmpeg, join_flv, join_mp4, join_ts, mp4_writer, mux_av
+)
+from lulu.processor.mp4_writer import parse_sps
+from lulu.processor.remux_flv import remux_flv
+from lulu.processor.remux_ts import TSRemuxer, is_remuxable, remux_ts
+from lulu.processor.join_flv import (
+    ECMAObject,
+    FLVJoiner,
+    write_tag,
+    write_uint,
+    concat_flv,
+    write_flv_header,
+    write_meta_tag,
+)
+
+
+def make_flv(duration, timestamps, keyframes=(0,)):
+    """Builds an FLV file with a metadata tag and one video tag per
+    timestamp, keyframes for those at the indexes in keyframes.
+    """
+    out = BytesIO()
+    write_flv_header(out)
+    meta = ECMAObject(2)
+    meta.put('duration', float(duration))
+    meta.put('width', 640.0)
+    write_meta_tag(out, 'onMetaData', meta)
+    previous_tag_size = 0
+    for i, timestamp in enumerate(timestamps):
+        body = (b'\x17' if i in keyframes else b'\x27') + os.urandom(49)
+        write_tag(out, (9, timestamp, len(body), body, previous_tag_size))
+        previous_tag_size = 11 + len(body)
+    write_uint(out, previous_tag_size)
+    return out.getvalue()
+
+
+def make_sps(width, height):
+    """Builds an H.264 (baseline) sequence parameter set NAL unit for a
+    picture of width x height.
+    """
+    bits = []
+
+    def u(n, value):
+        bits.extend(value >> i & 1 for i in reversed(range(n)))
+
+    def ue(value):
+        n = (value + 1).bit_length()
+        u(n - 1, 0)
+        u(n, value + 1)
+
+    u(8, 66)  # profile_idc
+    u(16, 30)  # constraint flags, level_idc
+    for value in (0, 0, 0, 0, 1):
+        # sps id, frame num, poc type and lsb, ref frames
+        ue(value)
+    u(1, 0)
+    width_in_mbs = (width + 15) // 16
+    height_in_mbs = (height + 15) // 16
+    ue(width_in_mbs - 1)
+    ue(height_in_mbs - 1)
+    u(2, 3)  # frame_mbs_only_flag, direct_8x8_inference_flag
+    crop = (width_in_mbs * 16 - width, height_in_mbs * 16 - height)
+    u(1, any(crop))
+    if any(crop):
+        for value in (0, crop[0] // 2, 0, crop[1] // 2):
+            ue(value)
+    u(1, 0)  # vui_parameters_present_flag
+    u(1, 1)  # stop bit
+    bits += [0] * (-len(bits) % 8)
+    return b'\x67' + int(''.join(map(str, bits)), 2).to_bytes(
+        len(bits) // 8, 'big'
+    )
+
+
+def make_avc_flv(timestamps, start=0, audio_frames=0):
+    """Builds an FLV file of H.264 and AAC (44.1 kHz, stereo), with a video
+    tag per timestamp, every third a keyframe, and audio_frames audio
+    tags; the payload of a tag is its number from start, repeated.
+    """
+    sps = make_sps(640, 360)
+    avcc = b'\x01\x42\x00\x1e\xff\xe1' + struct.pack('>H', len(sps)) + \
+        sps + b'\x01\x00\x04\x68\xce\x38\x80'
+    tags = [
+        (9, 0, b'\x17\x00\x00\x00\x00' + avcc),
+        (8, 0, b'\xaf\x00\x12\x10'),
+    ]
+    for i, timestamp in enumerate(timestamps):
+        frame = b'\x17' if i % 3 == 0 else b'\x27'
+        tags.append((
+            9, timestamp, frame + b'\x01\x00\x00\x28' +
+            struct.pack('>I', start + i) * 10
+        ))
+    for i in range(audio_frames):
+        tags.append((
+            8, i * 23, b'\xaf\x01' + struct.pack('>I', start + i) * 5
+        ))
+    out = BytesIO()
+    write_flv_header(out)
+    meta = ECMAObject(1)
+    meta.put('duration', 1.0)
+    write_meta_tag(out, 'onMetaData', meta)
+    previous_tag_size = 0
+    for data_type, timestamp, body in sorted(tags, key=lambda x: x[1]):
+        write_tag(out, (
+            data_type, timestamp, len(body), body, previous_tag_size
+        ))
+        previous_tag_size = 11 + len(body)
+    write_uint(out, previous_tag_size)
+    return out.getvalue()
+
+
+def ts_packet(pid, counter, payload, unit_start=False, pcr=None):
+    """Builds a TS packet, its payload padded by adaptation field
+    stuffing.
+    """
+    flags = 0x10 | counter
+    adaptation = b''
+    if pcr is not None:
+        adaptation = b'\x10' + (pcr << 15 | 0x7e00).to_bytes(6, 'big')
+    room = 184 - len(payload)
+    if room:
+        flags |= 0x20
+        adaptation = (adaptation or b'\x00').ljust(room - 1, b'\xff')
+        adaptation = bytes([room - 1]) + adaptation
+    return struct.pack(
+        '>BHB', 0x47, unit_start << 14 | pid, flags
+    ) + adaptation + payload
+
+
+def pes_timestamp(prefix, timestamp):
+    return bytes([prefix << 4 | timestamp >> 29 & 0x0e | 1]) + struct.pack(
+        '>HH', (timestamp >> 15 & 0x7fff) << 1 | 1,
+        (timestamp & 0x7fff) << 1 | 1
+    )
+
+
+def make_ts(frames, start=0, counters=None, frame_packets=2):
+    """Builds an MPEG-TS file of frames video frames of frame_packets
+    packets, 3000 ticks apart from start, with a PCR in each, and as many
+    audio frames 1920 ticks apart. The continuity counters go on from
+    counters, by PID.
+    """
+    counters = {} if counters is None else counters
+    packets = []
+
+    def packet(pid, payload, **kwargs):
+        counter = counters.get(pid, -1) + 1 & 0x0f
+        counters[pid] = counter
+        packets.append(ts_packet(pid, counter, payload, **kwargs))
+
+    # PAT and PMT, with no tables in them that matter here
+    packet(0, b'\x00\x00\xb0\x0d' + bytes(9), unit_start=True)
+    packet(0x1000, b'\x00\x02\xb0\x12' + bytes(14), unit_start=True)
+    for i in range(frames):
+        dts = start + i * 3000
+        header = b'\x00\x00\x01\xe0\x00\x00\x80\xc0\x0a' + \
+            pes_timestamp(3, dts + 3000) + pes_timestamp(1, dts)
+        packet(0x100, header + os.urandom(150), unit_start=True, pcr=dts)
+        for _ in range(frame_packets - 1):
+            packet(0x100, os.urandom(184))
+        header = b'\x00\x00\x01\xc0\x00\x00\x80\x80\x05' + \
+            pes_timestamp(2, start + i * 1920)
+        packet(0x101, header + os.urandom(100), unit_start=True)
+    return b''.join(packets)
+
+
+def make_av_ts(frames, start=0, stream_types=(0x1b, 0x0f), frame_size=400):
+    """Builds an MPEG-TS file of H.264 frames of about frame_size bytes
+    (every third an IDR, with the parameter sets), 3000 ticks apart from
+    start, and of AAC (44.1 kHz, stereo) in ADTS, an audio frame with each
+    video frame, 1920 ticks apart. The frame payloads are made of their
+    numbers.
+
+    Returns:
+        (the MPEG-TS file, the H.264 samples, the AAC samples).
+    """
+    counters = {}
+    packets = []
+    video = []
+    audio = []
+    sps = make_sps(640, 360)
+    pps = b'\x68\xce\x38\x80'
+
+    def pes(pid, stream_id, timestamps, data, pcr=None):
+        if len(timestamps) == 2:
+            header = bytes([0x80, 0xc0, 10]) + \
+                pes_timestamp(3, timestamps[0]) + \
+                pes_timestamp(1, timestamps[1])
+        else:
+            header = bytes([0x80, 0x80, 5]) + pes_timestamp(2, timestamps[0])
+        data = b'\x00\x00\x01' + bytes([stream_id]) + bytes(2) + header + \
+            data
+        first = 176 if pcr is not None else 184
+        chunks = [data[:first]] + [
+            data[i:i + 184] for i in range(first, len(data), 184)
+        ]
+        for i, chunk in enumerate(chunks):
+            counter = counters.get(pid, -1) + 1 & 0x0f
+            counters[pid] = counter
+            packets.append(ts_packet(
+                pid, counter, chunk, unit_start=not i,
+                pcr=pcr if not i else None
+            ))
+
+    packets.append(ts_packet(
+        0, 0, b'\x00\x00\xb0\x0d\x00\x01\xc1\x00\x00\x00\x01\xf0\x00' +
+        bytes(4), unit_start=True
+    ))
+    packets.append(ts_packet(
+        0x1000, 0, b'\x00\x02\xb0\x17\x00\x01\xc1\x00\x00\xe1\x00\xf0\x00' +
+        bytes([stream_types[0]]) + b'\xe1\x00\xf0\x00' +
+        bytes([stream_types[1]]) + b'\xe1\x01\xf0\x00' + bytes(4),
+        unit_start=True
+    ))
+    for i in range(frames):
+        dts = start + i * 3000
+        # with no zeros, which would have to be escaped
+        payload = bytes([0x80 | i & 0x7f]) * frame_size
+        nals = [b'\x09\xf0']
+        if i % 3 == 0:
+            nals += [sps, pps, b'\x65' + payload]
+        else:
+            nals.append(b'\x41' + payload)
+        pes(0x100, 0xe0, (dts + 3000, dts), b''.join(
+            b'\x00\x00\x00\x01' + nal for nal in nals
+        ), pcr=dts)
+        video.append(struct.pack('>I', len(nals[-1])) + nals[-1])
+        frame = struct.pack('>I', i) * 50
+        size = 7 + len(frame)
+        adts = bytes([
+            0xff, 0xf1, 0x50, 0x80 | size >> 11, size >> 3 & 0xff,
+            (size & 0x07) << 5 | 0x1f, 0xfc
+        ])
+        pes(0x101, 0xc0, (start + i * 1920,), adts + frame)
+        audio.append(frame)
+    return b''.join(packets), video, audio
+
+
+def read_ts(data):
+    """Returns the continuity counters of the packets of a TS file, by
+    PID, and its PCRs, PTSs and DTSs, as (pid, kind, timestamp).
+    """
+    counters = {}
+    timestamps = []
+    for pos in range(0, len(data), 188):
+        pid = struct.unpack_from('>H', data, pos + 1)[0] & 0x1fff
+        counters.setdefault(pid, []).append(data[pos + 3] & 0x0f)
+        start = join_ts.payload_start(data, pos)
+        if data[pos + 3] & 0x20 and data[pos + 5] & 0x10:
+            pcr = join_ts.read_pcr_base(data, pos + 6)
+            timestamps.append((pid, 'pcr', pcr))
+        if data[start:start + 3] == b'\x00\x00\x01':
+            flags = data[start + 7] >> 6
+            pts = join_ts.read_timestamp(data, start + 9)
+            timestamps.append((pid, 'pts', pts))
+            if flags == 3:
+                dts = join_ts.read_timestamp(data, start + 14)
+                timestamps.append((pid, 'dts', dts))
+    return counters, timestamps
+
+
+def atom(type, *children):
+    body = b''.join(children)
+    return struct.pack('>I', 8 + len(body)) + type + body
+
+
+def full_atom(type, *fields):
+    """Builds a full atom (version 0) of uint32 fields."""
+    return atom(type, struct.pack('>{}I'.format(len(fields) + 1), 0, *fields))
+
+
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def sample_data(track, number, size):
+    return (struct.pack('>HI', track, number) * size)[:size]
+
+
+def make_trak(track, sizes, chunk, delta, offsets, sync=30, extra=(),
+              track_id=None):
+    video = track == 1
+    count = len(sizes)
+    duration = count * delta
+    if video:
+        entry = atom(
+            b'avc1', bytes(6), struct.pack('>H', 1), bytes(16),
+            struct.pack('>HHII', 640, 360, 72 << 16, 72 << 16), bytes(4),
+            struct.pack('>HB', 1, 0), bytes(31), struct.pack('>H', 24),
+            b'\xff\xff', atom(b'avcC', b'\x01\x64\x00\x1f')
+        )
+    else:
+        entry = atom(
+            b'mp4a', bytes(6), struct.pack('>H', 1), bytes(8),
+            struct.pack('>HH', 2, 16), bytes(4), struct.pack('>H', 44100),
+            bytes(2), full_atom(b'esds', 0x03808080)
+        )
+    stsc = [1, chunk, 1]
+    if count % chunk:
+        stsc += [count // chunk + 1, count % chunk, 1]
+    stbl = [
+        atom(b'stsd', struct.pack('>II', 0, 1), entry),
+        full_atom(b'stts', 1, count, delta),
+        full_atom(b'stsc', len(stsc) // 3, *stsc),
+        full_atom(b'stsz', 0, count, *sizes),
+        full_atom(b'stco', len(offsets), *offsets),
+    ]
+    if video and sync:
+        keyframes = range(1, count + 1, sync)
+        stbl.append(full_atom(b'stss', len(keyframes), *keyframes))
+    if video:
+        stbl.append(full_atom(b'ctts', count, *[
+            x for i in range(count) for x in (1, i % 3 * delta)
+        ]))
+    stbl += extra
+    return atom(
+        b'trak',
+        atom(
+            b'tkhd',
+            struct.pack('>6I', 0, 0, 0, track_id or track, 0, duration),
+            bytes(8), struct.pack('>HHH', 0, 0, 0 if video else 0x100),
+            bytes(2), MATRIX, struct.pack('>II', 640 << 16, 360 << 16)
+        ),
+        atom(
+            b'mdia',
+            atom(
+                b'mdhd', struct.pack('>5I', 0, 0, 0, 1000 * delta, duration),
+                struct.pack('>HH', 0x55c4, 0)
+            ),
+            full_atom(
+                b'hdlr', 0, 0x76696465 if video else 0x736f756e, 0, 0, 0
+            ),
+            atom(
+                b'minf',
+                full_atom(b'vmhd', 0, 0) if video else full_atom(b'smhd', 0),
+                atom(b'dinf', full_atom(b'dref', 0)),
+                atom(b'stbl', *stbl),
+            ),
+        ),
+    )
+
+
+def make_mp4(out, video_sizes, audio_sizes, video_chunk=2, audio_chunk=3,
+             extra_tracks=(), sync=30, extra=(), faststart=True):
+    """Writes an MP4 file of an H.264 and an AAC track, and an AAC track
+    more per extra_tracks (sample sizes), whose samples are
+    sample_data(track, number, size). Chunks of the tracks alternate in the
+    mdat, which follows the moov unless faststart is false. A video sample
+    in sync is a sync sample, extra atoms go in each stbl.
+    """
+    tracks = [
+        (1, video_sizes, video_chunk, 1000),
+        (2, audio_sizes, audio_chunk, 1024),
+    ] + [
+        (3 + i, sizes, audio_chunk, 1024)
+        for i, sizes in enumerate(extra_tracks)
+    ]
+    chunks = [
+        [
+            (track, range(i, min(i + chunk, len(sizes))))
+            for i in range(0, len(sizes), chunk)
+        ]
+        for track, sizes, chunk, _ in tracks
+    ]
+    # chunks of all tracks in turn, while they last
+    layout = [
+        c for i in range(max(map(len, chunks)))
+        for c in (x[i] for x in chunks if i < len(x))
+    ]
+
+    def moov(offsets):
+        duration = len(video_sizes) * 1000
+        return atom(
+            b'moov',
+            atom(
+                b'mvhd', struct.pack('>6IH', 0, 0, 0, 1000, duration,
+                                     0x10000, 0x100),
+                bytes(10), MATRIX, bytes(24), struct.pack('>I', 3)
+            ),
+            *[
+                make_trak(track, sizes, chunk, delta, offsets[track], sync,
+                          extra)
+                for track, sizes, chunk, delta in tracks
+            ]
+        )
+
+    ftyp = atom(b'ftyp', b'isom', struct.pack('>I', 512), b'isomavc1')
+    offsets = {x[0]: [0] * len(c) for x, c in zip(tracks, chunks)}
+    mdat_start = len(ftyp) + (len(moov(offsets)) if faststart else 0)
+    offset = mdat_start + 8
+    offsets = {x[0]: [] for x in tracks}
+    for track, numbers in layout:
+        offsets[track].append(offset)
+        offset += sum(tracks[track - 1][1][i] for i in numbers)
+    out.write(ftyp)
+    if faststart:
+        out.write(moov(offsets))
+    out.write(struct.pack('>I', offset - mdat_start))
+    out.write(b'mdat')
+    for track, numbers in layout:
+        for i in numbers:
+            out.write(sample_data(track, i, tracks[track - 1][1][i]))
+    if not faststart:
+        out.write(moov(offsets))
+
+
+def read_samples(trak, source):
+    """Reads the samples of a trak (of join_mp4 atoms) through its sample
+    tables.
+    """
+    stbl = trak.get(b'mdia', b'minf', b'stbl')
+    stsc = stbl.get(b'stsc').body[1]
+    sizes = stbl.get(b'stsz').body[3]
+    offsets = (stbl.get_all(b'stco') or stbl.get_all(b'co64'))[0].body[1]
+    samples = []
+    for chunk, offset in enumerate(offsets, 1):
+        for i in range(0, len(stsc), 3):
+            if stsc[i] <= chunk:
+                per_chunk = stsc[i + 1]
+        source.seek(offset)
+        for _ in range(per_chunk):
+            samples.append(source.read(sizes[len(samples)]))
+    return samples
+
+
+def make_fragmented_mp4(out, track, fragments, base_offsets=False):
+    """Writes a fragmented MP4 file of a track of ID 1, the H.264 one of
+    make_mp4 if track is 1, else the AAC one, with a fragment per
+    (seconds, sample sizes) of fragments; its samples are
+    sample_data(track, number, size). The fragments are based on their moof,
+    by offsets from the start of the file if base_offsets.
+    """
+    delta = 1000 if track == 1 else 1024
+    time_scale = 1000 * delta
+    duration = max(seconds for seconds, _ in fragments) + 1
+    out.write(atom(b'ftyp', b'iso6', struct.pack('>I', 512), b'iso6dash'))
+    out.write(atom(
+        b'moov',
+        atom(
+            b'mvhd', struct.pack('>6IH', 0, 0, 0, 1000, duration * 1000,
+                                 0x10000, 0x100),
+            bytes(10), MATRIX, bytes(24), struct.pack('>I', 2)
+        ),
+        make_trak(track, [], 1, delta, [], track_id=1),
+        atom(
+            b'mvex', full_atom(b'mehd', duration * 1000),
+            full_atom(b'trex', 1, 1, 0, 0, 0)
+        ),
+    ))
+    # an index of the file, of no use once it is muxed
+    out.write(atom(b'sidx', bytes(24)))
+    number = 0
+    for sequence, (seconds, sizes) in enumerate(fragments, 1):
+        if base_offsets:
+            tfhd = struct.pack('>IIQ', 1, 1, out.tell())
+        else:
+            # default-base-is-moof
+            tfhd = struct.pack('>II', 0x020000, 1)
+
+        def moof(data_offset):
+            return atom(
+                b'moof', full_atom(b'mfhd', sequence),
+                atom(
+                    b'traf', atom(b'tfhd', tfhd),
+                    atom(b'tfdt', struct.pack(
+                        '>IQ', 1 << 24, seconds * time_scale
+                    )),
+                    # data-offset-present, sample-size-present
+                    atom(b'trun', struct.pack(
+                        '>III{}I'.format(len(sizes)), 0x201, len(sizes),
+                        data_offset, *sizes
+                    )),
+                )
+            )
+        out.write(moof(len(moof(0)) + 8))
+        samples = b''.join(
+            sample_data(track, number + i, size)
+            for i, size in enumerate(sizes)
+        )
+        out.write(atom(b'mdat', samples))
+        number += len(sizes)
+
+
+def read_fragments(data):
+    """Reads the fragments of a fragmented MP4 file.
+
+    Returns:
+        The types of its top-level atoms, and per moof its sequence number,
+        and the track ID, decode time and samples of its trafs.
+    """
+    types = []
+    fragments = []
+    pos = 0
+    while pos < len(data):
+        size, type = struct.unpack_from('>I4s', data, pos)
+        types.append(type)
+        if type == b'moof':
+            sequence = None
+            trafs = []
+            for child, start, end in mux_av.child_atoms(data, pos + 8,
+                                                        pos + size):
+                if child == b'mfhd':
+                    sequence = struct.unpack_from('>I', data, start + 12)[0]
+                    continue
+                base = pos
+                for child, start, _ in mux_av.child_atoms(data, start + 8,
+                                                          end):
+                    if child == b'tfhd':
+                        flags, track_id = struct.unpack_from(
+                            '>II', data, start + 8
+                        )
+                        if flags & 1:
+                            base = struct.unpack_from('>Q', data,
+                                                      start + 16)[0]
+                    elif child == b'tfdt':
+                        time = struct.unpack_from('>Q', data, start + 12)[0]
+                    elif child == b'trun':
+                        count, offset = struct.unpack_from(
+                            '>II', data, start + 12
+                        )
+                        sizes = struct.unpack_from(
+                            '>{}I'.format(count), data, start + 20
+                        )
+                samples = []
+                offset += base
+                for sample_size in sizes:
+                    samples.append(data[offset:offset + sample_size])
+                    offset += sample_size
+                trafs.append((track_id, time, samples))
+            fragments.append((sequence, trafs))
+        pos += size
+    return types, fragments
+
+
+def ebml(id, *children):
+    """Builds an EBML element, of an 8-byte size."""
+    body = b''.join(children)
+    return id.to_bytes((id.bit_length() + 7) // 8, 'big') + \
+        (1 << 56 | len(body)).to_bytes(8, 'big') + body
+
+
+def make_webm(out, track, clusters, duration):
+    """Writes a WebM file of a VP9 track numbered 1 if track is 1, else of
+    an Opus one; a cluster per (timecode, blocks) of clusters, of blocks
+    (time, keyframe, data) whose data is sample_data(track, number, size).
+    The blocks of the Opus track are in block groups.
+    """
+    entry = ebml(
+        mux_av.TRACK_ENTRY, ebml(mux_av.TRACK_NUMBER, b'\x01'),
+        ebml(mux_av.TRACK_UID, b'\x01'),
+        ebml(mux_av.TRACK_TYPE, bytes([1 if track == 1 else 2])),
+        ebml(0x86, b'V_VP9' if track == 1 else b'A_OPUS'),
+    )
+    segment = [
+        ebml(mux_av.SEEK_HEAD, ebml(mux_av.SEEK, bytes(4))),
+        ebml(
+            mux_av.INFO, ebml(mux_av.TIMECODE_SCALE, b'\x0f\x42\x40'),
+            ebml(mux_av.DURATION, struct.pack('>f', duration)),
+            ebml(0x4d80, b'lulu'),
+        ),
+        ebml(mux_av.TRACKS, entry),
+    ]
+    number = 0
+    for timecode, blocks in clusters:
+        elements = [ebml(mux_av.TIMECODE, struct.pack('>H', timecode))]
+        for time, keyframe, size in blocks:
+            block = b'\x81' + struct.pack('>hB', time, 0x80 * keyframe) + \
+                sample_data(track, number, size)
+            number += 1
+            if track == 1:
+                elements.append(ebml(mux_av.SIMPLE_BLOCK, block))
+            else:
+                elements.append(ebml(
+                    mux_av.BLOCK_GROUP, ebml(mux_av.BLOCK, block)
+                ))
+        segment.append(ebml(mux_av.CLUSTER, *elements))
+    # cues of the file alone, of no use once it is muxed
+    segment.append(ebml(mux_av.CUES, ebml(mux_av.CUE_POINT)))
+    out.write(ebml(mux_av.EBML, ebml(0x4282, b'webm')))
+    # a segment of unknown size
+    out.write(b'\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff')
+    out.write(b''.join(segment))
+
+
+def read_elements(data, start=0, end=None):
+    """Reads the EBML elements in data[start:end], as (id, start, body,
+    end).
+    """
+    return list(mux_av.children(data, start, len(data) if end is None
+                                else end))
+
+
+class TestJoinFLV(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.flvs = [
+            make_flv(2, [0, 1000, 0x1000000 + 2000], (0, 2)),
+            make_flv(1.5, [0, 40, 1500]),
+        ]
+        self.parts = []
+        for i, flv in enumerate(self.flvs):
+            part = os.path.join(self.output_dir, 'part{}.flv'.format(i))
+            with open(part, 'wb') as f:
+                f.write(flv)
+            self.parts.append(part)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def check_output(self, output):
+        stream = BytesIO(output)
+        join_flv.read_flv_header(stream)
+        _, meta = join_flv.read_meta_tag(join_flv.read_tag(stream))
+        self.assertEqual(meta.get('duration'), 3.5)
+        self.assertEqual(meta.get('width'), 640.0)
+        self.assertEqual(meta.get('filesize'), len(output))
+        timestamps = []
+        keyframes = []
+        while True:
+            position = stream.tell() + 4
+            tag = join_flv.read_tag(stream)
+            if not tag:
+                break
+            timestamps.append(tag[1])
+            if tag[3][0] == 0x17:
+                keyframes.append((tag[1] / 1000, position))
+        last = 0x1000000 + 2000
+        self.assertEqual(
+            timestamps, [0, 1000, last, last, last + 40, last + 1500]
+        )
+        index = meta.get('keyframes')
+        self.assertEqual(len(keyframes), 3)
+        self.assertEqual(
+            list(zip(index['times'], index['filepositions'])), keyframes
+        )
+
+    def test_concat(self):
+        # memory mapped files, rewritten in chunks of one tag or more
+        chunk_size = join_flv.REWRITE_CHUNK_SIZE
+        for join_flv.REWRITE_CHUNK_SIZE in (chunk_size, 100):
+            output = os.path.join(self.output_dir, 'output.flv')
+            concat_flv(self.parts, output)
+            with open(output, 'rb') as f:
+                self.check_output(f.read())
+        join_flv.REWRITE_CHUNK_SIZE = chunk_size
+
+    def test_joiner(self):
+        output = os.path.join(self.output_dir, 'output.flv')
+        concat_flv(self.parts, output)
+        with open(output, 'rb') as f:
+            expected = f.read()
+
+        # streams read tag by tag give the same output
+        out = BytesIO()
+        joiner = FLVJoiner(out, join_flv.index_size(self.parts))
+        for flv in self.flvs:
+            joiner.add(BytesIO(flv))
+        joiner.close()
+        self.assertEqual(out.getvalue(), expected)
+
+    def test_keyframe_index(self):
+        index = join_flv.KeyframeIndex(4)
+        for i in range(20):
+            index.add(i * 1000, i * 100)
+        # thinned out to every fourth keyframe, then every eighth
+        self.assertEqual(index.times, [0, 8, 16])
+        self.assertEqual(index.positions, [0, 800, 1600])
+
+        # the metadata keeps its size with fewer keyframes than room for
+        out = BytesIO()
+        joiner = FLVJoiner(out, 10)
+        for flv in self.flvs:
+            joiner.add(BytesIO(flv))
+        joiner.close()
+        self.check_output(out.getvalue())
+
+
+class TestJoinTS(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def concat(self, parts):
+        paths = []
+        for i, part in enumerate(parts):
+            path = os.path.join(self.output_dir, 'part{}.ts'.format(i))
+            with open(path, 'wb') as f:
+                f.write(part)
+            paths.append(path)
+        output = os.path.join(self.output_dir, 'output.ts')
+        join_ts.concat_ts(paths, output)
+        with open(output, 'rb') as f:
+            output = f.read()
+
+        # streams read a chunk at a time give the same output
+        out = BytesIO()
+        joiner = join_ts.TSJoiner(out)
+        for part in parts:
+            joiner.add(BytesIO(part))
+        joiner.close()
+        self.assertEqual(out.getvalue(), output)
+        return output
+
+    def test_continuous(self):
+        # cut from one stream, the parts are joined as they are
+        counters = {}
+        parts = [
+            make_ts(40, 0, counters),
+            make_ts(30, 40 * 3000, counters),
+            os.urandom(1000),
+        ]
+        self.assertEqual(self.concat(parts), b''.join(parts))
+
+    def test_normalize(self):
+        chunk_size = join_ts.REWRITE_CHUNK_SIZE
+        for join_ts.REWRITE_CHUNK_SIZE in (chunk_size, 188 * 5):
+            parts = [
+                make_ts(40, 900000), make_ts(30, 0), make_ts(20, 0)
+            ]
+            output = self.concat(parts)
+            counters, timestamps = read_ts(output)
+            for pid, values in counters.items():
+                self.assertEqual(
+                    values, [i & 0x0f for i in range(len(values))]
+                )
+            self.assertEqual(
+                [x for pid, kind, x in timestamps if kind == 'dts'],
+                [900000 + i * 3000 for i in range(90)]
+            )
+            self.assertEqual(
+                [x for pid, kind, x in timestamps if kind == 'pcr'],
+                [900000 + i * 3000 for i in range(90)]
+            )
+            # the audio follows where the video of the part before ends
+            audio = [x for pid, kind, x in timestamps if pid == 0x101]
+            self.assertEqual(audio[39:42], [
+                900000 + 39 * 1920, 900000 + 40 * 3000,
+                900000 + 40 * 3000 + 1920
+            ])
+        join_ts.REWRITE_CHUNK_SIZE = chunk_size
+
+
+class TestRemuxTS(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_remux(self):
+        # the second part starts over from another timeline
+        parts = [make_av_ts(10, 900000), make_av_ts(8, 0)]
+        paths = []
+        for i, (part, _, _) in enumerate(parts):
+            path = os.path.join(self.output_dir, 'part{}.ts'.format(i))
+            with open(path, 'wb') as f:
+                f.write(part)
+            paths.append(path)
+        output = os.path.join(self.output_dir, 'output.mp4')
+        remux_ts(paths, output)
+
+        with open(output, 'rb') as f:
+            atoms, moov, _ = join_mp4.read_mp4(f)
+            self.assertEqual(
+                [x.type for x in atoms],
+                [b'ftyp', b'moov', b'free', b'mdat']
+            )
+            video, audio = moov.get_all(b'trak')
+            self.assertEqual(
+                read_samples(video, f), parts[0][1] + parts[1][1]
+            )
+            self.assertEqual(
+                read_samples(audio, f), parts[0][2] + parts[1][2]
+            )
+            f.seek(0)
+            self.assertIn(make_sps(640, 360), f.read())
+        self.assertEqual(video.get(b'tkhd').body[-8:], struct.pack(
+            '>II', 640 << 16, 360 << 16
+        ))
+        stbl = video.get(b'mdia', b'minf', b'stbl')
+        self.assertEqual(list(stbl.get(b'stts').body[1]), [18, 3000])
+        self.assertEqual(list(stbl.get(b'ctts').body[1]), [18, 3000])
+        self.assertEqual(
+            list(stbl.get(b'stss').body[1]), [1, 4, 7, 10, 11, 14, 17]
+        )
+        stbl = audio.get(b'mdia', b'minf', b'stbl')
+        self.assertEqual(
+            audio.get(b'mdia', b'mdhd').get('time_scale'), 44100
+        )
+        # the audio of the second part starts where the video of the first
+        # one ends, 30000 ticks after the audio started
+        gap = 30000 * 44100 // 90000 - 9 * 1024
+        self.assertEqual(
+            list(stbl.get(b'stts').body[1]), [9, 1024, 1, gap, 8, 1024]
+        )
+
+    def test_stream(self):
+        data, video, audio = make_av_ts(10)
+        outputs = []
+        for size in (len(data), 1000):
+            out = BytesIO()
+            remuxer = TSRemuxer(out)
+            for i in range(0, len(data), size):
+                remuxer.add(BytesIO(data[i:i + size]))
+            remuxer.close()
+            outputs.append(out.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_unsupported(self):
+        # MPEG-2 video and AAC
+        data, _, _ = make_av_ts(3, stream_types=(0x02, 0x0f))
+        self.assertFalse(is_remuxable(data))
+        self.assertTrue(is_remuxable(make_av_ts(3)[0]))
+        out = BytesIO()
+        with self.assertRaises(ValueError):
+            TSRemuxer(out).add(BytesIO(data))
+        self.assertEqual(out.getvalue(), b'')
+        # read from a memory map of the file
+        output_dir = tempfile.mkdtemp()
+        try:
+            part = os.path.join(output_dir, 'part.ts')
+            with open(part, 'wb') as f:
+                f.write(data)
+            with self.assertRaises(ValueError):
+                remux_ts([part], os.path.join(output_dir, 'output.mp4'))
+        finally:
+            shutil.rmtree(output_dir)
+
+
+class TestJoinMP4(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.tracks = [
+            ([300 + i % 7 for i in range(65)], [100] * 40),
+            ([200 + i % 5 for i in range(32)], [90] * 23),
+        ]
+        self.parts = []
+        for i, (video_sizes, audio_sizes) in enumerate(self.tracks):
+            part = os.path.join(self.output_dir, 'part{}.mp4'.format(i))
+            with open(part, 'wb') as f:
+                make_mp4(f, video_sizes, audio_sizes)
+            self.parts.append(part)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_concat(self):
+        output = os.path.join(self.output_dir, 'output.mp4')
+        join_mp4.concat_mp4(self.parts, output)
+        with open(output, 'rb') as f:
+            _, moov, _ = join_mp4.read_mp4(f)
+            video, audio = moov.get_all(b'trak')
+            for track, trak in ((1, video), (2, audio)):
+                expected = [
+                    sample_data(track, i, size)
+                    for sizes in self.tracks
+                    for i, size in enumerate(sizes[track - 1])
+                ]
+                self.assertEqual(read_samples(trak, f), expected)
+
+        stbl = video.get(b'mdia', b'minf', b'stbl')
+        self.assertEqual(list(stbl.get(b'stts').body[1]), [97, 1000])
+        self.assertEqual(
+            list(stbl.get(b'stss').body[1]),
+            list(range(1, 66, 30)) + list(range(66, 98, 30))
+        )
+        self.assertEqual(len(stbl.get(b'ctts').body[1]), 97 * 2)
+        self.assertEqual(moov.get(b'mvhd').get('duration'), 97000)
+
+    def test_tracks(self):
+        parts = []
+        for i, sync in enumerate([30, None]):
+            part = os.path.join(self.output_dir, 'tracks{}.mp4'.format(i))
+            with open(part, 'wb') as f:
+                make_mp4(
+                    f, [100] * (10 + i), [50] * 7, extra_tracks=[[60] * 5],
+                    sync=sync, extra=[
+                        atom(b'sgpd', bytes(12)), atom(b'sbgp', bytes(12))
+                    ]
+                )
+            parts.append(part)
+        output = os.path.join(self.output_dir, 'output.mp4')
+
+        # chunk offsets of 32 bits are not enough
+        stco_max_offset = join_mp4.STCO_MAX_OFFSET
+        join_mp4.STCO_MAX_OFFSET = 1000
+        try:
+            join_mp4.concat_mp4(parts, output)
+        finally:
+            join_mp4.STCO_MAX_OFFSET = stco_max_offset
+
+        with open(output, 'rb') as f:
+            _, moov, _ = join_mp4.read_mp4(f)
+            traks = moov.get_all(b'trak')
+            self.assertEqual(len(traks), 3)
+            for track, trak in enumerate(traks, 1):
+                sizes = {1: [100] * 10, 2: [50] * 7, 3: [60] * 5}[track]
+                expected = [
+                    sample_data(track, i, size)
+                    for sizes in (sizes, sizes + [100] * (track == 1))
+                    for i, size in enumerate(sizes)
+                ]
+                self.assertEqual(read_samples(trak, f), expected)
+                stbl = trak.get(b'mdia', b'minf', b'stbl')
+                self.assertEqual(
+                    [x.type for x in stbl.body if x.type in (
+                        b'stco', b'co64', b'sgpd', b'sbgp'
+                    )],
+                    [b'co64', b'sgpd']
+                )
+        # every sample of the part without stss is a sync sample
+        stss = traks[0].get(b'mdia', b'minf', b'stbl', b'stss').body[1]
+        self.assertEqual(list(stss), [1] + list(range(11, 22)))
+
+    def check_samples(self, path, tracks):
+        with open(path, 'rb') as f:
+            atoms, moov, _ = join_mp4.read_mp4(f)
+            self.assertEqual(
+                [x.type for x in atoms], [b'ftyp', b'moov', b'mdat']
+            )
+            for track, trak in enumerate(moov.get_all(b'trak'), 1):
+                expected = [
+                    sample_data(track, i, size)
+                    for sizes in tracks
+                    for i, size in enumerate(sizes[track - 1])
+                ]
+                self.assertEqual(read_samples(trak, f), expected)
+
+    def test_faststart(self):
+        parts = []
+        for i, (video_sizes, audio_sizes) in enumerate(self.tracks):
+            part = os.path.join(self.output_dir, 'moov{}.mp4'.format(i))
+            with open(part, 'wb') as f:
+                make_mp4(f, video_sizes, audio_sizes, faststart=False)
+            parts.append(part)
+
+        # the moov of the joined file comes first
+        output = os.path.join(self.output_dir, 'output.mp4')
+        join_mp4.concat_mp4(parts, output)
+        self.check_samples(output, self.tracks)
+
+        # it is moved in place, once
+        size = os.path.getsize(parts[0])
+        self.assertTrue(join_mp4.faststart_mp4(parts[0]))
+        self.assertEqual(os.path.getsize(parts[0]), size)
+        self.check_samples(parts[0], self.tracks[:1])
+        self.assertFalse(join_mp4.faststart_mp4(parts[0]))
+
+
+class TestRemuxFLV(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_parse_sps(self):
+        for size in ((640, 360), (1920, 1080), (176, 144)):
+            self.assertEqual(parse_sps(make_sps(*size)), size)
+
+    def test_remux(self):
+        flvs = [
+            make_avc_flv([i * 40 for i in range(10)], 0, 12),
+            make_avc_flv([i * 40 for i in range(5)], 10, 7),
+        ]
+        parts = []
+        for i, flv in enumerate(flvs):
+            part = os.path.join(self.output_dir, 'part{}.flv'.format(i))
+            with open(part, 'wb') as f:
+                f.write(flv)
+            parts.append(part)
+        output = os.path.join(self.output_dir, 'output.mp4')
+        remux_flv(parts, output)
+
+        with open(output, 'rb') as f:
+            atoms, moov, _ = join_mp4.read_mp4(f)
+            self.assertEqual(
+                [x.type for x in atoms],
+                [b'ftyp', b'moov', b'free', b'mdat']
+            )
+            video, audio = moov.get_all(b'trak')
+            self.assertEqual(
+                read_samples(video, f),
+                [struct.pack('>I', i) * 10 for i in range(15)]
+            )
+            self.assertEqual(
+                read_samples(audio, f),
+                [struct.pack('>I', i) * 5 for i in range(12)] +
+                [struct.pack('>I', 10 + i) * 5 for i in range(7)]
+            )
+        self.assertEqual(video.get(b'tkhd').body[-8:], struct.pack(
+            '>II', 640 << 16, 360 << 16
+        ))
+        stbl = video.get(b'mdia', b'minf', b'stbl')
+        # the second part starts a frame after the first one ends
+        self.assertEqual(list(stbl.get(b'stts').body[1]), [15, 40])
+        self.assertEqual(
+            list(stbl.get(b'stss').body[1]), [1, 4, 7, 10, 11, 14]
+        )
+        self.assertEqual(video.get(b'mdia', b'mdhd').get('duration'), 600)
+        stbl = audio.get(b'mdia', b'minf', b'stbl')
+        # the audio of the second part starts with its video, 400ms in
+        gap = 400 * 44100 // 1000 - 11 * 1024
+        self.assertEqual(
+            list(stbl.get(b'stts').body[1]), [11, 1024, 1, gap, 7, 1024]
+        )
+        self.assertEqual(
+            audio.get(b'mdia', b'mdhd').get('time_scale'), 44100
+        )
+
+    def test_longer_audio(self):
+        # the audio of the first part runs on 12 * 1024 / 44.1 = 279ms, well
+        # past its video
+        parts = []
+        for i in range(2):
+            part = os.path.join(self.output_dir, 'part{}.flv'.format(i))
+            with open(part, 'wb') as f:
+                f.write(make_avc_flv([0, 40], i * 2, 12))
+            parts.append(part)
+        output = os.path.join(self.output_dir, 'output.mp4')
+        remux_flv(parts, output)
+        with open(output, 'rb') as f:
+            _, moov, _ = join_mp4.read_mp4(f)
+        video, audio = moov.get_all(b'trak')
+        stbl = video.get(b'mdia', b'minf', b'stbl')
+        # the second part starts where the audio of the first one ends
+        self.assertEqual(
+            list(stbl.get(b'stts').body[1]), [1, 40, 1, 239, 2, 40]
+        )
+        stbl = audio.get(b'mdia', b'minf', b'stbl')
+        gap = 279 * 44100 // 1000 - 11 * 1024
+        self.assertEqual(
+            list(stbl.get(b'stts').body[1]), [11, 1024, 1, gap, 12, 1024]
+        )
+
+    def test_unsupported(self):
+        # Sorenson H.263
+        flv = BytesIO()
+        write_flv_header(flv)
+        write_tag(flv, (9, 0, 5, b'\x12\x00\x00\x00\x00', 0))
+        write_uint(flv, 16)
+        part = os.path.join(self.output_dir, 'part.flv')
+        with open(part, 'wb') as f:
+            f.write(flv.getvalue())
+        with self.assertRaises(ValueError):
+            remux_flv([part], os.path.join(self.output_dir, 'output.mp4'))
+        self.assertEqual(os.listdir(self.output_dir), ['part.flv'])
+
+    def test_moov_reserve(self):
+        part = os.path.join(self.output_dir, 'part.flv')
+        with open(part, 'wb') as f:
+            f.write(make_avc_flv([i * 40 for i in range(10)], 0, 12))
+        expected = os.path.join(self.output_dir, 'expected.mp4')
+        remux_flv([part], expected)
+
+        # a moov that does not fit in the room left goes at the end first
+        reserve = mp4_writer.MOOV_RESERVE_MIN, mp4_writer.MOOV_RESERVE_RATIO
+        mp4_writer.MOOV_RESERVE_MIN, mp4_writer.MOOV_RESERVE_RATIO = 16, 0
+        try:
+            output = os.path.join(self.output_dir, 'output.mp4')
+            remux_flv([part], output)
+        finally:
+            mp4_writer.MOOV_RESERVE_MIN, mp4_writer.MOOV_RESERVE_RATIO = \
+                reserve
+        with open(output, 'rb') as f, open(expected, 'rb') as g:
+            atoms, moov, _ = join_mp4.read_mp4(f)
+            self.assertEqual(
+                [x.type for x in atoms], [b'ftyp', b'free', b'moov', b'mdat']
+            )
+            _, expected_moov, _ = join_mp4.read_mp4(g)
+            for trak, expected_trak in zip(
+                moov.get_all(b'trak'), expected_moov.get_all(b'trak')
+            ):
+                self.assertEqual(
+                    read_samples(trak, f), read_samples(expected_trak, g)
+                )
+
+
+class TestMuxAV(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def path(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def test_mp4(self):
+        # two movies of a video and an audio track each, of 4 tracks once
+        # muxed
+        tracks = [([300 + i % 7 for i in range(65)], [100] * 40),
+                  ([200] * 20, [90] * 23)]
+        for i, (video_sizes, audio_sizes) in enumerate(tracks):
+            with open(self.path('{}.mp4'.format(i)), 'wb') as f:
+                make_mp4(f, video_sizes, audio_sizes, faststart=i == 0)
+        parts = [self.path('0.mp4'), self.path('1.mp4')]
+        self.assertTrue(mux_av.can_mux(parts, 'mp4'))
+        mux_av.mux_av(parts, self.path('output.mp4'))
+
+        with open(self.path('output.mp4'), 'rb') as f:
+            atoms, moov, _ = join_mp4.read_mp4(f)
+            self.assertEqual(
+                [x.type for x in atoms], [b'ftyp', b'moov', b'mdat']
+            )
+            traks = moov.get_all(b'trak')
+            self.assertEqual(
+                [x.get(b'tkhd').get('track_id') for x in traks], [1, 2, 3, 4]
+            )
+            for trak, (track, sizes) in zip(traks, [
+                (1, tracks[0][0]), (2, tracks[0][1]),
+                (1, tracks[1][0]), (2, tracks[1][1]),
+            ]):
+                self.assertEqual(read_samples(trak, f), [
+                    sample_data(track, i, size)
+                    for i, size in enumerate(sizes)
+                ])
+        self.assertEqual(moov.get(b'mvhd').get('next_track_id'), 5)
+        self.assertEqual(moov.get(b'mvhd').get('duration'), 65000)
+
+    def test_fragmented(self):
+        with open(self.path('video.mp4'), 'wb') as f:
+            make_fragmented_mp4(f, 1, [(0, [300] * 4), (2, [200] * 3),
+                                       (4, [250] * 2)])
+        with open(self.path('audio.m4a'), 'wb') as f:
+            make_fragmented_mp4(f, 2, [(i, [90] * 3) for i in range(6)],
+                                base_offsets=True)
+        parts = [self.path('video.mp4'), self.path('audio.m4a')]
+        self.assertTrue(mux_av.can_mux(parts, 'mp4'))
+        self.assertFalse(mux_av.can_mux(parts, 'webm'))
+        mux_av.mux_av(parts, self.path('output.mp4'))
+
+        with open(self.path('output.mp4'), 'rb') as f:
+            data = f.read()
+        types, fragments = read_fragments(data)
+        self.assertEqual(types, [b'ftyp', b'moov'] + [b'moof', b'mdat'] * 9)
+        self.assertEqual([x[0] for x in fragments], list(range(1, 10)))
+        # interleaved by time, the video first
+        self.assertEqual(
+            [(traf[0][0], traf[0][1]) for _, traf in fragments],
+            [(1, 0), (2, 0), (2, 1024000), (1, 2000000), (2, 2048000),
+             (2, 3072000), (1, 4000000), (2, 4096000), (2, 5120000)]
+        )
+        for track in (1, 2):
+            samples = [
+                sample for _, trafs in fragments
+                for track_id, _, traf_samples in trafs
+                if track_id == track for sample in traf_samples
+            ]
+            sizes = [300] * 4 + [200] * 3 + [250] * 2 if track == 1 \
+                else [90] * 18
+            self.assertEqual(samples, [
+                sample_data(track, i, size) for i, size in enumerate(sizes)
+            ])
+
+        moov = join_mp4.read_atom(BytesIO(data[data.index(b'moov') - 4:]))
+        self.assertEqual(
+            [x.get(b'tkhd').get('track_id') for x in moov.get_all(b'trak')],
+            [1, 2]
+        )
+        trex = [
+            struct.unpack_from('>I', moov.get(b'mvex').body, start + 12)[0]
+            for type, start, _ in mux_av.child_atoms(
+                moov.get(b'mvex').body, 0, len(moov.get(b'mvex').body)
+            )
+            if type == b'trex'
+        ]
+        self.assertEqual(trex, [1, 2])
+        self.assertEqual(moov.get(b'mvhd').get('next_track_id'), 3)
+        self.assertEqual(moov.get(b'mvhd').get('duration'), 6000)
+
+    def test_webm(self):
+        with open(self.path('video.webm'), 'wb') as f:
+            make_webm(f, 1, [
+                (0, [(0, True, 300), (40, False, 200)]),
+                (80, [(0, True, 310), (40, False, 210)]),
+                (160, [(0, False, 320)]),
+            ], 200.0)
+        with open(self.path('audio.webm'), 'wb') as f:
+            make_webm(f, 2, [(0, [(0, True, 50), (20, True, 50)]),
+                             (100, [(0, True, 60)])], 120.0)
+        parts = [self.path('video.webm'), self.path('audio.webm')]
+        self.assertTrue(mux_av.can_mux(parts, 'webm'))
+        self.assertTrue(mux_av.can_mux(parts, 'mkv'))
+        self.assertFalse(mux_av.can_mux(parts, 'mp4'))
+        mux_av.mux_av(parts, self.path('output.webm'))
+
+        with open(self.path('output.webm'), 'rb') as f:
+            data = f.read()
+        (header, segment) = [x for x in read_elements(data)]
+        self.assertEqual(data[header[1]:header[3]], data[:header[3]])
+        self.assertEqual(segment[0], mux_av.SEGMENT)
+        self.assertEqual(segment[3], len(data))
+        elements = read_elements(data, segment[2])
+        self.assertEqual(
+            [x[0] for x in elements],
+            [mux_av.SEEK_HEAD, mux_av.INFO, mux_av.TRACKS] +
+            [mux_av.CLUSTER] * 5 + [mux_av.CUES]
+        )
+        # the SeekHead points at the elements after it
+        seek_head = elements[0]
+        positions = {}
+        for _, _, body, end in read_elements(data, seek_head[2],
+                                             seek_head[3]):
+            (_, _, id_start, id_end), (_, _, start, end) = read_elements(
+                data, body, end
+            )
+            positions[int.from_bytes(data[id_start:id_end], 'big')] = \
+                int.from_bytes(data[start:end], 'big')
+        self.assertEqual(positions, {
+            id: start - segment[2] for id, start, _, _ in elements
+            if id in (mux_av.INFO, mux_av.TRACKS, mux_av.CUES)
+        })
+
+        info = {
+            id: data[body:end]
+            for id, _, body, end in read_elements(data, elements[1][2],
+                                                  elements[1][3])
+        }
+        self.assertEqual(struct.unpack('>d', info[mux_av.DURATION])[0], 200)
+        self.assertEqual(info[0x4d80], b'lulu')
+        tracks = [
+            {
+                id: int.from_bytes(data[body:end], 'big')
+                for id, _, body, end in read_elements(data, body, end)
+                if id != 0x86
+            }
+            for _, _, body, end in read_elements(data, elements[2][2],
+                                                 elements[2][3])
+        ]
+        self.assertEqual(tracks, [
+            {mux_av.TRACK_NUMBER: 1, mux_av.TRACK_UID: 1,
+             mux_av.TRACK_TYPE: 1},
+            {mux_av.TRACK_NUMBER: 2, mux_av.TRACK_UID: 2,
+             mux_av.TRACK_TYPE: 2},
+        ])
+
+        # clusters by timecode, the audio blocks of track 2
+        clusters = []
+        samples = {1: [], 2: []}
+        for _, start, body, end in elements[3:8]:
+            timecode = None
+            for id, _, child, child_end in read_elements(data, body, end):
+                if id == mux_av.TIMECODE:
+                    timecode = int.from_bytes(data[child:child_end], 'big')
+                    clusters.append((timecode, start - segment[2]))
+                    continue
+                if id == mux_av.BLOCK_GROUP:
+                    _, _, child, child_end = read_elements(
+                        data, child, child_end
+                    )[0]
+                track = data[child] & 0x7f
+                samples[track].append(data[child + 4:child_end])
+        self.assertEqual([x[0] for x in clusters], [0, 0, 80, 100, 160])
+        for track, sizes in ((1, [300, 200, 310, 210, 320]),
+                             (2, [50, 50, 60])):
+            self.assertEqual(samples[track], [
+                sample_data(track, i, size) for i, size in enumerate(sizes)
+            ])
+
+        # a cue point per cluster starting with a video keyframe
+        cues = []
+        for _, _, body, end in read_elements(data, elements[8][2],
+                                             elements[8][3]):
+            time, positions = read_elements(data, body, end)
+            track, position = read_elements(data, positions[2], positions[3])
+            cues.append((
+                int.from_bytes(data[time[2]:time[3]], 'big'),
+                int.from_bytes(data[track[2]:track[3]], 'big'),
+                int.from_bytes(data[position[2]:position[3]], 'big'),
+            ))
+        self.assertEqual(cues, [
+            (0, 1, clusters[0][1]), (80, 1, clusters[2][1])
+        ])
+
+    def test_incompatible(self):
+        with open(self.path('video.webm'), 'wb') as f:
+            make_webm(f, 1, [(0, [(0, True, 300)])], 40.0)
+        with open(self.path('audio.m4a'), 'wb') as f:
+            make_fragmented_mp4(f, 2, [(0, [90] * 3)])
+        parts = [self.path('video.webm'), self.path('audio.m4a')]
+        self.assertFalse(mux_av.can_mux(parts, 'webm'))
+        self.assertTrue(mux_av.can_copy(parts, 'mkv'))
+        with self.assertRaises(ValueError):
+            mux_av.mux_av(parts, self.path('output.webm'))
+
+
+# reports its progress as FFmpeg does, and writes its arguments and when it
+# ran to its output (its last argument); it fails for outputs named fail
+FAKE_FFMPEG = """#!{}
+import sys, json, time
+args = sys.argv[1:]
+start = time.time()
+if '-progress' in args:
+    for size in (500, 1000):
+        print('frame=10\\nbitrate= 800.5kbits/s\\ntotal_size=%d' % size)
+        print('out_time_us=%d\\nspeed=2.5x' % (size * 1000))
+        print('progress=' + ('end' if size == 1000 else 'continue'))
+        sys.stdout.flush()
+        time.sleep(0.1)
+with open(args[-1], 'w') as f:
+    json.dump({{'args': args, 'start': start, 'end': time.time()}}, f)
+sys.exit(args[-1].endswith('fail'))
+""".format(sys.executable)
+
+
+class TestFFmpeg(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        fake = os.path.join(self.output_dir, 'ffmpeg')
+        with open(fake, 'w') as f:
+            f.write(FAKE_FFMPEG)
+        os.chmod(fake, 0o755)
+        self.ffmpeg = ffmpeg.FFMPEG
+        ffmpeg.FFMPEG = fake
+        self.max_processes = ffmpeg.MAX_PROCESSES
+
+    def tearDown(self):
+        ffmpeg.FFMPEG = self.ffmpeg
+        ffmpeg.set_max_processes(self.max_processes)
+        shutil.rmtree(self.output_dir)
+
+    def path(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def read_run(self, name):
+        with open(self.path(name)) as f:
+            return json.load(f)
+
+    def test_progress(self):
+        reports = []
+        job = ffmpeg.run_ffmpeg(
+            ['-i', 'input', self.path('output')], expected_size=2000,
+            progress=lambda x: reports.append((x.percent, x.speed,
+                                               x.bitrate, x.time))
+        )
+        self.assertEqual(reports, [(25.0, 2.5, 800.5, 0.5),
+                                   (100.0, 2.5, 800.5, 1.0)])
+        self.assertEqual(job.returncode, 0)
+        self.assertEqual(job.progress.size, 1000)
+        self.assertGreaterEqual(job.wall_time, 0.2)
+        if hasattr(os, 'wait4'):
+            self.assertGreater(job.cpu_time, 0)
+        self.assertIs(ffmpeg.runs[-1], job)
+        self.assertEqual(
+            self.read_run('output')['args'][:3],
+            ['-progress', 'pipe:1', '-nostats']
+        )
+
+    def test_check(self):
+        job = ffmpeg.run_ffmpeg([self.path('fail')])
+        self.assertEqual(job.returncode, 1)
+        with self.assertRaises(subprocess.CalledProcessError):
+            ffmpeg.run_ffmpeg([self.path('fail')], check=True)
+
+    def test_max_processes(self):
+        ffmpeg.set_max_processes(1)
+        threads = [
+            threading.Thread(target=ffmpeg.run_ffmpeg,
+                             args=([self.path(str(i))],))
+            for i in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        runs = sorted(
+            (run['start'], run['end'])
+            for run in map(self.read_run, ['0', '1', '2'])
+        )
+        # one after another
+        for before, after in zip(runs, runs[1:]):
+            self.assertLessEqual(before[1], after[0])
+
+    def test_context_manager(self):
+        ffmpeg.set_max_processes(1)
+        args = ['-c', 'import sys; sys.stdin.read()']
+        with self.assertRaises(ValueError):
+            with ffmpeg.FFmpegJob(
+                args, program=sys.executable, stdin=subprocess.PIPE
+            ) as job:
+                raise ValueError
+        # killed, and its slot given back
+        self.assertNotEqual(job.returncode, 0)
+        self.assertEqual(
+            ffmpeg.run_ffmpeg([self.path('output')]).returncode, 0
+        )
+        with ffmpeg.FFmpegJob(
+            args, program=sys.executable, stdin=subprocess.PIPE
+        ) as job:
+            job.stdin.write(b'data')
+        self.assertEqual(job.returncode, 0)
+
+    def test_unlimited(self):
+        ffmpeg.set_max_processes(1)
+        args = ['-c', 'import sys; sys.stdin.read()']
+        # a pipe left open does not keep a merge waiting
+        with ffmpeg.FFmpegJob(
+            args, program=sys.executable, stdin=subprocess.PIPE,
+            limited=False
+        ):
+            self.assertEqual(
+                ffmpeg.run_ffmpeg([self.path('output')]).returncode, 0
+            )
+
+    def test_helpers(self):
+        parts = []
+        for i in range(2):
+            parts.append(self.path('{}.mp4'.format(i)))
+            with open(parts[-1], 'wb') as f:
+                make_mp4(f, [100] * 3, [50] * 2)
+        reports = []
+        job = ffmpeg.ffmpeg_concat_av(
+            parts, self.path('av.mp4'), 'mp4', progress=reports.append
+        )
+        self.assertEqual(job.returncode, 0)
+        if hasattr(os, 'wait4'):
+            self.assertGreater(job.cpu_time, 0)
+        self.assertEqual(len(reports), 2)
+        args = self.read_run('av.mp4')['args']
+        self.assertEqual(args[args.index('-c') + 1], 'copy')
+
+        # the concat list is removed, whether FFmpeg succeeds or not
+        ffmpeg.concat_with_demuxer(
+            parts, self.path('concat.mp4'), ['-c', 'copy']
+        )
+        with self.assertRaises(subprocess.CalledProcessError):
+            ffmpeg.concat_with_demuxer(
+                parts, self.path('fail'), ['-c', 'copy']
+            )
+        self.assertIn('concat', self.read_run('concat.mp4')['args'])
+        self.assertEqual(
+            sorted(os.listdir(self.output_dir)),
+            ['0.mp4', '1.mp4', 'av.mp4', 'concat.mp4', 'fail', 'ffmpeg']
+        )
+
+
+# answers what an FFmpeg 4.4 would, and counts how many times it ran
+FFMPEG_PROBED = """#!{}
+import sys
+with open(__file__ + '.runs', 'a') as f:
+    f.write(sys.argv[1] + '\\n')
+print({{
+    '-version': 'ffmpeg version n4.4.2 Copyright (c) 2000-2021',
+    '-bsfs': 'Bitstream filters:\\naac_adtstoasc\\nh264_mp4toannexb\\n',
+    '-demuxers': 'File formats:\\n D. = Demuxing supported\\n'
+                 ' .E = Muxing supported\\n --\\n D  concat  Concat\\n'
+                 ' D d alsa  ALSA\\n'
+                 ' D  mov,mp4,m4a,3gp,3g2,mj2  QuickTime / MOV\\n',
+}}[sys.argv[1]])
+""".format(sys.executable)
+
+
+class TestCapabilities(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.environ = os.environ.get('LULU_CACHE_DIR')
+        os.environ['LULU_CACHE_DIR'] = self.cache_dir
+        capabilities._entries = None
+        self.program = os.path.join(self.cache_dir, 'ffmpeg')
+        with open(self.program, 'w') as f:
+            f.write(FFMPEG_PROBED)
+        os.chmod(self.program, 0o755)
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['LULU_CACHE_DIR']
+        else:
+            os.environ['LULU_CACHE_DIR'] = self.environ
+        capabilities._entries = None
+        shutil.rmtree(self.cache_dir)
+
+    def runs(self):
+        with open(self.program + '.runs') as f:
+            return f.read().split()
+
+    def test_detect(self):
+        self.assertEqual(capabilities.probe_ffmpeg(self.program), {
+            'name': 'ffmpeg',
+            'version': [4, 4, 2],
+            'bitstream_filters': ['aac_adtstoasc', 'h264_mp4toannexb'],
+            'demuxers': ['concat', 'alsa', 'mov', 'mp4', 'm4a', '3gp',
+                         '3g2', 'mj2'],
+        })
+        self.assertEqual(self.runs(), ['-version', '-bsfs', '-demuxers'])
+        self.assertIsNone(capabilities.probe_ffmpeg(
+            os.path.join(self.cache_dir, 'missing')
+        ))
+        self.assertEqual(capabilities.parse_version('N-86111-ga441a'), None)
+        self.assertEqual(
+            capabilities.parse_version('4.4.2-0ubuntu0.22.04.1'), [4, 4, 2]
+        )
+
+    def test_cache(self):
+        detected = capabilities.probe_ffmpeg(self.program)
+        # another process: from the disk, without running it again
+        capabilities._entries = None
+        self.assertEqual(capabilities.probe_ffmpeg(self.program), detected)
+        self.assertEqual(len(self.runs()), 3)
+
+        # replaced
+        stat = os.stat(self.program)
+        os.utime(self.program, (stat.st_atime, stat.st_mtime + 10))
+        capabilities._entries = None
+        self.assertEqual(capabilities.probe_ffmpeg(self.program), detected)
+        self.assertEqual(len(self.runs()), 6)
+
+        with open(capabilities.cache_path()) as f:
+            self.assertEqual(len(json.load(f)['programs']), 1)
+
+    def test_ffmpeg(self):
+        capabilities.probe_ffmpeg(self.program)
+        saved = ffmpeg.FFMPEG
+        ffmpeg.FFMPEG = self.program
+        try:
+            self.assertTrue(ffmpeg.has_demuxer('concat'))
+            self.assertFalse(ffmpeg.has_demuxer('hls'))
+            self.assertTrue(ffmpeg.has_bitstream_filter('aac_adtstoasc'))
+            ffmpeg.FFMPEG = None
+            self.assertFalse(ffmpeg.has_demuxer('concat'))
+            self.assertFalse(ffmpeg.has_concat_demuxer())
+        finally:
+            ffmpeg.FFMPEG = saved
+
+    def test_lazy(self):
+        saved = ffmpeg.FFMPEG, ffmpeg.FFPROBE, ffmpeg.FFMPEG_VERSION
+        path = os.environ['PATH']
+        os.environ['PATH'] = self.cache_dir
+        ffmpeg.FFMPEG = ffmpeg.FFPROBE = ffmpeg.FFMPEG_VERSION = \
+            ffmpeg._UNDETECTED
+        try:
+            # found when first asked for, and only then
+            self.assertTrue(ffmpeg.has_ffmpeg_installed())
+            self.assertEqual(
+                (ffmpeg.FFMPEG, ffmpeg.FFPROBE, ffmpeg.FFMPEG_VERSION),
+                ('ffmpeg', None, [4, 4, 2])
+            )
+            self.assertTrue(ffmpeg.has_concat_demuxer())
+            self.assertEqual(len(self.runs()), 3)
+        finally:
+            os.environ['PATH'] = path
+            ffmpeg.FFMPEG, ffmpeg.FFPROBE, ffmpeg.FFMPEG_VERSION = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from lulu import common, ratelimit
+from lulu.ratelimit import TokenBucket, HostRateLimiter
+from tests.util import start_http_server
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_consume(self):
+        bucket = TokenBucket(100, 10)
+        start = time.monotonic()
+        # the burst, then 20 tokens in debt
+        self.assertEqual(bucket.consume(10), 0)
+        self.assertAlmostEqual(bucket.consume(20), 0.2, delta=0.02)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+        bucket.set_rate(None)
+        self.assertEqual(bucket.consume(10 ** 9), 0)
+
+    def test_shared(self):
+        # 4 threads taking 50 each out of 1000 a second
+        bucket = TokenBucket(1000, 1)
+        threads = [
+            threading.Thread(target=bucket.consume, args=(50,))
+            for _ in range(4)
+        ]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+
+class TestHostRateLimiter(unittest.TestCase):
+    def test_buckets(self):
+        limiter = HostRateLimiter({'bilibili.com': 2, 'api.youku.com': 3})
+        self.assertIs(
+            limiter.bucket('api.bilibili.com'), limiter.bucket('bilibili.com')
+        )
+        self.assertEqual(limiter.bucket('api.youku.com').rate, 3)
+        self.assertIsNone(limiter.bucket('youku.com'))
+        self.assertIsNone(limiter.bucket('notbilibili.com'))
+        self.assertEqual(limiter.wait('http://example.com/'), 0)
+
+        limiter.set_rates({None: 5, 'youku.com': 1})
+        self.assertEqual(limiter.bucket('api.youku.com').rate, 1)
+        self.assertEqual(limiter.bucket('a.example.com').rate, 5)
+        self.assertIsNot(
+            limiter.bucket('a.example.com'), limiter.bucket('b.example.com')
+        )
+
+    def test_wait(self):
+        limiter = HostRateLimiter({'example.com': 20})
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.wait('http://www.example.com/api')
+        limiter.wait('http://other.com/')
+        self.assertAlmostEqual(time.monotonic() - start, 0.2, delta=0.05)
+
+
+class TestLimits(unittest.TestCase):
+    def tearDown(self):
+        ratelimit.set_limits({'bandwidth': None, 'request_rates': {}})
+
+    def test_parse(self):
+        self.assertEqual(ratelimit.parse_size('500'), 500)
+        self.assertEqual(ratelimit.parse_size('500K'), 500 * 1024)
+        self.assertEqual(ratelimit.parse_size('1.5m'), 1536 * 1024)
+        self.assertEqual(ratelimit.parse_size('2GiB'), 2 * 1024 ** 3)
+        with self.assertRaises(ValueError):
+            ratelimit.parse_size('fast')
+        self.assertEqual(
+            ratelimit.parse_host_rate('bilibili.com=0.5'),
+            ('bilibili.com', 0.5)
+        )
+        self.assertEqual(ratelimit.parse_host_rate('4'), (None, 4))
+        with self.assertRaises(ValueError):
+            ratelimit.parse_host_rate('youku.com=0')
+
+    def test_set_limits(self):
+        ratelimit.set_limits({
+            'bandwidth': '1M', 'request_rates': {'*': 4, 'youku.com': 1}
+        })
+        self.assertEqual(ratelimit.get_limits(), {
+            'bandwidth': 1024 * 1024,
+            'request_rates': {'*': 4, 'youku.com': 1},
+        })
+        # all or nothing
+        with self.assertRaises(ValueError):
+            ratelimit.set_limits({'bandwidth': 10, 'request_rates': [1]})
+        with self.assertRaises(ValueError):
+            ratelimit.set_limits({'bandwidth': 'x'})
+        self.assertEqual(ratelimit.get_limits()['bandwidth'], 1024 * 1024)
+        ratelimit.set_limits({'bandwidth': None})
+        self.assertEqual(ratelimit.get_limits(), {
+            'bandwidth': None,
+            'request_rates': {'*': 4, 'youku.com': 1},
+        })
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(300 * 1024)
+        self.server = start_http_server({'/video.mp4': self.data})
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ratelimit.set_limits({'bandwidth': None, 'request_rates': {}})
+        self.server.stop()
+        shutil.rmtree(self.output_dir)
+
+    def test_bandwidth(self):
+        # a second's worth in the bucket, and two more seconds
+        ratelimit.bandwidth.set_rate(100 * 1024)
+        filepath = os.path.join(self.output_dir, 'video.mp4')
+        start = time.monotonic()
+        common.url_save(self.server.url + '/video.mp4', filepath, None)
+        self.assertGreaterEqual(time.monotonic() - start, 1.9)
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_request_rate(self):
+        ratelimit.request_rate.set_rates({'127.0.0.1': 10})
+        start = time.monotonic()
+        for _ in range(4):
+            common.urls_size([self.server.url + '/video.mp4'])
+            common.clear_probe_cache()
+        self.assertGreaterEqual(time.monotonic() - start, 0.29)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import io
+import time
+import threading
+import unittest
+
+from lulu import common, scheduler
+from lulu.scheduler import Job, Scheduler
+
+
+class Recorder:
+    """Runs jobs which extract for a while, then download for a while, and
+    keeps how many of them ran at once.
+    """
+    def __init__(self, duration=0.05):
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.running = {}
+        self.downloading = 0
+        self.max_running = {}
+        self.max_downloading = 0
+        self.events = []
+
+    def __call__(self, job):
+        with self.lock:
+            self.running[job.site] = self.running.get(job.site, 0) + 1
+            self.max_running[job.site] = max(
+                self.max_running.get(job.site, 0), self.running[job.site]
+            )
+            self.events.append(('extract', job.url))
+        time.sleep(self.duration)
+        common.start_transfer()
+        with self.lock:
+            self.downloading += 1
+            self.max_downloading = max(
+                self.max_downloading, self.downloading
+            )
+        bar = common.SimpleProgressBar(100)
+        bar.update_received(100)
+        time.sleep(self.duration)
+        with self.lock:
+            self.downloading -= 1
+            self.running[job.site] -= 1
+            self.events.append(('done', job.url))
+        if job.url == 'fail':
+            raise ValueError('failed')
+
+
+class TestScheduler(unittest.TestCase):
+    def test_jobs(self):
+        run = Recorder()
+        s = Scheduler(run, jobs=2, site_jobs={None: 10})
+        s.run(Job(str(i), 'site') for i in range(8))
+        self.assertEqual(run.max_downloading, 2)
+        # two downloading, two extracting the next
+        self.assertEqual(run.max_running['site'], 4)
+        self.assertEqual(s.progress(), {
+            'jobs': 8, 'queued': 0, 'extracting': 0, 'downloading': 0,
+            'done': 8, 'failed': 0, 'received': 800, 'total_size': 800,
+        })
+
+    def test_ahead(self):
+        # the second job extracts while the first downloads
+        run = Recorder()
+        Scheduler(run, jobs=1, site_jobs={None: 2}).run(
+            Job(url, 'site') for url in 'ab'
+        )
+        self.assertEqual(run.events[:2], [('extract', 'a'), ('extract', 'b')])
+        self.assertEqual(run.max_downloading, 1)
+
+        run = Recorder()
+        Scheduler(run, jobs=1, site_jobs={None: 2}, ahead=0).run(
+            Job(url, 'site') for url in 'ab'
+        )
+        self.assertEqual(run.events[:2], [('extract', 'a'), ('done', 'a')])
+
+    def test_sites(self):
+        run = Recorder()
+        jobs = [Job('a' + str(i), 'a') for i in range(4)] + \
+            [Job('b' + str(i), 'b') for i in range(4)]
+        Scheduler(run, jobs=4, site_jobs={'b': 3}).run(jobs)
+        self.assertEqual(run.max_running, {'a': 1, 'b': 3})
+        # the jobs of b did not wait behind those of a
+        self.assertEqual(
+            sorted(url for _, url in run.events[:4]),
+            ['a0', 'b0', 'b1', 'b2']
+        )
+
+    def test_failed(self):
+        def run(job):
+            if job.url == 'exit':
+                common.log.wtf('gave up')
+            raise ValueError('failed')
+
+        s = Scheduler(run, jobs=2)
+        s.run([Job('fail'), Job('exit')])
+        self.assertEqual([job.state for job in s.all], ['failed'] * 2)
+        self.assertIsInstance(s.all[0].error, ValueError)
+        self.assertIsInstance(s.all[1].error, SystemExit)
+
+    def test_streamed(self):
+        read = []
+
+        def jobs():
+            for i in range(10):
+                read.append(i)
+                yield Job(str(i), 'site')
+
+        def run(job):
+            seen.append(len(read))
+            time.sleep(0.01)
+
+        seen = []
+        max_pending = scheduler.MAX_PENDING
+        scheduler.MAX_PENDING = 2
+        try:
+            s = Scheduler(run, jobs=1, ahead=0)
+            s.run(jobs())
+        finally:
+            scheduler.MAX_PENDING = max_pending
+        self.assertEqual(s.progress()['done'], 10)
+        # read as the jobs ran, not all at first
+        self.assertLessEqual(seen[0], 4)
+
+
+class TestDownloadMain(unittest.TestCase):
+    def test_download_main(self):
+        downloaded = []
+        lock = threading.Lock()
+
+        def download(url, **kwargs):
+            self.assertEqual(kwargs, {'output_dir': 'out'})
+            with lock:
+                downloaded.append(url)
+
+        urls = io.StringIO(
+            'youtube.com/watch?v=1\n\nhttps://youtu.be/2\n'
+            'https://example.com/3\n'
+        )
+        common.download_main(
+            download, None, common.read_urls(urls), False, jobs=2,
+            site_jobs={'youtube': 2}, output_dir='out'
+        )
+        self.assertEqual(sorted(downloaded), [
+            'http://youtube.com/watch?v=1', 'https://example.com/3',
+            'https://youtu.be/2',
+        ])
+        self.assertTrue(urls.closed)
+
+        def fail(url, **kwargs):
+            raise ValueError(url)
+
+        with self.assertRaises(SystemExit):
+            common.download_main(
+                fail, None, ['example.com/'], False, jobs=2
+            )
+
+    def test_sites(self):
+        self.assertEqual(
+            common.url_site('https://www.youtube.com/watch?v=1'), 'youtube'
+        )
+        self.assertEqual(common.url_site('https://youtu.be/1'), 'youtube')
+        self.assertEqual(
+            common.url_site('https://example.com/a'), 'universal'
+        )
+        self.assertEqual(common.parse_site_jobs('youtu=3'), ('youtube', 3))
+        self.assertEqual(common.parse_site_jobs('2'), (None, 2))
+        with self.assertRaises(Exception):
+            common.parse_site_jobs('youtube=0')
+
+
+if __name__ == '__main__':
+    unittest.main()
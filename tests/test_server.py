@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import json
+import time
+import threading
+import unittest
+from urllib import request
+from urllib.error import HTTPError
+
+from lulu import common, ratelimit, server
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.downloaded = []
+        self.release = threading.Event()
+
+        def download(url, **kwargs):
+            self.release.wait(5)
+            bar = common.SimpleProgressBar(200)
+            bar.update_received(150)
+            if 'fail' in url:
+                raise ValueError('no video')
+            self.downloaded.append((url, kwargs))
+
+        self.server = server.Server(
+            ('127.0.0.1', 0), common.job_runner(download, None),
+            common.make_job, {'output_dir': '.', 'merge': True}, jobs=2
+        )
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        ratelimit.set_limits({'bandwidth': None, 'request_rates': {}})
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def call(self, path, data=None, method=None):
+        req = request.Request(self.server.url + path, method=method)
+        if data is not None:
+            req.data = json.dumps(data).encode('utf-8')
+        with request.urlopen(req) as response:
+            return response.status, json.loads(response.read().decode())
+
+    def wait_done(self, id):
+        for _ in range(100):
+            _, job = self.call('/jobs/{}'.format(id))
+            if job['state'] in ('done', 'failed'):
+                return job
+            time.sleep(0.05)
+        self.fail('job {} did not end'.format(id))
+
+    def test_jobs(self):
+        status, jobs = self.call('/jobs', {
+            'url': 'youtube.com/watch?v=1', 'options': {'output_dir': 'out'}
+        })
+        self.assertEqual(status, 201)
+        self.assertEqual(jobs[0]['url'], 'http://youtube.com/watch?v=1')
+        self.assertEqual(jobs[0]['site'], 'youtube')
+        self.assertIn(jobs[0]['state'], ('queued', 'extracting'))
+
+        _, more = self.call('/jobs', {
+            'urls': ['https://example.com/a', 'https://example.com/fail']
+        })
+        self.assertEqual([job['id'] for job in more], [2, 3])
+        self.release.set()
+
+        done = self.wait_done(1)
+        self.assertEqual(done['state'], 'done')
+        self.assertEqual((done['received'], done['total_size']), (150, 200))
+        self.assertEqual(self.wait_done(2)['state'], 'done')
+        failed = self.wait_done(3)
+        self.assertEqual(failed['state'], 'failed')
+        self.assertEqual(failed['error'], 'no video')
+
+        self.assertEqual(sorted(self.downloaded), [
+            ('http://youtube.com/watch?v=1',
+             {'output_dir': 'out', 'merge': True}),
+            ('https://example.com/a', {'output_dir': '.', 'merge': True}),
+        ])
+        _, jobs = self.call('/jobs')
+        self.assertEqual(len(jobs), 3)
+        _, progress = self.call('/progress')
+        self.assertEqual(
+            (progress['jobs'], progress['done'], progress['failed']),
+            (3, 2, 1)
+        )
+
+    def test_errors(self):
+        for path, data, status in [
+            ('/jobs/9', None, 404),
+            ('/jobs/x', None, 404),
+            ('/other', None, 404),
+            ('/jobs', {'urls': []}, 400),
+            ('/jobs', ['http://example.com/'], 400),
+            ('/jobs', {'url': 'http://example.com/',
+                       'options': {'player': 'mpv'}}, 400),
+        ]:
+            with self.assertRaises(HTTPError) as cm:
+                self.call(path, data)
+            self.assertEqual(cm.exception.code, status)
+            cm.exception.close()
+
+    def test_limits(self):
+        status, limits = self.call('/limits', {
+            'bandwidth': '2M', 'request_rates': {'youku.com': 2, '*': 5}
+        }, 'PUT')
+        self.assertEqual(status, 200)
+        self.assertEqual(limits, {
+            'bandwidth': 2 * 1024 * 1024,
+            'request_rates': {'youku.com': 2, '*': 5},
+        })
+        self.assertEqual(ratelimit.bandwidth.rate, 2 * 1024 * 1024)
+        _, limits = self.call('/limits', {'bandwidth': None}, 'PUT')
+        self.assertIsNone(limits['bandwidth'])
+        self.assertEqual(self.call('/limits')[1], limits)
+
+        for data in [{'bandwidth': 'fast'}, {'request_rates': {'a': -1}}]:
+            with self.assertRaises(HTTPError) as cm:
+                self.call('/limits', data, 'PUT')
+            self.assertEqual(cm.exception.code, 400)
+            cm.exception.close()
+        self.assertEqual(self.call('/limits')[1], limits)
+
+    def test_address(self):
+        self.assertEqual(server.parse_address('9000'), ('127.0.0.1', 9000))
+        self.assertEqual(
+            server.parse_address('0.0.0.0:9000'), ('0.0.0.0', 9000)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
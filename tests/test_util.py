@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+import os
+import tempfile
 import unittest
+from io import BytesIO
 
 from lulu.util import fs
 from lulu.util import parser
@@ -12,6 +15,56 @@ class TestUtil(unittest.TestCase):
         self.assertEqual(fs.legitimize('1*2', os='Darwin'), '1*2')
         self.assertEqual(fs.legitimize('1*2', os='Windows'), '1-2')
 
+    def test_copy_data(self):
+        data = os.urandom(3 * 1024 * 1024 + 5)
+        chunk_size = fs.COPY_CHUNK_SIZE
+        fs.COPY_CHUNK_SIZE = 1024 * 1024
+        with tempfile.TemporaryFile() as source, \
+                tempfile.TemporaryFile() as target:
+            source.write(data)
+            # from the middle of a file to a file with something in it
+            source.seek(10)
+            source.read(5)
+            target.write(b'head')
+            self.assertEqual(fs.copy_data(source, target, 2000000), 2000000)
+            self.assertEqual(source.tell(), 2000015)
+            self.assertEqual(fs.copy_data(source, target), len(data) - 2000015)
+            target.write(b'tail')
+            target.seek(0)
+            self.assertEqual(target.read(), b'head' + data[15:] + b'tail')
+
+            # to and from objects without a file descriptor
+            source.seek(0)
+            out = BytesIO()
+            fs.copy_data(source, out)
+            self.assertEqual(out.getvalue(), data)
+            out.seek(0)
+            target.seek(0)
+            target.truncate()
+            fs.copy_data(out, target, 100)
+            target.seek(0)
+            self.assertEqual(target.read(), data[:100])
+
+            source.seek(len(data) - 10)
+            with self.assertRaises(EOFError):
+                fs.copy_data(source, target, 11)
+        fs.COPY_CHUNK_SIZE = chunk_size
+
+    def test_move_data(self):
+        data = os.urandom(3 * 1024 * 1024 + 5)
+        chunk_size = fs.COPY_CHUNK_SIZE
+        fs.COPY_CHUNK_SIZE = 1024 * 1024
+        with tempfile.TemporaryFile() as f:
+            # forward and back, over ranges that overlap
+            f.write(data)
+            fs.move_data(f, 0, 1000, len(data))
+            f.seek(0)
+            self.assertEqual(f.read()[1000:], data)
+            fs.move_data(f, 1000, 10, len(data))
+            f.seek(10)
+            self.assertEqual(f.read(len(data)), data)
+        fs.COPY_CHUNK_SIZE = chunk_size
+
     def test_parser(self):
         p = parser.get_parser('<h1> hello</h1>')
         self.assertEqual(p.h1.string.strip(), 'hello')
@@ -3,10 +3,16 @@
 import os
 import unittest
 import functools
+import threading
 from socket import (
     gaierror,
 )
 from string import Formatter
+from socketserver import ThreadingMixIn
+from http.server import (
+    HTTPServer,
+    BaseHTTPRequestHandler,
+)
 from urllib3.exceptions import (
     MaxRetryError,
     NewConnectionError,
@@ -21,6 +27,94 @@ from requests.exceptions import (
 )
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hanging up in the middle of a body are expected
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves self.server.files (a dict of path -> bytes, or a callable
+    returning bytes for content that changes) with HTTP range support and
+    the ETags of self.server.etags, and counts the requests it receives in
+    self.server.requests.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, head_only=False):
+        self.server.requests.append((self.command, self.path, self.headers))
+        data = self.server.files.get(self.path)
+        if callable(data):
+            data = data()
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get('Range')
+        if range_header and self.server.accept_ranges:
+            first, last = range_header[len('bytes='):].split('-')
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(
+                    len(data)
+                ))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(data)
+            ))
+        else:
+            self.send_response(200)
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if self.path in self.server.etags:
+            self.send_header('ETag', self.server.etags[self.path])
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(data[start:end + 1])
+
+    def do_GET(self):
+        self.send_body()
+
+    def do_HEAD(self):
+        self.send_body(head_only=True)
+
+
+def start_http_server(files, accept_ranges=True):
+    """Starts a local HTTP server in a daemon thread.
+
+    Returns:
+        The server; its base URL is server.url, call server.stop() to stop
+        it and close its socket.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.files = files
+    server.accept_ranges = accept_ranges
+    server.requests = []
+    server.etags = {}
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
 # 在 CI 上百分百失败用下面的 skipIf，有可能失败的用 ignore_network_issue
 # 使用 skip 或者 ignore 的必须在本地上跑通过
 NETWORK_ISSUE = 'tests will fail due to the network issue'